@@ -19,6 +19,7 @@ export const SettingsPanel: React.FC<SettingsPanelProps> = ({
   apiOnline
 }) => {
   const models = [
+    { value: 'auto', label: 'Auto', description: 'Picked per request by task, size, latency and cost' },
     { value: 'gpt-3.5-turbo', label: 'GPT-3.5 Turbo', description: 'Fast and efficient' },
     { value: 'gpt-4', label: 'GPT-4', description: 'More capable, slower' },
     { value: 'gpt-4-turbo', label: 'GPT-4 Turbo', description: 'Latest and greatest' }
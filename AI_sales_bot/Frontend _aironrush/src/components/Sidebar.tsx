@@ -130,9 +130,15 @@ export const Sidebar: React.FC<SidebarProps> = ({
                       {session.title || 'Untitled Session'}
                     </h3>
                   </div>
+                  {session.last_message_preview && (
+                    <p className="text-xs text-slate-600 truncate mb-1">{session.last_message_preview}</p>
+                  )}
                   <div className="flex items-center space-x-1 text-xs text-slate-500">
                     <Clock className="w-3 h-3" />
-                    <span>{formatDate(session.created_at)}</span>
+                    <span>{formatDate(session.last_updated || session.created_at)}</span>
+                    {!!session.message_count && (
+                      <span>· {session.message_count} messages</span>
+                    )}
                   </div>
                 </div>
               );
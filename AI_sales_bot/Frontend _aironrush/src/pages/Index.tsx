@@ -13,7 +13,7 @@ const Index = () => {
   const [isLoading, setIsLoading] = useState(false);
   const [isStreaming, setIsStreaming] = useState(false);
   const [apiOnline, setApiOnline] = useState(false);
-  const [selectedModel, setSelectedModel] = useState('gpt-3.5-turbo');
+  const [selectedModel, setSelectedModel] = useState('auto');
   const [userInfo, setUserInfo] = useState<UserInfo | null>(null);
   const [lastFileSummary, setLastFileSummary] = useState<{ summary: FileSummary; fileName: string } | null>(null);
   const [summaries, setSummaries] = useState<FileSummaryRecord[]>([]);
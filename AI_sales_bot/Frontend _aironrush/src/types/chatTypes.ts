@@ -10,6 +10,10 @@ export interface Session {
   title: string;
   created_at: string;
   updated_at?: string;
+  last_updated?: string;
+  message_count?: number;
+  last_message_preview?: string | null;
+  last_model?: string | null;
 }
 
 export interface UserInfo {
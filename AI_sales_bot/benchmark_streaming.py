@@ -0,0 +1,118 @@
+"""Time-to-first-content benchmark for the blocking vs streaming summary and insights endpoints.
+
+Run against a live backend (the mock OpenAI server works too):
+
+    python mock_openai_server.py --port 8099 --stream-chunk-ms 30 &
+    OPENAI_BASE_URL=http://localhost:8099/v1 OPENAI_API_KEY=mock python openai_chatbot.py &
+    python benchmark_streaming.py --base-url http://localhost:8000 --iterations 10 --file sample.txt
+
+For each endpoint pair it reports time to first byte, time to first content (the first
+partial or field event; the full body for blocking endpoints) and total time.
+"""
+import argparse
+import json
+import statistics
+import time
+
+import requests
+
+SAMPLE_DOCUMENT = (
+    "Meeting notes from Jane Doe. Client: Acme Corp (EMEA), retail vertical. "
+    "The client was pleased with the pilot results and the rollout is on-going. "
+) * 20
+
+SAMPLE_FINANCIAL_DATA = {
+    "ticker": "ACME",
+    "financials": {"Total Revenue": {"2023": 1000, "2024": 1200}},
+    "balance_sheet": {"Total Debt": {"2024": 300}},
+    "cashflow": {"Free Cash Flow": {"2024": 150}},
+    "earnings": {},
+}
+
+
+def _timed_blocking(method, url, **kwargs):
+    started = time.perf_counter()
+    with requests.request(method, url, stream=True, timeout=300, **kwargs) as response:
+        response.raise_for_status()
+        first_byte = None
+        for _ in response.iter_content(chunk_size=8192):
+            if first_byte is None:
+                first_byte = time.perf_counter() - started
+        total = time.perf_counter() - started
+    # A blocking endpoint has no content until the whole body has arrived
+    return {"ttfb": first_byte or total, "ttfc": total, "total": total}
+
+
+def _timed_stream(method, url, **kwargs):
+    started = time.perf_counter()
+    first_byte = first_content = None
+    with requests.request(method, url, stream=True, timeout=300, **kwargs) as response:
+        response.raise_for_status()
+        for line in response.iter_lines():
+            if first_byte is None:
+                first_byte = time.perf_counter() - started
+            if not line.startswith(b"data: "):
+                continue
+            event = json.loads(line[6:])
+            if first_content is None and event.get("type") in ("partial", "field", "done"):
+                first_content = time.perf_counter() - started
+            if event.get("type") == "done":
+                break
+    total = time.perf_counter() - started
+    return {"ttfb": first_byte or total, "ttfc": first_content or total, "total": total}
+
+
+def _percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+def _report(name, samples):
+    print(f"\n{name} ({len(samples)} runs)")
+    for key, label in (("ttfb", "time to first byte"), ("ttfc", "time to first content"), ("total", "total time")):
+        values = [s[key] * 1000 for s in samples]
+        print(f"  {label:<22} p50 {statistics.median(values):8.1f} ms   p95 {_percentile(values, 95):8.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark time-to-first-content of streaming endpoints")
+    parser.add_argument("--base-url", default="http://localhost:8000")
+    parser.add_argument("--iterations", type=int, default=5)
+    parser.add_argument("--user-id", default="benchmark-user")
+    parser.add_argument("--company", default="Acme Corp")
+    parser.add_argument("--file", help="Document to summarize (defaults to a built-in sample)")
+    parser.add_argument("--only", choices=["summary", "financial", "market"], action="append",
+                        help="Limit to some endpoint pairs (repeatable)")
+    args = parser.parse_args()
+
+    document = open(args.file, "rb").read() if args.file else SAMPLE_DOCUMENT.encode("utf-8")
+    file_name = args.file or "sample.txt"
+    base = args.base_url.rstrip("/")
+
+    cases = {
+        "summary": (
+            "/openai/summarize-file",
+            lambda: {"data": {"user_id": args.user_id}, "files": {"file": (file_name, document)}},
+        ),
+        "financial": (
+            "/openai/financial-insights",
+            lambda: {"json": {"company_name": args.company, "financial_data": SAMPLE_FINANCIAL_DATA,
+                              "user_id": args.user_id}},
+        ),
+        "market": (
+            "/openai/market-insights",
+            lambda: {"json": {"company_name": args.company, "user_id": args.user_id}},
+        ),
+    }
+
+    for name in args.only or list(cases):
+        path, make_kwargs = cases[name]
+        blocking = [_timed_blocking("POST", base + path, **make_kwargs()) for _ in range(args.iterations)]
+        streaming = [_timed_stream("POST", base + path + "/stream", **make_kwargs()) for _ in range(args.iterations)]
+        _report(f"POST {path}", blocking)
+        _report(f"POST {path}/stream", streaming)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""ETag / Last-Modified validators for conditional GETs.
+
+Endpoints compute a cheap validator (counts and newest timestamps, read from
+indexes) before loading anything, and answer 304 when the client's cached
+copy is still current.
+"""
+import hashlib
+import json
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+
+
+def make_etag(*parts) -> str:
+    # Weak: the same representation may be sent gzip-, brotli- or un-compressed
+    digest = hashlib.sha1(json.dumps(parts, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+    return f'W/"{digest[:32]}"'
+
+
+def _as_utc(value: datetime) -> datetime:
+    # Mongo hands back naive UTC datetimes
+    return value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value.astimezone(timezone.utc)
+
+
+def http_date(value: datetime) -> str:
+    return format_datetime(_as_utc(value).replace(microsecond=0), usegmt=True)
+
+
+def newest(*values):
+    """Latest of the datetimes given, ignoring missing ones"""
+    dates = [_as_utc(v) for v in values if isinstance(v, datetime)]
+    return max(dates) if dates else None
+
+
+def is_not_modified(headers, etag: str, last_modified: datetime = None) -> bool:
+    """If-None-Match takes precedence; If-Modified-Since is only consulted without it"""
+    if_none_match = headers.get("if-none-match")
+    if if_none_match is not None:
+        if if_none_match.strip() == "*":
+            return True
+        # Weak comparison: W/ prefixes are ignored
+        tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+        return etag.removeprefix("W/") in tags
+    if_modified_since = headers.get("if-modified-since")
+    if if_modified_since and last_modified is not None:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=timezone.utc)
+        return _as_utc(last_modified).replace(microsecond=0) <= since
+    return False
+
+
+def validator_headers(etag: str, last_modified: datetime = None) -> dict:
+    # no-cache: the browser may keep the body but must revalidate it on every use
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if last_modified is not None:
+        headers["Last-Modified"] = http_date(last_modified)
+    return headers
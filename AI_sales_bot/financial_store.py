@@ -0,0 +1,350 @@
+"""Local columnar store of fetched financial statements.
+
+Each fetch of a ticker is written as one Arrow IPC file in long format, with one
+row per (statement, line item, period) value. The file is uncompressed, so a
+read memory-maps it without copying or decoding anything. The file name and
+schema metadata carry the fetched-at watermark. Reads return the newest
+snapshot and callers decide whether it is fresh enough, so repeat analyses,
+comparisons across companies and restarts don't go back to yfinance.
+
+`compact` deletes superseded snapshots and can also write everything to one
+Parquet file for analysis tools. `refresh` fetches again the tickers whose
+newest snapshot is older than a maximum age.
+
+    python financial_store.py status
+    python financial_store.py refresh --max-age-hours 24 [--tickers AAPL,MSFT] [--force]
+    python financial_store.py compact [--keep 1] [--parquet all_statements.parquet]
+"""
+import argparse
+import hashlib
+import math
+import os
+import re
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.ipc as ipc
+    import pyarrow.parquet as pq
+except ImportError:  # the store is optional; without pyarrow every request fetches from yfinance
+    pa = None
+
+STATEMENTS = (
+    "financials", "balance_sheet", "cashflow", "earnings",
+    "quarterly_financials", "quarterly_balance_sheet", "quarterly_cashflow",
+)
+SNAPSHOT_SUFFIX = ".arrow"
+_TICKER_PATTERN = re.compile(r"^[A-Z0-9.^=\-]{1,20}$")
+
+
+def _schema():
+    return pa.schema([
+        ("statement", pa.dictionary(pa.int8(), pa.string())),
+        ("line_item", pa.string()),
+        ("period", pa.string()),
+        ("value", pa.float64()),
+    ])
+
+
+def _number(value):
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return None
+    return number if math.isfinite(number) else None
+
+
+def frame_rows(frame):
+    """(line_item, period, value) for a yfinance statement frame (line items x periods)"""
+    if frame is None or getattr(frame, "empty", True):
+        return
+    for period in frame.columns:
+        # Periods are Timestamps; keep the string form the API has always returned
+        period_key = str(period)
+        for line_item, value in frame[period].items():
+            yield str(line_item), period_key, _number(value)
+
+
+def frames_to_table(ticker: str, company_name: str, frames: dict, fetched_at: datetime):
+    statements, line_items, periods, values = [], [], [], []
+    for statement in STATEMENTS:
+        for line_item, period, value in frame_rows(frames.get(statement)):
+            statements.append(statement)
+            line_items.append(line_item)
+            periods.append(period)
+            values.append(value)
+    table = pa.table({
+        "statement": pa.array(statements, pa.string()).dictionary_encode().cast(pa.dictionary(pa.int8(), pa.string())),
+        "line_item": pa.array(line_items, pa.string()),
+        "period": pa.array(periods, pa.string()),
+        "value": pa.array(values, pa.float64()),
+    }, schema=_schema())
+    return table.replace_schema_metadata({
+        "ticker": ticker,
+        "company_name": company_name or "",
+        "fetched_at": fetched_at.isoformat(),
+    })
+
+
+def table_statements(table) -> dict:
+    """{statement: {period: {line_item: value}}}, the shape of DataFrame.to_dict() per statement"""
+    statements = {statement: {} for statement in STATEMENTS}
+    columns = table.to_pydict()
+    for statement, line_item, period, value in zip(columns["statement"], columns["line_item"],
+                                                    columns["period"], columns["value"]):
+        statements.setdefault(statement, {}).setdefault(period, {})[line_item] = value
+    return statements
+
+
+def frames_statements(frames: dict) -> dict:
+    """table_statements() straight from the frames, for when there is no store"""
+    statements = {statement: {} for statement in STATEMENTS}
+    for statement in STATEMENTS:
+        for line_item, period, value in frame_rows(frames.get(statement)):
+            statements[statement].setdefault(period, {})[line_item] = value
+    return statements
+
+
+def fetch_statements(ticker: str) -> dict:
+    """Statement frames of a ticker from yfinance (network)"""
+    import yfinance as yf
+    stock = yf.Ticker(ticker)
+    frames = {}
+    for statement in STATEMENTS:
+        try:
+            frames[statement] = getattr(stock, statement)
+        except Exception as e:
+            # yfinance drops attributes between releases (earnings, notably); one missing statement is not fatal
+            print(f"Could not fetch {statement} for {ticker}: {e}")
+            frames[statement] = None
+    return frames
+
+
+def _with_source(table, snapshot):
+    """Rows of a snapshot's table tagged with its ticker and watermark, for combining tickers"""
+    table = table.replace_schema_metadata(None)
+    table = table.append_column("ticker", pa.array([snapshot.ticker] * table.num_rows, pa.string()))
+    return table.append_column("fetched_at", pa.array([snapshot.fetched_at] * table.num_rows, pa.timestamp("us")))
+
+
+class Snapshot:
+    def __init__(self, path: str, table):
+        metadata = {key.decode(): value.decode() for key, value in (table.schema.metadata or {}).items()}
+        self.path = path
+        self.table = table
+        self.ticker = metadata.get("ticker")
+        self.company_name = metadata.get("company_name") or None
+        self.fetched_at = datetime.fromisoformat(metadata["fetched_at"])
+
+    def age(self) -> timedelta:
+        return datetime.utcnow() - self.fetched_at
+
+    def is_fresh(self, max_age: timedelta) -> bool:
+        return self.age() <= max_age
+
+    def statements(self) -> dict:
+        return table_statements(self.table)
+
+
+class FinancialStore:
+    def __init__(self, directory: str, cache_size: int = 256):
+        if pa is None:
+            raise RuntimeError("pyarrow is not installed")
+        self.directory = directory
+        self.cache_size = cache_size
+        # Memory-mapped tables by path: reopening is cheap, but not free at request rates
+        self._tables = OrderedDict()
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def normalize_ticker(ticker: str) -> str:
+        return ticker.strip().upper()
+
+    def ticker_dir(self, ticker: str) -> str:
+        ticker = self.normalize_ticker(ticker)
+        if not _TICKER_PATTERN.match(ticker):
+            # Anything unusual is hashed rather than trusted as a path component
+            ticker = "_" + hashlib.sha256(ticker.encode("utf-8")).hexdigest()[:32]
+        return os.path.join(self.directory, ticker)
+
+    def snapshot_paths(self, ticker: str) -> list:
+        """Snapshot files of a ticker, oldest first (names sort by fetch time)"""
+        directory = self.ticker_dir(ticker)
+        try:
+            names = sorted(name for name in os.listdir(directory) if name.endswith(SNAPSHOT_SUFFIX))
+        except FileNotFoundError:
+            return []
+        return [os.path.join(directory, name) for name in names]
+
+    def _ticker_dirs(self):
+        """(directory, snapshot file names oldest first, all file names) per stored ticker"""
+        for name in sorted(os.listdir(self.directory)):
+            directory = os.path.join(self.directory, name)
+            if not os.path.isdir(directory):
+                continue
+            files = sorted(os.listdir(directory))
+            yield directory, [f for f in files if f.endswith(SNAPSHOT_SUFFIX)], files
+
+    def tickers(self) -> list:
+        # Read from the snapshots: directory names of unusual tickers are hashes
+        return [self._open(os.path.join(directory, snapshots[-1])).ticker
+                for directory, snapshots, _ in self._ticker_dirs() if snapshots]
+
+    def _open(self, path: str) -> Snapshot:
+        with self._lock:
+            snapshot = self._tables.get(path)
+            if snapshot is not None:
+                self._tables.move_to_end(path)
+                return snapshot
+        # Uncompressed IPC over a memory map: the table's buffers point into the mapped file
+        with pa.memory_map(path, "r") as source:
+            table = ipc.open_file(source).read_all()
+        snapshot = Snapshot(path, table)
+        with self._lock:
+            self._tables[path] = snapshot
+            while len(self._tables) > self.cache_size:
+                self._tables.popitem(last=False)
+        return snapshot
+
+    def save(self, ticker: str, company_name: str, frames: dict, fetched_at: datetime = None) -> Snapshot:
+        ticker = self.normalize_ticker(ticker)
+        fetched_at = fetched_at or datetime.utcnow()
+        table = frames_to_table(ticker, company_name, frames, fetched_at)
+        directory = self.ticker_dir(ticker)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, fetched_at.strftime("%Y%m%dT%H%M%S%f") + SNAPSHOT_SUFFIX)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f, ipc.new_file(f, table.schema) as writer:
+                writer.write_table(table)
+            # Readers only ever see complete snapshots
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        return self._open(path)
+
+    def latest(self, ticker: str):
+        """Newest snapshot of a ticker, or None if it was never fetched"""
+        for _ in range(2):
+            paths = self.snapshot_paths(ticker)
+            if not paths:
+                return None
+            try:
+                return self._open(paths[-1])
+            except FileNotFoundError:
+                # Compacted away between listing and opening; list again
+                continue
+        return None
+
+    def compare(self, tickers, statement: str, line_items=None):
+        """One table of a statement across tickers, with ticker and fetched_at columns"""
+        tables = []
+        for ticker in tickers:
+            snapshot = self.latest(ticker)
+            if snapshot is None:
+                continue
+            table = snapshot.table
+            mask = pc.equal(table["statement"].cast(pa.string()), statement)
+            if line_items:
+                mask = pc.and_(mask, pc.is_in(table["line_item"], value_set=pa.array(list(line_items), pa.string())))
+            tables.append(_with_source(table.filter(mask).drop_columns(["statement"]), snapshot))
+        if not tables:
+            return None
+        return pa.concat_tables(tables)
+
+    def compact(self, keep: int = 1, parquet_path: str = None) -> dict:
+        """Delete all but the newest `keep` snapshots per ticker (and stray temp files)"""
+        stats = {"tickers": 0, "removed": 0, "bytes_freed": 0}
+        latest = []
+        for directory, snapshots, files in self._ticker_dirs():
+            stale = snapshots[:-max(keep, 1)] + [f for f in files if f.endswith(".tmp")]
+            for file_name in stale:
+                path = os.path.join(directory, file_name)
+                stats["bytes_freed"] += os.path.getsize(path)
+                with self._lock:
+                    self._tables.pop(path, None)
+                os.remove(path)
+                stats["removed"] += 1
+            if snapshots:
+                stats["tickers"] += 1
+                latest.append(self._open(os.path.join(directory, snapshots[-1])))
+        if parquet_path and latest:
+            tables = [_with_source(snapshot.table, snapshot) for snapshot in latest]
+            pq.write_table(pa.concat_tables(tables), parquet_path, compression="zstd")
+            stats["parquet"] = parquet_path
+        return stats
+
+    def stats(self) -> dict:
+        tickers, snapshots, size, oldest, newest = 0, 0, 0, None, None
+        for directory, files, _ in self._ticker_dirs():
+            if not files:
+                continue
+            tickers += 1
+            snapshots += len(files)
+            size += sum(os.path.getsize(os.path.join(directory, f)) for f in files)
+            watermark = self._open(os.path.join(directory, files[-1])).fetched_at
+            oldest = min(oldest, watermark) if oldest else watermark
+            newest = max(newest, watermark) if newest else watermark
+        return {
+            "directory": self.directory,
+            "tickers": tickers,
+            "snapshots": snapshots,
+            "bytes": size,
+            "oldest_watermark": oldest.isoformat() if oldest else None,
+            "newest_watermark": newest.isoformat() if newest else None,
+            "open_tables": len(self._tables),
+        }
+
+
+def refresh(store: FinancialStore, tickers=None, max_age: timedelta = timedelta(hours=24), force: bool = False,
+            fetch=fetch_statements) -> dict:
+    """Refetch stored tickers (or the ones given) whose newest snapshot is older than max_age"""
+    stats = {"refreshed": [], "fresh": [], "failed": {}}
+    for ticker in tickers or store.tickers():
+        snapshot = store.latest(ticker)
+        if snapshot is not None and not force and snapshot.is_fresh(max_age):
+            stats["fresh"].append(ticker)
+            continue
+        try:
+            store.save(ticker, snapshot.company_name if snapshot else ticker, fetch(ticker))
+            stats["refreshed"].append(ticker)
+        except Exception as e:
+            stats["failed"][ticker] = f"{type(e).__name__}: {e}"
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Maintain the local financial statement store")
+    parser.add_argument("command", choices=("status", "refresh", "compact"))
+    parser.add_argument("--dir", default=os.getenv("FINANCIAL_STORE_DIR", os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "financial_store")))
+    parser.add_argument("--max-age-hours", type=float, default=float(os.getenv("FINANCIAL_STORE_MAX_AGE_HOURS", "24")))
+    parser.add_argument("--tickers", help="Comma-separated tickers to refresh (default: every stored ticker)")
+    parser.add_argument("--force", action="store_true", help="Refresh even tickers that are still fresh")
+    parser.add_argument("--keep", type=int, default=1, help="Snapshots kept per ticker when compacting")
+    parser.add_argument("--parquet", help="Also write the newest snapshot of every ticker to this Parquet file")
+    args = parser.parse_args(argv)
+
+    store = FinancialStore(args.dir)
+    started = time.perf_counter()
+    if args.command == "status":
+        result = store.stats()
+    elif args.command == "refresh":
+        tickers = [t.strip() for t in args.tickers.split(",") if t.strip()] if args.tickers else None
+        result = refresh(store, tickers, timedelta(hours=args.max_age_hours), args.force)
+    else:
+        result = store.compact(args.keep, args.parquet)
+    for key, value in result.items():
+        print(f"{key}: {value}")
+    print(f"took {time.perf_counter() - started:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
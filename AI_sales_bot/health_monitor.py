@@ -0,0 +1,174 @@
+"""Background health checks of the services the API depends on.
+
+Each dependency has a probe (a callable that raises when the dependency is
+unhealthy) that a daemon thread runs every few seconds. Results are cached, so
+request handlers and the readiness endpoint read dependency state from memory
+instead of making a round trip per request. A dependency is marked down only
+after `failure_threshold` consecutive failed probes, and up again after one
+success, so a single slow probe doesn't flap it.
+"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as ProbeTimeout
+from datetime import datetime
+
+UNKNOWN = "unknown"
+UP = "up"
+DOWN = "down"
+
+
+class Dependency:
+    def __init__(self, name: str, probe, critical: bool, interval: float):
+        self.name = name
+        self.probe = probe
+        self.critical = critical
+        self.interval = interval
+        self.status = UNKNOWN
+        self.consecutive_failures = 0
+        self.last_checked = None
+        self.last_ok = None
+        self.latency_ms = None
+        self.error = None
+        self.details = None
+        self.next_check = 0.0
+        self.checking = False
+        self.check_started = 0.0
+        self.timed_out = False
+
+    def to_dict(self) -> dict:
+        return {
+            "status": self.status,
+            "critical": self.critical,
+            "latency_ms": self.latency_ms,
+            "last_checked": self.last_checked.isoformat() if self.last_checked else None,
+            "last_ok": self.last_ok.isoformat() if self.last_ok else None,
+            "consecutive_failures": self.consecutive_failures,
+            "error": self.error,
+            "details": self.details,
+        }
+
+
+class HealthMonitor:
+    def __init__(self, interval: float = 15.0, probe_timeout: float = 5.0, failure_threshold: int = 2):
+        self.interval = interval
+        self.probe_timeout = probe_timeout
+        self.failure_threshold = failure_threshold
+        self._dependencies = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        # A hung probe only ties up its own worker, never the monitor loop
+        self._executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="health-probe")
+        self.started_at = None
+
+    def register(self, name: str, probe, critical: bool = True, interval: float = None):
+        """probe() raises if the dependency is unhealthy; it may return a dict of details"""
+        with self._lock:
+            self._dependencies[name] = Dependency(name, probe, critical, interval or self.interval)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self.started_at = datetime.utcnow()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="health-monitor", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.probe_timeout + 1)
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            now = time.monotonic()
+            timed_out = []
+            with self._lock:
+                due = [d for d in self._dependencies.values() if d.next_check <= now and not d.checking]
+                for dependency in due:
+                    dependency.checking = True
+                    dependency.check_started = now
+                    dependency.timed_out = False
+                for dependency in self._dependencies.values():
+                    if not dependency.checking or now - dependency.check_started <= self.probe_timeout:
+                        continue
+                    # A probe that stays hung counts as another failure every interval
+                    if not dependency.timed_out or dependency.next_check <= now:
+                        dependency.timed_out = True
+                        dependency.next_check = now + dependency.interval
+                        timed_out.append(dependency)
+            for dependency in timed_out:
+                self._record(dependency, f"probe timed out after {self.probe_timeout}s", None, now - dependency.check_started)
+            for dependency in due:
+                future = self._executor.submit(dependency.probe)
+                future.add_done_callback(lambda f, d=dependency: self._finished(d, f))
+            self._stop.wait(0.5)
+
+    def _finished(self, dependency: Dependency, future):
+        elapsed = time.monotonic() - dependency.check_started
+        with self._lock:
+            dependency.checking = False
+            if dependency.timed_out:
+                # Already recorded as a failure; a hung probe is not retried until it returns
+                return
+            dependency.next_check = time.monotonic() + dependency.interval
+        try:
+            self._record(dependency, None, future.result(), elapsed)
+        except Exception as e:
+            self._record(dependency, f"{type(e).__name__}: {e}", None, elapsed)
+
+    def _record(self, dependency: Dependency, error, details, elapsed: float):
+        with self._lock:
+            dependency.last_checked = datetime.utcnow()
+            dependency.latency_ms = round(elapsed * 1000, 1)
+            dependency.next_check = time.monotonic() + dependency.interval
+            if error is None:
+                if dependency.status == DOWN:
+                    print(f"Health: {dependency.name} is up again")
+                dependency.status = UP
+                dependency.consecutive_failures = 0
+                dependency.last_ok = dependency.last_checked
+                dependency.error = None
+                dependency.details = details if isinstance(details, dict) else None
+                return
+            dependency.consecutive_failures += 1
+            dependency.error = error
+            if dependency.consecutive_failures >= self.failure_threshold or dependency.status == UNKNOWN:
+                if dependency.status != DOWN:
+                    print(f"Health: {dependency.name} is down: {error}")
+                dependency.status = DOWN
+
+    def check_now(self, name: str) -> str:
+        """Probe one dependency synchronously (e.g. at startup) and return its status"""
+        dependency = self._dependencies[name]
+        started = time.monotonic()
+        future = self._executor.submit(dependency.probe)
+        try:
+            self._record(dependency, None, future.result(timeout=self.probe_timeout), time.monotonic() - started)
+        except ProbeTimeout:
+            self._record(dependency, f"probe timed out after {self.probe_timeout}s", None, time.monotonic() - started)
+        except Exception as e:
+            self._record(dependency, f"{type(e).__name__}: {e}", None, time.monotonic() - started)
+        return dependency.status
+
+    def status(self, name: str) -> str:
+        dependency = self._dependencies.get(name)
+        return dependency.status if dependency else UNKNOWN
+
+    def is_down(self, name: str) -> bool:
+        """Known to be down; an unprobed dependency is given the benefit of the doubt"""
+        return self.status(name) == DOWN
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            dependencies = {name: d.to_dict() for name, d in self._dependencies.items()}
+        not_ready = [name for name, d in dependencies.items() if d["critical"] and d["status"] != UP]
+        degraded = [name for name, d in dependencies.items() if not d["critical"] and d["status"] == DOWN]
+        return {
+            "ready": not not_ready,
+            "not_ready": not_ready,
+            "degraded": degraded,
+            "dependencies": dependencies,
+            "started_at": self.started_at.isoformat() if self.started_at else None,
+        }
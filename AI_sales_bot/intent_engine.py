@@ -0,0 +1,332 @@
+"""Local intent classification for chat messages.
+
+Every rule's pattern is compiled into one alternation, so a message is
+scanned once however many rules there are. The scan runs over the lowercased
+message and only tries positions at a word boundary, so patterns are written
+in lowercase and start at a word. Each match adds its rule's weight to its
+intent, and the highest-scoring intent wins, with ties going to the intent
+listed first. A message that no rule matches can be handed to an
+optional TF-IDF + softmax regression classifier. The classifier is trained
+offline with numpy (`python intent_engine.py train examples.jsonl`) and only
+used when it is confident. Anything else is a general request.
+
+Some intents ask for the user's own data ("show my summaries this week") and
+are answered from the database instead of by a model. Only the rules produce
+them, and only for short messages. A long message that mentions summaries is
+more likely a request about them than a lookup.
+"""
+import json
+import os
+import re
+import sys
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+# Chat tasks: each has its own prompt and routing policy
+GENERAL = "General Assistant"
+BUSINESS_ANALYST = "Business Analyst"
+SUMMARIZER = "Summarizer"
+FINANCIAL_ANALYST = "Financial Analyst"
+MARKET_ANALYST = "Market Analyst"
+CHAT_TASKS = (BUSINESS_ANALYST, SUMMARIZER, FINANCIAL_ANALYST, MARKET_ANALYST, GENERAL)
+
+# Intents answered from the database without a model call
+SUMMARY_LIST = "Summary List"
+SUMMARY_COUNT = "Summary Count"
+DOCUMENT_LIST = "Document List"
+DIRECT_INTENTS = (SUMMARY_LIST, SUMMARY_COUNT, DOCUMENT_LIST)
+
+_MY_SUMMARIES = r"my (?:file |document |uploaded )?summar(?:y|ies)"
+
+# (intent, pattern, weight); earlier intents win ties, and at one position the earlier pattern matches
+DEFAULT_RULES = [
+    (SUMMARY_COUNT, rf"\bhow many (?:file |document )?summaries\b|\bcount (?:of )?{_MY_SUMMARIES}", 10),
+    (SUMMARY_LIST, rf"\b(?:show|list|display|get|give|see|view|fetch|find)(?: me)?(?: all)?(?: of)? {_MY_SUMMARIES}", 10),
+    (SUMMARY_LIST, rf"\bwhat (?:are|were) {_MY_SUMMARIES}|^\s*{_MY_SUMMARIES}\b", 10),
+    (DOCUMENT_LIST, r"\b(?:show|list|display|see|view)(?: me)?(?: all)?(?: of)? my (?:uploaded )?(?:documents|files)\b", 10),
+    (DOCUMENT_LIST, r"\bwh(?:at|ich) (?:documents|files) (?:have|did) i upload", 10),
+    (BUSINESS_ANALYST, r"\buser stor(?:y|ies)\b|\bacceptance criteria\b|\bbusiness requirements?\b", 3),
+    (BUSINESS_ANALYST, r"\b(?:convert|turn|break)\b[^.?!\n]{0,80}?\brequirements?\b", 2),
+    (BUSINESS_ANALYST, r"\b(?:epics?|backlog items?|use cases?|functional spec(?:ification)?s?)\b", 1),
+    (SUMMARIZER, r"\bsummari[sz](?:e|ing)\b|\bsummary of\b|\btl;?dr\b|\bboil (?:it|this) down\b", 2),
+    (SUMMARIZER, r"\bkey (?:points|takeaways)\b|\bin (?:a few|three|3|two|2) (?:sentences|bullets|lines)\b", 1),
+    (FINANCIAL_ANALYST, r"\bfinancial (?:analysis|performance|health|statements?|ratios?)\b", 3),
+    (FINANCIAL_ANALYST, r"\b(?:revenue|profit(?:ability)?|margins?|ebitda|earnings|cash ?flow|balance sheet"
+                        r"|income statement|valuation|p/e|eps|dividends?|debt|quarterly results)\b", 1),
+    (MARKET_ANALYST, r"\bmarket (?:trends?|share|size|analysis|research|outlook|insights?|opportunit(?:y|ies))\b", 3),
+    (MARKET_ANALYST, r"\b(?:competitors?|competitive landscape|industry trends?|go[- ]to[- ]market"
+                     r"|emerging trends?|tam|sector outlook)\b", 1),
+]
+
+_WINDOW = re.compile(
+    r"\b(today|yesterday|this week|last week|past week|this month|last month|this year"
+    r"|(?:last|past) (\d{1,3}) (days?|weeks?|months?))\b",
+    re.IGNORECASE
+)
+_TOKEN = re.compile(r"[a-z0-9][a-z0-9'&/.-]*[a-z0-9]|[a-z0-9]")
+
+
+class Intent:
+    __slots__ = ("name", "score", "source", "matched", "window")
+
+    def __init__(self, name: str, score: float, source: str, matched=(), window=None):
+        self.name = name
+        self.score = score
+        # "rules", "classifier" or "default"
+        self.source = source
+        self.matched = list(matched)
+        # (label, start, end) for database intents that named a period, else None
+        self.window = window
+
+    @property
+    def direct(self) -> bool:
+        return self.name in DIRECT_INTENTS
+
+    @property
+    def task(self) -> str:
+        """The chat task to use when the message goes to a model"""
+        return GENERAL if self.direct else self.name
+
+    def to_dict(self) -> dict:
+        data = {"intent": self.name, "task": self.task, "direct": self.direct, "score": round(self.score, 4),
+                "source": self.source, "matched": self.matched}
+        if self.window:
+            label, start, end = self.window
+            data["window"] = {"label": label, "start": start.isoformat(), "end": end.isoformat()}
+        return data
+
+
+def time_window(text: str, now: datetime = None):
+    """(label, start, end) for the first period named in text, in UTC; None when there is none"""
+    match = _WINDOW.search(text)
+    if not match:
+        return None
+    now = now or datetime.utcnow()
+    today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    phrase = match.group(1).lower()
+    if match.group(2):
+        amount = int(match.group(2))
+        unit = match.group(3).lower().rstrip("s")
+        days = amount * {"day": 1, "week": 7, "month": 30}[unit]
+        return phrase, now - timedelta(days=days), now
+    if phrase == "today":
+        return phrase, today, now
+    if phrase == "yesterday":
+        return phrase, today - timedelta(days=1), today
+    if phrase == "this week":
+        return phrase, today - timedelta(days=today.weekday()), now
+    if phrase == "last week":
+        start = today - timedelta(days=today.weekday() + 7)
+        return phrase, start, start + timedelta(days=7)
+    if phrase == "past week":
+        return phrase, now - timedelta(days=7), now
+    if phrase == "this month":
+        return phrase, today.replace(day=1), now
+    if phrase == "last month":
+        end = today.replace(day=1)
+        start = (end - timedelta(days=1)).replace(day=1)
+        return phrase, start, end
+    return phrase, today.replace(month=1, day=1), now
+
+
+def tokenize(text: str) -> list:
+    """Lowercased word unigrams and bigrams"""
+    words = _TOKEN.findall(text.lower())
+    return words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+
+
+class IntentClassifier:
+    """TF-IDF features and one linear layer with a softmax over the trained intents"""
+
+    def __init__(self, vocabulary: dict, idf: np.ndarray, weights: np.ndarray, bias: np.ndarray, classes: list):
+        self.vocabulary = vocabulary
+        self.idf = idf
+        self.weights = weights
+        self.bias = bias
+        self.classes = list(classes)
+
+    def _features(self, text: str):
+        counts = {}
+        for token in tokenize(text):
+            index = self.vocabulary.get(token)
+            if index is not None:
+                counts[index] = counts.get(index, 0) + 1
+        if not counts:
+            return None, None
+        indices = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+        values = np.fromiter(counts.values(), dtype=np.float32, count=len(counts)) * self.idf[indices]
+        return indices, values / np.linalg.norm(values)
+
+    def predict(self, text: str):
+        """(intent, probability); (None, 0.0) when the text shares no term with the training data"""
+        indices, values = self._features(text)
+        if indices is None:
+            return None, 0.0
+        logits = values @ self.weights[indices] + self.bias
+        probabilities = np.exp(logits - logits.max())
+        probabilities /= probabilities.sum()
+        best = int(probabilities.argmax())
+        return self.classes[best], float(probabilities[best])
+
+    @classmethod
+    def train(cls, examples, epochs: int = 100, learning_rate: float = 2.0, l2: float = 1e-4,
+              max_features: int = 20000, batch_size: int = 256, seed: int = 0):
+        """Fit on (text, intent) pairs with mini-batch gradient descent on the cross-entropy"""
+        examples = [(text, intent) for text, intent in examples if text and intent]
+        if not examples:
+            raise ValueError("No training examples")
+        classes = sorted({intent for _, intent in examples})
+        documents = [tokenize(text) for text, _ in examples]
+        document_frequency = {}
+        for tokens in documents:
+            for token in set(tokens):
+                document_frequency[token] = document_frequency.get(token, 0) + 1
+        terms = sorted(document_frequency, key=lambda term: (-document_frequency[term], term))[:max_features]
+        vocabulary = {term: i for i, term in enumerate(terms)}
+        n = len(documents)
+        idf = np.array([np.log((1 + n) / (1 + document_frequency[term])) + 1 for term in terms], dtype=np.float32)
+        model = cls(vocabulary, idf, np.zeros((len(terms), len(classes)), dtype=np.float32),
+                    np.zeros(len(classes), dtype=np.float32), classes)
+
+        # Sparse rows, densified one batch at a time so memory stays at batch_size x vocabulary
+        rows = [model._features(text) for text, _ in examples]
+        labels = np.array([classes.index(intent) for _, intent in examples])
+        rng = np.random.default_rng(seed)
+        for _ in range(epochs):
+            order = rng.permutation(n)
+            for start in range(0, n, batch_size):
+                batch = order[start:start + batch_size]
+                features = np.zeros((len(batch), len(terms)), dtype=np.float32)
+                for row, i in enumerate(batch):
+                    indices, values = rows[i]
+                    if indices is not None:
+                        features[row, indices] = values
+                logits = features @ model.weights + model.bias
+                logits -= logits.max(axis=1, keepdims=True)
+                probabilities = np.exp(logits)
+                probabilities /= probabilities.sum(axis=1, keepdims=True)
+                probabilities[np.arange(len(batch)), labels[batch]] -= 1
+                model.weights -= learning_rate * (features.T @ probabilities / len(batch) + l2 * model.weights)
+                model.bias -= learning_rate * probabilities.mean(axis=0)
+        return model
+
+    def save(self, path: str):
+        terms = sorted(self.vocabulary, key=self.vocabulary.get)
+        tmp_path = path + ".tmp.npz"
+        np.savez(tmp_path, terms=np.array(terms, dtype=str), idf=self.idf, weights=self.weights,
+                 bias=self.bias, classes=np.array(self.classes, dtype=str))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str):
+        with np.load(path, allow_pickle=False) as data:
+            vocabulary = {str(term): i for i, term in enumerate(data["terms"])}
+            return cls(vocabulary, data["idf"], data["weights"], data["bias"], [str(c) for c in data["classes"]])
+
+
+class IntentEngine:
+    def __init__(self, rules=None, classifier: IntentClassifier = None, min_confidence: float = 0.6,
+                 direct_max_words: int = 16, default: str = GENERAL):
+        """rules: (intent, pattern, weight) tuples or {"intent", "pattern", "weight"} dicts; defaults to DEFAULT_RULES"""
+        self.rules = [
+            (rule["intent"], rule["pattern"], float(rule.get("weight", 1))) if isinstance(rule, dict)
+            else (rule[0], rule[1], float(rule[2]))
+            for rule in (DEFAULT_RULES if rules is None else rules)
+        ]
+        # One named group per rule: a single scan finds every rule that matches. The leading
+        # lookahead lets the scan skip mid-word positions before trying any alternative.
+        self.pattern = re.compile(
+            r"(?=\b|^)(?:" + "|".join(f"(?P<r{i}>{pattern})" for i, (_, pattern, _) in enumerate(self.rules)) + ")"
+        )
+        self.intent_order = list(dict.fromkeys(intent for intent, _, _ in self.rules))
+        self.classifier = classifier
+        self.min_confidence = min_confidence
+        self.direct_max_words = direct_max_words
+        self.default = default
+        self.stats = {"classified": 0, "rules": 0, "classifier": 0, "default": 0, "direct": 0,
+                      "total_us": 0.0, "max_us": 0.0, "by_intent": {}}
+
+    def classify(self, text: str, now: datetime = None) -> Intent:
+        started = time.perf_counter()
+        intent = self._classify(text or "", now)
+        took_us = (time.perf_counter() - started) * 1e6
+        stats = self.stats
+        stats["classified"] += 1
+        stats[intent.source] += 1
+        stats["direct"] += intent.direct
+        stats["total_us"] += took_us
+        stats["max_us"] = max(stats["max_us"], took_us)
+        stats["by_intent"][intent.name] = stats["by_intent"].get(intent.name, 0) + 1
+        return intent
+
+    def _classify(self, text: str, now: datetime = None) -> Intent:
+        allow_direct = len(text.split()) <= self.direct_max_words
+        scores = {}
+        matched = {}
+        for match in self.pattern.finditer(text.lower()):
+            intent, _, weight = self.rules[int(match.lastgroup[1:])]
+            if intent in DIRECT_INTENTS and not allow_direct:
+                continue
+            scores[intent] = scores.get(intent, 0.0) + weight
+            matched.setdefault(intent, []).append(match.group(0).strip())
+        if scores:
+            best = max(scores, key=lambda name: (scores[name], -self.intent_order.index(name)))
+            window = time_window(text, now) if best in DIRECT_INTENTS else None
+            return Intent(best, scores[best], "rules", matched[best], window)
+        if self.classifier is not None:
+            name, probability = self.classifier.predict(text)
+            # The classifier picks prompts, never database answers
+            if name is not None and probability >= self.min_confidence and name not in DIRECT_INTENTS:
+                return Intent(name, probability, "classifier")
+        return Intent(self.default, 0.0, "default")
+
+    def snapshot(self) -> dict:
+        stats = dict(self.stats)
+        stats["by_intent"] = dict(stats["by_intent"])
+        stats["avg_us"] = round(stats["total_us"] / stats["classified"], 2) if stats["classified"] else 0.0
+        stats["total_us"] = round(stats["total_us"], 1)
+        stats["max_us"] = round(stats["max_us"], 1)
+        return {
+            "rules": len(self.rules),
+            "intents": self.intent_order,
+            "classifier": {"classes": self.classifier.classes, "terms": len(self.classifier.vocabulary),
+                           "min_confidence": self.min_confidence} if self.classifier else None,
+            "stats": stats,
+        }
+
+
+def read_examples(path: str) -> list:
+    """(text, intent) pairs from a JSONL file of {"text": ..., "intent": ...} lines"""
+    examples = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                row = json.loads(line)
+                examples.append((row["text"], row.get("intent") or row.get("task")))
+    return examples
+
+
+def main(argv):
+    """python intent_engine.py train <examples.jsonl> [model.npz] | classify <model.npz> <text>"""
+    if len(argv) >= 2 and argv[0] == "train":
+        output = argv[2] if len(argv) > 2 else "intent_model.npz"
+        examples = read_examples(argv[1])
+        started = time.perf_counter()
+        model = IntentClassifier.train(examples)
+        model.save(output)
+        correct = sum(model.predict(text)[0] == intent for text, intent in examples)
+        print(f"Trained on {len(examples)} examples ({len(model.classes)} intents, {len(model.vocabulary)} terms) "
+              f"in {time.perf_counter() - started:.1f}s; training accuracy {correct / len(examples):.1%}; saved {output}")
+        return 0
+    if len(argv) >= 3 and argv[0] == "classify":
+        engine = IntentEngine(classifier=IntentClassifier.load(argv[1]))
+        print(json.dumps(engine.classify(" ".join(argv[2:])).to_dict(), indent=2))
+        return 0
+    print(main.__doc__)
+    return 2
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
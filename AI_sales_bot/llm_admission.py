@@ -0,0 +1,279 @@
+"""Admission control for outbound LLM calls.
+
+Every OpenAI call goes through an AdmissionController before it is sent:
+token buckets cap the request rate per user and per model, in-flight caps
+bound concurrency, and a priority queue decides who gets the next free slot
+so interactive chat is served before summarization, insights and bulk jobs.
+Calls that cannot be admitted fail fast with an AdmissionRejected carrying
+the HTTP status and a Retry-After hint instead of piling up behind the
+upstream.
+"""
+import heapq
+import itertools
+import math
+import threading
+import time
+
+# Lower value = served first
+PRIORITY_CHAT = 0
+PRIORITY_SUMMARIZE = 1
+PRIORITY_INSIGHTS = 2
+PRIORITY_BULK = 3
+
+
+class AdmissionRejected(Exception):
+    """Raised when an LLM call is refused by admission control"""
+
+    def __init__(self, status_code: int, detail: str, retry_after: float):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.retry_after = max(1, int(math.ceil(retry_after)))
+
+
+class TokenBucket:
+    """Classic token bucket refilled continuously at `rate` tokens per second"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        elapsed = now - self.updated
+        if elapsed > 0:
+            self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+            self.updated = now
+
+    def wait_time(self, tokens: float = 1, now: float = None) -> float:
+        """Seconds until `tokens` are available (0 if available now)"""
+        self._refill(now if now is not None else time.monotonic())
+        if self.tokens >= tokens:
+            return 0.0
+        if self.rate <= 0:
+            return float("inf")
+        return (tokens - self.tokens) / self.rate
+
+    def consume(self, tokens: float = 1):
+        self.tokens -= tokens
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class AdmissionTicket:
+    """Handle for an admitted call; release() is idempotent"""
+
+    def __init__(self, controller, user_key: str, model: str):
+        self._controller = controller
+        self.user_key = user_key
+        self.model = model
+        self.admitted_at = time.monotonic()
+        self._released = False
+
+    def release(self):
+        if self._released:
+            return
+        self._released = True
+        self._controller._release(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+        return False
+
+
+class AdmissionController:
+    """Per-user / per-model rate and concurrency limits with a priority queue"""
+
+    # Idle buckets are pruned once this many keys are tracked
+    MAX_TRACKED_KEYS = 10000
+
+    def __init__(
+        self,
+        user_rate_per_min: float = 30,
+        user_burst: float = 10,
+        model_rate_per_min: float = 300,
+        model_burst: float = 50,
+        max_in_flight: int = 16,
+        max_user_in_flight: int = 4,
+        max_model_in_flight: int = 12,
+        max_queue: int = 64,
+        queue_timeout: float = 15.0,
+        model_limits: dict = None,
+    ):
+        self.user_rate = user_rate_per_min / 60.0
+        self.user_burst = user_burst
+        self.model_rate = model_rate_per_min / 60.0
+        self.model_burst = model_burst
+        self.max_in_flight = max_in_flight
+        self.max_user_in_flight = max_user_in_flight
+        self.max_model_in_flight = max_model_in_flight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        # Optional per-model overrides: {"gpt-4": {"rate_per_min": 60, "burst": 10, "max_in_flight": 4}}
+        self.model_limits = model_limits or {}
+
+        self._cond = threading.Condition(threading.Lock())
+        self._user_buckets = {}
+        self._model_buckets = {}
+        self._in_flight = 0
+        self._user_in_flight = {}
+        self._user_queued = {}
+        self._model_in_flight = {}
+        self._waiters = []
+        self._seq = itertools.count()
+        self.stats = {
+            "admitted": 0,
+            "queued": 0,
+            "rejected_user_concurrency": 0,
+            "rejected_user_rate": 0,
+            "rejected_model_rate": 0,
+            "rejected_queue_full": 0,
+            "rejected_queue_timeout": 0,
+        }
+
+    # ---------- internals (caller holds the lock) ----------
+    def _bucket(self, buckets: dict, key: str, rate: float, burst: float) -> TokenBucket:
+        bucket = buckets.get(key)
+        if bucket is None:
+            if len(buckets) >= self.MAX_TRACKED_KEYS:
+                now = time.monotonic()
+                for stale in [k for k, b in buckets.items() if b.is_full(now)]:
+                    del buckets[stale]
+            bucket = TokenBucket(rate, burst)
+            buckets[key] = bucket
+        return bucket
+
+    def _model_cap(self, model: str) -> int:
+        return self.model_limits.get(model, {}).get("max_in_flight", self.max_model_in_flight)
+
+    def _has_slot(self, model: str) -> bool:
+        return (
+            self._in_flight < self.max_in_flight
+            and self._model_in_flight.get(model, 0) < self._model_cap(model)
+        )
+
+    def _next_eligible(self):
+        """Best-priority waiter whose model currently has a free slot"""
+        for entry in sorted(self._waiters):
+            if self._has_slot(entry[2]):
+                return entry
+        return None
+
+    def _dequeue(self, entry, user_key: str):
+        self._waiters.remove(entry)
+        heapq.heapify(self._waiters)
+        remaining = self._user_queued.get(user_key, 1) - 1
+        if remaining > 0:
+            self._user_queued[user_key] = remaining
+        else:
+            self._user_queued.pop(user_key, None)
+
+    def _reject(self, stat: str, status_code: int, detail: str, retry_after: float):
+        self.stats[stat] += 1
+        raise AdmissionRejected(status_code, detail, retry_after)
+
+    # ---------- public API ----------
+    def acquire(self, user_id: str, model: str, priority: int = PRIORITY_CHAT, timeout: float = None) -> AdmissionTicket:
+        """Admit a call or raise AdmissionRejected; blocks at most `timeout` seconds in the queue"""
+        user_key = user_id or "anonymous"
+        timeout = self.queue_timeout if timeout is None else timeout
+
+        with self._cond:
+            now = time.monotonic()
+
+            # Queued calls count too, so one user's batch can't fill the queue and then exceed the cap
+            user_active = self._user_in_flight.get(user_key, 0) + self._user_queued.get(user_key, 0)
+            if user_active >= self.max_user_in_flight:
+                self._reject("rejected_user_concurrency", 429,
+                             "Too many concurrent AI requests for this user", 1)
+
+            user_bucket = self._bucket(self._user_buckets, user_key, self.user_rate, self.user_burst)
+            user_wait = user_bucket.wait_time(now=now)
+            if user_wait > 0:
+                self._reject("rejected_user_rate", 429, "AI request rate limit exceeded for this user", user_wait)
+
+            limits = self.model_limits.get(model, {})
+            model_bucket = self._bucket(
+                self._model_buckets, model,
+                limits.get("rate_per_min", self.model_rate * 60.0) / 60.0,
+                limits.get("burst", self.model_burst),
+            )
+            model_wait = model_bucket.wait_time(now=now)
+            if model_wait > 0:
+                self._reject("rejected_model_rate", 503, f"Model {model} is at capacity, please retry shortly", model_wait)
+
+            if not self._has_slot(model) or self._waiters:
+                if len(self._waiters) >= self.max_queue:
+                    self._reject("rejected_queue_full", 503, "AI request queue is full, please retry shortly", 2)
+
+                # Rate tokens are charged up-front so a burst can't all slip into the queue
+                user_bucket.consume()
+                model_bucket.consume()
+                self.stats["queued"] += 1
+
+                entry = (priority, next(self._seq), model)
+                heapq.heappush(self._waiters, entry)
+                self._user_queued[user_key] = self._user_queued.get(user_key, 0) + 1
+                deadline = now + timeout
+                while self._next_eligible() != entry:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._dequeue(entry, user_key)
+                        self._cond.notify_all()
+                        self._reject("rejected_queue_timeout", 503,
+                                     "Timed out waiting for an AI request slot", 2)
+                    self._cond.wait(remaining)
+                self._dequeue(entry, user_key)
+            else:
+                user_bucket.consume()
+                model_bucket.consume()
+
+            self._in_flight += 1
+            self._user_in_flight[user_key] = self._user_in_flight.get(user_key, 0) + 1
+            self._model_in_flight[model] = self._model_in_flight.get(model, 0) + 1
+            self.stats["admitted"] += 1
+            # Another waiter may also fit into the remaining slots
+            self._cond.notify_all()
+
+        return AdmissionTicket(self, user_key, model)
+
+    def _release(self, ticket: AdmissionTicket):
+        with self._cond:
+            self._in_flight -= 1
+            remaining = self._user_in_flight.get(ticket.user_key, 1) - 1
+            if remaining > 0:
+                self._user_in_flight[ticket.user_key] = remaining
+            else:
+                self._user_in_flight.pop(ticket.user_key, None)
+            remaining = self._model_in_flight.get(ticket.model, 1) - 1
+            if remaining > 0:
+                self._model_in_flight[ticket.model] = remaining
+            else:
+                self._model_in_flight.pop(ticket.model, None)
+            self._cond.notify_all()
+
+    def snapshot(self) -> dict:
+        with self._cond:
+            return {
+                "in_flight": self._in_flight,
+                "queued": len(self._waiters),
+                "in_flight_by_model": dict(self._model_in_flight),
+                "users_in_flight": len(self._user_in_flight),
+                "limits": {
+                    "user_rate_per_min": self.user_rate * 60.0,
+                    "user_burst": self.user_burst,
+                    "model_rate_per_min": self.model_rate * 60.0,
+                    "model_burst": self.model_burst,
+                    "max_in_flight": self.max_in_flight,
+                    "max_user_in_flight": self.max_user_in_flight,
+                    "max_model_in_flight": self.max_model_in_flight,
+                    "max_queue": self.max_queue,
+                },
+                "stats": dict(self.stats),
+            }
@@ -0,0 +1,278 @@
+"""Retry, hedging and circuit breaking for upstream LLM calls.
+
+call_with_resilience() wraps a single upstream attempt (a callable taking the
+per-attempt timeout in seconds) with:
+
+- deadline-aware exponential backoff with full jitter, honouring Retry-After
+- an optional hedged second attempt when the first one is slow
+- a circuit breaker that fails fast while the upstream keeps failing
+
+Failures that survive all of that are raised as LLMUpstreamError carrying the
+HTTP status the API should answer with, instead of a generic 500.
+"""
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from openai import APIStatusError
+
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+# Hedged attempts run here; a losing attempt is left to finish in the background
+_hedge_executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix="llm-hedge")
+
+
+class LLMUpstreamError(Exception):
+    """Upstream LLM failure translated into an HTTP status for the API"""
+
+    def __init__(self, status_code: int, detail: str, retry_after: float = None, cause: Exception = None):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.retry_after = None if retry_after is None else max(1, int(round(retry_after)))
+        self.cause = cause
+
+
+class CircuitOpenError(LLMUpstreamError):
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(503, f"AI service for {name} is temporarily unavailable, please retry shortly", retry_after)
+
+
+class DeadlineExceeded(LLMUpstreamError):
+    def __init__(self, detail: str = "AI request timed out", cause: Exception = None):
+        super().__init__(504, detail, cause=cause)
+
+
+def _status_code(exc: Exception):
+    status = getattr(exc, "status_code", None)
+    if status is None:
+        status = getattr(getattr(exc, "response", None), "status_code", None)
+    return status
+
+
+def _is_timeout(exc: Exception) -> bool:
+    return isinstance(exc, TimeoutError) or "Timeout" in type(exc).__name__
+
+
+def is_retryable(exc: Exception) -> bool:
+    """Timeouts, connection failures, 429s and 5xx responses are worth retrying"""
+    if isinstance(exc, LLMUpstreamError):
+        return False
+    status = _status_code(exc)
+    if status is not None:
+        return status in RETRYABLE_STATUS_CODES or status >= 500
+    name = type(exc).__name__
+    return _is_timeout(exc) or "Connection" in name or isinstance(exc, ConnectionError)
+
+
+def retry_after_seconds(exc: Exception):
+    """Retry-After hint from an upstream error response, if any"""
+    headers = getattr(getattr(exc, "response", None), "headers", None)
+    if not headers:
+        return None
+    value = headers.get("retry-after-ms")
+    if value:
+        try:
+            return float(value) / 1000.0
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if value:
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return None
+
+
+def to_upstream_error(exc: Exception) -> LLMUpstreamError:
+    """Map a final upstream failure onto the status our API should return"""
+    if isinstance(exc, LLMUpstreamError):
+        return exc
+    status = _status_code(exc)
+    if _is_timeout(exc) or status in (408, 504):
+        return DeadlineExceeded(cause=exc)
+    if status == 429:
+        return LLMUpstreamError(503, "AI provider is rate limiting requests, please retry shortly",
+                                retry_after_seconds(exc) or 5, exc)
+    if status is not None and 400 <= status < 500:
+        return LLMUpstreamError(502, f"AI provider rejected the request: {exc}", cause=exc)
+    return LLMUpstreamError(502, f"AI provider error: {exc}", retry_after_seconds(exc), exc)
+
+
+class RetryPolicy:
+    def __init__(self, max_attempts: int = 3, base_delay: float = 0.5, max_delay: float = 8.0):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def backoff(self, attempt: int, exc: Exception = None) -> float:
+        """Full-jitter exponential backoff; never shorter than the upstream's Retry-After"""
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+        hint = retry_after_seconds(exc) if exc is not None else None
+        if hint is not None:
+            delay = max(delay, hint)
+        return delay
+
+
+class CircuitBreaker:
+    """Closed -> open after N consecutive failures -> half-open probe after a cool-down"""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str, failure_threshold: int = 5, recovery_timeout: float = 30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+        self.stats = {"successes": 0, "failures": 0, "short_circuited": 0, "opened": 0}
+
+    def allow(self):
+        """Raise CircuitOpenError unless a call may go through now"""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+            elapsed = time.monotonic() - self.opened_at
+            if self.state == self.OPEN and elapsed >= self.recovery_timeout:
+                self.state = self.HALF_OPEN
+                self._probe_in_flight = False
+            if self.state == self.HALF_OPEN and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return
+            self.stats["short_circuited"] += 1
+            raise CircuitOpenError(self.name, max(1.0, self.recovery_timeout - elapsed))
+
+    def is_open(self) -> bool:
+        """True while calls are being failed fast (open and still cooling down)"""
+        with self._lock:
+            return self.state == self.OPEN and time.monotonic() - self.opened_at < self.recovery_timeout
+
+    def record_success(self):
+        with self._lock:
+            self.stats["successes"] += 1
+            self.failures = 0
+            self.state = self.CLOSED
+            self._probe_in_flight = False
+
+    def release(self):
+        """End an attempt that says nothing about the upstream, letting the next half-open probe through"""
+        with self._lock:
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.stats["failures"] += 1
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    self.stats["opened"] += 1
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+                self._probe_in_flight = False
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {"state": self.state, "consecutive_failures": self.failures, **self.stats}
+
+
+class CircuitBreakers:
+    """Lazily created breaker per upstream (e.g. per model)"""
+
+    def __init__(self, failure_threshold: int = 5, recovery_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def get(self, name: str) -> CircuitBreaker:
+        with self._lock:
+            breaker = self._breakers.get(name)
+            if breaker is None:
+                breaker = CircuitBreaker(name, self.failure_threshold, self.recovery_timeout)
+                self._breakers[name] = breaker
+            return breaker
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            breakers = list(self._breakers.values())
+        return {b.name: b.snapshot() for b in breakers}
+
+
+def _attempt(fn, timeout: float, hedge_after: float, stats: dict):
+    """One logical attempt, optionally hedged with a second identical request"""
+    if not hedge_after or hedge_after >= timeout:
+        return fn(timeout)
+
+    primary = _hedge_executor.submit(fn, timeout)
+    done, _ = wait([primary], timeout=hedge_after)
+    if done:
+        return primary.result()
+
+    stats["hedges"] = stats.get("hedges", 0) + 1
+    hedge = _hedge_executor.submit(fn, max(0.1, timeout - hedge_after))
+    pending = {primary, hedge}
+    error = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                if future is hedge:
+                    stats["hedge_wins"] = stats.get("hedge_wins", 0) + 1
+                return future.result()
+            error = future.exception()
+    raise error
+
+
+def call_with_resilience(fn, deadline: float, retry_policy: RetryPolicy = None,
+                         breaker: CircuitBreaker = None, hedge_after: float = None, stats: dict = None):
+    """Call fn(timeout) until it succeeds, the deadline (seconds from now) passes or retries run out"""
+    retry_policy = retry_policy or RetryPolicy()
+    stats = stats if stats is not None else {}
+    give_up_at = time.monotonic() + deadline
+    last_error = None
+
+    for attempt in range(retry_policy.max_attempts):
+        remaining = give_up_at - time.monotonic()
+        if remaining <= 0:
+            break
+        if breaker is not None:
+            breaker.allow()
+        try:
+            result = _attempt(fn, remaining, hedge_after, stats)
+        except Exception as e:
+            last_error = e
+            if not is_retryable(e):
+                if isinstance(e, APIStatusError):
+                    # The upstream answered; a bad request is not a sign it is degraded
+                    if breaker is not None:
+                        breaker.record_success()
+                    raise to_upstream_error(e)
+                # A local error (e.g. a bug in fn) is neither an upstream failure nor a success
+                if breaker is not None:
+                    breaker.release()
+                raise
+            if breaker is not None:
+                breaker.record_failure()
+            if attempt + 1 >= retry_policy.max_attempts:
+                break
+            delay = retry_policy.backoff(attempt, e)
+            if time.monotonic() + delay >= give_up_at:
+                break
+            stats["retries"] = stats.get("retries", 0) + 1
+            print(f"LLM call failed ({type(e).__name__}: {e}), retrying in {delay:.2f}s")
+            time.sleep(delay)
+            continue
+        if breaker is not None:
+            breaker.record_success()
+        return result
+
+    if last_error is None:
+        raise DeadlineExceeded()
+    raise to_upstream_error(last_error)
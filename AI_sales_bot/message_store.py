@@ -0,0 +1,383 @@
+"""Chat message storage: one document per message or time-bucketed documents,
+with idle sessions moved to a compressed cold archive.
+
+In "bucket" mode a session's messages are appended to a bucket document until
+it holds `bucket_size` messages, `bucket_max_bytes` of content or spans
+`bucket_span`, and a new bucket is started. That keeps one index entry per
+bucket instead of per message, and a session's recent history is one or two
+document reads. Messages written before the switch stay where they are: every
+read merges per-message documents, buckets and the archive, ordered by
+timestamp, so either format (or both) can be present for a session.
+
+Archiving copies a session's hot messages to the archive first and only then
+deletes the copies that were read, so a crash in between leaves duplicates
+(which reads drop) rather than gaps.
+"""
+import gzip
+import hashlib
+import heapq
+import json
+import os
+import tempfile
+import uuid
+import zlib
+from datetime import datetime, timedelta
+
+from bson import Binary
+from pymongo import ASCENDING, DESCENDING
+
+DOCUMENT = "document"
+BUCKET = "bucket"
+
+# Stored with every message (a bucket stores session_id once, on the bucket)
+MESSAGE_FIELDS = ("user_id", "message_type", "content", "timestamp", "model_used")
+
+
+def message_key(message: dict):
+    """Identity of a message across storage formats, for dropping duplicates"""
+    return message.get("timestamp"), message.get("message_type"), message.get("content")
+
+
+def in_range(timestamp, condition: dict = None) -> bool:
+    """Evaluate a Mongo-style range ({"$gt": ..., "$lte": ...}) in Python"""
+    for op, bound in (condition or {}).items():
+        if bound is None:
+            continue
+        if op == "$gt" and not timestamp > bound:
+            return False
+        if op == "$gte" and not timestamp >= bound:
+            return False
+        if op == "$lt" and not timestamp < bound:
+            return False
+        if op == "$lte" and not timestamp <= bound:
+            return False
+    return True
+
+
+def _encode_messages(messages) -> bytes:
+    return json.dumps(
+        [{**m, "timestamp": m["timestamp"].isoformat()} for m in messages],
+        ensure_ascii=False
+    ).encode("utf-8")
+
+
+def _decode_messages(data: bytes) -> list:
+    messages = json.loads(data)
+    for message in messages:
+        message["timestamp"] = datetime.fromisoformat(message["timestamp"])
+    return messages
+
+
+class MongoArchive:
+    """zlib-compressed JSON of a session's messages in a cold collection.
+
+    A session is written as a new version of one or more parts (each kept well
+    under the 16MB document limit); older versions are deleted only after the
+    new one is complete, and readers take the newest complete version.
+    """
+    name = "mongo"
+
+    def __init__(self, collection, part_bytes: int = 4 * 1024 * 1024):
+        self.collection = collection
+        self.part_bytes = part_bytes
+
+    def ensure_indexes(self):
+        self.collection.create_index(
+            [("session_id", ASCENDING), ("version", ASCENDING), ("part", ASCENDING)],
+            name="session_version_part"
+        )
+
+    def _parts(self, messages):
+        part, size = [], 0
+        for message in messages:
+            part.append(message)
+            size += len(message.get("content") or "") + 200
+            if size >= self.part_bytes:
+                yield part
+                part, size = [], 0
+        if part or not messages:
+            yield part
+
+    def write(self, session_id: str, user_id: str, messages: list):
+        version = datetime.utcnow().strftime("%Y%m%d%H%M%S%f") + uuid.uuid4().hex[:6]
+        parts = list(self._parts(messages))
+        for index, part in enumerate(parts):
+            self.collection.insert_one({
+                "session_id": session_id,
+                "user_id": user_id,
+                "version": version,
+                "part": index,
+                "parts": len(parts),
+                "count": len(part),
+                "codec": "zlib",
+                "data": Binary(zlib.compress(_encode_messages(part), 6)),
+                "archived_at": datetime.utcnow(),
+            })
+        self.collection.delete_many({"session_id": session_id, "version": {"$ne": version}})
+
+    def read(self, session_id: str) -> list:
+        versions = {}
+        for doc in self.collection.find({"session_id": session_id}, {"_id": 0, "version": 1, "part": 1, "parts": 1, "data": 1}):
+            versions.setdefault(doc["version"], []).append(doc)
+        for version in sorted(versions, reverse=True):
+            parts = sorted(versions[version], key=lambda doc: doc["part"])
+            if len(parts) != parts[0]["parts"]:
+                continue  # a write that never finished
+            messages = []
+            for part in parts:
+                messages.extend(_decode_messages(zlib.decompress(part["data"])))
+            return messages
+        return []
+
+
+class FileArchive:
+    """One gzipped JSON file per session under `directory`, replaced atomically"""
+    name = "file"
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def ensure_indexes(self):
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path(self, session_id: str) -> str:
+        # Hashed: session ids come from clients and must not become path components
+        digest = hashlib.sha256(session_id.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, digest[:2], f"{digest}.json.gz")
+
+    def write(self, session_id: str, user_id: str, messages: list):
+        path = self.path(session_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as raw, gzip.GzipFile(fileobj=raw, mode="wb") as f:
+                f.write(_encode_messages(messages))
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def read(self, session_id: str) -> list:
+        try:
+            with gzip.open(self.path(session_id), "rb") as f:
+                return _decode_messages(f.read())
+        except FileNotFoundError:
+            return []
+
+
+class MessageStore:
+    def __init__(self, messages, buckets=None, archive=None, mode: str = DOCUMENT, bucket_size: int = 100,
+                 bucket_span: timedelta = timedelta(hours=24), bucket_max_bytes: int = 1024 * 1024):
+        if mode not in (DOCUMENT, BUCKET):
+            raise ValueError(f"Unknown message storage mode: {mode}")
+        if mode == BUCKET and buckets is None:
+            raise ValueError("Bucket storage needs a bucket collection")
+        self.messages = messages
+        self.buckets = buckets
+        self.archive = archive
+        self.mode = mode
+        self.bucket_size = bucket_size
+        self.bucket_span = bucket_span
+        self.bucket_max_bytes = bucket_max_bytes
+
+    def ensure_indexes(self):
+        self.messages.create_index(
+            [("session_id", ASCENDING), ("timestamp", ASCENDING)],
+            name="session_timestamp"
+        )
+        if self.buckets is not None:
+            self.buckets.create_index([("session_id", ASCENDING), ("start", ASCENDING)], name="session_start")
+        if self.archive is not None:
+            self.archive.ensure_indexes()
+
+    # ---------- writes ----------
+    def insert(self, message: dict):
+        if self.mode == DOCUMENT:
+            self.messages.insert_one(dict(message))
+            return
+        size = len(message.get("content") or "")
+        # Append to the session's open bucket, or start one when none has room
+        self.buckets.update_one(
+            {
+                "session_id": message["session_id"],
+                "count": {"$lt": self.bucket_size},
+                "bytes": {"$lt": max(self.bucket_max_bytes - size, 1)},
+                "start": {"$gte": message["timestamp"] - self.bucket_span},
+            },
+            {
+                "$push": {"messages": {field: message.get(field) for field in MESSAGE_FIELDS}},
+                "$inc": {"count": 1, "bytes": size},
+                "$max": {"end": message["timestamp"]},
+                "$setOnInsert": {"start": message["timestamp"], "user_id": message.get("user_id")},
+            },
+            upsert=True
+        )
+
+    # ---------- reads ----------
+    def _bucket_messages(self, bucket: dict, session_id: str) -> list:
+        return [{"session_id": session_id, **m} for m in bucket.get("messages", [])]
+
+    def recent(self, session_id: str, limit: int) -> list:
+        """Newest `limit` messages, oldest first"""
+        documents = list(self.messages.find({"session_id": session_id}, {"_id": 0}).sort("timestamp", DESCENDING).limit(limit))
+        buckets, count = [], 0
+        if self.buckets is not None:
+            for bucket in self.buckets.find({"session_id": session_id}, {"_id": 0, "messages": 1, "count": 1}).sort("start", DESCENDING):
+                buckets.append(bucket)
+                count += bucket.get("count", 0)
+                if count >= limit:
+                    break
+        # Oldest first, so the stable sort keeps write order among equal timestamps
+        hot = documents[::-1]
+        for bucket in reversed(buckets):
+            hot.extend(self._bucket_messages(bucket, session_id))
+        merged = self._merge(hot)
+        if len(merged) < limit and self.archive is not None:
+            # Hot storage can't fill the window: the session may have been archived
+            merged = self._merge(self._archived(session_id) + merged)
+        return merged[-limit:]
+
+    def iter_messages(self, session_id: str, timestamp: dict = None, message_type: str = None, fields=None,
+                      batch_size: int = 0):
+        """A session's messages in timestamp order, streamed from every storage format.
+
+        `timestamp` is a Mongo range filter; `fields` limits the message fields read.
+        """
+        query = {"session_id": session_id}
+        if timestamp:
+            query["timestamp"] = timestamp
+        if message_type:
+            query["message_type"] = message_type
+        projection = {"_id": 0}
+        if fields:
+            projection.update({field: 1 for field in set(fields) | {"timestamp", "message_type", "content"}})
+        cursors = [self.messages.find(query, projection, batch_size=batch_size).sort("timestamp", ASCENDING)]
+        sources = [cursors[0]]
+
+        if self.buckets is not None:
+            bucket_query = {"session_id": session_id}
+            lower = (timestamp or {}).get("$gt") or (timestamp or {}).get("$gte")
+            upper = (timestamp or {}).get("$lt") or (timestamp or {}).get("$lte")
+            if lower is not None:
+                bucket_query["end"] = {"$gte": lower}
+            if upper is not None:
+                bucket_query["start"] = {"$lte": upper}
+            bucket_projection = {"_id": 0, "messages": 1}
+            if fields:
+                bucket_projection = {"_id": 0, **{f"messages.{field}": 1 for field in projection if field != "_id"}}
+            # A batch of buckets already holds many messages each
+            bucket_batch = max(1, batch_size // self.bucket_size) if batch_size else 0
+            cursors.append(self.buckets.find(bucket_query, bucket_projection, batch_size=bucket_batch).sort("start", ASCENDING))
+            sources.append(self._filter(self._unwind(cursors[-1], session_id), timestamp, message_type))
+
+        if self.archive is not None:
+            sources.append(self._filter(
+                ({"session_id": session_id, **m} for m in self._archived(session_id)), timestamp, message_type
+            ))
+
+        try:
+            seen_at, seen = None, set()
+            for message in heapq.merge(*sources, key=lambda m: m["timestamp"]):
+                if message["timestamp"] != seen_at:
+                    seen_at, seen = message["timestamp"], set()
+                key = message_key(message)
+                if key in seen:
+                    continue
+                seen.add(key)
+                yield message
+        finally:
+            for cursor in cursors:
+                cursor.close()
+
+    def history(self, session_id: str) -> list:
+        return list(self.iter_messages(session_id))
+
+    def session_stats(self, session_ids) -> dict:
+        """{session_id: {"message_count", "last_content", "last_model", "last_timestamp"}} over hot storage"""
+        stats = {}
+
+        def fold(session_id, count, last):
+            row = stats.setdefault(session_id, {"message_count": 0, "last_content": None,
+                                                 "last_model": None, "last_timestamp": None})
+            row["message_count"] += count
+            if last and (row["last_timestamp"] is None or last["timestamp"] >= row["last_timestamp"]):
+                row.update(last_content=last.get("content"), last_model=last.get("model_used"),
+                           last_timestamp=last["timestamp"])
+
+        for row in self.messages.aggregate([
+            {"$match": {"session_id": {"$in": list(session_ids)}}},
+            {"$sort": {"timestamp": 1}},
+            {"$group": {
+                "_id": "$session_id",
+                "message_count": {"$sum": 1},
+                "last_content": {"$last": "$content"},
+                "last_model": {"$last": "$model_used"},
+                "last_timestamp": {"$last": "$timestamp"},
+            }},
+        ]):
+            fold(row["_id"], row["message_count"], {"content": row["last_content"], "model_used": row["last_model"],
+                                                   "timestamp": row["last_timestamp"]})
+        if self.buckets is not None:
+            for row in self.buckets.aggregate([
+                {"$match": {"session_id": {"$in": list(session_ids)}}},
+                {"$sort": {"start": 1}},
+                {"$group": {
+                    "_id": "$session_id",
+                    "message_count": {"$sum": "$count"},
+                    "last_bucket": {"$last": "$messages"},
+                }},
+            ]):
+                last = max(row["last_bucket"], key=lambda m: m["timestamp"]) if row["last_bucket"] else None
+                fold(row["_id"], row["message_count"], last)
+        return stats
+
+    # ---------- archival ----------
+    def archive_session(self, session_id: str, user_id: str = None) -> int:
+        """Move a session's hot messages into the archive; returns how many were moved"""
+        if self.archive is None:
+            raise RuntimeError("No message archive configured")
+        documents = list(self.messages.find({"session_id": session_id}, {"session_id": 0}))
+        buckets = list(self.buckets.find({"session_id": session_id}, {"_id": 1, "count": 1, "messages": 1})) \
+            if self.buckets is not None else []
+        hot = [{field: doc.get(field) for field in MESSAGE_FIELDS} for doc in documents]
+        for bucket in buckets:
+            hot.extend(bucket.get("messages", []))
+        if not hot:
+            return 0
+
+        archived = self.archive.read(session_id)
+        messages = [
+            {field: m.get(field) for field in MESSAGE_FIELDS}
+            for m in self._merge(archived + hot)
+        ]
+        self.archive.write(session_id, user_id, messages)
+
+        # Only what was copied is deleted; a bucket that grew since it was read stays hot
+        self.messages.delete_many({"_id": {"$in": [doc["_id"] for doc in documents]}})
+        for bucket in buckets:
+            self.buckets.delete_one({"_id": bucket["_id"], "count": bucket.get("count")})
+        return len(hot)
+
+    # ---------- internals ----------
+    def _archived(self, session_id: str) -> list:
+        return [{"session_id": session_id, **m} for m in self.archive.read(session_id)]
+
+    def _unwind(self, cursor, session_id):
+        for bucket in cursor:
+            # Concurrent appends can interleave slightly; order within the bucket
+            yield from sorted(self._bucket_messages(bucket, session_id), key=lambda m: m["timestamp"])
+
+    @staticmethod
+    def _filter(messages, timestamp=None, message_type=None):
+        for message in messages:
+            if message_type and message.get("message_type") != message_type:
+                continue
+            if in_range(message["timestamp"], timestamp):
+                yield message
+
+    @staticmethod
+    def _merge(messages) -> list:
+        unique = {}
+        for message in messages:
+            unique.setdefault(message_key(message), message)
+        return sorted(unique.values(), key=lambda m: m["timestamp"])
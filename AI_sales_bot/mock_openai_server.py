@@ -0,0 +1,250 @@
+"""Fault-injecting mock of the OpenAI chat completions and embeddings APIs.
+
+Point the backend at it to exercise retries, hedging and the circuit breaker
+without touching the real API:
+
+    python mock_openai_server.py --port 8099 --error-rate 0.2 --slow-rate 0.1 --slow-ms 4000
+    OPENAI_BASE_URL=http://localhost:8099/v1 OPENAI_API_KEY=mock python openai_chatbot.py
+
+Faults can be changed at runtime:
+
+    curl -X POST localhost:8099/_faults -d '{"fail_next": 3, "fail_status": 503}'
+    curl localhost:8099/_stats
+"""
+import argparse
+import hashlib
+import json
+import math
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_FAULTS = {
+    "latency_ms": 50,          # base latency for every response
+    "error_rate": 0.0,         # fraction of requests answered with fail_status
+    "fail_status": 500,
+    "rate_limit_rate": 0.0,    # fraction answered with 429 + Retry-After
+    "retry_after": 1,
+    "slow_rate": 0.0,          # fraction delayed by slow_ms (tail latency)
+    "slow_ms": 3000,
+    "hang_rate": 0.0,          # fraction that never answer within a client timeout
+    "fail_next": 0,            # deterministic: fail the next N requests
+    "reply": "This is a mock response.",
+    "json_reply": None,        # returned instead of `reply` when set
+    "stream_chunk_ms": 20,     # generation time per word, streamed or not
+}
+
+faults = dict(DEFAULT_FAULTS)
+stats = {"requests": 0, "errors": 0, "rate_limited": 0, "slow": 0, "hung": 0, "ok": 0}
+lock = threading.Lock()
+
+
+def _pick_fault():
+    """Decide what happens to the next request"""
+    with lock:
+        stats["requests"] += 1
+        if faults["fail_next"] > 0:
+            faults["fail_next"] -= 1
+            stats["errors"] += 1
+            return "error"
+        roll = random.random()
+        for name, key, stat in (("error", "error_rate", "errors"),
+                                ("rate_limit", "rate_limit_rate", "rate_limited"),
+                                ("hang", "hang_rate", "hung"),
+                                ("slow", "slow_rate", "slow")):
+            if roll < faults[key]:
+                stats[stat] += 1
+                return name
+            roll -= faults[key]
+        stats["ok"] += 1
+        return None
+
+
+def _hashed_embedding(text, dimensions=64):
+    """Deterministic bag-of-words embedding so similar texts get similar vectors"""
+    vector = [0.0] * dimensions
+    for word in text.lower().split():
+        bucket = int(hashlib.md5(word.strip(".,;:!?").encode("utf-8")).hexdigest(), 16) % dimensions
+        vector[bucket] += 1.0
+    norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+    return [v / norm for v in vector]
+
+
+class MockOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b"{}"
+        return json.loads(raw or b"{}")
+
+    def do_GET(self):
+        if self.path == "/_faults":
+            with lock:
+                return self._send_json(200, faults)
+        if self.path == "/_stats":
+            with lock:
+                return self._send_json(200, stats)
+        if self.path.rstrip("/").endswith("/models"):
+            return self._send_json(200, {"object": "list", "data": [
+                {"id": "gpt-3.5-turbo", "object": "model"},
+                {"id": "gpt-4o-mini", "object": "model"},
+                {"id": "gpt-4o", "object": "model"},
+            ]})
+        self._send_json(404, {"error": {"message": "not found"}})
+
+    def do_POST(self):
+        body = self._read_json()
+        if self.path == "/_faults":
+            with lock:
+                if body.get("reset"):
+                    faults.clear()
+                    faults.update(DEFAULT_FAULTS)
+                    for key in stats:
+                        stats[key] = 0
+                faults.update({k: v for k, v in body.items() if k in DEFAULT_FAULTS})
+                return self._send_json(200, faults)
+        if self.path.endswith("/chat/completions"):
+            return self._chat_completion(body)
+        if self.path.endswith("/embeddings"):
+            return self._embeddings(body)
+        self._send_json(404, {"error": {"message": "not found"}})
+
+    def _embeddings(self, body):
+        fault = _pick_fault()
+        with lock:
+            config = dict(faults)
+        time.sleep(config["latency_ms"] / 1000.0)
+        if fault == "error":
+            return self._send_json(config["fail_status"], {"error": {"message": "injected failure", "type": "server_error"}})
+        if fault == "rate_limit":
+            return self._send_json(429, {"error": {"message": "injected rate limit", "type": "rate_limit_error"}},
+                                   {"Retry-After": str(config["retry_after"])})
+
+        inputs = body.get("input", [])
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        data = [{"object": "embedding", "index": i, "embedding": _hashed_embedding(text)} for i, text in enumerate(inputs)]
+        tokens = sum(max(1, len(text) // 4) for text in inputs)
+        self._send_json(200, {
+            "object": "list",
+            "data": data,
+            "model": body.get("model", "text-embedding-3-small"),
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+        })
+
+    def _chat_completion(self, body):
+        fault = _pick_fault()
+        with lock:
+            config = dict(faults)
+        time.sleep(config["latency_ms"] / 1000.0)
+
+        if fault == "error":
+            return self._send_json(config["fail_status"], {"error": {"message": "injected failure", "type": "server_error"}})
+        if fault == "rate_limit":
+            return self._send_json(429, {"error": {"message": "injected rate limit", "type": "rate_limit_error"}},
+                                   {"Retry-After": str(config["retry_after"])})
+        if fault == "hang":
+            time.sleep(300)
+        if fault == "slow":
+            time.sleep(config["slow_ms"] / 1000.0)
+
+        model = body.get("model", "gpt-3.5-turbo")
+        content = config["json_reply"] if config["json_reply"] is not None else config["reply"]
+        if not isinstance(content, str):
+            content = json.dumps(content)
+        prompt_chars = sum(len(m.get("content") or "") for m in body.get("messages", []))
+        usage = {
+            "prompt_tokens": max(1, prompt_chars // 4),
+            "completion_tokens": max(1, len(content) // 4),
+        }
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        completion_id = f"chatcmpl-mock-{uuid.uuid4().hex[:12]}"
+
+        words = content.split(" ")
+        if not body.get("stream"):
+            # A blocking completion still takes as long to generate as a streamed one
+            time.sleep(len(words) * config["stream_chunk_ms"] / 1000.0)
+            return self._send_json(200, {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                "usage": usage,
+            })
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        for i, word in enumerate(words):
+            piece = word if i == 0 else " " + word
+            chunk = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}],
+            }
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+            time.sleep(config["stream_chunk_ms"] / 1000.0)
+        final = {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+        }
+        if (body.get("stream_options") or {}).get("include_usage"):
+            final["usage"] = usage
+        self.wfile.write(f"data: {json.dumps(final)}\n\ndata: [DONE]\n\n".encode("utf-8"))
+        self.wfile.flush()
+        self.close_connection = True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fault-injecting mock OpenAI server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8099)
+    for key, value in DEFAULT_FAULTS.items():
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            parser.add_argument(f"--{key.replace('_', '-')}", type=type(value), default=value)
+    parser.add_argument("--reply", default=DEFAULT_FAULTS["reply"])
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.seed is not None:
+        random.seed(args.seed)
+    for key in DEFAULT_FAULTS:
+        if hasattr(args, key):
+            faults[key] = getattr(args, key)
+
+    server = ThreadingHTTPServer((args.host, args.port), MockOpenAIHandler)
+    print(f"Mock OpenAI server listening on http://{args.host}:{args.port}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
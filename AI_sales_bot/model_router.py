@@ -0,0 +1,290 @@
+"""Cost- and latency-aware model selection.
+
+route() picks, per request, the cheapest model that is good enough for the
+task, fits the prompt in its context window, is expected to answer within the
+task's latency SLO and stays under the per-request cost budget. The remaining
+eligible models are returned as ordered fallbacks for when the chosen one is
+rate-limited or too slow.
+
+Latency estimates start from a static per-model profile and are corrected by
+an EWMA of observed/predicted latency, so a model that is currently slow is
+routed around. Rate limits and SLO misses put a model in a short penalty box.
+"""
+import copy
+import threading
+import time
+from collections import deque
+
+AUTO_MODEL = "auto"
+
+# Prices are USD per 1K tokens; latency is base seconds plus seconds per output token
+DEFAULT_MODEL_PROFILES = {
+    "gpt-4o-mini": {"context_window": 128000, "input_cost": 0.00015, "output_cost": 0.0006,
+                    "quality": 2, "base_latency": 0.6, "seconds_per_token": 0.012},
+    "gpt-3.5-turbo": {"context_window": 16385, "input_cost": 0.0005, "output_cost": 0.0015,
+                      "quality": 1, "base_latency": 0.5, "seconds_per_token": 0.012},
+    "gpt-4o": {"context_window": 128000, "input_cost": 0.0025, "output_cost": 0.01,
+               "quality": 3, "base_latency": 0.8, "seconds_per_token": 0.02},
+}
+
+# Minimum quality tier and latency SLO (seconds) per task
+DEFAULT_TASK_POLICIES = {
+    "General Assistant": {"quality": 1, "latency_slo": 15},
+    "Business Analyst": {"quality": 2, "latency_slo": 20},
+    "Summarizer": {"quality": 1, "latency_slo": 20},
+    "Financial Analyst": {"quality": 2, "latency_slo": 30},
+    "Market Analyst": {"quality": 2, "latency_slo": 30},
+    "file_summary": {"quality": 1, "latency_slo": 30},
+    "financial_insights": {"quality": 2, "latency_slo": 45},
+    "market_insights": {"quality": 2, "latency_slo": 45},
+}
+
+
+def estimate_tokens(text: str) -> int:
+    """Cheap token estimate (~4 characters per token for English text)"""
+    return len(text or "") // 4 + 1
+
+
+def estimate_message_tokens(messages: list) -> int:
+    # A few tokens of framing per message
+    return sum(estimate_tokens(m.get("content")) + 4 for m in messages)
+
+
+class ModelProfile:
+    def __init__(self, name: str, context_window: int, input_cost: float, output_cost: float,
+                 quality: int, base_latency: float, seconds_per_token: float):
+        self.name = name
+        self.context_window = context_window
+        self.input_cost = input_cost
+        self.output_cost = output_cost
+        self.quality = quality
+        self.base_latency = base_latency
+        self.seconds_per_token = seconds_per_token
+
+    def cost(self, prompt_tokens: int, output_tokens: int) -> float:
+        return (prompt_tokens * self.input_cost + output_tokens * self.output_cost) / 1000.0
+
+
+class RoutingDecision:
+    def __init__(self, task, model, fallbacks, prompt_tokens, max_output_tokens, estimated_cost,
+                 estimated_latency, latency_slo, cost_budget, reason):
+        self.task = task
+        self.model = model
+        self.fallbacks = fallbacks
+        self.prompt_tokens = prompt_tokens
+        self.max_output_tokens = max_output_tokens
+        self.estimated_cost = estimated_cost
+        self.estimated_latency = estimated_latency
+        self.latency_slo = latency_slo
+        self.cost_budget = cost_budget
+        self.reason = reason
+        self.served_by = None
+        self.attempts = []
+        self.created_at = time.time()
+
+    @property
+    def candidates(self) -> list:
+        return [self.model] + list(self.fallbacks)
+
+    def to_dict(self) -> dict:
+        return {
+            "task": self.task,
+            "model": self.model,
+            "fallbacks": self.fallbacks,
+            "served_by": self.served_by,
+            "attempts": self.attempts,
+            "prompt_tokens": self.prompt_tokens,
+            "max_output_tokens": self.max_output_tokens,
+            "estimated_cost": round(self.estimated_cost, 6) if self.estimated_cost is not None else None,
+            "estimated_latency": round(self.estimated_latency, 3) if self.estimated_latency is not None else None,
+            "latency_slo": self.latency_slo,
+            "cost_budget": self.cost_budget,
+            "reason": self.reason,
+            "created_at": self.created_at,
+        }
+
+
+class ModelRouter:
+    def __init__(self, profiles: dict = None, task_policies: dict = None, default_quality: int = 1,
+                 latency_slo: float = 30.0, cost_budget: float = 0.05, max_fallbacks: int = 1,
+                 penalty_seconds: float = 30.0, ewma_alpha: float = 0.2, history: int = 200,
+                 expected_output_ratio: float = 0.5):
+        profiles = profiles or DEFAULT_MODEL_PROFILES
+        self.profiles = {name: ModelProfile(name, **spec) for name, spec in profiles.items()}
+        self.task_policies = dict(DEFAULT_TASK_POLICIES)
+        self.task_policies.update(task_policies or {})
+        self.default_quality = default_quality
+        self.latency_slo = latency_slo
+        self.cost_budget = cost_budget
+        self.max_fallbacks = max_fallbacks
+        self.penalty_seconds = penalty_seconds
+        self.ewma_alpha = ewma_alpha
+        # Completions rarely use all of max_tokens; estimates assume this fraction
+        self.expected_output_ratio = expected_output_ratio
+        self._slowdown = {name: 1.0 for name in self.profiles}
+        self._penalized_until = {}
+        self._lock = threading.Lock()
+        self._recent = deque(maxlen=history)
+        self.stats = {"routed": 0, "fallbacks": 0, "slo_misses": 0, "penalties": 0, "by_model": {}, "by_task": {}}
+
+    def knows(self, model: str) -> bool:
+        return model in self.profiles
+
+    def cost(self, model: str, prompt_tokens: int, output_tokens: int):
+        """USD cost of a call, or None for a model without a profile"""
+        profile = self.profiles.get(model)
+        return profile.cost(prompt_tokens, output_tokens) if profile else None
+
+    def policy(self, task: str) -> dict:
+        policy = self.task_policies.get(task or "", {})
+        return {
+            "quality": policy.get("quality", self.default_quality),
+            "latency_slo": policy.get("latency_slo", self.latency_slo),
+            "cost_budget": policy.get("cost_budget", self.cost_budget),
+        }
+
+    def estimate_latency(self, model: str, output_tokens: int) -> float:
+        profile = self.profiles[model]
+        with self._lock:
+            slowdown = self._slowdown.get(model, 1.0)
+        return (profile.base_latency + output_tokens * profile.seconds_per_token) * slowdown
+
+    def attempt_deadline(self, decision: RoutingDecision, model: str) -> float:
+        """How long to wait on one candidate before falling back.
+
+        The SLO is sized for a typical answer, so the deadline also leaves room for a full
+        max_output_tokens answer at the model's profiled speed; only a model slower than that is cut off.
+        """
+        profile = self.profiles.get(model)
+        if profile is None:
+            return decision.latency_slo
+        full_answer = profile.base_latency + decision.max_output_tokens * profile.seconds_per_token
+        return max(decision.latency_slo, full_answer)
+
+    def _penalized(self, model: str, now: float) -> bool:
+        return self._penalized_until.get(model, 0) > now
+
+    def route(self, task: str, prompt_tokens: int, max_output_tokens: int, latency_slo: float = None,
+              cost_budget: float = None, available=None) -> RoutingDecision:
+        """Choose a model plus ordered fallbacks; `available(model)` can veto models (e.g. open breakers)"""
+        policy = self.policy(task)
+        latency_slo = latency_slo or policy["latency_slo"]
+        cost_budget = cost_budget or policy["cost_budget"]
+        now = time.monotonic()
+        expected_output = int(max_output_tokens * self.expected_output_ratio)
+
+        options = []
+        for name, profile in self.profiles.items():
+            if profile.context_window < prompt_tokens + max_output_tokens:
+                continue
+            if available is not None and not available(name):
+                continue
+            cost = profile.cost(prompt_tokens, expected_output)
+            latency = self.estimate_latency(name, expected_output)
+            with self._lock:
+                penalized = self._penalized(name, now)
+            options.append({
+                "model": name,
+                "cost": cost,
+                "latency": latency,
+                "quality_ok": profile.quality >= policy["quality"],
+                "fits": latency <= latency_slo and cost <= cost_budget,
+                "penalized": penalized,
+            })
+
+        if not options:
+            # Nothing fits the prompt: fall back to the largest context window and let the API decide
+            name = max(self.profiles.values(), key=lambda p: p.context_window).name
+            decision = RoutingDecision(task, name, [], prompt_tokens, max_output_tokens, None, None,
+                                       latency_slo, cost_budget, "no model fits; using largest context window")
+            self._record(decision)
+            return decision
+
+        # Healthy beats penalized, good-enough beats cheaper-but-weaker, then SLO/budget fit, then cost
+        options.sort(key=lambda o: (o["penalized"], not o["quality_ok"], not o["fits"], o["cost"], o["latency"]))
+        best = options[0]
+        if best["penalized"]:
+            reason = "all eligible models penalized"
+        elif not best["quality_ok"]:
+            reason = "no model meets the task's quality tier"
+        elif not best["fits"]:
+            reason = "no model meets the latency SLO and cost budget; cheapest"
+        else:
+            reason = "cheapest within latency SLO and cost budget"
+        fallbacks = [o["model"] for o in options[1:] if o["quality_ok"] or not best["quality_ok"]]
+        decision = RoutingDecision(task, best["model"], fallbacks[:self.max_fallbacks], prompt_tokens,
+                                   max_output_tokens, best["cost"], best["latency"], latency_slo, cost_budget, reason)
+        self._record(decision)
+        return decision
+
+    def pinned(self, task: str, model: str, prompt_tokens: int, max_output_tokens: int) -> RoutingDecision:
+        """Decision for an explicitly requested model (recorded, but no fallbacks)"""
+        policy = self.policy(task)
+        profile = self.profiles.get(model)
+        expected_output = int(max_output_tokens * self.expected_output_ratio)
+        decision = RoutingDecision(
+            task, model, [], prompt_tokens, max_output_tokens,
+            profile.cost(prompt_tokens, expected_output) if profile else None,
+            self.estimate_latency(model, expected_output) if profile else None,
+            policy["latency_slo"], policy["cost_budget"], "requested"
+        )
+        self._record(decision)
+        return decision
+
+    def _record(self, decision: RoutingDecision):
+        with self._lock:
+            self.stats["routed"] += 1
+            by_task = self.stats["by_task"].setdefault(decision.task or "unknown", {})
+            by_task[decision.model] = by_task.get(decision.model, 0) + 1
+            self._recent.append(decision)
+
+    def record_success(self, decision: RoutingDecision, model: str, latency: float, output_tokens: int = None):
+        """Update the latency model and penalize the model if it missed the SLO"""
+        profile = self.profiles.get(model)
+        with self._lock:
+            decision.served_by = model
+            decision.attempts.append({"model": model, "outcome": "ok", "latency": round(latency, 3)})
+            counts = self.stats["by_model"].setdefault(model, {"served": 0, "failed": 0})
+            counts["served"] += 1
+            if model != decision.model:
+                self.stats["fallbacks"] += 1
+            if profile is None:
+                return
+            tokens = output_tokens if output_tokens is not None else int(decision.max_output_tokens * self.expected_output_ratio)
+            predicted = profile.base_latency + tokens * profile.seconds_per_token
+            ratio = min(max(latency / predicted, 0.2), 10.0) if predicted > 0 else 1.0
+            self._slowdown[model] = (1 - self.ewma_alpha) * self._slowdown[model] + self.ewma_alpha * ratio
+            if decision.latency_slo and latency > decision.latency_slo:
+                self.stats["slo_misses"] += 1
+                self._penalize(model)
+
+    def record_failure(self, decision: RoutingDecision, model: str, reason: str):
+        """The model was rate-limited, unavailable or too slow; route around it for a while"""
+        with self._lock:
+            decision.attempts.append({"model": model, "outcome": reason})
+            counts = self.stats["by_model"].setdefault(model, {"served": 0, "failed": 0})
+            counts["failed"] += 1
+            if model in self.profiles:
+                self._penalize(model)
+
+    def _penalize(self, model: str):
+        self._penalized_until[model] = time.monotonic() + self.penalty_seconds
+        self.stats["penalties"] += 1
+
+    def snapshot(self, recent: int = 20) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            return {
+                "models": {
+                    name: {
+                        "quality": profile.quality,
+                        "context_window": profile.context_window,
+                        "slowdown": round(self._slowdown[name], 3),
+                        "penalized_for": round(max(0.0, self._penalized_until.get(name, 0) - now), 1),
+                    }
+                    for name, profile in self.profiles.items()
+                },
+                "task_policies": copy.deepcopy(self.task_policies),
+                "stats": copy.deepcopy(self.stats),
+                "recent_decisions": [d.to_dict() for d in list(self._recent)[-recent:]],
+            }
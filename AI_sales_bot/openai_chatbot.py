@@ -1,17 +1,25 @@
-from fastapi import FastAPI, HTTPException, UploadFile, File, Form, BackgroundTasks
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi import FastAPI, HTTPException, UploadFile, File, Form, BackgroundTasks, Request, WebSocket, WebSocketDisconnect, Depends
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from starlette.background import BackgroundTask
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from typing import Optional, List, Dict
-from pymongo import MongoClient, DESCENDING
+from pydantic import BaseModel, BeforeValidator, Field
+from typing import Optional, List, Dict, Annotated
+from pymongo import MongoClient, ASCENDING, DESCENDING, TEXT, timeout as mongo_timeout
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 import os
+import hmac
+import hashlib
 import json
+import asyncio
 import docx
 from PyPDF2 import PdfReader
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from dotenv import load_dotenv
 import uvicorn
-import re
+import threading
+import time
+import zipfile
+from itertools import islice
 from bson import json_util
 import uuid
 from openai import OpenAI
@@ -21,7 +29,59 @@ import plotly.graph_objects as go
 import plotly.express as px
 from plotly.subplots import make_subplots
 from weasyprint import HTML
-from io import BytesIO
+from html import escape as html_escape
+from concurrent.futures import ThreadPoolExecutor
+from anyio import to_thread
+from llm_admission import (
+    AdmissionController,
+    AdmissionRejected,
+    PRIORITY_CHAT,
+    PRIORITY_SUMMARIZE,
+    PRIORITY_INSIGHTS,
+    PRIORITY_BULK,
+)
+from llm_resilience import CircuitBreakers, LLMUpstreamError, RetryPolicy, call_with_resilience
+from summary_jobs import SummaryJobManager
+from upload_ingest import DOCX, PDF, TEXT_PLAIN, ZIP, UploadTooLarge, inspect_upload, spool_upload_to_path
+from rag_index import VectorIndexStore, chunk_text
+from session_cache import SessionHistoryCache
+from message_store import DOCUMENT, FileArchive, MessageStore, MongoArchive
+from single_flight import SingleFlight, flight_key
+from financial_store import STATEMENTS, FinancialStore, fetch_statements, frames_statements
+from weekly_reports import ReportStore, WeeklyReportScheduler
+from health_monitor import HealthMonitor
+from intent_engine import (
+    BUSINESS_ANALYST,
+    DEFAULT_RULES,
+    DOCUMENT_LIST,
+    FINANCIAL_ANALYST,
+    MARKET_ANALYST,
+    SUMMARIZER,
+    SUMMARY_COUNT,
+    IntentClassifier,
+    IntentEngine,
+)
+from profiling import (
+    PROFILE_MODES,
+    ProfilingMiddleware,
+    RequestProfiler,
+    collapsed_stacks,
+    pstats_bytes,
+    run_in_threadpool,
+    stage,
+)
+from usage_ledger import GROUP_FIELDS, MeteredStream, UsageContextMiddleware, UsageLedger
+from conditional_get import is_not_modified, make_etag, newest, validator_headers
+from response_compression import CompressionMiddleware
+from streaming_export import EXPORT_FORMATS, content_disposition, iter_rows, stream_export
+from model_router import AUTO_MODEL, ModelRouter, estimate_message_tokens, estimate_tokens
+from structured_output import (
+    IncrementalJSONParser,
+    ParseFailureTracker,
+    StructuredOutputError,
+    generate_structured,
+    repair_prompt,
+)
 
 load_dotenv()
 app = FastAPI()
@@ -35,6 +95,15 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# ---------- Response Compression ----------
+app.add_middleware(
+    CompressionMiddleware,
+    minimum_size=int(os.getenv("COMPRESSION_MIN_BYTES", "1024")),
+    gzip_level=int(os.getenv("COMPRESSION_GZIP_LEVEL", "6")),
+    brotli_quality=int(os.getenv("COMPRESSION_BROTLI_QUALITY", "4")),
+    brotli_enabled=os.getenv("COMPRESSION_BROTLI", "true").lower() == "true",
+)
+
 # Initialize OpenAI client
 openai_api_key = os.getenv("OPENAI_API_KEY")
 if not openai_api_key:
@@ -42,7 +111,141 @@ if not openai_api_key:
     print("You can create a .env file with: OPENAI_API_KEY=your_api_key_here")
     openai_client = None
 else:
-    openai_client = OpenAI(api_key=openai_api_key)
+    # Retries are handled by call_with_resilience, not the SDK
+    openai_client = OpenAI(api_key=openai_api_key, max_retries=0)
+
+# ---------- LLM Admission Control ----------
+llm_admission = AdmissionController(
+    user_rate_per_min=float(os.getenv("LLM_USER_RATE_PER_MIN", "30")),
+    user_burst=float(os.getenv("LLM_USER_BURST", "10")),
+    model_rate_per_min=float(os.getenv("LLM_MODEL_RATE_PER_MIN", "300")),
+    model_burst=float(os.getenv("LLM_MODEL_BURST", "50")),
+    max_in_flight=int(os.getenv("LLM_MAX_IN_FLIGHT", "16")),
+    max_user_in_flight=int(os.getenv("LLM_MAX_USER_IN_FLIGHT", "4")),
+    max_model_in_flight=int(os.getenv("LLM_MAX_MODEL_IN_FLIGHT", "12")),
+    max_queue=int(os.getenv("LLM_MAX_QUEUE", "64")),
+    queue_timeout=float(os.getenv("LLM_QUEUE_TIMEOUT", "15")),
+    model_limits=json.loads(os.getenv("LLM_MODEL_LIMITS", "{}")),
+)
+# Queued and in-flight LLM calls each hold a threadpool worker while they wait. anyio's default pool
+# (40 threads) is smaller than a full queue, so it is sized to leave this many threads for everything else.
+THREADPOOL_HEADROOM = int(os.getenv("THREADPOOL_HEADROOM", "40"))
+
+@app.on_event("startup")
+async def size_threadpool():
+    limiter = to_thread.current_default_thread_limiter()
+    needed = llm_admission.max_in_flight + llm_admission.max_queue + THREADPOOL_HEADROOM
+    if limiter.total_tokens < needed:
+        limiter.total_tokens = needed
+
+# ---------- LLM Resilience ----------
+llm_retry_policy = RetryPolicy(
+    max_attempts=int(os.getenv("LLM_MAX_ATTEMPTS", "3")),
+    base_delay=float(os.getenv("LLM_RETRY_BASE_DELAY", "0.5")),
+    max_delay=float(os.getenv("LLM_RETRY_MAX_DELAY", "8")),
+)
+llm_breakers = CircuitBreakers(
+    failure_threshold=int(os.getenv("LLM_BREAKER_FAILURES", "5")),
+    recovery_timeout=float(os.getenv("LLM_BREAKER_RECOVERY_SECONDS", "30")),
+)
+LLM_CALL_DEADLINE = float(os.getenv("LLM_CALL_DEADLINE", "60"))
+# Hedging is off unless LLM_HEDGE_AFTER (seconds) is set; only short prompts are hedged
+LLM_HEDGE_AFTER = float(os.getenv("LLM_HEDGE_AFTER", "0"))
+LLM_HEDGE_MAX_PROMPT_CHARS = int(os.getenv("LLM_HEDGE_MAX_PROMPT_CHARS", "2000"))
+llm_resilience_stats = {}
+
+# ---------- Model Routing ----------
+# "auto" lets the router pick a model per request; set a model name to pin every call to it
+DEFAULT_MODEL = os.getenv("LLM_DEFAULT_MODEL", AUTO_MODEL)
+model_router = ModelRouter(
+    profiles=json.loads(os.getenv("LLM_MODEL_PROFILES", "null")),
+    task_policies=json.loads(os.getenv("LLM_ROUTER_TASK_POLICIES", "{}")),
+    latency_slo=float(os.getenv("LLM_ROUTER_LATENCY_SLO", "30")),
+    cost_budget=float(os.getenv("LLM_ROUTER_COST_BUDGET", "0.05")),
+    max_fallbacks=int(os.getenv("LLM_ROUTER_MAX_FALLBACKS", "1")),
+    penalty_seconds=float(os.getenv("LLM_ROUTER_PENALTY_SECONDS", "30")),
+)
+
+# ---------- Request Coalescing ----------
+# Identical concurrent calls share one upstream request; a leader's own admission rejection is not shared
+file_summary_flight = SingleFlight("file_summary", unshared_errors=(AdmissionRejected,))
+financial_insights_flight = SingleFlight("financial_insights", unshared_errors=(AdmissionRejected,))
+market_insights_flight = SingleFlight("market_insights", unshared_errors=(AdmissionRejected,))
+company_financials_flight = SingleFlight("company_financials")
+# Concurrent on-demand weekly PDF renders for one user
+weekly_report_flight = SingleFlight("weekly_report")
+SINGLE_FLIGHTS = (file_summary_flight, financial_insights_flight, market_insights_flight, company_financials_flight,
+                  weekly_report_flight)
+
+# ---------- Structured Output ----------
+# "json_object" requests the API's JSON mode; "prompt" relies on the prompt alone for models without it
+STRUCTURED_OUTPUT_MODE = os.getenv("STRUCTURED_OUTPUT_MODE", "json_object")
+STRUCTURED_REPAIR_MODEL = os.getenv("STRUCTURED_REPAIR_MODEL", "gpt-3.5-turbo")
+structured_output_stats = ParseFailureTracker()
+# Streaming endpoints report completed values up to this many levels deep (2 = each sector / list item)
+STREAM_FIELD_DEPTH = int(os.getenv("STREAM_FIELD_DEPTH", "2"))
+
+# Errors that already carry the right HTTP status and must not become a generic 500
+PASSTHROUGH_ERRORS = (HTTPException, AdmissionRejected, LLMUpstreamError)
+
+@app.exception_handler(AdmissionRejected)
+async def admission_rejected_handler(request: Request, exc: AdmissionRejected):
+    return JSONResponse(
+        {"detail": exc.detail},
+        status_code=exc.status_code,
+        headers={"Retry-After": str(exc.retry_after)}
+    )
+
+@app.exception_handler(LLMUpstreamError)
+async def llm_upstream_error_handler(request: Request, exc: LLMUpstreamError):
+    headers = {"Retry-After": str(exc.retry_after)} if exc.retry_after else None
+    return JSONResponse({"detail": exc.detail}, status_code=exc.status_code, headers=headers)
+
+# ---------- Upload Limits ----------
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_MB", "25")) * 1024 * 1024
+MAX_BULK_UPLOAD_BYTES = int(os.getenv("MAX_BULK_UPLOAD_MB", "500")) * 1024 * 1024
+BULK_UPLOAD_PATHS = ("/openai/summarize-files/jobs",)
+
+@app.middleware("http")
+async def reject_oversized_uploads(request: Request, call_next):
+    """Refuse oversized bodies from Content-Length before the multipart form is parsed"""
+    if request.method == "POST":
+        length = request.headers.get("content-length")
+        if length and length.isdigit():
+            limit = MAX_BULK_UPLOAD_BYTES if request.url.path in BULK_UPLOAD_PATHS else MAX_UPLOAD_BYTES + 1024 * 1024
+            if int(length) > limit:
+                return JSONResponse(
+                    {"detail": f"Request body exceeds the maximum upload size of {limit // (1024 * 1024)} MB"},
+                    status_code=413
+                )
+    return await call_next(request)
+
+# ---------- Request Profiling ----------
+# Added after the other middleware, so it times the whole request. Only the usage ledger's
+# context middleware, which just sets a context variable, is added later and wraps it.
+request_profiler = RequestProfiler(
+    capacity=int(os.getenv("PROFILE_RING_SIZE", "50")),
+    slow_ms=float(os.getenv("PROFILE_SLOW_MS", "8000")),
+    sample_interval=float(os.getenv("PROFILE_SAMPLE_INTERVAL_MS", "10")) / 1000,
+    exclude=("/openai/profiling",),
+)
+if os.getenv("PROFILING", "true").lower() == "true":
+    app.add_middleware(ProfilingMiddleware, profiler=request_profiler)
+
+@app.on_event("shutdown")
+async def stop_request_profiler():
+    request_profiler.stop()
+
+# ---------- Admin Access ----------
+# Admin endpoints are refused unless ADMIN_TOKEN is set and sent back in the X-Admin-Token header
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+def require_admin(request: Request):
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Admin endpoints are disabled. Set ADMIN_TOKEN to enable them.")
+    token = request.headers.get("x-admin-token", "")
+    if not hmac.compare_digest(token.encode("utf-8"), ADMIN_TOKEN.encode("utf-8")):
+        raise HTTPException(status_code=403, detail="A valid X-Admin-Token header is required")
 
 # ---------- MongoDB Connection ----------
 mongo_uri = os.getenv("MONGO_URI", "mongodb://localhost:27017/")
@@ -55,8 +258,14 @@ try:
     users_collection = db["users"]
     chat_sessions_collection = db["chat_sessions"]  # New collection name
     chat_messages_collection = db["chat_messages"]  # New collection name
+    chat_message_buckets_collection = db["chat_message_buckets"]  # Messages grouped per session and time window
+    chat_messages_archive_collection = db["chat_messages_archive"]  # Compressed messages of idle sessions
     documents_collection = db["documents"]  # New collection for uploaded files
+    document_chunks_collection = db["document_chunks"]  # Text of embedded document chunks
     file_summaries_collection = db["file_summaries"]  # New collection for file summaries
+    summary_jobs_collection = db["summary_jobs"]  # Finished bulk summarization jobs
+    weekly_reports_collection = db["weekly_reports"]  # Current pre-generated weekly PDF per user
+    weekly_report_runs_collection = db["weekly_report_runs"]  # One document per pre-generation run
 except Exception as e:
     print(f"MongoDB Connection Error: {e}")
     print("Please ensure MongoDB is running and MONGO_URI is set correctly in your .env file")
@@ -67,8 +276,221 @@ except Exception as e:
     users_collection = None
     chat_sessions_collection = None
     chat_messages_collection = None
+    chat_message_buckets_collection = None
+    chat_messages_archive_collection = None
     documents_collection = None
+    document_chunks_collection = None
     file_summaries_collection = None
+    summary_jobs_collection = None
+    weekly_reports_collection = None
+    weekly_report_runs_collection = None
+
+# ---------- Message Storage ----------
+# "document" stores one document per message, "bucket" groups them; reads handle both
+MESSAGE_STORAGE = os.getenv("MESSAGE_STORAGE", DOCUMENT)
+# "off", "mongo" (compressed cold collection) or "file" (gzipped files under MESSAGE_ARCHIVE_DIR)
+MESSAGE_ARCHIVE = os.getenv("MESSAGE_ARCHIVE", "off")
+MESSAGE_ARCHIVE_DIR = os.getenv("MESSAGE_ARCHIVE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "message_archive"))
+MESSAGE_ARCHIVE_AFTER_DAYS = float(os.getenv("MESSAGE_ARCHIVE_AFTER_DAYS", "90"))
+# Hours between archival runs; 0 leaves archival to POST /openai/messages/archive
+MESSAGE_ARCHIVE_INTERVAL_HOURS = float(os.getenv("MESSAGE_ARCHIVE_INTERVAL_HOURS", "0"))
+MESSAGE_ARCHIVE_BATCH = int(os.getenv("MESSAGE_ARCHIVE_BATCH", "500"))
+
+if chat_messages_collection is not None:
+    if MESSAGE_ARCHIVE == "mongo":
+        message_archive = MongoArchive(chat_messages_archive_collection)
+    elif MESSAGE_ARCHIVE == "file":
+        message_archive = FileArchive(MESSAGE_ARCHIVE_DIR)
+    else:
+        message_archive = None
+    message_store = MessageStore(
+        chat_messages_collection,
+        buckets=chat_message_buckets_collection,
+        archive=message_archive,
+        mode=MESSAGE_STORAGE,
+        bucket_size=int(os.getenv("MESSAGE_BUCKET_SIZE", "100")),
+        bucket_span=timedelta(hours=float(os.getenv("MESSAGE_BUCKET_HOURS", "24"))),
+        bucket_max_bytes=int(os.getenv("MESSAGE_BUCKET_MAX_KB", "1024")) * 1024
+    )
+else:
+    message_store = None
+
+# ---------- Database Indexes ----------
+@app.on_event("startup")
+def ensure_indexes():
+    """Create the indexes the read paths rely on (no-op when they already exist)"""
+    if db is None:
+        return
+    try:
+        file_summaries_collection.create_index(
+            [("user_id", ASCENDING), ("created_at", DESCENDING)],
+            name="user_created_at"
+        )
+        # Compound text index: every $text query is scoped to one user via the equality prefix
+        file_summaries_collection.create_index(
+            [
+                ("user_id", ASCENDING),
+                ("summary.input_summary", TEXT),
+                ("summary.client_name", TEXT),
+                ("summary.vertical", TEXT),
+                ("summary.client_region", TEXT),
+            ],
+            name="user_summary_text",
+            weights={
+                "summary.client_name": 5,
+                "summary.vertical": 3,
+                "summary.client_region": 3,
+                "summary.input_summary": 1,
+            },
+            default_language="english"
+        )
+        # Lookup key of the summary backfill's upserts
+        file_summaries_collection.create_index(
+            [("user_id", ASCENDING), ("file_sha256", ASCENDING)],
+            name="user_sha256"
+        )
+        # Newest modification of a user's summaries, for conditional GETs
+        file_summaries_collection.create_index(
+            [("user_id", ASCENDING), ("updated_at", DESCENDING)],
+            name="user_updated_at"
+        )
+        chat_sessions_collection.create_index("session_id", name="session_id")
+        message_store.ensure_indexes()
+        # Finds idle sessions for archival
+        chat_sessions_collection.create_index("last_updated", name="last_updated")
+        # Covers the sidebar's session listing: the query never touches the session documents
+        chat_sessions_collection.create_index(
+            [("user_id", ASCENDING), ("last_updated", DESCENDING)] + [(field, ASCENDING) for field in SESSION_LIST_FIELDS],
+            name="user_session_list"
+        )
+        documents_collection.create_index("document_id", name="document_id", unique=True)
+        document_chunks_collection.create_index("chunk_id", name="chunk_id", unique=True)
+        document_chunks_collection.create_index("document_id", name="document_id")
+        weekly_report_store.ensure_indexes()
+    except Exception as e:
+        print(f"Error creating indexes: {e}")
+    try:
+        # One document per user and file, so concurrent uploads of the same file can't both be ingested;
+        # an older non-unique index of the same name is replaced
+        existing_index = documents_collection.index_information().get("user_sha256")
+        if existing_index and not existing_index.get("unique"):
+            documents_collection.drop_index("user_sha256")
+        documents_collection.create_index(
+            [("user_id", ASCENDING), ("file_sha256", ASCENDING)],
+            name="user_sha256",
+            unique=True
+        )
+    except Exception as e:
+        print(f"Error creating the unique document hash index (remove duplicate uploads first): {e}")
+
+# ---------- Dependency Health ----------
+HEALTH_PROBE_TIMEOUT = float(os.getenv("HEALTH_PROBE_TIMEOUT", "5"))
+health_monitor = HealthMonitor(
+    interval=float(os.getenv("HEALTH_CHECK_INTERVAL", "15")),
+    probe_timeout=HEALTH_PROBE_TIMEOUT,
+    failure_threshold=int(os.getenv("HEALTH_FAILURE_THRESHOLD", "2"))
+)
+
+def probe_mongo():
+    if client is None:
+        raise RuntimeError("MongoDB client not initialized")
+    with mongo_timeout(HEALTH_PROBE_TIMEOUT):
+        client.admin.command('ping')
+
+def probe_openai():
+    if openai_client is None:
+        raise RuntimeError("OPENAI_API_KEY not configured")
+    openai_client.models.list(timeout=HEALTH_PROBE_TIMEOUT)
+    open_breakers = [name for name, breaker in llm_breakers.snapshot().items() if breaker["state"] == "open"]
+    return {"open_circuit_breakers": open_breakers}
+
+def probe_pdf_renderer():
+    if not HTML(string="<p>health check</p>").write_pdf().startswith(b"%PDF"):
+        raise RuntimeError("Renderer did not produce a PDF")
+
+# Only the database is required to serve traffic; without the others the API runs degraded
+health_monitor.register("mongo", probe_mongo, critical=True)
+health_monitor.register("openai", probe_openai, critical=False, interval=float(os.getenv("HEALTH_OPENAI_INTERVAL", "30")))
+health_monitor.register("pdf_renderer", probe_pdf_renderer, critical=False, interval=float(os.getenv("HEALTH_PDF_INTERVAL", "60")))
+
+@app.on_event("startup")
+def start_health_monitor():
+    health_monitor.check_now("mongo")
+    health_monitor.start()
+
+@app.on_event("shutdown")
+def stop_health_monitor():
+    health_monitor.stop()
+
+def require_database(collection):
+    """Fail fast from cached health state instead of pinging the database per request"""
+    if collection is None:
+        raise HTTPException(status_code=500, detail="Database not connected. Please ensure MongoDB is running and MONGO_URI is set correctly.")
+    if health_monitor.is_down("mongo"):
+        raise HTTPException(status_code=503, detail="Database is currently unavailable, please retry shortly",
+                            headers={"Retry-After": str(int(health_monitor.interval))})
+
+# ---------- Usage Ledger ----------
+# Every OpenAI call is recorded with its tokens, cost and latency; writes are batched by a flusher thread
+USAGE_LEDGER = os.getenv("USAGE_LEDGER", "true").lower() == "true"
+# Ask the API for a final usage chunk on streamed calls; without it streamed usage is estimated
+LLM_STREAM_USAGE = os.getenv("LLM_STREAM_USAGE", "true").lower() == "true"
+# Embedding models have no routing profile, so their price is configured here (USD per 1K tokens)
+EMBEDDING_COST_PER_1K = float(os.getenv("EMBEDDING_COST_PER_1K", "0.00002"))
+
+def usage_price(model, prompt_tokens, completion_tokens):
+    if model == EMBEDDING_MODEL:
+        return prompt_tokens * EMBEDDING_COST_PER_1K / 1000.0
+    return model_router.cost(model, prompt_tokens, completion_tokens)
+
+if USAGE_LEDGER and db is not None:
+    usage_ledger = UsageLedger(
+        db["llm_usage"] if os.getenv("USAGE_KEEP_RECORDS", "true").lower() == "true" else None,
+        db["llm_usage_counters"],
+        price=usage_price,
+        flush_interval=float(os.getenv("USAGE_FLUSH_SECONDS", "2")),
+        max_batch=int(os.getenv("USAGE_FLUSH_BATCH", "500")),
+        max_buffer=int(os.getenv("USAGE_MAX_BUFFER", "50000")),
+        retention_days=int(os.getenv("USAGE_RETENTION_DAYS", "30"))
+    )
+    app.add_middleware(UsageContextMiddleware)
+else:
+    usage_ledger = None
+
+@app.on_event("startup")
+def start_usage_ledger():
+    if usage_ledger is None:
+        return
+    try:
+        usage_ledger.ensure_indexes()
+    except Exception as e:
+        print(f"Error creating usage ledger indexes: {e}")
+    usage_ledger.start()
+
+@app.on_event("shutdown")
+def stop_usage_ledger():
+    # Final flush, so buffered usage is not lost on a clean restart
+    if usage_ledger is not None:
+        usage_ledger.stop()
+
+def record_llm_usage(model, messages, usage, latency, user_id=None, task=None, streamed=False, output_chars=0,
+                     error=None):
+    """Put one call in the ledger; token counts are estimated when the API returned none"""
+    if usage_ledger is None:
+        return
+    # A call that failed before producing output is recorded with zero tokens
+    estimated = usage is None and (error is None or output_chars > 0)
+    if usage is not None:
+        prompt_tokens = usage.prompt_tokens
+        completion_tokens = getattr(usage, "completion_tokens", 0)
+    elif estimated:
+        prompt_tokens = estimate_message_tokens(messages)
+        completion_tokens = output_chars // 4 + 1 if output_chars else 0
+    else:
+        prompt_tokens = completion_tokens = 0
+    usage_ledger.record(model, prompt_tokens, completion_tokens, latency, user_id=user_id, task=task,
+                        streamed=streamed, estimated=estimated,
+                        error=type(error).__name__ if error is not None else None)
 
 # ---------- Models ----------
 class UserDetails(BaseModel):
@@ -90,6 +512,9 @@ class ChatSession(BaseModel):
     created_at: datetime
     last_updated: datetime
     model_used: str = "gpt-3.5-turbo"
+    message_count: int = 0
+    last_message_preview: Optional[str] = None
+    last_model: Optional[str] = None
 
 class SessionCreate(BaseModel):
     cognitoId: str
@@ -107,82 +532,508 @@ class ChatMessage(BaseModel):
     timestamp: datetime
     model_used: str
 
-class FileSummary(BaseModel):
-    user_name: str
-    input_summary: str
-    client_name: str
-    client_region: str
-    vertical: str
-    feedback: str
-    project_status: str
+def coerce_text(value):
+    """Models sometimes answer a text field with a list of points or a bare number"""
+    if isinstance(value, list):
+        return "\n".join(f"• {item}" for item in value)
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return str(value)
+    return value
+
+Text = Annotated[str, BeforeValidator(coerce_text)]
+
+class FileSummaryFields(BaseModel):
+    """What the model extracts from a document"""
+    user_name: Text = "Unknown"
+    input_summary: Text
+    client_name: Text = "Unknown"
+    client_region: Text = "Unknown"
+    vertical: Text = "Unknown"
+    feedback: Text = "Neutral"
+    project_status: Text = "Unknown"
+
+class FileSummary(FileSummaryFields):
     timestamp: datetime
 
+class GrowthMetrics(BaseModel):
+    revenue_growth: Text = "Unknown"
+    profit_margin: Text = "Unknown"
+    debt_ratio: Text = "Unknown"
+    liquidity: Text = "Unknown"
+
+class ChartsData(BaseModel):
+    revenue_trend: Text = "Unknown"
+    profitability: Text = "Unknown"
+    cash_flow: Text = "Unknown"
+
+class FinancialInsights(BaseModel):
+    insights: Text
+    recommendations: Text
+    risk_assessment: Text
+    growth_metrics: GrowthMetrics = Field(default_factory=GrowthMetrics)
+    charts_data: ChartsData = Field(default_factory=ChartsData)
+    innovation_ideas: Text = ""
+    current_trends: Text = ""
+    market_position: Text = ""
+    competitive_analysis: Text = ""
+
+class SectorInsight(BaseModel):
+    trends: List[str] = []
+    opportunities: List[str] = []
+    challenges: List[str] = []
+    key_players: List[str] = []
+
+class EmergingTrend(BaseModel):
+    title: Text
+    description: Text = ""
+    impact: Text = ""
+    sector: Text = ""
+
+class MarketOpportunity(BaseModel):
+    title: Text
+    description: Text = ""
+    potential: Text = ""
+    timeline: Text = ""
+
+class MarketInsights(BaseModel):
+    sector_insights: Dict[str, SectorInsight]
+    emerging_trends: List[EmergingTrend]
+    market_opportunities: List[MarketOpportunity]
+
+class ProfilingConfig(BaseModel):
+    sample_rate: float = Field(0.0, ge=0, le=1)  # Share of all requests to profile
+    routes: List[str] = []  # Paths whose every request is profiled; a trailing * matches a prefix
+    mode: str = "stack"  # "stack" samples stacks; "cprofile" also runs cProfile (one request at a time)
+    duration_minutes: float = Field(15, gt=0, le=24 * 60)  # Profiling switches itself off after this
+    slow_ms: Optional[float] = Field(None, ge=0)  # New slow-request threshold; 0 stops slow capture
+
 # ---------- Utilities ----------
 def serialize_mongo_doc(doc):
     return json.loads(json_util.dumps(doc))
 
-def extract_text_from_file(file: UploadFile):
+SUPPORTED_CONTENT_TYPES = (TEXT_PLAIN, PDF, DOCX)
+
+def check_conditional(request: Request, validator, last_modified=None):
+    """(validator headers, 304 response or None) for a conditional GET"""
+    etag = make_etag(*validator)
+    headers = validator_headers(etag, last_modified)
+    if is_not_modified(request.headers, etag, last_modified):
+        return headers, Response(status_code=304, headers=headers)
+    return headers, None
+
+def extract_text(stream, content_type):
+    """Extract text from a binary stream of a supported document type"""
     try:
-        if file.content_type == "text/plain":
-            return file.file.read().decode("utf-8")
-        elif file.content_type == "application/pdf":
-            reader = PdfReader(file.file)
+        if content_type == TEXT_PLAIN:
+            data = stream.read()
+            try:
+                return data.decode("utf-8-sig")
+            except UnicodeDecodeError:
+                # Text accepted on its declared type is usually Windows-1252 / Latin-1
+                return data.decode("cp1252", errors="replace")
+        elif content_type == PDF:
+            reader = PdfReader(stream)
             return "".join([page.extract_text() or "" for page in reader.pages])
-        elif file.content_type == "application/vnd.openxmlformats-officedocument.wordprocessingml.document":
-            doc = docx.Document(file.file)
+        elif content_type == DOCX:
+            doc = docx.Document(stream)
             return "".join([para.text for para in doc.paragraphs])
         else:
             raise HTTPException(status_code=415, detail="Unsupported file type")
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"File processing error: {str(e)}")
 
-def query_openai(prompt, model="gpt-3.5-turbo", temperature=0.7, max_tokens=1500):
+def ingest_upload(file: UploadFile):
+    """Size-check, hash and sniff the upload where Starlette spooled it, without a second copy"""
     try:
-        if not openai_client:
-            raise HTTPException(status_code=500, detail="OpenAI API key not configured. Please set OPENAI_API_KEY in your .env file.")
-        
-        response = openai_client.chat.completions.create(
+        return inspect_upload(file.file, file.filename, MAX_UPLOAD_BYTES, declared_type=file.content_type)
+    except UploadTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+
+@stage("upload")
+def read_upload(file: UploadFile):
+    """Return (document_text, upload) for an uploaded file; the spooled file is closed afterwards"""
+    with ingest_upload(file) as upload:
+        if upload.content_type not in SUPPORTED_CONTENT_TYPES:
+            raise HTTPException(status_code=415, detail="Unsupported file type. Please upload a PDF, DOCX or TXT file.")
+        return extract_text(upload.file, upload.content_type), upload
+
+def acquire_llm_slot(user_id, model, priority=PRIORITY_CHAT):
+    """Admit an OpenAI call; raises AdmissionRejected (429/503) when over limits"""
+    if not openai_client:
+        raise HTTPException(status_code=500, detail="OpenAI API key not configured. Please set OPENAI_API_KEY in your .env file.")
+    with stage("admission"):
+        return llm_admission.acquire(user_id, model, priority)
+
+def mark_fallback(data, reason):
+    """Flag canned content so callers never mistake it for a model answer"""
+    data["is_fallback"] = True
+    data["fallback_reason"] = reason
+    return data
+
+def fallback_reason(exc):
+    return "upstream_error" if isinstance(exc, LLMUpstreamError) else "error"
+
+def call_openai_resilient(messages, model, temperature, max_tokens, stream=False, hedge=False, deadline=None,
+                          response_format=None, user_id=None, task=None):
+    """Call the chat completions API with retries, optional hedging and a per-model circuit breaker.
+
+    Each call is recorded in the usage ledger; a stream is recorded when it has been read to the end or closed.
+    """
+    extra = {"response_format": response_format} if response_format else {}
+    if stream and LLM_STREAM_USAGE:
+        extra["stream_options"] = {"include_usage": True}
+
+    def attempt(timeout):
+        return openai_client.chat.completions.create(
             model=model,
-            messages=[
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            stream=stream,
+            timeout=timeout,
+            **extra
+        )
+
+    hedge_after = None
+    if hedge and not stream and LLM_HEDGE_AFTER > 0:
+        if sum(len(m.get("content") or "") for m in messages) <= LLM_HEDGE_MAX_PROMPT_CHARS:
+            hedge_after = LLM_HEDGE_AFTER
+
+    started = time.monotonic()
+    try:
+        with stage("llm"):
+            response = call_with_resilience(
+                attempt,
+                deadline or LLM_CALL_DEADLINE,
+                retry_policy=llm_retry_policy,
+                breaker=llm_breakers.get(model),
+                hedge_after=hedge_after,
+                stats=llm_resilience_stats
+            )
+    except Exception as e:
+        record_llm_usage(model, messages, None, time.monotonic() - started, user_id, task, stream, error=e)
+        raise
+    if stream:
+        return MeteredStream(response, lambda usage, output_chars, error: record_llm_usage(
+            model, messages, usage, time.monotonic() - started, user_id, task, True, output_chars, error))
+    usage = getattr(response, "usage", None)
+    output_chars = 0 if usage else sum(len(choice.message.content or "") for choice in response.choices)
+    record_llm_usage(model, messages, usage, time.monotonic() - started, user_id, task, output_chars=output_chars)
+    return response
+
+def create_chat_completion(messages, model="gpt-3.5-turbo", temperature=0.7, max_tokens=1500,
+                           user_id=None, priority=PRIORITY_CHAT, hedge=False, response_format=None, deadline=None,
+                           task=None):
+    """Single entry point for non-streaming chat completions"""
+    with acquire_llm_slot(user_id, model, priority):
+        return call_openai_resilient(messages, model, temperature, max_tokens, hedge=hedge, deadline=deadline,
+                                     response_format=response_format, user_id=user_id, task=task)
+
+def route_model(task, messages, max_tokens, model=AUTO_MODEL):
+    """Routing decision for a call; an explicitly requested model is used as-is"""
+    prompt_tokens = estimate_message_tokens(messages)
+    if model and model != AUTO_MODEL:
+        return model_router.pinned(task, model, prompt_tokens, max_tokens)
+    return model_router.route(task, prompt_tokens, max_tokens,
+                              available=lambda name: not llm_breakers.get(name).is_open())
+
+def is_fallback_worthy(exc):
+    """Capacity rejections, rate limits, timeouts and provider errors may succeed on another model"""
+    if isinstance(exc, AdmissionRejected):
+        # 429 is the caller's own rate limit, which applies to every model
+        return exc.status_code == 503
+    return isinstance(exc, LLMUpstreamError)
+
+def create_routed_completion(messages, task=None, model=AUTO_MODEL, temperature=0.7, max_tokens=1500,
+                             user_id=None, priority=PRIORITY_CHAT, hedge=False, response_format=None):
+    """Chat completion on the routed model, falling back to the next candidate when it is rate-limited or slow.
+
+    Returns (response, model_used).
+    """
+    decision = route_model(task, messages, max_tokens, model)
+    candidates = decision.candidates
+    for i, candidate in enumerate(candidates):
+        last = i == len(candidates) - 1
+        started = time.monotonic()
+        try:
+            # While another candidate remains, give up on a model too slow for even a full-length answer
+            response = create_chat_completion(
+                messages,
+                model=candidate,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                user_id=user_id,
+                priority=priority,
+                hedge=hedge,
+                response_format=response_format,
+                deadline=None if last else model_router.attempt_deadline(decision, candidate),
+                task=task
+            )
+        except (AdmissionRejected, LLMUpstreamError) as e:
+            if not is_fallback_worthy(e):
+                raise
+            model_router.record_failure(decision, candidate, f"{type(e).__name__}:{e.status_code}")
+            if last:
+                raise
+            print(f"Model {candidate} failed with {e.status_code}; falling back to {candidates[i + 1]}")
+            continue
+        usage = getattr(response, "usage", None)
+        model_router.record_success(decision, candidate, time.monotonic() - started,
+                                    getattr(usage, "completion_tokens", None))
+        return response, candidate
+
+def acquire_routed_slot(decision, user_id, priority=PRIORITY_CHAT):
+    """Admit a streaming call on the first candidate model with capacity; returns (ticket, model)"""
+    candidates = decision.candidates
+    for i, candidate in enumerate(candidates):
+        try:
+            return acquire_llm_slot(user_id, candidate, priority), candidate
+        except AdmissionRejected as e:
+            if not is_fallback_worthy(e):
+                raise
+            model_router.record_failure(decision, candidate, f"AdmissionRejected:{e.status_code}")
+            if i == len(candidates) - 1:
+                raise
+
+def record_stream_failure(decision, model, exc):
+    """A stream that failed to open or died partway penalizes its model, like a failed routed completion"""
+    model_router.record_failure(decision, model, f"{type(exc).__name__}:{getattr(exc, 'status_code', 'stream')}")
+
+def structured_response_format():
+    return {"type": "json_object"} if STRUCTURED_OUTPUT_MODE == "json_object" else None
+
+def repair_structured_output(output_model, content, error, max_tokens, user_id=None, priority=PRIORITY_CHAT):
+    """One cheap call that fixes invalid JSON against the schema; returns the raw text"""
+    response = create_chat_completion(
+        [
+            {"role": "system", "content": "You fix malformed JSON so it matches a schema. Return only JSON."},
+            {"role": "user", "content": repair_prompt(content, error, output_model)}
+        ],
+        model=STRUCTURED_REPAIR_MODEL,
+        temperature=0,
+        max_tokens=max_tokens,
+        user_id=user_id,
+        priority=priority,
+        response_format=structured_response_format(),
+        task="structured_repair"
+    )
+    return response.choices[0].message.content or ""
+
+def create_structured_completion(call_site, output_model, messages, model=AUTO_MODEL, temperature=0.3,
+                                 max_tokens=1500, user_id=None, priority=PRIORITY_CHAT):
+    """One JSON-mode call validated against `output_model`, with a single cheap repair call on failure.
+
+    Raises StructuredOutputError when the output is still invalid after the repair.
+    """
+    def request():
+        response, _ = create_routed_completion(messages, task=call_site, model=model, temperature=temperature,
+                                               max_tokens=max_tokens, user_id=user_id, priority=priority,
+                                               response_format=structured_response_format())
+        return response.choices[0].message.content or ""
+
+    def repair(content, error):
+        return repair_structured_output(output_model, content, error, max_tokens, user_id, priority)
+
+    return generate_structured(call_site, output_model, request, repair=repair, tracker=structured_output_stats)
+
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+def sse_event(payload):
+    return f"data: {json.dumps(payload, default=str)}\n\n"
+
+def stream_structured_completion(call_site, output_model, messages, decision, model, ticket, fallback,
+                                 temperature=0.3, max_tokens=1500, user_id=None, priority=PRIORITY_CHAT,
+                                 on_result=None):
+    """Server-sent events for a streamed JSON-mode completion.
+
+    Emits {"type": "partial"} text deltas for the string field being written, {"type": "field"}
+    for each value completed up to STREAM_FIELD_DEPTH levels deep, then a single {"type": "done"}
+    with the validated result, or flagged content from fallback(reason, error).
+    """
+    parser = IncrementalJSONParser(max_depth=STREAM_FIELD_DEPTH)
+    sent = {}
+    content = ""
+    try:
+        try:
+            started = time.monotonic()
+            # Retries only cover opening the stream; tokens already sent can't be replayed
+            response = call_openai_resilient(messages, model, temperature, max_tokens, stream=True,
+                                             response_format=structured_response_format(),
+                                             user_id=user_id, task=call_site)
+            for chunk in response:
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if not delta:
+                    continue
+                content += delta
+                for path, value in parser.feed(delta):
+                    yield sse_event({"type": "field", "path": list(path), "value": value})
+                partial = parser.partial()
+                if partial:
+                    path, text = partial
+                    if len(text) > sent.get(path, 0):
+                        yield sse_event({"type": "partial", "path": list(path), "delta": text[sent.get(path, 0):]})
+                        sent[path] = len(text)
+            model_router.record_success(decision, model, time.monotonic() - started, estimate_tokens(content))
+        except Exception as e:
+            record_stream_failure(decision, model, e)
+            raise
+        finally:
+            # Free the slot before a repair call, which is admitted on its own
+            ticket.release()
+
+        result = generate_structured(
+            call_site,
+            output_model,
+            lambda: content,
+            repair=lambda raw, error: repair_structured_output(output_model, raw, error, max_tokens, user_id, priority),
+            tracker=structured_output_stats
+        )
+        data = result.model_dump()
+        data["is_fallback"] = False
+    except StructuredOutputError as e:
+        print(f"JSON parsing error: {e}")
+        data = fallback("parse_error", e)
+    except Exception as e:
+        print(f"Error streaming {call_site}: {e}")
+        data = fallback(fallback_reason(e), e)
+    if on_result:
+        data = on_result(data)
+    yield sse_event({"type": "done", "result": data, "is_fallback": data.get("is_fallback", False)})
+
+def query_openai(prompt, model=AUTO_MODEL, temperature=0.7, max_tokens=1500, user_id=None, priority=PRIORITY_CHAT,
+                 task=None):
+    """Returns (answer, model_used)"""
+    try:
+        response, model_used = create_routed_completion(
+            [
                 {"role": "system", "content": "You are a helpful AI assistant."},
                 {"role": "user", "content": prompt}
             ],
+            task=task,
+            model=model,
             temperature=temperature,
-            max_tokens=max_tokens
+            max_tokens=max_tokens,
+            user_id=user_id,
+            priority=priority,
+            hedge=True
         )
-        return response.choices[0].message.content.strip()
+        return response.choices[0].message.content.strip(), model_used
+    except PASSTHROUGH_ERRORS:
+        raise
     except Exception as e:
         print("Error calling OpenAI:", e)
         raise HTTPException(status_code=500, detail="Failed to query OpenAI model")
 
-def map_input_to_task(text):
-    """Map input text to specific task type"""
-    text = text.lower()
-    
-    # Business Analyst patterns
-    ba_patterns = [
-        r"user story",
-        r"acceptance criteria",
-        r"business requirement",
-        r"convert.*requirement",
-        r"create.*user story"
-    ]
-    
-    # Check for Business Analyst patterns
-    for pattern in ba_patterns:
-        if re.search(pattern, text):
-            return "Business Analyst"
+# ---------- Intent Classification ----------
+def load_intent_classifier(path):
+    if not path:
+        return None
+    try:
+        return IntentClassifier.load(path)
+    except Exception as e:
+        print(f"Intent classifier not loaded from {path}: {e}")
+        return None
+
+intent_engine = IntentEngine(
+    # Extra rules: a JSON list of {"intent", "pattern", "weight"}; patterns are lowercase and start at a word
+    rules=DEFAULT_RULES + json.loads(os.getenv("INTENT_RULES", "[]")),
+    classifier=load_intent_classifier(os.getenv("INTENT_MODEL_PATH")),
+    min_confidence=float(os.getenv("INTENT_MIN_CONFIDENCE", "0.6")),
+    direct_max_words=int(os.getenv("INTENT_DIRECT_MAX_WORDS", "16")),
+)
+# Requests for the user's own data ("show my summaries this week") are answered without a model call
+INTENT_DIRECT_ANSWERS = os.getenv("INTENT_DIRECT_ANSWERS", "true").lower() == "true"
+DIRECT_ANSWER_MODEL = "local"
+DIRECT_ANSWER_LIMIT = 20
+
+def period_phrase(window):
+    if window is None:
+        return ""
+    label = window[0]
+    if label.startswith("past") or (label.startswith("last") and any(c.isdigit() for c in label)):
+        return f" from the {label}"
+    return f" from {label}"
+
+def plural(count, singular, plural_form):
+    return f"{count} {singular if count == 1 else plural_form}"
+
+def summaries_answer(intent, user_id):
+    query = {"user_id": user_id}
+    if intent.window:
+        query["created_at"] = {"$gte": intent.window[1], "$lt": intent.window[2]}
+    period = period_phrase(intent.window)
+    if intent.name == SUMMARY_COUNT:
+        count = file_summaries_collection.count_documents(query)
+        return f"You have {plural(count, 'summary', 'summaries')}{period}."
     
-    # Default to general assistant
-    return "General Assistant"
+    summaries = list(file_summaries_collection.find(
+        query,
+        {"_id": 0, "file_name": 1, "created_at": 1, "summary.client_name": 1, "summary.project_status": 1}
+    ).sort("created_at", DESCENDING).limit(DIRECT_ANSWER_LIMIT))
+    if not summaries:
+        return f"You have no summaries{period}."
+    total = len(summaries)
+    if total == DIRECT_ANSWER_LIMIT:
+        total = file_summaries_collection.count_documents(query)
+    lines = [f"You have {plural(total, 'summary', 'summaries')}{period}:"]
+    for doc in summaries:
+        summary = doc.get("summary") or {}
+        created_at = doc.get("created_at")
+        day = created_at.strftime("%Y-%m-%d") if isinstance(created_at, datetime) else "unknown date"
+        lines.append(f"- {day}: {doc.get('file_name') or 'Untitled'} "
+                     f"(client: {summary.get('client_name') or 'Unknown'}, status: {summary.get('project_status') or 'Unknown'})")
+    if total > len(summaries):
+        lines.append(f"\nShowing the {len(summaries)} most recent; the Summary Dashboard lists them all.")
+    return "\n".join(lines)
 
-def generate_file_summary(document_text):
-    """Generate file summary in the required JSON format"""
+def documents_answer(intent, user_id):
+    query = {"user_id": user_id}
+    if intent.window:
+        query["created_at"] = {"$gte": intent.window[1], "$lt": intent.window[2]}
+    period = period_phrase(intent.window)
+    documents = list(documents_collection.find(
+        query,
+        {"_id": 0, "file_name": 1, "created_at": 1, "chunk_count": 1}
+    ).sort("created_at", DESCENDING).limit(DIRECT_ANSWER_LIMIT))
+    if not documents:
+        return f"You have not uploaded any documents{period}."
+    lines = [f"Your {'most recent ' if len(documents) == DIRECT_ANSWER_LIMIT else ''}documents{period}:"]
+    for doc in documents:
+        created_at = doc.get("created_at")
+        day = created_at.strftime("%Y-%m-%d") if isinstance(created_at, datetime) else "unknown date"
+        lines.append(f"- {day}: {doc.get('file_name') or 'Untitled'}")
+    return "\n".join(lines)
+
+@stage("direct_answer")
+def direct_answer(intent, user_id):
+    """Answer a database intent from the user's data; None leaves the message to the model"""
+    collection = documents_collection if intent.name == DOCUMENT_LIST else file_summaries_collection
+    if collection is None or health_monitor.is_down("mongo"):
+        return None
     try:
-        if not openai_client:
-            raise HTTPException(status_code=500, detail="OpenAI API key not configured. Please set OPENAI_API_KEY in your .env file.")
-        
-        prompt = f"""Analyze the following document and extract key information. Return ONLY a JSON object in this exact format:
+        if intent.name == DOCUMENT_LIST:
+            return documents_answer(intent, user_id)
+        return summaries_answer(intent, user_id)
+    except Exception as e:
+        print(f"Error answering {intent.name} from the database: {e}")
+        return None
+
+async def answer_locally(intent, session_id, user_id, message):
+    """Answer a database intent and store the turn; None when the message should go to a model"""
+    if intent is None or not intent.direct or not INTENT_DIRECT_ANSWERS:
+        return None
+    response = await run_in_threadpool(direct_answer, intent, user_id)
+    if response is None:
+        return None
+    await run_in_threadpool(save_chat_message, session_id, user_id, "user", message, DIRECT_ANSWER_MODEL)
+    await run_in_threadpool(save_chat_message, session_id, user_id, "assistant", response, DIRECT_ANSWER_MODEL)
+    background_executor.submit(update_rolling_summary, session_id, user_id)
+    return response
+
+def file_summary_messages(document_text):
+    prompt = f"""Analyze the following document and extract key information. Return ONLY a JSON object in this exact format:
 
 {{
     "user_name": "extracted user name or 'Unknown'",
@@ -198,95 +1049,127 @@ Document content:
 {document_text}
 
 Important: Return ONLY the JSON object, no additional text or explanations."""
+    return [
+        {"role": "system", "content": "You are a document analysis expert. Extract key information and return it in the exact JSON format specified."},
+        {"role": "user", "content": prompt}
+    ]
 
-        response = openai_client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": "You are a document analysis expert. Extract key information and return it in the exact JSON format specified."},
-                {"role": "user", "content": prompt}
-            ],
+def file_summary_fallback(input_summary, reason):
+    return mark_fallback({
+        "user_name": "Unknown",
+        "input_summary": input_summary,
+        "client_name": "Unknown",
+        "client_region": "Unknown",
+        "vertical": "Unknown",
+        "feedback": "Neutral",
+        "project_status": "Unknown",
+        "timestamp": datetime.utcnow().isoformat()
+    }, reason)
+
+def file_summary_flight_key(document_text, user_id=None, priority=PRIORITY_SUMMARIZE):
+    """User, priority and exact text: each user's call is admitted and billed to that user, an
+    interactive call never waits on a bulk-priority leader, and documents that differ only in case
+    or spacing are summarized separately"""
+    return f"{user_id}:{priority}:{hashlib.sha256(document_text.encode('utf-8')).hexdigest()}"
+
+@file_summary_flight.coalesce(file_summary_flight_key)
+def generate_file_summary(document_text, user_id=None, priority=PRIORITY_SUMMARIZE):
+    """Generate file summary in the required JSON format"""
+    try:
+        if not openai_client:
+            raise HTTPException(status_code=500, detail="OpenAI API key not configured. Please set OPENAI_API_KEY in your .env file.")
+        
+        summary = create_structured_completion(
+            "file_summary",
+            FileSummaryFields,
+            file_summary_messages(document_text),
+            model=DEFAULT_MODEL,
             temperature=0.3,
-            max_tokens=1000
+            max_tokens=1000,
+            user_id=user_id,
+            priority=priority
         )
-        
-        content = response.choices[0].message.content.strip()
-        
-        # Try to parse the JSON response
-        try:
-            # Remove any markdown formatting if present
-            if content.startswith("```json"):
-                content = content.replace("```json", "").replace("```", "").strip()
-            elif content.startswith("```"):
-                content = content.replace("```", "").strip()
-            
-            summary_data = json.loads(content)
-            
-            # Ensure all required fields are present
-            required_fields = ["user_name", "input_summary", "client_name", "client_region", "vertical", "feedback", "project_status"]
-            for field in required_fields:
-                if field not in summary_data:
-                    summary_data[field] = "Unknown"
-            
-            # Add timestamp
-            summary_data["timestamp"] = datetime.utcnow().isoformat()
-            
-            return summary_data
-            
-        except json.JSONDecodeError as e:
-            print(f"JSON parsing error: {e}")
-            # Return default structure if JSON parsing fails
-            return {
-                "user_name": "Unknown",
-                "input_summary": "Failed to parse document content",
-                "client_name": "Unknown",
-                "client_region": "Unknown",
-                "vertical": "Unknown",
-                "feedback": "Neutral",
-                "project_status": "Unknown",
-                "timestamp": datetime.utcnow().isoformat()
-            }
-            
+
+        summary_data = summary.model_dump()
+        summary_data["timestamp"] = datetime.utcnow().isoformat()
+        summary_data["is_fallback"] = False
+        return summary_data
+
+    except StructuredOutputError as e:
+        print(f"JSON parsing error: {e}")
+        # Return default structure if the output could not be parsed or repaired
+        return file_summary_fallback("Failed to parse document content", "parse_error")
+    except AdmissionRejected:
+        raise
     except Exception as e:
         print(f"Error generating file summary: {e}")
-        return {
-            "user_name": "Unknown",
-            "input_summary": f"Error processing document: {str(e)}",
-            "client_name": "Unknown",
-            "client_region": "Unknown",
-            "vertical": "Unknown",
-            "feedback": "Neutral",
-            "project_status": "Unknown",
-            "timestamp": datetime.utcnow().isoformat()
+        return file_summary_fallback(f"Error processing document: {str(e)}", fallback_reason(e))
+
+# ---------- Session History Cache ----------
+session_history_cache = SessionHistoryCache(
+    max_sessions=int(os.getenv("SESSION_CACHE_MAX_SESSIONS", "1000")),
+    max_bytes=int(os.getenv("SESSION_CACHE_MAX_MB", "64")) * 1024 * 1024,
+    max_messages=int(os.getenv("SESSION_CACHE_MESSAGES", "50"))
+)
+
+# ---------- Session List ----------
+# Denormalized onto each session so the sidebar needs no per-session history reads
+SESSION_LIST_FIELDS = ("session_id", "title", "created_at", "message_count", "last_message_preview", "last_model")
+SESSION_PREVIEW_CHARS = int(os.getenv("SESSION_PREVIEW_CHARS", "120"))
+
+def message_preview(content):
+    text = " ".join((content or "").split())
+    return text[:SESSION_PREVIEW_CHARS - 3] + "..." if len(text) > SESSION_PREVIEW_CHARS else text
+
+def backfill_session_list_fields(session_ids):
+    """Compute the denormalized list fields of sessions created before they existed"""
+    stats = message_store.session_stats(session_ids)
+    filled = {}
+    for session_id in session_ids:
+        row = stats.get(session_id, {})
+        fields = {
+            "message_count": row.get("message_count", 0),
+            "last_message_preview": message_preview(row["last_content"]) if row.get("last_content") else None,
+            "last_model": row.get("last_model"),
         }
+        # Leave sessions alone if a message write initialized them in the meantime
+        chat_sessions_collection.update_one(
+            {"session_id": session_id, "message_count": {"$exists": False}},
+            {"$set": fields}
+        )
+        filled[session_id] = fields
+    return filled
 
 async def get_chat_history(session_id: str, limit: Optional[int] = None) -> List[Dict]:
     """Get chat history for a session"""
     try:
+        cached = session_history_cache.get(session_id, limit)
+        if cached is not None:
+            return cached
+        
         if chat_messages_collection is None:
             print("Warning: Database not connected, returning empty chat history")
             return []
             
-        query = {"session_id": session_id}
+        token = session_history_cache.begin_load(session_id)
         
         if limit:
-            messages = list(chat_messages_collection.find(
-                query,
-                {"_id": 0}
-            ).sort("timestamp", -1).limit(limit))
+            # Read a full cache window so the next, possibly larger, request is a hit too
+            fetch_limit = max(limit, session_history_cache.max_messages)
+            messages = message_store.recent(session_id, fetch_limit)
             # Convert datetime objects to ISO format strings
             for msg in messages:
                 if 'timestamp' in msg and isinstance(msg['timestamp'], datetime):
                     msg['timestamp'] = msg['timestamp'].isoformat()
-            return list(reversed(messages))
+            session_history_cache.populate(session_id, messages, len(messages) < fetch_limit, token)
+            return messages[-limit:]
         else:
-            messages = list(chat_messages_collection.find(
-                query,
-                {"_id": 0}
-            ).sort("timestamp", 1))
+            messages = message_store.history(session_id)
             # Convert datetime objects to ISO format strings
             for msg in messages:
                 if 'timestamp' in msg and isinstance(msg['timestamp'], datetime):
                     msg['timestamp'] = msg['timestamp'].isoformat()
+            session_history_cache.populate(session_id, messages, True, token)
             return messages
     except Exception as e:
         print(f"Error getting chat history: {e}")
@@ -294,28 +1177,171 @@ async def get_chat_history(session_id: str, limit: Optional[int] = None) -> List
 
 async def store_chat_message(session_id: str, user_id: str, message_type: str, content: str, model_used: str = "gpt-3.5-turbo"):
     """Store a chat message in the database"""
+    save_chat_message(session_id, user_id, message_type, content, model_used)
+
+@stage("store")
+def save_chat_message(session_id: str, user_id: str, message_type: str, content: str, model_used: str = "gpt-3.5-turbo"):
+    """Synchronous variant of store_chat_message for worker threads and streaming generators"""
     try:
         if chat_messages_collection is None:
             print("Warning: Database not connected, skipping message storage")
             return
             
+        # Mongo keeps millisecond precision; truncate so cached copies compare equal to stored ones
+        now = datetime.utcnow()
         message = {
             "session_id": session_id,
             "user_id": user_id,
             "message_type": message_type,
             "content": content,
-            "timestamp": datetime.utcnow(),
+            "timestamp": now.replace(microsecond=now.microsecond // 1000 * 1000),
             "model_used": model_used
         }
-        chat_messages_collection.insert_one(message)
+        message_store.insert(message)
+        if chat_sessions_collection is not None:
+            session_update = {
+                "$set": {"last_message_preview": message_preview(content), "last_model": model_used},
+                "$max": {"last_updated": message["timestamp"]},
+            }
+            result = chat_sessions_collection.update_one(
+                {"session_id": session_id, "message_count": {"$exists": True}},
+                {**session_update, "$inc": {"message_count": 1}}
+            )
+            if result.matched_count == 0:
+                # Legacy session: its count is computed from the messages when it is next listed
+                chat_sessions_collection.update_one({"session_id": session_id}, session_update)
+        
+        cached = {key: value for key, value in message.items() if key != "_id"}
+        cached["timestamp"] = message["timestamp"].isoformat()
+        session_history_cache.append(session_id, cached)
     except Exception as e:
+        # The stored state is unknown; make the next read go to the database
+        session_history_cache.invalidate(session_id)
         print(f"Error storing chat message: {e}")
 
-def generate_prompt(task, document_text, chat_history=None):
+# ---------- Rolling Conversation Summary ----------
+ROLLING_SUMMARY_MODEL = os.getenv("ROLLING_SUMMARY_MODEL", "gpt-3.5-turbo")
+# Messages always sent verbatim (the last couple of turns)
+ROLLING_SUMMARY_KEEP_RECENT = int(os.getenv("ROLLING_SUMMARY_KEEP_RECENT", "4"))
+# Upper bound on verbatim messages in a prompt while the summary catches up
+ROLLING_SUMMARY_MAX_RAW = int(os.getenv("ROLLING_SUMMARY_MAX_RAW", "8"))
+ROLLING_SUMMARY_MIN_BATCH = int(os.getenv("ROLLING_SUMMARY_MIN_BATCH", "2"))
+ROLLING_SUMMARY_MAX_BATCH = int(os.getenv("ROLLING_SUMMARY_MAX_BATCH", "20"))
+ROLLING_SUMMARY_MAX_MESSAGE_CHARS = 2000
+
+background_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="background")
+_summaries_in_progress = set()
+_summaries_lock = threading.Lock()
+
+def summarize_conversation(previous_summary, messages, user_id=None):
+    """Fold new messages into the running summary with one short LLM call"""
+    transcript = "\n".join(
+        f"{msg['message_type'].title()}: {msg['content'][:ROLLING_SUMMARY_MAX_MESSAGE_CHARS]}"
+        for msg in messages
+    )
+    prompt = f"""Update the running summary of a conversation between a user and an AI assistant.
+
+Current summary:
+{previous_summary or "(none yet)"}
+
+New messages:
+{transcript}
+
+Write the updated summary in at most 200 words. Keep names, companies, numbers, decisions and open questions; drop pleasantries. Return only the summary text."""
+    response = create_chat_completion(
+        [
+            {"role": "system", "content": "You maintain concise, factual summaries of conversations."},
+            {"role": "user", "content": prompt}
+        ],
+        model=ROLLING_SUMMARY_MODEL,
+        temperature=0.2,
+        max_tokens=400,
+        user_id=user_id,
+        priority=PRIORITY_BULK,
+        task="rolling_summary"
+    )
+    return response.choices[0].message.content.strip()
+
+def update_rolling_summary(session_id, user_id=None):
+    """Fold messages that fell out of the verbatim window into the session's rolling summary"""
+    if chat_sessions_collection is None or chat_messages_collection is None:
+        return
+    with _summaries_lock:
+        if session_id in _summaries_in_progress:
+            return
+        _summaries_in_progress.add(session_id)
+    try:
+        session = chat_sessions_collection.find_one(
+            {"session_id": session_id},
+            {"_id": 0, "rolling_summary": 1, "summary_upto": 1}
+        )
+        if session is None:
+            return
+        
+        summary_upto = session.get("summary_upto")
+        pending = list(islice(message_store.iter_messages(
+            session_id,
+            timestamp={"$gt": summary_upto} if summary_upto else None,
+            fields=("message_type", "content", "timestamp")
+        ), ROLLING_SUMMARY_MAX_BATCH + ROLLING_SUMMARY_KEEP_RECENT))
+        
+        to_fold = pending[:len(pending) - ROLLING_SUMMARY_KEEP_RECENT]
+        if len(to_fold) < ROLLING_SUMMARY_MIN_BATCH:
+            return
+        
+        summary = summarize_conversation(session.get("rolling_summary"), to_fold, user_id)
+        # Only apply if no other worker advanced the summary in the meantime
+        chat_sessions_collection.update_one(
+            {"session_id": session_id, "summary_upto": summary_upto},
+            {
+                "$set": {
+                    "rolling_summary": summary,
+                    "summary_upto": to_fold[-1]["timestamp"],
+                    "summary_updated_at": datetime.utcnow()
+                },
+                "$inc": {"summary_message_count": len(to_fold)}
+            }
+        )
+    except AdmissionRejected:
+        # Background work yields under load; the next turn will fold these messages
+        pass
+    except Exception as e:
+        print(f"Error updating rolling summary for session {session_id}: {e}")
+    finally:
+        with _summaries_lock:
+            _summaries_in_progress.discard(session_id)
+
+async def get_prompt_context(session_id: str):
+    """Return (rolling_summary, recent_messages) for building a chat prompt"""
+    summary = None
+    summary_upto = None
+    if chat_sessions_collection is not None:
+        try:
+            session = chat_sessions_collection.find_one(
+                {"session_id": session_id},
+                {"_id": 0, "rolling_summary": 1, "summary_upto": 1}
+            ) or {}
+            summary = session.get("rolling_summary")
+            summary_upto = session.get("summary_upto")
+        except Exception as e:
+            print(f"Error reading rolling summary: {e}")
+    
+    history = await get_chat_history(session_id, limit=ROLLING_SUMMARY_MAX_RAW)
+    if summary_upto:
+        # Anything at or before summary_upto is already covered by the summary
+        history = [
+            msg for msg in history
+            if datetime.fromisoformat(msg["timestamp"]) > summary_upto
+        ]
+    else:
+        history = history[-ROLLING_SUMMARY_MAX_RAW:]
+    return summary, history
+
+def generate_prompt(task, document_text, chat_history=None, conversation_summary=None):
     """Generate appropriate prompt based on task and context"""
     base_prompt = ""
     
-    if task == "Business Analyst":
+    if task == BUSINESS_ANALYST:
         base_prompt = f"""You are a Business Analyst. Based on the following requirement, create user stories and acceptance criteria.
 
 Requirement:
@@ -332,6 +1358,28 @@ Please provide:
    When [action]
    Then [expected result]"""
     
+    elif task == SUMMARIZER:
+        base_prompt = f"""You are an expert at summarizing business content. Summarize the following clearly and concisely.
+
+Content:
+{document_text}
+
+Start with a one-sentence overview, then list the key points, decisions and any action items with their owners."""
+    
+    elif task == FINANCIAL_ANALYST:
+        base_prompt = f"""You are a financial analyst. Please answer the following request:
+
+Request: {document_text}
+
+Ground the answer in concrete figures where they are available (revenue, margins, cash flow, valuation), explain what drives them, and note the main risks. Say so when a figure is an estimate or may be out of date."""
+    
+    elif task == MARKET_ANALYST:
+        base_prompt = f"""You are a market research analyst. Please answer the following request:
+
+Request: {document_text}
+
+Cover the relevant market size and trends, the main competitors and how they are positioned, and the opportunities and risks for a sales team."""
+    
     else:
         base_prompt = f"""You are a helpful AI assistant. Please help with the following request:
 
@@ -339,10 +1387,14 @@ Request: {document_text}
 
 Please provide a clear, detailed, and helpful response."""
     
-    # Add chat history context if available
+    # Add the rolling summary of older turns if available
+    if conversation_summary:
+        base_prompt += f"\n\nSummary of the earlier conversation:\n{conversation_summary}\n"
+    
+    # Add chat history context if available (already bounded by the caller)
     if chat_history:
         context = "\n\nPrevious conversation context:\n"
-        for msg in chat_history[-5:]:  # Last 5 messages for context
+        for msg in chat_history:
             context += f"{msg['message_type'].title()}: {msg['content']}\n"
         base_prompt += context
     
@@ -359,17 +1411,7 @@ async def create_session(session: SessionCreate):
     try:
         print(f"Creating session for user: {session.cognitoId}")
         
-        # Check if MongoDB is connected
-        if chat_sessions_collection is None:
-            raise HTTPException(status_code=500, detail="Database not connected. Please ensure MongoDB is running and MONGO_URI is set correctly.")
-        
-        # Check MongoDB connection
-        try:
-            client.admin.command('ping')
-            print("MongoDB connection is healthy")
-        except Exception as db_error:
-            print(f"MongoDB connection error: {db_error}")
-            raise HTTPException(status_code=500, detail=f"Database connection error: {str(db_error)}")
+        require_database(chat_sessions_collection)
         
         session_id = str(uuid.uuid4())
         title = session.title or "New Chat Session"
@@ -380,7 +1422,10 @@ async def create_session(session: SessionCreate):
             "title": title,
             "created_at": datetime.utcnow(),
             "last_updated": datetime.utcnow(),
-            "model_used": "gpt-3.5-turbo"
+            "model_used": "gpt-3.5-turbo",
+            "message_count": 0,
+            "last_message_preview": None,
+            "last_model": None
         }
         
         print(f"Inserting session: {session_id}")
@@ -406,26 +1451,39 @@ async def create_session(session: SessionCreate):
         print(f"Traceback: {traceback.format_exc()}")
         raise HTTPException(status_code=500, detail=f"Error creating session: {str(e)}")
 
+def sessions_validator(user_id):
+    """Session count and newest last_updated, both read from the user_session_list index"""
+    query = {"user_id": user_id}
+    latest = chat_sessions_collection.find_one(query, {"_id": 0, "last_updated": 1}, sort=[("last_updated", DESCENDING)])
+    last_updated = (latest or {}).get("last_updated")
+    return ["sessions", user_id, chat_sessions_collection.count_documents(query), last_updated], newest(last_updated)
+
 @app.get("/openai/users/{cognito_id}/sessions")
-async def get_user_sessions(cognito_id: str):
+async def get_user_sessions(cognito_id: str, request: Request):
     try:
         print(f"Fetching sessions for user: {cognito_id}")
+        require_database(chat_sessions_collection)
         
-        # Check MongoDB connection
-        try:
-            client.admin.command('ping')
-            print("MongoDB connection is healthy")
-        except Exception as db_error:
-            print(f"MongoDB connection error: {db_error}")
-            raise HTTPException(status_code=500, detail=f"Database connection error: {str(db_error)}")
+        validator, last_modified = await run_in_threadpool(sessions_validator, cognito_id)
+        headers, not_modified = check_conditional(request, validator, last_modified)
+        if not_modified:
+            return not_modified
         
+        # Covered by the user_session_list index
+        projection = {"_id": 0, "last_updated": 1, **{field: 1 for field in SESSION_LIST_FIELDS}}
         sessions = list(chat_sessions_collection.find(
             {"user_id": cognito_id},
-            {"_id": 0}
+            projection
         ).sort("last_updated", DESCENDING))
         
         print(f"Found {len(sessions)} sessions for user {cognito_id}")
         
+        legacy = [s["session_id"] for s in sessions if "message_count" not in s]
+        if legacy:
+            filled = await run_in_threadpool(backfill_session_list_fields, legacy)
+            for session in sessions:
+                session.update(filled.get(session["session_id"], {}))
+        
         serialized_sessions = []
         for session in sessions:
             try:
@@ -438,7 +1496,7 @@ async def get_user_sessions(cognito_id: str):
         
         return JSONResponse({
             "sessions": serialized_sessions
-        })
+        }, headers=headers)
     except HTTPException:
         raise
     except Exception as e:
@@ -448,14 +1506,33 @@ async def get_user_sessions(cognito_id: str):
         print(f"Traceback: {traceback.format_exc()}")
         raise HTTPException(status_code=500, detail=f"Error fetching sessions: {str(e)}")
 
+def history_validator(session_id):
+    """Message count and newest message time, from the session document when it tracks them"""
+    session = chat_sessions_collection.find_one(
+        {"session_id": session_id},
+        {"_id": 0, "message_count": 1, "last_updated": 1}
+    ) if chat_sessions_collection is not None else None
+    if session and "message_count" in session:
+        return [session["message_count"], session.get("last_updated")], newest(session.get("last_updated"))
+    stats = message_store.session_stats([session_id]).get(session_id, {})
+    timestamp = stats.get("last_timestamp")
+    return [stats.get("message_count", 0), timestamp], newest(timestamp)
+
 @app.get("/openai/sessions/{session_id}/history")
-async def get_session_history(session_id: str, limit: int = 10):
+async def get_session_history(session_id: str, request: Request, limit: int = 10):
     try:
+        headers = None
+        if chat_messages_collection is not None:
+            validator, last_modified = await run_in_threadpool(history_validator, session_id)
+            headers, not_modified = check_conditional(request, ["history", session_id, limit] + validator, last_modified)
+            if not_modified:
+                return not_modified
+        
         messages = await get_chat_history(session_id, limit)
         return JSONResponse({
             "session_id": session_id,
             "messages": messages
-        })
+        }, headers=headers)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching chat history: {str(e)}")
 
@@ -466,8 +1543,10 @@ async def chat_with_ai(
     message: Optional[str] = Form(""),  # Make message optional
     task: Optional[str] = Form(None),
     file: Optional[UploadFile] = File(None),
-    model: str = Form("gpt-3.5-turbo"),
+    model: str = Form(DEFAULT_MODEL),  # "auto" routes by task, prompt size, latency and cost
     summarize_file: bool = Form(False),  # New flag to control summarization
+    use_documents: bool = Form(False),  # Answer from retrieved chunks of the user's documents
+    document_ids: Optional[str] = Form(None),  # Comma-separated ids to restrict retrieval to
     background_tasks: BackgroundTasks = None
 ):
     try:
@@ -476,18 +1555,19 @@ async def chat_with_ai(
         summary_data = None
         
         if file:
-            document_text = extract_text_from_file(file)
+            document_text, upload = await run_in_threadpool(read_upload, file)
             
             # Only generate summary if explicitly requested
             if summarize_file:
-                summary_data = generate_file_summary(document_text)
+                summary_data = await run_in_threadpool(generate_file_summary, document_text, user_id)
                 
                 # Store summary in database
                 summary_doc = {
                     "user_id": user_id,
                     "file_name": file.filename,
-                    "file_size": file.size,
-                    "content_type": file.content_type,
+                    "file_size": upload.size,
+                    "content_type": upload.content_type,
+                    "file_sha256": upload.sha256,
                     "summary": summary_data,
                     "created_at": datetime.utcnow()
                 }
@@ -496,6 +1576,12 @@ async def chat_with_ai(
                     background_tasks.add_task(lambda: file_summaries_collection.insert_one(summary_doc))
                 else:
                     file_summaries_collection.insert_one(summary_doc)
+            
+            # Keep the document so later turns can retrieve from it without a re-upload
+            if use_documents:
+                document, _ = await run_in_threadpool(ingest_document, user_id, file.filename, document_text, upload)
+                if document_ids:
+                    document_ids = f"{document_ids},{document['document_id']}"
         
         # Handle case where only file is uploaded without message
         if not message and document_text:
@@ -505,48 +1591,64 @@ async def chat_with_ai(
         
         # Combine user message with document text
         full_input = message
-        if document_text:
+        sources = []
+        if use_documents:
+            full_input, sources = await run_in_threadpool(build_retrieval_input, user_id, message, document_ids)
+        elif document_text:
             full_input = f"Document content:\n{document_text}\n\nUser question: {message}"
         
         # Determine task if not provided
+        intent = None
         if not task:
-            task = map_input_to_task(message)
-        
-        # Get chat history for context
-        chat_history = await get_chat_history(session_id, limit=5)
+            intent = intent_engine.classify(message)
+            task = intent.task
+        
+        # Requests for the user's own data are answered from the database
+        if not document_text and not use_documents:
+            response = await answer_locally(intent, session_id, user_id, message)
+            if response is not None:
+                return JSONResponse({
+                    "response": response,
+                    "task": intent.name,
+                    "model_used": DIRECT_ANSWER_MODEL,
+                    "session_id": session_id,
+                    "file_summary": summary_data,
+                    "sources": []
+                })
+        
+        # Rolling summary of older turns plus the most recent messages
+        with stage("history"):
+            conversation_summary, chat_history = await get_prompt_context(session_id)
         
         # Generate prompt
-        prompt = generate_prompt(task, full_input, chat_history)
+        prompt = generate_prompt(task, full_input, chat_history, conversation_summary)
         
         # Query OpenAI
-        response = query_openai(prompt, model=model)
+        response, model = await run_in_threadpool(
+            query_openai, prompt, model=model, user_id=user_id, priority=PRIORITY_CHAT, task=task
+        )
         
-        # Store messages in background
+        # Store messages in background, then fold older turns into the rolling summary
         if background_tasks:
             background_tasks.add_task(store_chat_message, session_id, user_id, "user", message, model)
             background_tasks.add_task(store_chat_message, session_id, user_id, "assistant", response, model)
+            background_tasks.add_task(update_rolling_summary, session_id, user_id)
         else:
             await store_chat_message(session_id, user_id, "user", message, model)
             await store_chat_message(session_id, user_id, "assistant", response, model)
-        
-        # Update session last_updated
-        if chat_sessions_collection is not None:
-            try:
-                chat_sessions_collection.update_one(
-                    {"session_id": session_id},
-                    {"$set": {"last_updated": datetime.utcnow()}}
-                )
-            except Exception as e:
-                print(f"Error updating session: {e}")
+            background_executor.submit(update_rolling_summary, session_id, user_id)
         
         return JSONResponse({
             "response": response,
             "task": task,
             "model_used": model,
             "session_id": session_id,
-            "file_summary": summary_data  # Include summary data only if generated
+            "file_summary": summary_data,  # Include summary data only if generated
+            "sources": sources
         })
         
+    except PASSTHROUGH_ERRORS:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error in chat: {str(e)}")
 
@@ -557,8 +1659,10 @@ async def stream_chat_with_ai(
     message: Optional[str] = Form(""),  # Make message optional
     task: Optional[str] = Form(None),
     file: Optional[UploadFile] = File(None),
-    model: str = Form("gpt-3.5-turbo"),
-    summarize_file: bool = Form(False)  # New flag to control summarization
+    model: str = Form(DEFAULT_MODEL),  # "auto" routes by task, prompt size, latency and cost
+    summarize_file: bool = Form(False),  # New flag to control summarization
+    use_documents: bool = Form(False),  # Answer from retrieved chunks of the user's documents
+    document_ids: Optional[str] = Form(None)  # Comma-separated ids to restrict retrieval to
 ):
     try:
         # Extract text from file if provided
@@ -566,23 +1670,30 @@ async def stream_chat_with_ai(
         summary_data = None
         
         if file:
-            document_text = extract_text_from_file(file)
+            document_text, upload = await run_in_threadpool(read_upload, file)
             
             # Only generate summary if explicitly requested
             if summarize_file:
-                summary_data = generate_file_summary(document_text)
+                summary_data = await run_in_threadpool(generate_file_summary, document_text, user_id)
                 
                 # Store summary in database
                 summary_doc = {
                     "user_id": user_id,
                     "file_name": file.filename,
-                    "file_size": file.size,
-                    "content_type": file.content_type,
+                    "file_size": upload.size,
+                    "content_type": upload.content_type,
+                    "file_sha256": upload.sha256,
                     "summary": summary_data,
                     "created_at": datetime.utcnow()
                 }
                 
                 file_summaries_collection.insert_one(summary_doc)
+            
+            # Keep the document so later turns can retrieve from it without a re-upload
+            if use_documents:
+                document, _ = await run_in_threadpool(ingest_document, user_id, file.filename, document_text, upload)
+                if document_ids:
+                    document_ids = f"{document_ids},{document['document_id']}"
         
         # Handle case where only file is uploaded without message
         if not message and document_text:
@@ -592,30 +1703,55 @@ async def stream_chat_with_ai(
         
         # Combine user message with document text
         full_input = message
-        if document_text:
+        sources = []
+        if use_documents:
+            full_input, sources = await run_in_threadpool(build_retrieval_input, user_id, message, document_ids)
+        elif document_text:
             full_input = f"Document content:\n{document_text}\n\nUser question: {message}"
         
         # Determine task if not provided
+        intent = None
         if not task:
-            task = map_input_to_task(message)
+            intent = intent_engine.classify(message)
+            task = intent.task
+        
+        # Requests for the user's own data are answered from the database, as a single event
+        if not document_text and not use_documents:
+            response = await answer_locally(intent, session_id, user_id, message)
+            if response is not None:
+                event = {"content": response, "task": intent.name, "model_used": DIRECT_ANSWER_MODEL,
+                         "file_summary": summary_data, "sources": []}
+                return StreamingResponse(iter([f"data: {json.dumps(event)}\n\n"]), media_type="text/plain")
         
-        # Get chat history for context
-        chat_history = await get_chat_history(session_id, limit=5)
+        # Rolling summary of older turns plus the most recent messages
+        with stage("history"):
+            conversation_summary, chat_history = await get_prompt_context(session_id)
         
         # Generate prompt
-        prompt = generate_prompt(task, full_input, chat_history)
+        prompt = generate_prompt(task, full_input, chat_history, conversation_summary)
+        
+        messages = [
+            {"role": "system", "content": "You are a helpful AI assistant."},
+            {"role": "user", "content": prompt}
+        ]
+        decision = route_model(task, messages, 1500, model)
+        
+        # Admit before the response starts so a rejection can still be a 429/503
+        ticket, model = await run_in_threadpool(acquire_routed_slot, decision, user_id, PRIORITY_CHAT)
         
         def stream_response():
+            streamed = False
             try:
-                response = openai_client.chat.completions.create(
-                    model=model,
-                    messages=[
-                        {"role": "system", "content": "You are a helpful AI assistant."},
-                        {"role": "user", "content": prompt}
-                    ],
+                started = time.monotonic()
+                # Retries only cover opening the stream; tokens already sent can't be replayed
+                response = call_openai_resilient(
+                    messages,
+                    model,
                     temperature=0.7,
                     max_tokens=1500,
-                    stream=True
+                    stream=True,
+                    user_id=user_id,
+                    task=task
                 )
                 
                 full_response = ""
@@ -623,53 +1759,488 @@ async def stream_chat_with_ai(
                     if chunk.choices[0].delta.content:
                         content = chunk.choices[0].delta.content
                         full_response += content
-                        yield f"data: {json.dumps({'content': content, 'task': task, 'file_summary': summary_data})}\n\n"
+                        yield f"data: {json.dumps({'content': content, 'task': task, 'model_used': model, 'file_summary': summary_data, 'sources': sources})}\n\n"
                 
-                # Store the complete response
-                store_chat_message(session_id, user_id, "user", message, model)
-                store_chat_message(session_id, user_id, "assistant", full_response, model)
+                streamed = True
+                model_router.record_success(decision, model, time.monotonic() - started, estimate_tokens(full_response))
                 
-                # Update session
-                if chat_sessions_collection is not None:
-                    try:
-                        chat_sessions_collection.update_one(
-                            {"session_id": session_id},
-                            {"$set": {"last_updated": datetime.utcnow()}}
-                        )
-                    except Exception as e:
-                        print(f"Error updating session: {e}")
+                # Store the complete response
+                save_chat_message(session_id, user_id, "user", message, model)
+                save_chat_message(session_id, user_id, "assistant", full_response, model)
+                background_executor.submit(update_rolling_summary, session_id, user_id)
                 
             except Exception as e:
+                if not streamed:
+                    record_stream_failure(decision, model, e)
                 yield f"data: {json.dumps({'error': str(e)})}\n\n"
+            finally:
+                ticket.release()
         
-        return StreamingResponse(stream_response(), media_type="text/plain")
+        # Release again after the response in case the generator never started
+        return StreamingResponse(stream_response(), media_type="text/plain", background=BackgroundTask(ticket.release))
         
+    except PASSTHROUGH_ERRORS:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error in streaming chat: {str(e)}")
 
-@app.get("/openai/health")
-async def health_check():
-    return JSONResponse({"status": "healthy", "service": "AIron Rush API"})
+# ---------- WebSocket Chat ----------
+WS_HEARTBEAT_SECONDS = float(os.getenv("WS_HEARTBEAT_SECONDS", "20"))
+WS_IDLE_TIMEOUT = float(os.getenv("WS_IDLE_TIMEOUT", "900"))
 
-@app.post("/openai/summarize-file")
-async def summarize_file(
-    user_id: str = Form(...),
-    file: UploadFile = File(...),
-    background_tasks: BackgroundTasks = None
-):
-    try:
-        # Extract text from file
-        document_text = extract_text_from_file(file)
-        
-        # Generate summary using OpenAI
-        summary_data = generate_file_summary(document_text)
-        
+def ws_error_frame(request_id, exc):
+    frame = {
+        "type": "error",
+        "id": request_id,
+        "status_code": getattr(exc, "status_code", 500),
+        "detail": getattr(exc, "detail", None) or str(exc)
+    }
+    if getattr(exc, "retry_after", None):
+        frame["retry_after"] = exc.retry_after
+    return frame
+
+class ChatConnection:
+    """One chat WebSocket: the session's prompt context stays in memory between turns"""
+
+    def __init__(self, websocket: WebSocket, session_id: str, user_id: str, model: str):
+        self.websocket = websocket
+        self.session_id = session_id
+        self.user_id = user_id
+        self.model = model
+        self.conversation_summary = None
+        self.history = []
+        self.turns = 0
+        self.generation = None
+        self.request_id = None
+        self.cancel_event = None
+        self.stream_holder = None
+        self.last_activity = time.monotonic()
+        self.send_lock = asyncio.Lock()
+        self.closed = False
+
+    @property
+    def state(self):
+        return "generating" if self.generation is not None and not self.generation.done() else "idle"
+
+    async def send(self, payload):
+        # After the client goes away a running turn still finishes and stores its messages
+        if self.closed:
+            return
+        try:
+            async with self.send_lock:
+                await self.websocket.send_json(payload)
+        except Exception:
+            self.closed = True
+
+    async def load_context(self):
+        self.conversation_summary, self.history = await get_prompt_context(self.session_id)
+
+    def status(self):
+        return {
+            "type": "status",
+            "state": self.state,
+            "id": self.request_id if self.state == "generating" else None,
+            "session_id": self.session_id,
+            "model": self.model,
+            "turns": self.turns,
+            "history_messages": len(self.history),
+            "openai": health_monitor.status("openai")
+        }
+
+    def cancel(self):
+        if self.cancel_event is None or self.cancel_event.is_set():
+            return False
+        self.cancel_event.set()
+        # Closing the upstream stream stops generation (and billing) without waiting for the next token
+        stream = (self.stream_holder or {}).get("stream")
+        if stream is not None:
+            try:
+                stream.close()
+            except Exception:
+                pass
+        return True
+
+    async def run_turn(self, request_id, frame):
+        self.request_id = request_id
+        try:
+            await self._run_turn(request_id, frame)
+        except Exception as e:
+            print(f"Error in WebSocket chat turn: {e}")
+            await self.send(ws_error_frame(request_id, e))
+        finally:
+            self.cancel_event = None
+            self.stream_holder = None
+
+    async def record_turn(self, message, response, model):
+        """Keep the in-memory context in step with a stored turn"""
+        self.turns += 1
+        now = datetime.utcnow().isoformat()
+        self.history.append({"message_type": "user", "content": message, "timestamp": now, "model_used": model})
+        if response:
+            self.history.append({"message_type": "assistant", "content": response, "timestamp": now, "model_used": model})
+        if len(self.history) > ROLLING_SUMMARY_MAX_RAW:
+            # Older turns are being folded into the rolling summary; pick up its latest state
+            await self.load_context()
+    
+    async def _run_turn(self, request_id, frame):
+        message = (frame.get("content") or "").strip()
+        if not message:
+            await self.send(ws_error_frame(request_id, HTTPException(status_code=400, detail="Message content is required")))
+            return
+        intent = None if frame.get("task") else intent_engine.classify(message)
+        task = frame.get("task") or intent.task
+        model = frame.get("model") or self.model
+        
+        if not frame.get("use_documents"):
+            response = await answer_locally(intent, self.session_id, self.user_id, message)
+            if response is not None:
+                await self.send({"type": "start", "id": request_id, "task": intent.name,
+                                 "model_used": DIRECT_ANSWER_MODEL, "sources": []})
+                await self.send({"type": "token", "id": request_id, "content": response})
+                await self.record_turn(message, response, DIRECT_ANSWER_MODEL)
+                await self.send({"type": "done", "id": request_id, "model_used": DIRECT_ANSWER_MODEL,
+                                 "cancelled": False, "content": response})
+                return
+        
+        full_input, sources = message, []
+        if frame.get("use_documents"):
+            full_input, sources = await run_in_threadpool(build_retrieval_input, self.user_id, message, frame.get("document_ids"))
+        
+        prompt = generate_prompt(task, full_input, self.history, self.conversation_summary)
+        messages = [
+            {"role": "system", "content": "You are a helpful AI assistant."},
+            {"role": "user", "content": prompt}
+        ]
+        decision = route_model(task, messages, 1500, model)
+        try:
+            ticket, model = await run_in_threadpool(acquire_routed_slot, decision, self.user_id, PRIORITY_CHAT)
+        except PASSTHROUGH_ERRORS as e:
+            await self.send(ws_error_frame(request_id, e))
+            return
+        
+        cancel_event = self.cancel_event = threading.Event()
+        holder = self.stream_holder = {}
+        queue = asyncio.Queue()
+        loop = asyncio.get_running_loop()
+        
+        def produce():
+            try:
+                started = time.monotonic()
+                stream = call_openai_resilient(messages, model, temperature=0.7, max_tokens=1500, stream=True,
+                                               user_id=self.user_id, task=task)
+                holder["stream"] = stream
+                output_chars = 0
+                for chunk in stream:
+                    if cancel_event.is_set():
+                        break
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        output_chars += len(chunk.choices[0].delta.content)
+                        loop.call_soon_threadsafe(queue.put_nowait, ("token", chunk.choices[0].delta.content))
+                if not cancel_event.is_set():
+                    model_router.record_success(decision, model, time.monotonic() - started, output_chars // 4 + 1)
+                loop.call_soon_threadsafe(queue.put_nowait, ("end", None))
+            except Exception as e:
+                # A stream closed by cancel() ends with a read error; that is not a failure
+                if not cancel_event.is_set():
+                    record_stream_failure(decision, model, e)
+                loop.call_soon_threadsafe(queue.put_nowait, ("end", None) if cancel_event.is_set() else ("error", e))
+            finally:
+                ticket.release()
+        
+        producer = asyncio.ensure_future(run_in_threadpool(produce))
+        await self.send({"type": "start", "id": request_id, "task": task, "model_used": model, "sources": sources})
+        parts = []
+        error = None
+        while True:
+            kind, value = await queue.get()
+            if kind == "token":
+                parts.append(value)
+                await self.send({"type": "token", "id": request_id, "content": value})
+            else:
+                error = value
+                break
+        await producer
+        
+        if error is not None:
+            await self.send(ws_error_frame(request_id, error))
+            return
+        
+        # A cancelled turn keeps whatever was generated, so the transcript matches what the user saw
+        response = "".join(parts)
+        cancelled = cancel_event.is_set()
+        await run_in_threadpool(save_chat_message, self.session_id, self.user_id, "user", message, model)
+        if response:
+            await run_in_threadpool(save_chat_message, self.session_id, self.user_id, "assistant", response, model)
+        background_executor.submit(update_rolling_summary, self.session_id, self.user_id)
+        
+        await self.record_turn(message, response, model)
+        await self.send({"type": "done", "id": request_id, "model_used": model, "cancelled": cancelled, "content": response})
+
+async def ws_heartbeat(connection: ChatConnection):
+    while True:
+        await asyncio.sleep(WS_HEARTBEAT_SECONDS)
+        if connection.state == "idle" and time.monotonic() - connection.last_activity > WS_IDLE_TIMEOUT:
+            await connection.websocket.close(code=1000, reason="Idle timeout")
+            return
+        await connection.send({"type": "heartbeat", "ts": datetime.utcnow().isoformat(), "state": connection.state})
+
+@app.websocket("/openai/ws/sessions/{session_id}")
+async def websocket_chat(websocket: WebSocket, session_id: str, user_id: str, model: str = DEFAULT_MODEL):
+    await websocket.accept()
+    if chat_sessions_collection is None or health_monitor.is_down("mongo"):
+        await websocket.close(code=1013, reason="Database unavailable")
+        return
+    session = await run_in_threadpool(chat_sessions_collection.find_one, {"session_id": session_id}, {"_id": 0, "user_id": 1})
+    if session is None or session.get("user_id") != user_id:
+        await websocket.close(code=4404, reason="Session not found")
+        return
+    
+    connection = ChatConnection(websocket, session_id, user_id, model)
+    await connection.load_context()
+    await connection.send({**connection.status(), "type": "ready"})
+    heartbeat = asyncio.create_task(ws_heartbeat(connection))
+    try:
+        while True:
+            raw = await websocket.receive_text()
+            connection.last_activity = time.monotonic()
+            try:
+                frame = json.loads(raw)
+                frame_type = frame.get("type")
+            except (ValueError, AttributeError):
+                await connection.send(ws_error_frame(None, HTTPException(status_code=400, detail="Frames must be JSON objects")))
+                continue
+            
+            if frame_type == "message":
+                request_id = frame.get("id") or str(uuid.uuid4())
+                if connection.state == "generating":
+                    await connection.send(ws_error_frame(request_id, HTTPException(
+                        status_code=409, detail="A response is still being generated; cancel it first")))
+                    continue
+                connection.generation = asyncio.create_task(connection.run_turn(request_id, frame))
+            elif frame_type == "cancel":
+                if not connection.cancel():
+                    await connection.send(connection.status())
+            elif frame_type == "ping":
+                await connection.send({"type": "pong", "ts": datetime.utcnow().isoformat()})
+            elif frame_type == "status":
+                await connection.send(connection.status())
+            elif frame_type == "config":
+                connection.model = frame.get("model") or connection.model
+                await connection.send(connection.status())
+            else:
+                await connection.send(ws_error_frame(frame.get("id"), HTTPException(
+                    status_code=400, detail=f"Unknown frame type: {frame_type}")))
+    except WebSocketDisconnect:
+        pass
+    finally:
+        heartbeat.cancel()
+        connection.cancel()
+        if connection.generation is not None:
+            # Let a cancelled turn store what was generated before the connection goes away
+            try:
+                await connection.generation
+            except Exception:
+                pass
+
+@app.get("/openai/health")
+async def health_check():
+    health = health_monitor.snapshot()
+    return JSONResponse({
+        "status": "healthy" if health["ready"] and not health["degraded"] else "degraded",
+        "service": "AIron Rush API",
+        "dependencies": {name: dependency["status"] for name, dependency in health["dependencies"].items()}
+    })
+
+@app.get("/openai/health/live")
+async def liveness_check():
+    # The process is up and its event loop answers; dependencies don't matter here
+    return JSONResponse({"status": "alive"})
+
+@app.get("/openai/health/ready")
+async def readiness_check():
+    health = health_monitor.snapshot()
+    return JSONResponse(health, status_code=200 if health["ready"] else 503)
+
+@app.get("/openai/admission/stats", dependencies=[Depends(require_admin)])
+async def get_admission_stats():
+    return JSONResponse(llm_admission.snapshot())
+
+@app.get("/openai/session-cache/stats", dependencies=[Depends(require_admin)])
+async def get_session_cache_stats():
+    return JSONResponse(session_history_cache.snapshot())
+
+@app.get("/openai/routing/stats", dependencies=[Depends(require_admin)])
+async def get_routing_stats(recent: int = 20):
+    return JSONResponse(model_router.snapshot(recent=min(max(recent, 0), 200)))
+
+@app.get("/openai/intents/stats")
+async def get_intent_stats():
+    return JSONResponse(intent_engine.snapshot())
+
+@app.get("/openai/intents/classify")
+async def classify_message(text: str):
+    """How a message would be routed, without sending it anywhere"""
+    return JSONResponse(intent_engine.classify(text).to_dict())
+
+@app.get("/openai/coalescing/stats", dependencies=[Depends(require_admin)])
+async def get_coalescing_stats():
+    return JSONResponse({flight.name: flight.snapshot() for flight in SINGLE_FLIGHTS})
+
+@app.get("/openai/structured-output/stats", dependencies=[Depends(require_admin)])
+async def get_structured_output_stats():
+    return JSONResponse({"mode": STRUCTURED_OUTPUT_MODE, "call_sites": structured_output_stats.snapshot()})
+
+@app.get("/openai/resilience/stats", dependencies=[Depends(require_admin)])
+async def get_resilience_stats():
+    return JSONResponse({
+        "circuit_breakers": llm_breakers.snapshot(),
+        "retries": llm_resilience_stats.get("retries", 0),
+        "hedges": llm_resilience_stats.get("hedges", 0),
+        "hedge_wins": llm_resilience_stats.get("hedge_wins", 0)
+    })
+
+# ---------- Usage (admin) ----------
+def require_usage_ledger():
+    if usage_ledger is None:
+        raise HTTPException(status_code=503, detail="Usage ledger is disabled or the database is not connected")
+    return usage_ledger
+
+def parse_usage_day(value, name):
+    if value is None:
+        return None
+    try:
+        return datetime.strptime(value, "%Y-%m-%d").strftime("%Y-%m-%d")
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"{name} must be a date in YYYY-MM-DD format")
+
+@app.get("/openai/usage/stats")
+async def get_usage_stats(request: Request):
+    require_admin(request)
+    return JSONResponse(require_usage_ledger().snapshot())
+
+@app.get("/openai/usage")
+async def get_usage(
+    request: Request,
+    group_by: str = "user",
+    user_id: Optional[str] = None,
+    endpoint: Optional[str] = None,
+    model: Optional[str] = None,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    limit: int = 100
+):
+    """Tokens, cost and latency summed per user, endpoint, model, task and/or day (comma-separated group_by)"""
+    require_admin(request)
+    ledger = require_usage_ledger()
+    groups = [name.strip() for name in group_by.split(",") if name.strip()]
+    unknown = [name for name in groups if name not in GROUP_FIELDS]
+    if not groups or unknown:
+        raise HTTPException(status_code=400, detail=f"Unsupported group_by. Use any of: {', '.join(GROUP_FIELDS)}")
+    date_from = parse_usage_day(date_from, "date_from")
+    date_to = parse_usage_day(date_to, "date_to")
+
+    def flush_and_query():
+        # Include what this instance has buffered but not yet written
+        ledger.flush()
+        return ledger.query(group_by=groups, user_id=user_id, endpoint=endpoint, model=model,
+                            date_from=date_from, date_to=date_to, limit=min(max(limit, 1), 1000))
+
+    try:
+        return JSONResponse(serialize_mongo_doc(await run_in_threadpool(flush_and_query)))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error querying usage: {str(e)}")
+
+# ---------- Profiling (admin) ----------
+@app.get("/openai/profiling")
+async def get_profiling(request: Request):
+    require_admin(request)
+    return JSONResponse(request_profiler.snapshot())
+
+@app.put("/openai/profiling/config")
+async def set_profiling_config(request: Request, config: ProfilingConfig):
+    require_admin(request)
+    if config.mode not in PROFILE_MODES:
+        raise HTTPException(status_code=400, detail=f"Unsupported mode. Use one of: {', '.join(PROFILE_MODES)}")
+    request_profiler.configure(
+        sample_rate=config.sample_rate,
+        routes=config.routes,
+        mode=config.mode,
+        duration=config.duration_minutes * 60,
+        slow_ms=config.slow_ms
+    )
+    return JSONResponse(request_profiler.config())
+
+@app.delete("/openai/profiling/config")
+async def clear_profiling_config(request: Request):
+    require_admin(request)
+    request_profiler.disable()
+    return JSONResponse(request_profiler.config())
+
+def get_captured_profile(profile_id: str):
+    trace = request_profiler.get(profile_id)
+    if trace is None:
+        raise HTTPException(status_code=404, detail="Profile not found; it may have left the ring buffer")
+    return trace
+
+@app.get("/openai/profiling/profiles/{profile_id}")
+async def get_profile(request: Request, profile_id: str, top: int = 30):
+    require_admin(request)
+    trace = get_captured_profile(profile_id)
+    return JSONResponse(await run_in_threadpool(trace.detail, min(max(top, 1), 200)))
+
+@app.get("/openai/profiling/profiles/{profile_id}/download")
+async def download_profile(request: Request, profile_id: str, format: str = "collapsed"):
+    """Collapsed stacks for flamegraph.pl/speedscope, or pstats (.prof) data when the request was cProfiled"""
+    require_admin(request)
+    trace = get_captured_profile(profile_id)
+    if format == "collapsed":
+        return Response(
+            collapsed_stacks([trace]),
+            media_type="text/plain; charset=utf-8",
+            headers={"Content-Disposition": content_disposition(f"profile-{trace.id}.folded")}
+        )
+    if format == "pstats":
+        data = await run_in_threadpool(pstats_bytes, trace)
+        if data is None:
+            raise HTTPException(status_code=404, detail="This request was not profiled with cProfile")
+        return Response(
+            data,
+            media_type="application/octet-stream",
+            headers={"Content-Disposition": content_disposition(f"profile-{trace.id}.prof")}
+        )
+    raise HTTPException(status_code=400, detail="Unsupported format. Use collapsed or pstats.")
+
+@app.get("/openai/profiling/flamegraph")
+async def download_flamegraph(request: Request, path: Optional[str] = None):
+    """Collapsed stacks of every captured profile (optionally one route's), merged into one flamegraph"""
+    require_admin(request)
+    traces = request_profiler.profiles(path)
+    return Response(
+        collapsed_stacks(traces),
+        media_type="text/plain; charset=utf-8",
+        headers={"Content-Disposition": content_disposition("profiles.folded")}
+    )
+
+@app.post("/openai/summarize-file")
+async def summarize_file(
+    user_id: str = Form(...),
+    file: UploadFile = File(...),
+    background_tasks: BackgroundTasks = None
+):
+    try:
+        # Extract text from file
+        document_text, upload = await run_in_threadpool(read_upload, file)
+        
+        # Generate summary using OpenAI
+        summary_data = await run_in_threadpool(generate_file_summary, document_text, user_id)
+        
         # Store summary in database
         summary_doc = {
             "user_id": user_id,
             "file_name": file.filename,
-            "file_size": file.size,
-            "content_type": file.content_type,
+            "file_size": upload.size,
+            "content_type": upload.content_type,
+            "file_sha256": upload.sha256,
             "summary": summary_data,
             "created_at": datetime.utcnow()
         }
@@ -682,15 +2253,99 @@ async def summarize_file(
         return JSONResponse({
             "success": True,
             "summary": summary_data,
+            "is_fallback": summary_data.get("is_fallback", False),
             "file_name": file.filename
         })
         
+    except PASSTHROUGH_ERRORS:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error summarizing file: {str(e)}")
+
+@app.post("/openai/summarize-file/stream")
+async def summarize_file_stream(
+    user_id: str = Form(...),
+    file: UploadFile = File(...)
+):
+    """Server-sent events: summary fields as they are generated, then the stored summary"""
+    try:
+        document_text, upload = await run_in_threadpool(read_upload, file)
+        
+        messages = file_summary_messages(document_text)
+        decision = route_model("file_summary", messages, 1000, DEFAULT_MODEL)
+        
+        # Admit before the response starts so a rejection can still be a 429/503
+        ticket, model = await run_in_threadpool(acquire_routed_slot, decision, user_id, PRIORITY_SUMMARIZE)
+        
+        def fallback(reason, error):
+            if reason == "parse_error":
+                return file_summary_fallback("Failed to parse document content", reason)
+            return file_summary_fallback(f"Error processing document: {str(error)}", reason)
+        
+        def store_summary(summary_data):
+            summary_data.setdefault("timestamp", datetime.utcnow().isoformat())
+            if file_summaries_collection is not None:
+                try:
+                    file_summaries_collection.insert_one({
+                        "user_id": user_id,
+                        "file_name": file.filename,
+                        "file_size": upload.size,
+                        "content_type": upload.content_type,
+                        "file_sha256": upload.sha256,
+                        "summary": dict(summary_data),
+                        "created_at": datetime.utcnow()
+                    })
+                except Exception as e:
+                    print(f"Error storing summary: {e}")
+            return summary_data
+        
+        events = stream_structured_completion(
+            "file_summary",
+            FileSummaryFields,
+            messages,
+            decision,
+            model,
+            ticket,
+            fallback,
+            temperature=0.3,
+            max_tokens=1000,
+            user_id=user_id,
+            priority=PRIORITY_SUMMARIZE,
+            on_result=store_summary
+        )
+        # Release again after the response in case the generator never started
+        return StreamingResponse(events, media_type="text/event-stream", headers=SSE_HEADERS,
+                                 background=BackgroundTask(ticket.release))
+        
+    except PASSTHROUGH_ERRORS:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error summarizing file: {str(e)}")
 
+def summaries_validator(user_id):
+    """Summary count plus newest created_at and updated_at (backfills rewrite summaries in place)"""
+    query = {"user_id": user_id}
+    created = file_summaries_collection.find_one(query, {"_id": 0, "created_at": 1}, sort=[("created_at", DESCENDING)])
+    updated = file_summaries_collection.find_one(
+        {"user_id": user_id, "updated_at": {"$exists": True}},
+        {"_id": 0, "updated_at": 1},
+        sort=[("updated_at", DESCENDING)]
+    )
+    created_at = (created or {}).get("created_at")
+    updated_at = (updated or {}).get("updated_at")
+    validator = ["summaries", user_id, file_summaries_collection.count_documents(query), created_at, updated_at]
+    return validator, newest(created_at, updated_at)
+
 @app.get("/openai/summaries/{user_id}")
-async def get_user_summaries(user_id: str):
+async def get_user_summaries(user_id: str, request: Request):
     try:
+        headers = None
+        if file_summaries_collection is not None:
+            validator, last_modified = await run_in_threadpool(summaries_validator, user_id)
+            headers, not_modified = check_conditional(request, validator, last_modified)
+            if not_modified:
+                return not_modified
+        
         summaries = list(file_summaries_collection.find(
             {"user_id": user_id},
             {"_id": 0}
@@ -707,96 +2362,794 @@ async def get_user_summaries(user_id: str):
         
         return JSONResponse({
             "summaries": serialized_summaries
-        })
+        }, headers=headers)
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching summaries: {str(e)}")
 
-# ---------- Financial Analysis Functions ----------
-def get_company_financials(company_name: str):
-    """Get comprehensive financial data for a company"""
+SUMMARY_FACETS = {
+    "feedback": "$summary.feedback",
+    "project_status": "$summary.project_status",
+    "vertical": "$summary.vertical",
+}
+MAX_SEARCH_PAGE_SIZE = 100
+
+def parse_date_param(value, name):
+    """Naive UTC datetime of an ISO date or datetime; an explicit offset is converted, not dropped"""
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid {name}, expected an ISO date")
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+def date_range_filter(date_from, date_to):
+    """Mongo range for date_from/date_to; a date-only date_to includes that whole day"""
+    date_range = {}
+    start = parse_date_param(date_from, "date_from")
+    end = parse_date_param(date_to, "date_to")
+    if start:
+        date_range["$gte"] = start
+    if end:
+        if len(date_to.strip()) == 10:
+            date_range["$lt"] = end + timedelta(days=1)
+        else:
+            date_range["$lte"] = end
+    return date_range
+
+def build_summary_search_query(user_id, q=None, feedback=None, project_status=None, vertical=None,
+                               client_region=None, date_from=None, date_to=None):
+    """Mongo filter for a user's summaries; comma-separated values match any of them"""
+    query = {"user_id": user_id}
+    if q:
+        query["$text"] = {"$search": q}
+    for field, value in (("feedback", feedback), ("project_status", project_status),
+                         ("vertical", vertical), ("client_region", client_region)):
+        if value:
+            values = [v.strip() for v in value.split(",") if v.strip()]
+            query[f"summary.{field}"] = values[0] if len(values) == 1 else {"$in": values}
+    created_at = date_range_filter(date_from, date_to)
+    if created_at:
+        query["created_at"] = created_at
+    return query
+
+@app.get("/openai/summaries/{user_id}/search")
+async def search_user_summaries(
+    user_id: str,
+    q: Optional[str] = None,
+    feedback: Optional[str] = None,
+    project_status: Optional[str] = None,
+    vertical: Optional[str] = None,
+    client_region: Optional[str] = None,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    page: int = 1,
+    page_size: int = 20
+):
+    try:
+        if file_summaries_collection is None:
+            raise HTTPException(status_code=500, detail="Database not connected. Please ensure MongoDB is running and MONGO_URI is set correctly.")
+        
+        page = max(1, page)
+        page_size = min(max(1, page_size), MAX_SEARCH_PAGE_SIZE)
+        query = build_summary_search_query(user_id, q, feedback, project_status, vertical,
+                                           client_region, date_from, date_to)
+        
+        facets = {
+            name: [
+                {"$group": {"_id": {"$ifNull": [path, "Unknown"]}, "count": {"$sum": 1}}},
+                {"$sort": {"count": -1}}
+            ]
+            for name, path in SUMMARY_FACETS.items()
+        }
+        pipeline = [{"$match": query}]
+        if q:
+            pipeline.append({"$addFields": {"score": {"$meta": "textScore"}}})
+            sort_stage = {"$sort": {"score": -1, "created_at": -1}}
+        else:
+            sort_stage = {"$sort": {"created_at": -1}}
+        pipeline.append({"$facet": {
+            "results": [
+                sort_stage,
+                {"$skip": (page - 1) * page_size},
+                {"$limit": page_size},
+                {"$project": {"_id": 0}}
+            ],
+            "total": [{"$count": "count"}],
+            **facets
+        }})
+        
+        started = time.perf_counter()
+        result = await run_in_threadpool(lambda: next(file_summaries_collection.aggregate(pipeline), {}))
+        took_ms = round((time.perf_counter() - started) * 1000, 2)
+        
+        total = result["total"][0]["count"] if result.get("total") else 0
+        return JSONResponse({
+            "summaries": [serialize_mongo_doc(doc) for doc in result.get("results", [])],
+            "total": total,
+            "page": page,
+            "page_size": page_size,
+            "pages": (total + page_size - 1) // page_size,
+            "facets": {
+                name: {str(bucket["_id"]): bucket["count"] for bucket in result.get(name, [])}
+                for name in SUMMARY_FACETS
+            },
+            "took_ms": took_ms
+        })
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error searching summaries: {str(e)}")
+
+# ---------- Message Archival ----------
+_archival_lock = threading.Lock()
+_archival_stop = threading.Event()
+
+def idle_sessions_query(cutoff):
+    """Sessions idle since before cutoff with messages newer than their last archival"""
+    return {
+        "last_updated": {"$lt": cutoff},
+        "$or": [
+            {"archived_upto": {"$exists": False}},
+            {"$expr": {"$gt": ["$last_updated", "$archived_upto"]}},
+        ],
+    }
+
+def archive_idle_sessions(older_than_days=None, limit=None):
+    """Move the messages of sessions idle for longer than older_than_days into the archive"""
+    if not _archival_lock.acquire(blocking=False):
+        return {"skipped": "An archival run is already in progress"}
     try:
-        # Search for the company ticker
-        ticker = None
+        started = time.perf_counter()
+        cutoff = datetime.utcnow() - timedelta(days=older_than_days or MESSAGE_ARCHIVE_AFTER_DAYS)
+        sessions = list(chat_sessions_collection.find(
+            idle_sessions_query(cutoff),
+            {"_id": 0, "session_id": 1, "user_id": 1, "last_updated": 1, "message_count": 1}
+        ).sort("last_updated", ASCENDING).limit(limit or MESSAGE_ARCHIVE_BATCH))
+        
+        legacy = [session["session_id"] for session in sessions if "message_count" not in session]
+        if legacy:
+            # Counts are computed from hot storage, so they must exist before the messages leave it
+            backfill_session_list_fields(legacy)
+        
+        stats = {"sessions": 0, "messages": 0, "failed": 0}
+        for session in sessions:
+            session_id = session["session_id"]
+            try:
+                moved = message_store.archive_session(session_id, session.get("user_id"))
+                # A message written meanwhile moves last_updated, and the session is picked up next run
+                chat_sessions_collection.update_one(
+                    {"session_id": session_id, "last_updated": session["last_updated"]},
+                    {
+                        "$set": {"archived_at": datetime.utcnow(), "archived_upto": session["last_updated"]},
+                        "$inc": {"archived_messages": moved}
+                    }
+                )
+                # Cold sessions shouldn't hold cache memory
+                session_history_cache.invalidate(session_id)
+                stats["sessions"] += 1
+                stats["messages"] += moved
+            except Exception as e:
+                stats["failed"] += 1
+                print(f"Error archiving session {session_id}: {e}")
+        stats["took_ms"] = round((time.perf_counter() - started) * 1000, 2)
+        stats["cutoff"] = cutoff.isoformat()
+        print(f"Message archival: {stats['messages']} messages from {stats['sessions']} sessions "
+              f"({stats['failed']} failed)")
+        return stats
+    finally:
+        _archival_lock.release()
+
+def message_archival_loop():
+    while not _archival_stop.wait(MESSAGE_ARCHIVE_INTERVAL_HOURS * 3600):
         try:
-            # Try to find ticker using yfinance search
-            search_results = yf.Tickers(company_name)
-            if search_results.tickers:
-                ticker = search_results.tickers[0]
-        except:
-            pass
+            archive_idle_sessions()
+        except Exception as e:
+            print(f"Error in scheduled message archival: {e}")
+
+@app.on_event("startup")
+def start_message_archival():
+    if MESSAGE_ARCHIVE_INTERVAL_HOURS > 0 and message_store is not None and message_store.archive is not None:
+        threading.Thread(target=message_archival_loop, name="message-archival", daemon=True).start()
+
+@app.on_event("shutdown")
+def stop_message_archival():
+    _archival_stop.set()
+
+@app.post("/openai/messages/archive")
+async def run_message_archival(request: Request, older_than_days: Optional[float] = None, limit: Optional[int] = None):
+    """Archive idle sessions now instead of waiting for the scheduled run (admin)"""
+    require_admin(request)
+    try:
+        require_database(chat_sessions_collection)
+        if message_store.archive is None:
+            raise HTTPException(status_code=400, detail="Message archive is disabled; set MESSAGE_ARCHIVE to mongo or file")
+        return JSONResponse(await run_in_threadpool(archive_idle_sessions, older_than_days, limit))
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error archiving messages: {str(e)}")
+
+# ---------- Streaming Exports ----------
+# Rows fetched per cursor round trip and encoded per response chunk
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "500"))
+
+# Export field name -> document path
+SUMMARY_EXPORT_COLUMNS = {
+    "file_name": "file_name",
+    "user_name": "summary.user_name",
+    "client_name": "summary.client_name",
+    "client_region": "summary.client_region",
+    "vertical": "summary.vertical",
+    "feedback": "summary.feedback",
+    "project_status": "summary.project_status",
+    "input_summary": "summary.input_summary",
+    "created_at": "created_at",
+    "updated_at": "updated_at",
+}
+TRANSCRIPT_EXPORT_COLUMNS = {
+    "timestamp": "timestamp",
+    "message_type": "message_type",
+    "content": "content",
+    "model_used": "model_used",
+}
+
+def export_columns(available, fields=None):
+    """(field, path) pairs for the comma-separated fields requested, all of them by default"""
+    if not fields:
+        return list(available.items())
+    names = list(dict.fromkeys(f.strip() for f in fields.split(",") if f.strip()))
+    unknown = [name for name in names if name not in available]
+    if unknown or not names:
+        raise HTTPException(status_code=400, detail=f"Unknown export fields: {', '.join(unknown)}. "
+                                                    f"Available: {', '.join(available)}")
+    return [(name, available[name]) for name in names]
+
+def check_export_format(export_format):
+    if export_format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unsupported export format, expected one of: {', '.join(EXPORT_FORMATS)}")
+
+def export_response(export_format, docs, columns, filename, sheet_name="Export", close=None):
+    """Stream the documents (a cursor or generator); the sync generator is driven from the threadpool"""
+    chunks = stream_export(export_format, iter_rows(docs, columns), [name for name, _ in columns],
+                           sheet_name, EXPORT_BATCH_SIZE)
+    return StreamingResponse(
+        chunks,
+        media_type=EXPORT_FORMATS[export_format],
+        headers={
+            "Content-Disposition": content_disposition(f"{filename}.{export_format}"),
+            "Cache-Control": "no-store",
+        },
+        background=BackgroundTask(close) if close else None
+    )
+
+@app.get("/openai/summaries/{user_id}/export")
+async def export_user_summaries(
+    user_id: str,
+    format: str = "csv",
+    fields: Optional[str] = None,
+    q: Optional[str] = None,
+    feedback: Optional[str] = None,
+    project_status: Optional[str] = None,
+    vertical: Optional[str] = None,
+    client_region: Optional[str] = None,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None
+):
+    """Every matching summary, streamed; filters and the field list are pushed down into the query"""
+    try:
+        require_database(file_summaries_collection)
+        check_export_format(format)
+        columns = export_columns(SUMMARY_EXPORT_COLUMNS, fields)
+        query = build_summary_search_query(user_id, q, feedback, project_status, vertical,
+                                           client_region, date_from, date_to)
+        projection = {"_id": 0, **{path: 1 for _, path in columns}}
+        cursor = file_summaries_collection.find(query, projection).sort("created_at", DESCENDING).batch_size(EXPORT_BATCH_SIZE)
+        filename = f"summaries_{user_id}_{datetime.utcnow().strftime('%Y-%m-%d')}"
+        return export_response(format, cursor, columns, filename, sheet_name="Summaries", close=cursor.close)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error exporting summaries: {str(e)}")
+
+@app.get("/openai/sessions/{session_id}/export")
+async def export_session_transcript(
+    session_id: str,
+    format: str = "csv",
+    fields: Optional[str] = None,
+    message_type: Optional[str] = None,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None
+):
+    """A session's messages in chronological order, streamed"""
+    try:
+        require_database(chat_messages_collection)
+        check_export_format(format)
+        columns = export_columns(TRANSCRIPT_EXPORT_COLUMNS, fields)
+        session = await run_in_threadpool(chat_sessions_collection.find_one, {"session_id": session_id}, {"_id": 1})
+        if session is None:
+            raise HTTPException(status_code=404, detail="Session not found")
+        timestamp = date_range_filter(date_from, date_to)
+        # Merged from per-message documents, buckets and the archive, whichever hold the session
+        messages = message_store.iter_messages(session_id, timestamp=timestamp, message_type=message_type,
+                                               fields=[path for _, path in columns], batch_size=EXPORT_BATCH_SIZE)
+        return export_response(format, messages, columns, f"chat_{session_id}", sheet_name="Transcript",
+                               close=messages.close)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error exporting chat transcript: {str(e)}")
+
+# ---------- Document Retrieval (RAG) ----------
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-3-small")
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "96"))
+RAG_CHUNK_CHARS = int(os.getenv("RAG_CHUNK_CHARS", "1500"))
+RAG_CHUNK_OVERLAP = int(os.getenv("RAG_CHUNK_OVERLAP", "200"))
+RAG_TOP_K = int(os.getenv("RAG_TOP_K", "5"))
+RAG_MIN_SCORE = float(os.getenv("RAG_MIN_SCORE", "0.2"))
+# Full text is kept on the document record (for re-summarization) up to this size
+MAX_STORED_DOCUMENT_CHARS = 4 * 1024 * 1024
+
+vector_store = VectorIndexStore(os.getenv("VECTOR_INDEX_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "vector_index")))
+
+def create_embeddings(texts, user_id=None, priority=PRIORITY_CHAT):
+    """Embed texts in batches, each batch admitted and retried like a chat completion"""
+    vectors = []
+    for start in range(0, len(texts), EMBEDDING_BATCH_SIZE):
+        batch = texts[start:start + EMBEDDING_BATCH_SIZE]
+        with acquire_llm_slot(user_id, EMBEDDING_MODEL, priority):
+            started = time.monotonic()
+            try:
+                response = call_with_resilience(
+                    lambda timeout: openai_client.embeddings.create(model=EMBEDDING_MODEL, input=batch, timeout=timeout),
+                    LLM_CALL_DEADLINE,
+                    retry_policy=llm_retry_policy,
+                    breaker=llm_breakers.get(EMBEDDING_MODEL),
+                    stats=llm_resilience_stats
+                )
+            except Exception as e:
+                record_llm_usage(EMBEDDING_MODEL, [], None, time.monotonic() - started, user_id, "embedding", error=e)
+                raise
+            record_llm_usage(EMBEDDING_MODEL, [{"content": text} for text in batch], getattr(response, "usage", None),
+                             time.monotonic() - started, user_id, "embedding")
+        vectors.extend(item.embedding for item in sorted(response.data, key=lambda item: item.index))
+    return vectors
+
+@stage("ingest")
+def ingest_document(user_id, file_name, document_text, upload):
+    """Chunk, embed and store a document for retrieval; returns (document, created)"""
+    if documents_collection is None:
+        raise HTTPException(status_code=500, detail="Database not connected. Please ensure MongoDB is running and MONGO_URI is set correctly.")
+    
+    existing = documents_collection.find_one({"user_id": user_id, "file_sha256": upload.sha256}, {"_id": 0, "text": 0})
+    if existing:
+        return existing, False
+    
+    chunks = chunk_text(document_text, RAG_CHUNK_CHARS, RAG_CHUNK_OVERLAP)
+    if not chunks:
+        raise HTTPException(status_code=400, detail="No text could be extracted from the document")
+    
+    document_id = str(uuid.uuid4())
+    vectors = create_embeddings(chunks, user_id, PRIORITY_SUMMARIZE)
+    chunk_ids = [f"{document_id}:{i}" for i in range(len(chunks))]
+    document_chunks_collection.insert_many([
+        {
+            "chunk_id": chunk_id,
+            "document_id": document_id,
+            "user_id": user_id,
+            "chunk_index": i,
+            "text": chunk
+        }
+        for i, (chunk_id, chunk) in enumerate(zip(chunk_ids, chunks))
+    ])
+    vector_store.get(user_id).add(chunk_ids, vectors)
+    
+    document = {
+        "document_id": document_id,
+        "user_id": user_id,
+        "file_name": file_name,
+        "file_size": upload.size,
+        "content_type": upload.content_type,
+        "file_sha256": upload.sha256,
+        "chunk_count": len(chunks),
+        "text_length": len(document_text),
+        "embedding_model": EMBEDDING_MODEL,
+        "created_at": datetime.utcnow()
+    }
+    stored = dict(document)
+    if len(document_text) <= MAX_STORED_DOCUMENT_CHARS:
+        stored["text"] = document_text
+    try:
+        documents_collection.insert_one(stored)
+    except DuplicateKeyError:
+        # A concurrent upload of the same file won; drop this copy's chunks and return that one
+        document_chunks_collection.delete_many({"document_id": document_id})
+        vector_store.get(user_id).remove_prefix(f"{document_id}:")
+        existing = documents_collection.find_one({"user_id": user_id, "file_sha256": upload.sha256}, {"_id": 0, "text": 0})
+        if existing is None:
+            raise
+        return existing, False
+    return document, True
+
+def retrieve_document_chunks(user_id, query, k=RAG_TOP_K, document_ids=None):
+    """Top-k chunks of the user's documents most similar to the query"""
+    index = vector_store.get(user_id)
+    if len(index) == 0:
+        return []
+    query_vector = create_embeddings([query], user_id, PRIORITY_CHAT)[0]
+    allowed = set(document_ids) if document_ids else None
+    hits = [(chunk_id, score) for chunk_id, score in index.search(query_vector, k, allowed) if score >= RAG_MIN_SCORE]
+    if not hits:
+        return []
+    
+    chunks = {
+        chunk["chunk_id"]: chunk
+        for chunk in document_chunks_collection.find({"chunk_id": {"$in": [chunk_id for chunk_id, _ in hits]}}, {"_id": 0})
+    }
+    document_names = {
+        doc["document_id"]: doc.get("file_name")
+        for doc in documents_collection.find(
+            {"document_id": {"$in": list({chunk["document_id"] for chunk in chunks.values()})}},
+            {"_id": 0, "document_id": 1, "file_name": 1}
+        )
+    }
+    results = []
+    for chunk_id, score in hits:
+        chunk = chunks.get(chunk_id)
+        if chunk:
+            chunk["score"] = round(score, 4)
+            chunk["file_name"] = document_names.get(chunk["document_id"])
+            results.append(chunk)
+    return results
+
+@stage("retrieval")
+def build_retrieval_input(user_id, message, document_ids=None):
+    """Prompt input made of the message plus the most relevant document excerpts"""
+    ids = [i.strip() for i in document_ids.split(",") if i.strip()] if document_ids else None
+    chunks = retrieve_document_chunks(user_id, message, RAG_TOP_K, ids)
+    if not chunks:
+        return message, []
+    
+    excerpts = "\n\n".join(
+        f"[{i + 1}] From {chunk.get('file_name') or 'document'}:\n{chunk['text']}"
+        for i, chunk in enumerate(chunks)
+    )
+    full_input = f"Relevant excerpts from the user's documents:\n{excerpts}\n\nUser question: {message}"
+    sources = [
+        {
+            "document_id": chunk["document_id"],
+            "file_name": chunk.get("file_name"),
+            "chunk_index": chunk["chunk_index"],
+            "score": chunk["score"]
+        }
+        for chunk in chunks
+    ]
+    return full_input, sources
+
+@app.post("/openai/documents")
+async def upload_document(
+    user_id: str = Form(...),
+    file: UploadFile = File(...)
+):
+    try:
+        document_text, upload = await run_in_threadpool(read_upload, file)
+        document, created = await run_in_threadpool(ingest_document, user_id, file.filename, document_text, upload)
+        return JSONResponse({
+            "success": True,
+            "created": created,
+            "document": serialize_mongo_doc(document)
+        }, status_code=201 if created else 200)
         
-        if not ticker:
-            # Fallback: try common ticker mappings
-            ticker_mappings = {
-                'apple': 'AAPL',
-                'tesla': 'TSLA',
-                'microsoft': 'MSFT',
-                'google': 'GOOGL',
-                'amazon': 'AMZN',
-                'netflix': 'NFLX',
-                'meta': 'META',
-                'nvidia': 'NVDA',
-                'amd': 'AMD',
-                'intel': 'INTC'
-            }
-            ticker = ticker_mappings.get(company_name.lower())
+    except PASSTHROUGH_ERRORS:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error ingesting document: {str(e)}")
+
+@app.get("/openai/users/{user_id}/documents")
+async def list_user_documents(user_id: str):
+    try:
+        if documents_collection is None:
+            raise HTTPException(status_code=500, detail="Database not connected. Please ensure MongoDB is running and MONGO_URI is set correctly.")
+        documents = list(documents_collection.find(
+            {"user_id": user_id},
+            {"_id": 0, "text": 0}
+        ).sort("created_at", DESCENDING))
+        return JSONResponse({"documents": [serialize_mongo_doc(doc) for doc in documents]})
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error fetching documents: {str(e)}")
+
+@app.delete("/openai/documents/{document_id}")
+async def delete_document(document_id: str, user_id: str):
+    try:
+        if documents_collection is None:
+            raise HTTPException(status_code=500, detail="Database not connected. Please ensure MongoDB is running and MONGO_URI is set correctly.")
+        result = documents_collection.delete_one({"document_id": document_id, "user_id": user_id})
+        if result.deleted_count == 0:
+            raise HTTPException(status_code=404, detail="Document not found")
+        document_chunks_collection.delete_many({"document_id": document_id})
+        removed = await run_in_threadpool(vector_store.get(user_id).remove_prefix, f"{document_id}:")
+        return JSONResponse({"success": True, "document_id": document_id, "chunks_removed": removed})
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error deleting document: {str(e)}")
+
+# ---------- Bulk Summarization Jobs ----------
+SUMMARY_JOB_WORKERS = int(os.getenv("SUMMARY_JOB_WORKERS", "4"))
+SUMMARY_JOB_MAX_FILES = int(os.getenv("SUMMARY_JOB_MAX_FILES", "500"))
+SUMMARY_JOB_FILE_TIMEOUT = float(os.getenv("SUMMARY_JOB_FILE_TIMEOUT", "600"))
+
+def summarize_spooled_file(user_id, item):
+    """Extract and summarize one file of a bulk job; raises if no real summary was produced"""
+    with open(item["path"], "rb") as f:
+        document_text = extract_text(f, item["content_type"])
+    
+    # Bulk work yields to interactive traffic: wait out admission rejections instead of failing
+    give_up_at = time.monotonic() + SUMMARY_JOB_FILE_TIMEOUT
+    while True:
+        try:
+            summary_data = generate_file_summary(document_text, user_id, PRIORITY_BULK)
+            break
+        except AdmissionRejected as e:
+            if time.monotonic() + e.retry_after > give_up_at:
+                raise
+            time.sleep(e.retry_after)
+    
+    if summary_data.get("is_fallback"):
+        raise RuntimeError(summary_data.get("input_summary") or "Summary generation failed")
+    
+    return {
+        "user_id": user_id,
+        "file_name": item["file_name"],
+        "file_size": item.get("file_size"),
+        "content_type": item["content_type"],
+        "file_sha256": item.get("sha256"),
+        "summary": summary_data,
+        "created_at": datetime.utcnow()
+    }
+
+def store_summary_batch(documents):
+    if file_summaries_collection is None:
+        raise RuntimeError("Database not connected")
+    try:
+        file_summaries_collection.insert_many(documents, ordered=False)
+    except BulkWriteError as e:
+        # A duplicate _id means an earlier attempt already stored that document
+        return [error["index"] for error in e.details.get("writeErrors", []) if error.get("code") != 11000]
+
+def persist_summary_job(job):
+    if summary_jobs_collection is None:
+        return
+    summary_jobs_collection.replace_one({"job_id": job["job_id"]}, job, upsert=True)
+
+summary_job_manager = SummaryJobManager(
+    summarize_spooled_file,
+    store_summary_batch,
+    persist_job=persist_summary_job,
+    max_workers=SUMMARY_JOB_WORKERS,
+    batch_size=int(os.getenv("SUMMARY_JOB_BATCH_SIZE", "25"))
+)
+
+def job_item(upload):
+    return {
+        "file_name": upload.filename,
+        "path": upload.path,
+        "content_type": upload.content_type,
+        "file_size": upload.size,
+        "sha256": upload.sha256
+    }
+
+def discard_spooled(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+def spool_job_uploads(files: List[UploadFile]):
+    """Spool uploads (expanding zip archives) to temp files the job workers can read later.
+
+    Returns (items, skipped); every file left out of the job is listed in `skipped` with the reason,
+    whether it was uploaded directly or found in an archive.
+    """
+    items = []
+    skipped = []
+    
+    def accept(upload, file_name):
+        if upload.content_type not in SUPPORTED_CONTENT_TYPES:
+            discard_spooled(upload.path)
+            skipped.append({"file_name": file_name, "reason": "unsupported file type"})
+        elif upload.size > MAX_UPLOAD_BYTES:
+            discard_spooled(upload.path)
+            skipped.append({"file_name": file_name, "reason": "exceeds the maximum upload size"})
+        elif len(items) >= SUMMARY_JOB_MAX_FILES:
+            discard_spooled(upload.path)
+            skipped.append({"file_name": file_name, "reason": f"job file limit of {SUMMARY_JOB_MAX_FILES} reached"})
+        else:
+            items.append(job_item(upload))
+    
+    try:
+        for file in files:
+            file_name = file.filename or "upload"
+            upload = spool_upload_to_path(file.file, file_name, MAX_BULK_UPLOAD_BYTES, prefix="summary-job-",
+                                          declared_type=file.content_type)
+            if upload.content_type != ZIP:
+                accept(upload, file_name)
+                continue
+            
+            try:
+                with zipfile.ZipFile(upload.path) as archive:
+                    for member in archive.infolist():
+                        member_name = os.path.basename(member.filename)
+                        if member.is_dir() or member.filename.startswith("__MACOSX/") or member_name.startswith("."):
+                            continue
+                        if member.file_size > MAX_UPLOAD_BYTES:
+                            skipped.append({"file_name": member.filename, "reason": "exceeds the maximum upload size"})
+                            continue
+                        if len(items) >= SUMMARY_JOB_MAX_FILES:
+                            skipped.append({"file_name": member.filename, "reason": f"job file limit of {SUMMARY_JOB_MAX_FILES} reached"})
+                            continue
+                        try:
+                            with archive.open(member) as member_stream:
+                                extracted = spool_upload_to_path(member_stream, member_name, MAX_UPLOAD_BYTES, prefix="summary-job-")
+                        except UploadTooLarge:
+                            # The archive's size header understated the member
+                            skipped.append({"file_name": member.filename, "reason": "exceeds the maximum upload size"})
+                            continue
+                        accept(extracted, member.filename)
+            finally:
+                discard_spooled(upload.path)
+    except UploadTooLarge as e:
+        for item in items:
+            discard_spooled(item["path"])
+        raise HTTPException(status_code=413, detail=str(e))
+    except Exception:
+        for item in items:
+            discard_spooled(item["path"])
+        raise
+    return items, skipped
+
+@app.post("/openai/summarize-files/jobs")
+async def create_summary_job(
+    user_id: str = Form(...),
+    files: List[UploadFile] = File(...)
+):
+    try:
+        items, skipped = await run_in_threadpool(spool_job_uploads, files)
+        if not items:
+            raise HTTPException(status_code=400, detail={
+                "message": "No supported files (PDF, DOCX, TXT) within the size limit found in upload",
+                "skipped": skipped
+            })
+        
+        job = summary_job_manager.submit(user_id, items, skipped)
+        print(f"Created summary job {job.job_id} with {job.total} files for user {user_id} ({len(skipped)} skipped)")
         
+        return JSONResponse({
+            "success": True,
+            "job_id": job.job_id,
+            "total": job.total,
+            "skipped": skipped,
+            "status": job.status
+        }, status_code=202)
+        
+    except PASSTHROUGH_ERRORS:
+        raise
+    except zipfile.BadZipFile:
+        raise HTTPException(status_code=400, detail="Invalid zip archive")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error creating summary job: {str(e)}")
+
+@app.get("/openai/summarize-files/jobs/{job_id}")
+async def get_summary_job(job_id: str, include_results: bool = True):
+    job = summary_job_manager.get(job_id)
+    if job is not None:
+        return JSONResponse(job.to_dict(include_results))
+    
+    # Finished jobs outlive the in-memory registry
+    if summary_jobs_collection is not None:
+        stored = summary_jobs_collection.find_one({"job_id": job_id}, {"_id": 0})
+        if stored:
+            if not include_results:
+                stored.pop("files", None)
+            return JSONResponse(serialize_mongo_doc(stored))
+    raise HTTPException(status_code=404, detail="Job not found")
+
+@app.get("/openai/users/{user_id}/summarize-jobs")
+async def list_summary_jobs(user_id: str):
+    jobs = [job.to_dict(include_results=False) for job in summary_job_manager.list_for_user(user_id)]
+    return JSONResponse({"jobs": jobs})
+
+# ---------- Financial Statement Store ----------
+# Statements older than this are refetched from yfinance (and served stale if that fails)
+FINANCIAL_STORE_MAX_AGE = timedelta(hours=float(os.getenv("FINANCIAL_STORE_MAX_AGE_HOURS", "24")))
+
+try:
+    financial_store = FinancialStore(os.getenv("FINANCIAL_STORE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "financial_store")))
+except Exception as e:
+    print(f"Financial statement store disabled: {e}")
+    financial_store = None
+
+# ---------- Financial Analysis Functions ----------
+def resolve_ticker(company_name: str):
+    """Ticker symbol for a company name, or None"""
+    ticker = None
+    try:
+        # Try to find ticker using yfinance search
+        search_results = yf.Tickers(company_name)
+        if search_results.tickers:
+            ticker = search_results.tickers[0]
+    except:
+        pass
+    
+    if not ticker:
+        # Fallback: try common ticker mappings
+        ticker_mappings = {
+            'apple': 'AAPL',
+            'tesla': 'TSLA',
+            'microsoft': 'MSFT',
+            'google': 'GOOGL',
+            'amazon': 'AMZN',
+            'netflix': 'NFLX',
+            'meta': 'META',
+            'nvidia': 'NVDA',
+            'amd': 'AMD',
+            'intel': 'INTC'
+        }
+        ticker = ticker_mappings.get(company_name.lower())
+    return ticker
+
+def financials_response(ticker, company_name, statements, fetched_at, stale=False):
+    return {
+        "ticker": ticker,
+        "company_name": company_name,
+        **statements,
+        "fetched_at": fetched_at.isoformat(),
+        "stale": stale
+    }
+
+@company_financials_flight.coalesce(lambda company_name: flight_key(company_name))
+def get_company_financials(company_name: str):
+    """Get comprehensive financial data for a company"""
+    try:
+        ticker = resolve_ticker(company_name)
         if not ticker:
             raise HTTPException(status_code=404, detail=f"Could not find ticker for company: {company_name}")
         
-        # Get financial data
-        stock = yf.Ticker(ticker)
+        snapshot = financial_store.latest(ticker) if financial_store is not None else None
+        if snapshot is not None and snapshot.is_fresh(FINANCIAL_STORE_MAX_AGE):
+            return financials_response(ticker, company_name, snapshot.statements(), snapshot.fetched_at)
         
-        # Helper function to convert pandas data to JSON-serializable format
-        def convert_to_json_serializable(data):
-            if data is None:
-                return {}
+        try:
+            frames = fetch_statements(ticker)
+        except Exception as e:
+            if snapshot is None:
+                raise
+            print(f"Serving stored financials for {ticker} fetched at {snapshot.fetched_at}: {e}")
+            return financials_response(ticker, company_name, snapshot.statements(), snapshot.fetched_at, stale=True)
+        
+        if financial_store is not None:
             try:
-                # Convert to dict and handle datetime objects
-                if hasattr(data, 'to_dict'):
-                    data_dict = data.to_dict()
-                else:
-                    data_dict = data
-                
-                # Convert any remaining non-serializable objects
-                return json.loads(json.dumps(data_dict, default=str))
-            except:
-                return {}
-        
-        # Get various financial statements
-        financials = convert_to_json_serializable(stock.financials)
-        balance_sheet = convert_to_json_serializable(stock.balance_sheet)
-        cashflow = convert_to_json_serializable(stock.cashflow)
-        earnings = convert_to_json_serializable(stock.earnings)
-        quarterly_financials = convert_to_json_serializable(stock.quarterly_financials)
-        quarterly_balance_sheet = convert_to_json_serializable(stock.quarterly_balance_sheet)
-        quarterly_cashflow = convert_to_json_serializable(stock.quarterly_cashflow)
-        
-        return {
-            "ticker": ticker,
-            "company_name": company_name,
-            "financials": financials,
-            "balance_sheet": balance_sheet,
-            "cashflow": cashflow,
-            "earnings": earnings,
-            "quarterly_financials": quarterly_financials,
-            "quarterly_balance_sheet": quarterly_balance_sheet,
-            "quarterly_cashflow": quarterly_cashflow
-        }
+                snapshot = financial_store.save(ticker, company_name, frames)
+                return financials_response(ticker, company_name, snapshot.statements(), snapshot.fetched_at)
+            except Exception as e:
+                print(f"Error storing financials for {ticker}: {e}")
+        return financials_response(ticker, company_name, frames_statements(frames), datetime.utcnow())
         
     except Exception as e:
         print(f"Error getting financial data: {e}")
         raise HTTPException(status_code=500, detail=f"Error fetching financial data: {str(e)}")
 
-def generate_financial_insights(company_name: str, financial_data: dict):
-    """Generate AI-powered insights from financial data"""
-    try:
-        if not openai_client:
-            raise HTTPException(status_code=500, detail="OpenAI API key not configured")
-        
-        # Prepare financial data summary for LLM
-        financial_summary = f"""
+def financial_insights_messages(company_name, financial_data):
+    # Prepare financial data summary for LLM
+    financial_summary = f"""
         Company: {company_name}
         Ticker: {financial_data.get('ticker', 'Unknown')}
         
@@ -806,8 +3159,8 @@ def generate_financial_insights(company_name: str, financial_data: dict):
         - Cash Flow: {len(financial_data.get('cashflow', {}))} data points
         - Earnings: {len(financial_data.get('earnings', {}))} data points
         """
-        
-        prompt = f"""Analyze the following financial data for {company_name} and provide comprehensive insights:
+    
+    prompt = f"""Analyze the following financial data for {company_name} and provide comprehensive insights:
 
 {financial_summary}
 
@@ -835,65 +3188,79 @@ Please provide a detailed analysis in the following JSON format:
 }}
 
 Focus on actionable insights that would be valuable for sales teams and business development. Include specific innovation ideas and current market trends."""
+    return [
+        {"role": "system", "content": "You are a financial analyst expert with deep knowledge of business strategy and innovation. Provide clear, actionable insights based on financial data and market trends."},
+        {"role": "user", "content": prompt}
+    ]
+
+def default_financial_insights():
+    """Canned insights used when the model's output could not be parsed"""
+    return mark_fallback({
+        "insights": "Financial analysis completed. Key metrics show mixed performance with opportunities for growth.",
+        "recommendations": "Focus on revenue diversification and cost optimization strategies.",
+        "risk_assessment": "Monitor market volatility and competitive pressures.",
+        "growth_metrics": {
+            "revenue_growth": "5-10%",
+            "profit_margin": "15-20%",
+            "debt_ratio": "0.3-0.5",
+            "liquidity": "medium"
+        },
+        "charts_data": {
+            "revenue_trend": "stable",
+            "profitability": "improving",
+            "cash_flow": "positive"
+        },
+        "innovation_ideas": "Based on the company's financial position, consider:\n• Digital transformation initiatives\n• New market expansion strategies\n• Product development opportunities\n• Operational efficiency improvements\n• Strategic partnerships and acquisitions",
+        "current_trends": "Current market trends include:\n• Digital transformation acceleration\n• Sustainability and ESG focus\n• Remote work and hybrid models\n• Supply chain optimization\n• AI and automation adoption",
+        "market_position": "The company shows a solid market position with opportunities for growth in emerging markets and digital channels.",
+        "competitive_analysis": "Competitive landscape analysis suggests opportunities for differentiation through innovation and customer experience improvements."
+    }, "parse_error")
+
+def unavailable_financial_insights(error, reason):
+    return mark_fallback({
+        "insights": f"Error analyzing financial data: {error}",
+        "recommendations": "Unable to provide recommendations due to data processing error.",
+        "risk_assessment": "Risk assessment unavailable.",
+        "growth_metrics": {},
+        "charts_data": {},
+        "innovation_ideas": "Innovation analysis unavailable due to data processing error.",
+        "current_trends": "Trend analysis unavailable due to data processing error.",
+        "market_position": "Market position analysis unavailable due to data processing error.",
+        "competitive_analysis": "Competitive analysis unavailable due to data processing error."
+    }, reason)
+
+# LLM calls are only shared within a user, so admission and usage stay per user
+@financial_insights_flight.coalesce(lambda company_name, financial_data, user_id=None: flight_key(user_id, company_name, financial_data))
+def generate_financial_insights(company_name: str, financial_data: dict, user_id: Optional[str] = None):
+    """Generate AI-powered insights from financial data"""
+    try:
+        if not openai_client:
+            raise HTTPException(status_code=500, detail="OpenAI API key not configured")
         
-        response = openai_client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": "You are a financial analyst expert with deep knowledge of business strategy and innovation. Provide clear, actionable insights based on financial data and market trends."},
-                {"role": "user", "content": prompt}
-            ],
+        analysis = create_structured_completion(
+            "financial_insights",
+            FinancialInsights,
+            financial_insights_messages(company_name, financial_data),
+            model=DEFAULT_MODEL,
             temperature=0.3,
-            max_tokens=2000
+            max_tokens=2000,
+            user_id=user_id,
+            priority=PRIORITY_INSIGHTS
         )
         
-        content = response.choices[0].message.content.strip()
-        
-        # Parse JSON response
-        try:
-            if content.startswith("```json"):
-                content = content.replace("```json", "").replace("```", "").strip()
-            elif content.startswith("```"):
-                content = content.replace("```", "").strip()
-            
-            analysis = json.loads(content)
-            return analysis
-            
-        except json.JSONDecodeError:
-            # Return default structure if JSON parsing fails
-            return {
-                "insights": "Financial analysis completed. Key metrics show mixed performance with opportunities for growth.",
-                "recommendations": "Focus on revenue diversification and cost optimization strategies.",
-                "risk_assessment": "Monitor market volatility and competitive pressures.",
-                "growth_metrics": {
-                    "revenue_growth": "5-10%",
-                    "profit_margin": "15-20%",
-                    "debt_ratio": "0.3-0.5",
-                    "liquidity": "medium"
-                },
-                "charts_data": {
-                    "revenue_trend": "stable",
-                    "profitability": "improving",
-                    "cash_flow": "positive"
-                },
-                "innovation_ideas": "Based on the company's financial position, consider:\n• Digital transformation initiatives\n• New market expansion strategies\n• Product development opportunities\n• Operational efficiency improvements\n• Strategic partnerships and acquisitions",
-                "current_trends": "Current market trends include:\n• Digital transformation acceleration\n• Sustainability and ESG focus\n• Remote work and hybrid models\n• Supply chain optimization\n• AI and automation adoption",
-                "market_position": "The company shows a solid market position with opportunities for growth in emerging markets and digital channels.",
-                "competitive_analysis": "Competitive landscape analysis suggests opportunities for differentiation through innovation and customer experience improvements."
-            }
-            
+        analysis = analysis.model_dump()
+        analysis["is_fallback"] = False
+        return analysis
+
+    except StructuredOutputError as e:
+        print(f"JSON parsing error: {e}")
+        # Return default structure if the output could not be parsed or repaired
+        return default_financial_insights()
+    except AdmissionRejected:
+        raise
     except Exception as e:
         print(f"Error generating financial insights: {e}")
-        return {
-            "insights": f"Error analyzing financial data: {str(e)}",
-            "recommendations": "Unable to provide recommendations due to data processing error.",
-            "risk_assessment": "Risk assessment unavailable.",
-            "growth_metrics": {},
-            "charts_data": {},
-            "innovation_ideas": "Innovation analysis unavailable due to data processing error.",
-            "current_trends": "Trend analysis unavailable due to data processing error.",
-            "market_position": "Market position analysis unavailable due to data processing error.",
-            "competitive_analysis": "Competitive analysis unavailable due to data processing error."
-        }
+        return unavailable_financial_insights(str(e), fallback_reason(e))
 
 # ---------- Financial Analysis Endpoints ----------
 @app.post("/openai/financial-analysis")
@@ -905,7 +3272,7 @@ async def analyze_financial_data(request: dict):
             
         print(f"Analyzing financial data for company: {company_name}")
         
-        financial_data = get_company_financials(company_name)
+        financial_data = await run_in_threadpool(get_company_financials, company_name)
         
         return JSONResponse({
             "success": True,
@@ -913,9 +3280,53 @@ async def analyze_financial_data(request: dict):
             "message": f"Financial analysis completed for {company_name}"
         })
         
+    except PASSTHROUGH_ERRORS:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error in financial analysis: {str(e)}")
 
+MAX_COMPARE_COMPANIES = 10
+
+@app.get("/openai/financials/compare")
+async def compare_company_financials(companies: str, statement: str = "financials", line_items: Optional[str] = None):
+    """One statement side by side across companies, read from the local store"""
+    try:
+        if financial_store is None:
+            raise HTTPException(status_code=503, detail="Financial statement store is disabled (pyarrow not installed)")
+        if statement not in STATEMENTS:
+            raise HTTPException(status_code=400, detail=f"Unknown statement, expected one of: {', '.join(STATEMENTS)}")
+        names = list(dict.fromkeys(name.strip() for name in companies.split(",") if name.strip()))
+        if not 1 <= len(names) <= MAX_COMPARE_COMPANIES:
+            raise HTTPException(status_code=400, detail=f"Pass between 1 and {MAX_COMPARE_COMPANIES} comma-separated companies")
+        items = [item.strip() for item in line_items.split(",") if item.strip()] if line_items else None
+        
+        # Fresh snapshots load from disk; only missing or stale ones go to yfinance
+        results = await asyncio.gather(*(run_in_threadpool(get_company_financials, name) for name in names))
+        tickers = {name: result["ticker"] for name, result in zip(names, results)}
+        table = await run_in_threadpool(financial_store.compare, list(tickers.values()), statement, items)
+        
+        comparison = {}
+        fetched_at = {}
+        for row in (table.to_pylist() if table is not None else []):
+            comparison.setdefault(row["line_item"], {}).setdefault(row["ticker"], {})[row["period"]] = row["value"]
+            fetched_at[row["ticker"]] = row["fetched_at"].isoformat()
+        return JSONResponse({
+            "statement": statement,
+            "companies": tickers,
+            "fetched_at": fetched_at,
+            "line_items": comparison
+        })
+    except PASSTHROUGH_ERRORS:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error comparing financials: {str(e)}")
+
+@app.get("/openai/financials/store/stats")
+async def financial_store_stats():
+    if financial_store is None:
+        return JSONResponse({"enabled": False})
+    return JSONResponse({"enabled": True, **await run_in_threadpool(financial_store.stats)})
+
 @app.post("/openai/financial-insights")
 async def get_financial_insights(request: dict):
     try:
@@ -927,14 +3338,58 @@ async def get_financial_insights(request: dict):
             
         print(f"Generating financial insights for company: {company_name}")
         
-        analysis = generate_financial_insights(company_name, financial_data)
+        analysis = await run_in_threadpool(generate_financial_insights, company_name, financial_data, request.get("user_id"))
         
         return JSONResponse({
             "success": True,
             "analysis": analysis,
+            "is_fallback": analysis.get("is_fallback", False),
             "message": f"Financial insights generated for {company_name}"
         })
         
+    except PASSTHROUGH_ERRORS:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error generating financial insights: {str(e)}")
+
+@app.post("/openai/financial-insights/stream")
+async def stream_financial_insights(request: dict):
+    """Server-sent events: insight fields as they are generated, then the validated analysis"""
+    try:
+        company_name = request.get("company_name")
+        financial_data = request.get("financial_data")
+        
+        if not company_name or not financial_data:
+            raise HTTPException(status_code=400, detail="company_name and financial_data are required")
+        
+        user_id = request.get("user_id")
+        messages = financial_insights_messages(company_name, financial_data)
+        decision = route_model("financial_insights", messages, 2000, DEFAULT_MODEL)
+        ticket, model = await run_in_threadpool(acquire_routed_slot, decision, user_id, PRIORITY_INSIGHTS)
+        
+        def fallback(reason, error):
+            if reason == "parse_error":
+                return default_financial_insights()
+            return unavailable_financial_insights(str(error), reason)
+        
+        events = stream_structured_completion(
+            "financial_insights",
+            FinancialInsights,
+            messages,
+            decision,
+            model,
+            ticket,
+            fallback,
+            temperature=0.3,
+            max_tokens=2000,
+            user_id=user_id,
+            priority=PRIORITY_INSIGHTS
+        )
+        return StreamingResponse(events, media_type="text/event-stream", headers=SSE_HEADERS,
+                                 background=BackgroundTask(ticket.release))
+        
+    except PASSTHROUGH_ERRORS:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error generating financial insights: {str(e)}")
 
@@ -949,8 +3404,8 @@ def get_weekly_summaries(user_id):
     }, {"_id": 0}).sort("created_at", DESCENDING))
     return summaries
 
-def render_weekly_report_html(user_id, summaries):
-    total = len(summaries)
+def weekly_report_data(summaries):
+    """Counts shown in the weekly report's header block"""
     feedback_counts = {"Positive": 0, "Negative": 0, "Neutral": 0, "Unknown": 0}
     status_counts = {"on-going": 0, "completed": 0, "pending": 0, "Unknown": 0}
     for s in summaries:
@@ -958,6 +3413,21 @@ def render_weekly_report_html(user_id, summaries):
         feedback_counts[fb] = feedback_counts.get(fb, 0) + 1
         st = s.get("summary", {}).get("project_status", "Unknown")
         status_counts[st] = status_counts.get(st, 0) + 1
+    return {"total": len(summaries), "feedback_counts": feedback_counts, "status_counts": status_counts}
+
+def weekly_report_row(s):
+    summary = s.get("summary", {})
+    created_at = s.get("created_at")
+    date = created_at.strftime("%Y-%m-%d") if isinstance(created_at, datetime) else str(created_at or "")[:10]
+    cells = [date, summary.get("client_name", ""), summary.get("client_region", ""), summary.get("vertical", ""),
+             summary.get("project_status", ""), summary.get("feedback", ""), f'{str(summary.get("input_summary", ""))[:60]}...']
+    return "<tr>" + "".join(f"<td>{html_escape(str(cell))}</td>" for cell in cells) + "</tr>"
+
+def render_weekly_report_html(user_id, summaries):
+    data = weekly_report_data(summaries)
+    total = data["total"]
+    feedback_counts = data["feedback_counts"]
+    status_counts = data["status_counts"]
     html = f'''
     <html>
     <head>
@@ -976,7 +3446,7 @@ def render_weekly_report_html(user_id, summaries):
     <body>
         <h1>AIron Rush <span class="rocket">🚀</span> Weekly Summary Report</h1>
         <div class="summary-block">
-            <b>User ID:</b> {user_id}<br>
+            <b>User ID:</b> {html_escape(user_id)}<br>
             <b>Total Summaries:</b> {total}<br>
             <b>Feedback:</b> Positive: {feedback_counts['Positive']}, Negative: {feedback_counts['Negative']}, Neutral: {feedback_counts['Neutral']}, Unknown: {feedback_counts['Unknown']}<br>
             <b>Status:</b> on-going: {status_counts['on-going']}, completed: {status_counts['completed']}, pending: {status_counts['pending']}, Unknown: {status_counts['Unknown']}
@@ -991,10 +3461,7 @@ def render_weekly_report_html(user_id, summaries):
                 <th>Feedback</th>
                 <th>Summary</th>
             </tr>
-            {''.join([
-                f'<tr><td>{s.get("created_at", "")[:10]}</td><td>{s.get("summary", {}).get("client_name", "")}</td><td>{s.get("summary", {}).get("client_region", "")}</td><td>{s.get("summary", {}).get("vertical", "")}</td><td>{s.get("summary", {}).get("project_status", "")}</td><td>{s.get("summary", {}).get("feedback", "")}</td><td>{s.get("summary", {}).get("input_summary", "")[:60]}...</td></tr>'
-                for s in summaries
-            ])}
+            {''.join(weekly_report_row(s) for s in summaries)}
         </table>
         <div style="margin-top:2em; color:#888; font-size:0.9em;">Generated by AIron Rush on {datetime.utcnow().strftime('%Y-%m-%d %H:%M UTC')}</div>
     </body>
@@ -1002,24 +3469,83 @@ def render_weekly_report_html(user_id, summaries):
     '''
     return html
 
-@app.get("/openai/weekly-summary-pdf/{user_id}")
-def get_weekly_summary_pdf(user_id: str):
+# ---------- Weekly Report Pre-generation ----------
+# Stored reports younger than this are served as is; older ones are rendered on demand
+WEEKLY_REPORT_MAX_AGE = timedelta(hours=float(os.getenv("WEEKLY_REPORT_MAX_AGE_HOURS", "26")))
+WEEKLY_REPORT_DAYS = ("mon", "tue", "wed", "thu", "fri", "sat", "sun")
+
+def build_weekly_report(user_id):
     summaries = get_weekly_summaries(user_id)
-    html = render_weekly_report_html(user_id, summaries)
-    pdf_io = BytesIO()
-    HTML(string=html).write_pdf(pdf_io)
-    pdf_io.seek(0)
-    return StreamingResponse(pdf_io, media_type="application/pdf", headers={
-        "Content-Disposition": f"attachment; filename=AIronRush_Weekly_Report_{user_id}.pdf"
+    return render_weekly_report_html(user_id, summaries), weekly_report_data(summaries)
+
+def list_weekly_report_users():
+    """Users with summaries in the report window; everyone else gets an empty report on demand"""
+    week_ago = datetime.utcnow() - timedelta(days=7)
+    return file_summaries_collection.distinct("user_id", {"created_at": {"$gte": week_ago}})
+
+weekly_report_store = ReportStore(weekly_reports_collection, weekly_report_runs_collection)
+weekly_report_scheduler = WeeklyReportScheduler(
+    weekly_report_store,
+    list_weekly_report_users,
+    build_weekly_report,
+    hour=int(os.getenv("WEEKLY_REPORT_HOUR", "3")),  # UTC
+    weekdays=[WEEKLY_REPORT_DAYS.index(day.strip().lower()[:3])
+              for day in os.getenv("WEEKLY_REPORT_DAYS", ",".join(WEEKLY_REPORT_DAYS)).split(",") if day.strip()],
+    workers=int(os.getenv("WEEKLY_REPORT_WORKERS", "2")),
+    use_processes=os.getenv("WEEKLY_REPORT_RENDER_PROCESSES", "true").lower() == "true"
+)
+@app.on_event("startup")
+def start_weekly_report_scheduler():
+    if db is not None and os.getenv("WEEKLY_REPORT_SCHEDULER", "true").lower() == "true":
+        weekly_report_scheduler.start()
+
+@app.on_event("shutdown")
+def stop_weekly_report_scheduler():
+    weekly_report_scheduler.stop()
+
+@app.get("/openai/weekly-summary-pdf/{user_id}")
+def get_weekly_summary_pdf(user_id: str, refresh: bool = False):
+    """The stored pre-generated report, or a render on demand when there is none (or refresh=true)"""
+    report = None
+    if db is not None and not refresh:
+        require_database(weekly_reports_collection)
+        report = weekly_report_store.get(user_id, WEEKLY_REPORT_MAX_AGE)
+    if report is not None:
+        pdf, generated_at, source = bytes(report["pdf"]), report["generated_at"], report["source"]
+    elif db is not None:
+        pdf, _, generated_at = weekly_report_flight.do(user_id, lambda: weekly_report_scheduler.generate(user_id))
+        source = "on_demand"
+    else:
+        pdf = HTML(string=render_weekly_report_html(user_id, [])).write_pdf()
+        generated_at, source = datetime.utcnow(), "on_demand"
+    return Response(pdf, media_type="application/pdf", headers={
+        "Content-Disposition": f"attachment; filename=AIronRush_Weekly_Report_{user_id}.pdf",
+        "X-Report-Generated-At": generated_at.isoformat(),
+        "X-Report-Source": source
     })
 
-def generate_market_insights(company_name: str):
-    """Generate comprehensive market and industry insights"""
-    try:
-        if not openai_client:
-            raise HTTPException(status_code=500, detail="OpenAI API key not configured")
-        
-        prompt = f"""Analyze the market and industry landscape for {company_name} and provide comprehensive insights. 
+@app.post("/openai/weekly-reports/run")
+async def run_weekly_reports(request: Request):
+    """Pre-generate every active user's report now instead of at the scheduled hour (admin)"""
+    require_admin(request)
+    require_database(weekly_reports_collection)
+    return JSONResponse(await run_in_threadpool(weekly_report_scheduler.run))
+
+@app.get("/openai/weekly-reports/stats")
+async def weekly_report_stats():
+    require_database(weekly_report_runs_collection)
+    runs = await run_in_threadpool(weekly_report_store.recent_runs)
+    return JSONResponse({
+        "running": weekly_report_scheduler.running,
+        "hour_utc": weekly_report_scheduler.hour,
+        "weekdays": [WEEKLY_REPORT_DAYS[day] for day in sorted(weekly_report_scheduler.weekdays)],
+        "workers": weekly_report_scheduler.workers,
+        "max_age_hours": WEEKLY_REPORT_MAX_AGE.total_seconds() / 3600,
+        "recent_runs": serialize_mongo_doc(runs)
+    })
+
+def market_insights_messages(company_name):
+    prompt = f"""Analyze the market and industry landscape for {company_name} and provide comprehensive insights. 
         
         Please provide a detailed analysis in the following JSON format:
 
@@ -1079,119 +3605,129 @@ def generate_market_insights(company_name: str):
         8. Risk factors and market challenges
 
         Provide actionable insights that would be valuable for sales teams and business development."""
+    return [
+        {"role": "system", "content": "You are a market intelligence expert with deep knowledge of business trends, industry analysis, and competitive landscapes. Provide comprehensive, data-driven insights that help businesses understand market opportunities and challenges."},
+        {"role": "user", "content": prompt}
+    ]
+
+def default_market_insights():
+    """Canned insights used when the model's output could not be parsed"""
+    return mark_fallback({
+        "sector_insights": {
+            "BFSI": {
+                "trends": ["Digital banking transformation", "AI-powered risk assessment", "Sustainable finance initiatives", "Regulatory technology adoption"],
+                "opportunities": ["Fintech partnerships", "Digital payment solutions", "ESG investment products", "Cybersecurity services"],
+                "challenges": ["Regulatory compliance", "Cybersecurity threats", "Low interest rates", "Digital disruption"],
+                "key_players": ["JPMorgan Chase", "Bank of America", "Wells Fargo", "Goldman Sachs", "Morgan Stanley"]
+            },
+            "Technology": {
+                "trends": ["AI/ML adoption", "Cloud migration", "Cybersecurity focus", "Remote work solutions", "Edge computing"],
+                "opportunities": ["SaaS platforms", "AI consulting", "Cybersecurity services", "Digital transformation", "IoT solutions"],
+                "challenges": ["Talent shortage", "Rapid innovation", "Data privacy", "Supply chain issues", "Competition"],
+                "key_players": ["Microsoft", "Google", "Amazon", "Apple", "Meta", "NVIDIA"]
+            },
+            "Healthcare": {
+                "trends": ["Telemedicine growth", "AI diagnostics", "Personalized medicine", "Digital health records", "Wearable technology"],
+                "opportunities": ["Health tech solutions", "Remote monitoring", "AI-powered diagnostics", "Patient engagement", "Preventive care"],
+                "challenges": ["Regulatory hurdles", "Data security", "Integration complexity", "Cost pressures", "Provider adoption"],
+                "key_players": ["UnitedHealth", "Anthem", "Aetna", "Cigna", "Humana", "CVS Health"]
+            },
+            "Retail": {
+                "trends": ["E-commerce growth", "Omnichannel retail", "Personalization", "Sustainability focus", "Social commerce"],
+                "opportunities": ["Digital commerce", "Supply chain optimization", "Customer experience", "Sustainable products", "Mobile commerce"],
+                "challenges": ["Supply chain disruption", "Labor shortages", "Digital transformation", "Competition", "Customer expectations"],
+                "key_players": ["Amazon", "Walmart", "Target", "Costco", "Home Depot", "Best Buy"]
+            }
+        },
+        "emerging_trends": [
+            {
+                "title": "AI-Powered Business Intelligence",
+                "description": "Advanced analytics and AI-driven insights transforming decision-making processes across industries",
+                "impact": "High - Enabling data-driven strategies and predictive capabilities",
+                "sector": "Cross-sector"
+            },
+            {
+                "title": "Sustainability & ESG Focus",
+                "description": "Growing emphasis on environmental, social, and governance factors in business decisions",
+                "impact": "Medium-High - Driving investment decisions and consumer preferences",
+                "sector": "Cross-sector"
+            },
+            {
+                "title": "Digital Transformation Acceleration",
+                "description": "Rapid adoption of digital technologies across all industries post-pandemic",
+                "impact": "High - Creating new business models and competitive advantages",
+                "sector": "Cross-sector"
+            },
+            {
+                "title": "Supply Chain Resilience",
+                "description": "Focus on building robust and flexible supply chain networks",
+                "impact": "Medium - Addressing global disruptions and ensuring continuity",
+                "sector": "Manufacturing, Retail, Technology"
+            }
+        ],
+        "market_opportunities": [
+            {
+                "title": "AI Consulting Services",
+                "description": "Help businesses implement and optimize AI solutions for competitive advantage",
+                "potential": "High growth potential with increasing AI adoption across industries",
+                "timeline": "6-18 months"
+            },
+            {
+                "title": "Cybersecurity Solutions",
+                "description": "Address growing security concerns in digital transformation initiatives",
+                "potential": "Strong demand due to increasing cyber threats and regulatory requirements",
+                "timeline": "3-12 months"
+            },
+            {
+                "title": "Sustainability Consulting",
+                "description": "Guide companies in ESG compliance and sustainable business practices",
+                "potential": "Growing market with regulatory pressure and stakeholder demands",
+                "timeline": "12-24 months"
+            },
+            {
+                "title": "Digital Health Platforms",
+                "description": "Telemedicine and remote health monitoring solutions for healthcare providers",
+                "potential": "High growth post-pandemic adoption and regulatory support",
+                "timeline": "6-15 months"
+            }
+        ]
+    }, "parse_error")
+
+@market_insights_flight.coalesce(lambda company_name, user_id=None: flight_key(user_id, company_name))
+def generate_market_insights(company_name: str, user_id: Optional[str] = None):
+    """Generate comprehensive market and industry insights"""
+    try:
+        if not openai_client:
+            raise HTTPException(status_code=500, detail="OpenAI API key not configured")
         
-        response = openai_client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": "You are a market intelligence expert with deep knowledge of business trends, industry analysis, and competitive landscapes. Provide comprehensive, data-driven insights that help businesses understand market opportunities and challenges."},
-                {"role": "user", "content": prompt}
-            ],
+        insights = create_structured_completion(
+            "market_insights",
+            MarketInsights,
+            market_insights_messages(company_name),
+            model=DEFAULT_MODEL,
             temperature=0.3,
-            max_tokens=2500
+            max_tokens=2500,
+            user_id=user_id,
+            priority=PRIORITY_INSIGHTS
         )
         
-        content = response.choices[0].message.content.strip()
-        
-        # Parse JSON response
-        try:
-            if content.startswith("```json"):
-                content = content.replace("```json", "").replace("```", "").strip()
-            elif content.startswith("```"):
-                content = content.replace("```", "").strip()
-            
-            insights = json.loads(content)
-            return insights
-            
-        except json.JSONDecodeError:
-            # Return default structure if JSON parsing fails
-            return {
-                "sector_insights": {
-                    "BFSI": {
-                        "trends": ["Digital banking transformation", "AI-powered risk assessment", "Sustainable finance initiatives", "Regulatory technology adoption"],
-                        "opportunities": ["Fintech partnerships", "Digital payment solutions", "ESG investment products", "Cybersecurity services"],
-                        "challenges": ["Regulatory compliance", "Cybersecurity threats", "Low interest rates", "Digital disruption"],
-                        "key_players": ["JPMorgan Chase", "Bank of America", "Wells Fargo", "Goldman Sachs", "Morgan Stanley"]
-                    },
-                    "Technology": {
-                        "trends": ["AI/ML adoption", "Cloud migration", "Cybersecurity focus", "Remote work solutions", "Edge computing"],
-                        "opportunities": ["SaaS platforms", "AI consulting", "Cybersecurity services", "Digital transformation", "IoT solutions"],
-                        "challenges": ["Talent shortage", "Rapid innovation", "Data privacy", "Supply chain issues", "Competition"],
-                        "key_players": ["Microsoft", "Google", "Amazon", "Apple", "Meta", "NVIDIA"]
-                    },
-                    "Healthcare": {
-                        "trends": ["Telemedicine growth", "AI diagnostics", "Personalized medicine", "Digital health records", "Wearable technology"],
-                        "opportunities": ["Health tech solutions", "Remote monitoring", "AI-powered diagnostics", "Patient engagement", "Preventive care"],
-                        "challenges": ["Regulatory hurdles", "Data security", "Integration complexity", "Cost pressures", "Provider adoption"],
-                        "key_players": ["UnitedHealth", "Anthem", "Aetna", "Cigna", "Humana", "CVS Health"]
-                    },
-                    "Retail": {
-                        "trends": ["E-commerce growth", "Omnichannel retail", "Personalization", "Sustainability focus", "Social commerce"],
-                        "opportunities": ["Digital commerce", "Supply chain optimization", "Customer experience", "Sustainable products", "Mobile commerce"],
-                        "challenges": ["Supply chain disruption", "Labor shortages", "Digital transformation", "Competition", "Customer expectations"],
-                        "key_players": ["Amazon", "Walmart", "Target", "Costco", "Home Depot", "Best Buy"]
-                    }
-                },
-                "emerging_trends": [
-                    {
-                        "title": "AI-Powered Business Intelligence",
-                        "description": "Advanced analytics and AI-driven insights transforming decision-making processes across industries",
-                        "impact": "High - Enabling data-driven strategies and predictive capabilities",
-                        "sector": "Cross-sector"
-                    },
-                    {
-                        "title": "Sustainability & ESG Focus",
-                        "description": "Growing emphasis on environmental, social, and governance factors in business decisions",
-                        "impact": "Medium-High - Driving investment decisions and consumer preferences",
-                        "sector": "Cross-sector"
-                    },
-                    {
-                        "title": "Digital Transformation Acceleration",
-                        "description": "Rapid adoption of digital technologies across all industries post-pandemic",
-                        "impact": "High - Creating new business models and competitive advantages",
-                        "sector": "Cross-sector"
-                    },
-                    {
-                        "title": "Supply Chain Resilience",
-                        "description": "Focus on building robust and flexible supply chain networks",
-                        "impact": "Medium - Addressing global disruptions and ensuring continuity",
-                        "sector": "Manufacturing, Retail, Technology"
-                    }
-                ],
-                "market_opportunities": [
-                    {
-                        "title": "AI Consulting Services",
-                        "description": "Help businesses implement and optimize AI solutions for competitive advantage",
-                        "potential": "High growth potential with increasing AI adoption across industries",
-                        "timeline": "6-18 months"
-                    },
-                    {
-                        "title": "Cybersecurity Solutions",
-                        "description": "Address growing security concerns in digital transformation initiatives",
-                        "potential": "Strong demand due to increasing cyber threats and regulatory requirements",
-                        "timeline": "3-12 months"
-                    },
-                    {
-                        "title": "Sustainability Consulting",
-                        "description": "Guide companies in ESG compliance and sustainable business practices",
-                        "potential": "Growing market with regulatory pressure and stakeholder demands",
-                        "timeline": "12-24 months"
-                    },
-                    {
-                        "title": "Digital Health Platforms",
-                        "description": "Telemedicine and remote health monitoring solutions for healthcare providers",
-                        "potential": "High growth post-pandemic adoption and regulatory support",
-                        "timeline": "6-15 months"
-                    }
-                ]
-            }
-            
+        insights = insights.model_dump()
+        insights["is_fallback"] = False
+        return insights
+
+    except StructuredOutputError as e:
+        print(f"JSON parsing error: {e}")
+        # Return default structure if the output could not be parsed or repaired
+        return default_market_insights()
+    except AdmissionRejected:
+        raise
     except Exception as e:
         print(f"Error generating market insights: {e}")
-        return {
+        return mark_fallback({
             "sector_insights": {},
             "emerging_trends": [],
             "market_opportunities": []
-        }
+        }, fallback_reason(e))
 
 @app.post("/openai/market-insights")
 async def get_market_insights(request: dict):
@@ -1203,14 +3739,57 @@ async def get_market_insights(request: dict):
             
         print(f"Generating market insights for company: {company_name}")
         
-        insights = generate_market_insights(company_name)
+        insights = await run_in_threadpool(generate_market_insights, company_name, request.get("user_id"))
         
         return JSONResponse({
             "success": True,
             "insights": insights,
+            "is_fallback": insights.get("is_fallback", False),
             "message": f"Market insights generated for {company_name}"
         })
         
+    except PASSTHROUGH_ERRORS:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error generating market insights: {str(e)}")
+
+@app.post("/openai/market-insights/stream")
+async def stream_market_insights(request: dict):
+    """Server-sent events: each sector and trend as it is generated, then the validated insights"""
+    try:
+        company_name = request.get("company_name")
+        
+        if not company_name:
+            raise HTTPException(status_code=400, detail="company_name is required")
+        
+        user_id = request.get("user_id")
+        messages = market_insights_messages(company_name)
+        decision = route_model("market_insights", messages, 2500, DEFAULT_MODEL)
+        ticket, model = await run_in_threadpool(acquire_routed_slot, decision, user_id, PRIORITY_INSIGHTS)
+        
+        def fallback(reason, error):
+            if reason == "parse_error":
+                return default_market_insights()
+            return mark_fallback({"sector_insights": {}, "emerging_trends": [], "market_opportunities": []}, reason)
+        
+        events = stream_structured_completion(
+            "market_insights",
+            MarketInsights,
+            messages,
+            decision,
+            model,
+            ticket,
+            fallback,
+            temperature=0.3,
+            max_tokens=2500,
+            user_id=user_id,
+            priority=PRIORITY_INSIGHTS
+        )
+        return StreamingResponse(events, media_type="text/event-stream", headers=SSE_HEADERS,
+                                 background=BackgroundTask(ticket.release))
+        
+    except PASSTHROUGH_ERRORS:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error generating market insights: {str(e)}")
 
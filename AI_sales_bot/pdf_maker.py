@@ -1,43 +1,248 @@
+"""Batch PDF report generation: LLM-written or stored-summary reports rendered with WeasyPrint.
+
+A manifest (JSON list or JSONL) describes one report per entry:
+
+    {"output": "nature.pdf", "title": "Shakespearean Story",
+     "system": "You are a Shakespearean storyteller.", "prompt": "Write a story about nature."}
+    {"output": "acme.pdf", "title": "Acme Corp", "summary": {"client_name": "Acme Corp", "input_summary": "..."}}
+
+Entries with a `prompt` are written by the model, entries with a `summary` (a
+stored file summary) are rendered as-is. LLM calls run concurrently on a
+thread pool and each finished text is handed to a process pool for rendering,
+whose workers load the stylesheet and fonts once and reuse them for every
+document. PDFs are written to a temp file and renamed, so a crashed run never
+leaves a truncated report behind.
+
+    python pdf_maker.py manifest.jsonl --out-dir reports --llm-workers 8 --render-workers 4
+    python pdf_maker.py --from-summaries <user_id> --days 7 --out-dir reports
+    python pdf_maker.py --prompt "Write a story about nature." --output output.pdf
+"""
+import argparse
+import html
+import json
 import os
-from openai import OpenAI
-from weasyprint import HTML
+import tempfile
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from datetime import datetime, timedelta
+
 from dotenv import load_dotenv
 
+DEFAULT_MODEL = "gpt-4o"
+DEFAULT_SYSTEM_PROMPT = "You are a helpful business writer."
 
-load_dotenv()
+REPORT_STYLESHEET = """
+@page { size: A4; margin: 2cm; }
+body { font-family: Arial, sans-serif; font-size: 11pt; line-height: 1.5; }
+h1 { color: #ff6600; }
+p { margin: 0 0 0.8em 0; }
+table { border-collapse: collapse; width: 100%; margin-top: 1em; }
+th, td { border: 1px solid #ccc; padding: 8px; text-align: left; vertical-align: top; }
+th { background: #ffe5d0; width: 30%; }
+.footer { margin-top: 2em; color: #888; font-size: 0.9em; }
+"""
 
-# Initialize the OpenAI client with API key from environment
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+SUMMARY_FIELDS = (
+    ("client_name", "Client"),
+    ("client_region", "Region"),
+    ("vertical", "Vertical"),
+    ("project_status", "Status"),
+    ("feedback", "Feedback"),
+    ("user_name", "Author"),
+    ("input_summary", "Summary"),
+)
 
+# Per render worker: parsed once by the pool initializer, reused for every document
+_stylesheet = None
+_font_config = None
 
 
-# 1️⃣ Generate text
-response = client.chat.completions.create(
-    model="gpt-4o",
-    messages=[
-        {"role": "system", "content": "You are a Shakespearean storyteller."},
-        {"role": "user", "content": "Write a story about nature."}
-    ]
-)
+def load_manifest(path: str) -> list:
+    with open(path, "r", encoding="utf-8") as f:
+        content = f.read().strip()
+    if content.startswith("["):
+        entries = json.loads(content)
+    else:
+        entries = [json.loads(line) for line in content.splitlines() if line.strip()]
+    for i, entry in enumerate(entries):
+        if "prompt" not in entry and "summary" not in entry:
+            raise ValueError(f"Manifest entry {i} needs a 'prompt' or a 'summary'")
+        entry.setdefault("output", f"report_{i + 1}.pdf")
+    return entries
+
+
+def summaries_manifest(user_id: str, days: int = 7, mongo_uri: str = None) -> list:
+    """One entry per stored file summary of the user in the last `days` days"""
+    from pymongo import DESCENDING, MongoClient
+
+    client = MongoClient(mongo_uri or os.getenv("MONGO_URI", "mongodb://localhost:27017/"))
+    collection = client["ai_chatbot_db"]["file_summaries"]
+    since = datetime.utcnow() - timedelta(days=days)
+    entries = []
+    for doc in collection.find({"user_id": user_id, "created_at": {"$gte": since}},
+                               {"_id": 1, "file_name": 1, "summary": 1}).sort("created_at", DESCENDING):
+        summary = doc.get("summary") or {}
+        entries.append({
+            "output": f"summary_{doc['_id']}.pdf",
+            "title": summary.get("client_name") or doc.get("file_name") or "File Summary",
+            "summary": summary,
+        })
+    return entries
 
-generated_text = response.choices[0].message.content
-print("Generated text:", generated_text)
 
-# 2️⃣ Convert to simple HTML
-html_content = f"""
-<html>
+def generate_text(client, entry: dict, model: str = DEFAULT_MODEL) -> str:
+    response = client.chat.completions.create(
+        model=entry.get("model", model),
+        messages=[
+            {"role": "system", "content": entry.get("system", DEFAULT_SYSTEM_PROMPT)},
+            {"role": "user", "content": entry["prompt"]}
+        ],
+        temperature=entry.get("temperature", 0.7),
+        max_tokens=entry.get("max_tokens", 1500)
+    )
+    return response.choices[0].message.content or ""
+
+
+def render_html(entry: dict, text: str = None) -> str:
+    """Report body; styling comes from the shared stylesheet"""
+    title = html.escape(entry.get("title") or "Report")
+    if text is not None:
+        body = "".join(
+            f"<p>{html.escape(paragraph).replace(chr(10), '<br>')}</p>"
+            for paragraph in text.split("\n\n") if paragraph.strip()
+        )
+    else:
+        summary = entry["summary"]
+        body = "<table>" + "".join(
+            f"<tr><th>{label}</th><td>{html.escape(str(summary.get(key, '')))}</td></tr>"
+            for key, label in SUMMARY_FIELDS
+        ) + "</table>"
+    return f"""<html>
   <head>
     <meta charset="utf-8">
-    <title>My Story</title>
+    <title>{title}</title>
   </head>
   <body>
-    <h1>Shakespearean Story</h1>
-    <p>{generated_text}</p>
+    <h1>{title}</h1>
+    {body}
+    <div class="footer">Generated by AIron Rush on {datetime.utcnow().strftime('%Y-%m-%d %H:%M UTC')}</div>
   </body>
-</html>
-"""
+</html>"""
+
+
+def init_render_worker(stylesheet: str = REPORT_STYLESHEET):
+    global _stylesheet, _font_config
+    from weasyprint import CSS
+    from weasyprint.text.fonts import FontConfiguration
+
+    _font_config = FontConfiguration()
+    _stylesheet = CSS(string=stylesheet, font_config=_font_config)
+
+
+def render_pdf(html_content: str, path: str) -> int:
+    """Render to `path` atomically; returns the file size"""
+    from weasyprint import HTML
+
+    if _stylesheet is None:
+        init_render_worker()
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix=".pdf-", suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            HTML(string=html_content).write_pdf(f, stylesheets=[_stylesheet], font_config=_font_config)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return os.path.getsize(path)
+
+
+def generate_reports(entries: list, out_dir: str = ".", client=None, model: str = DEFAULT_MODEL,
+                     llm_workers: int = 4, render_workers: int = None) -> dict:
+    """Generate every entry's PDF; returns per-entry results and throughput"""
+    started = time.perf_counter()
+    results = []
+    llm_pool = ThreadPoolExecutor(max_workers=llm_workers, thread_name_prefix="pdf-llm")
+    render_pool = ProcessPoolExecutor(max_workers=render_workers, initializer=init_render_worker)
+    try:
+        pending = {}
+        for entry in entries:
+            if "prompt" in entry:
+                if client is None:
+                    raise ValueError("Prompt entries need an OpenAI client (set OPENAI_API_KEY)")
+                pending[llm_pool.submit(generate_text, client, entry, model)] = ("llm", entry)
+            else:
+                path = os.path.join(out_dir, entry["output"])
+                pending[render_pool.submit(render_pdf, render_html(entry), path)] = ("render", entry)
+
+        # Renders start as soon as their text arrives instead of after the slowest LLM call
+        while pending:
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage, entry = pending.pop(future)
+                path = os.path.join(out_dir, entry["output"])
+                try:
+                    value = future.result()
+                except Exception as e:
+                    print(f"Failed to generate {entry['output']} ({stage}): {e}")
+                    results.append({"output": path, "ok": False, "stage": stage, "error": str(e)})
+                    continue
+                if stage == "llm":
+                    pending[render_pool.submit(render_pdf, render_html(entry, value), path)] = ("render", entry)
+                else:
+                    results.append({"output": path, "ok": True, "bytes": value})
+    finally:
+        llm_pool.shutdown(wait=True)
+        render_pool.shutdown(wait=True)
+
+    elapsed = time.perf_counter() - started
+    generated = sum(1 for r in results if r["ok"])
+    return {
+        "generated": generated,
+        "failed": len(results) - generated,
+        "seconds": round(elapsed, 2),
+        "docs_per_minute": round(generated / elapsed * 60, 1) if elapsed > 0 else None,
+        "results": results,
+    }
+
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Generate PDF reports from a manifest of prompts or stored summaries")
+    parser.add_argument("manifest", nargs="?", help="JSON list or JSONL file of report entries")
+    parser.add_argument("--from-summaries", metavar="USER_ID", help="Render the user's stored file summaries")
+    parser.add_argument("--days", type=int, default=7, help="Summary age limit for --from-summaries")
+    parser.add_argument("--prompt", help="Generate a single report from this prompt")
+    parser.add_argument("--system", default="You are a Shakespearean storyteller.", help="System prompt for --prompt")
+    parser.add_argument("--title", default="Shakespearean Story", help="Title for --prompt")
+    parser.add_argument("--output", default="output.pdf", help="Output file for --prompt")
+    parser.add_argument("--out-dir", default=".")
+    parser.add_argument("--model", default=DEFAULT_MODEL)
+    parser.add_argument("--llm-workers", type=int, default=4)
+    parser.add_argument("--render-workers", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    if args.prompt:
+        entries = [{"output": args.output, "title": args.title, "system": args.system, "prompt": args.prompt}]
+    elif args.from_summaries:
+        entries = summaries_manifest(args.from_summaries, args.days)
+    elif args.manifest:
+        entries = load_manifest(args.manifest)
+    else:
+        parser.error("Give a manifest, --from-summaries or --prompt")
+
+    client = None
+    if any("prompt" in entry for entry in entries):
+        from openai import OpenAI
+        client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+
+    report = generate_reports(entries, args.out_dir, client, args.model, args.llm_workers, args.render_workers)
+    print(f"✅ {report['generated']} PDFs saved to {os.path.abspath(args.out_dir)} "
+          f"({report['failed']} failed) in {report['seconds']}s — {report['docs_per_minute']} docs/min")
 
-# 3️⃣ Make PDF
-HTML(string=html_content).write_pdf("output.pdf")
 
-print("✅ PDF saved as output.pdf")
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,483 @@
+"""On-demand request profiling and slow-request capture.
+
+Every HTTP request runs with a trace. Code marks its stages with
+`stage("llm")`, which costs two clock reads. Only requests the profiling
+config picked (a share of all requests, or every request on the listed
+routes) are stack-sampled. While one is in flight, a sampler thread records
+the Python stack of every thread working for it every `sample_interval`
+seconds. The sampler sleeps while no picked request runs. Work on the event
+loop is attributed through the asyncio task that is running, and tasks a
+request creates inherit its trace. Work on worker threads is attributed
+through `run_in_threadpool`, which registers the thread for the call.
+
+When a request finishes, its trace is kept in a ring buffer of the last
+`capacity` if it took at least `slow_ms`, or if the profiling config picked
+it. Slow requests that were not picked are kept with their stage timings
+only. Other traces are dropped. Kept stacks export in the collapsed "frame;frame;frame N"
+format that flamegraph.pl, speedscope and inferno read.
+
+Picked requests can run under cProfile instead of stack sampling alone.
+cProfile hooks a single thread, and only one profiler can be active per
+thread. So at most one request is cProfiled at a time, and other requests
+picked while it runs are only stack-sampled. The event loop's cProfile data
+also covers whatever else the loop ran in the meantime.
+"""
+import asyncio
+import cProfile
+import contextvars
+import marshal
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, deque
+from contextlib import contextmanager
+from datetime import datetime
+from functools import partial
+
+from starlette.concurrency import run_in_threadpool as starlette_run_in_threadpool
+
+STACK_MODE = "stack"
+CPROFILE_MODE = "cprofile"
+PROFILE_MODES = (STACK_MODE, CPROFILE_MODE)
+MAX_STACK_DEPTH = 96
+# Distinct stacks kept per request; samples of further new stacks are counted under one bucket
+MAX_STACKS_PER_TRACE = 2000
+MAX_TIMELINE_STAGES = 200
+OTHER_STACKS = ("[other stacks]",)
+# Root frame of a sample, naming the thread it was taken on
+LOOP_ROLE = "[event loop]"
+WORKER_ROLE = "[worker thread]"
+
+_current_trace = contextvars.ContextVar("profiling_trace", default=None)
+
+
+def route_matches(route: str, path: str) -> bool:
+    """Exact path match, or a prefix match for routes ending in '*'"""
+    if route.endswith("*"):
+        return path.startswith(route[:-1])
+    return path == route
+
+
+def _pop_stage(names: list, name: str):
+    # Concurrent tasks of one request can close their stages out of order
+    for i in range(len(names) - 1, -1, -1):
+        if names[i] == name:
+            del names[i]
+            return
+
+
+@contextmanager
+def stage(name: str):
+    """Time a stage of the current request; a no-op outside a traced request"""
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+    names = trace.open_stages.setdefault(threading.get_ident(), [])
+    names.append(name)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        ended = time.perf_counter()
+        _pop_stage(names, name)
+        trace.stages.append((name, started - trace.started, ended - started))
+
+
+async def run_in_threadpool(func, *args, **kwargs):
+    """Starlette's run_in_threadpool, with the worker thread's stacks attributed to the calling request"""
+    trace = _current_trace.get()
+    if trace is None or not trace.reason:
+        return await starlette_run_in_threadpool(func, *args, **kwargs)
+    return await starlette_run_in_threadpool(trace.profiler.run_attached, trace, partial(func, *args, **kwargs))
+
+
+class Trace:
+    def __init__(self, profiler, method: str, path: str, reason=None):
+        self.profiler = profiler
+        self.id = uuid.uuid4().hex[:16]
+        self.method = method
+        self.path = path
+        self.reason = reason
+        self.started_at = datetime.utcnow()
+        self.started = time.perf_counter()
+        self.duration = None
+        self.status = None
+        # (name, offset, duration) in seconds from the start of the request
+        self.stages = []
+        # thread ident -> names of the stages open on that thread, outermost first
+        self.open_stages = {}
+        self.samples = Counter()
+        self.tasks = []
+        # cProfile.Profile objects, one per thread, when the request is cProfiled
+        self.profiles = None
+        self.loop_profile = None
+
+    def add_sample(self, role: str, ident: int, stack: tuple):
+        # Stages open on the thread sit between its role and the Python frames
+        key = (role, *(f"[{name}]" for name in tuple(self.open_stages.get(ident, ()))), *stack)
+        if key not in self.samples and len(self.samples) >= MAX_STACKS_PER_TRACE:
+            key = OTHER_STACKS
+        self.samples[key] += 1
+
+    def stage_breakdown(self) -> list:
+        totals = {}
+        for name, _, duration in self.stages:
+            row = totals.setdefault(name, {"stage": name, "calls": 0, "total_ms": 0.0, "max_ms": 0.0})
+            row["calls"] += 1
+            row["total_ms"] += duration * 1000
+            row["max_ms"] = max(row["max_ms"], duration * 1000)
+        rows = sorted(totals.values(), key=lambda row: row["total_ms"], reverse=True)
+        for row in rows:
+            row["total_ms"] = round(row["total_ms"], 2)
+            row["max_ms"] = round(row["max_ms"], 2)
+        return rows
+
+    def summary(self) -> dict:
+        return {
+            "id": self.id,
+            "method": self.method,
+            "path": self.path,
+            "status": self.status,
+            "reason": self.reason or "slow",
+            "started_at": self.started_at.isoformat(),
+            "duration_ms": round(self.duration * 1000, 2),
+            "samples": sum(self.samples.values()),
+            "cprofile": bool(self.profiles),
+            "stages": self.stage_breakdown(),
+        }
+
+    def detail(self, top: int = 30) -> dict:
+        data = self.summary()
+        data["timeline"] = [
+            {"stage": name, "offset_ms": round(offset * 1000, 2), "duration_ms": round(duration * 1000, 2)}
+            for name, offset, duration in sorted(self.stages, key=lambda item: item[1])[:MAX_TIMELINE_STAGES]
+        ]
+        data["top_stacks"] = [
+            {"stack": ";".join(stack), "samples": count}
+            for stack, count in self.samples.most_common(top)
+        ]
+        stats = self.cprofile_stats()
+        if stats is not None:
+            data["top_functions"] = top_functions(stats, top)
+        return data
+
+    def cprofile_stats(self):
+        """The cProfile data of every thread that worked for the request, merged"""
+        if not self.profiles:
+            return None
+        return pstats.Stats(*self.profiles)
+
+
+def top_functions(stats: pstats.Stats, limit: int = 30) -> list:
+    rows = []
+    for (filename, line, name), (_, calls, own, cumulative, _) in stats.stats.items():
+        rows.append({
+            "function": f"{name} ({os.path.basename(filename)}:{line})",
+            "calls": calls,
+            "own_ms": round(own * 1000, 3),
+            "cumulative_ms": round(cumulative * 1000, 3),
+        })
+    rows.sort(key=lambda row: row["cumulative_ms"], reverse=True)
+    return rows[:limit]
+
+
+def collapsed_stacks(traces) -> str:
+    """Collapsed-stack text for flamegraph tools, each trace rooted at its method and path"""
+    merged = Counter()
+    for trace in traces:
+        root = f"{trace.method} {trace.path}"
+        for stack, count in trace.samples.items():
+            merged[(root, *stack)] += count
+    return "".join(
+        ";".join(frame.replace(";", ":") for frame in stack) + f" {count}\n"
+        for stack, count in sorted(merged.items())
+    )
+
+
+class RequestProfiler:
+    def __init__(self, capacity: int = 50, slow_ms: float = 8000, sample_interval: float = 0.01,
+                 exclude=()):
+        """sample_interval 0 turns stack sampling off; stage timings are still captured.
+
+        Sampling a thread walks its whole stack under the GIL, so keep the interval coarse
+        when many requests are picked at once.
+        """
+        self.ring = deque(maxlen=capacity)
+        self.slow_ms = slow_ms
+        self.sample_interval = sample_interval
+        # Path prefixes never traced (the profiling endpoints themselves)
+        self.exclude = tuple(exclude)
+        self.sample_rate = 0.0
+        self.routes = ()
+        self.mode = STACK_MODE
+        self.expires_at = None
+        self._active = set()
+        # Picked traces in flight; the sampler only runs while there are any
+        self._sampling = set()
+        self._tasks = {}
+        self._threads = {}
+        self._labels = {}
+        self._lock = threading.Lock()
+        self._cprofile_busy = False
+        self._loop = None
+        self._loop_thread = None
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._sampler = None
+        self.stats = {"traced": 0, "picked": 0, "slow": 0, "cprofiled": 0, "cprofile_busy": 0, "samples": 0}
+
+    # ----- Configuration -----
+
+    def configure(self, sample_rate: float = 0.0, routes=(), mode: str = STACK_MODE, duration: float = None,
+                  slow_ms: float = None):
+        """Pick a share of requests and/or every request on `routes` for `duration` seconds"""
+        if mode not in PROFILE_MODES:
+            raise ValueError(f"Unknown profiling mode: {mode}")
+        self.sample_rate = min(max(sample_rate, 0.0), 1.0)
+        self.routes = tuple(routes)
+        self.mode = mode
+        self.expires_at = time.time() + duration if duration else None
+        if slow_ms is not None:
+            self.slow_ms = slow_ms
+
+    def disable(self):
+        self.sample_rate = 0.0
+        self.routes = ()
+        self.expires_at = None
+
+    def config(self) -> dict:
+        self._expire()
+        return {
+            "sample_rate": self.sample_rate,
+            "routes": list(self.routes),
+            "mode": self.mode,
+            "expires_at": datetime.utcfromtimestamp(self.expires_at).isoformat() if self.expires_at else None,
+            "slow_ms": self.slow_ms,
+            "sample_interval_ms": round(self.sample_interval * 1000, 3),
+            "capacity": self.ring.maxlen,
+        }
+
+    def _expire(self):
+        if self.expires_at is not None and time.time() >= self.expires_at:
+            self.disable()
+
+    def _pick(self, path: str):
+        self._expire()
+        if any(route_matches(route, path) for route in self.routes):
+            return "route"
+        if self.sample_rate and random.random() < self.sample_rate:
+            return "sampled"
+        return None
+
+    # ----- Request lifecycle -----
+
+    def traced(self, path: str) -> bool:
+        return not path.startswith(self.exclude) if self.exclude else True
+
+    def begin(self, method: str, path: str) -> Trace:
+        """Start a trace on the event loop; the caller makes it current for the request"""
+        if self._loop is None:
+            self._loop = asyncio.get_running_loop()
+            self._loop_thread = threading.get_ident()
+            if self._loop.get_task_factory() is None:
+                self._loop.set_task_factory(self._task_factory)
+        trace = Trace(self, method, path, self._pick(path))
+        self.stats["traced"] += 1
+        with self._lock:
+            self._active.add(trace)
+        if not trace.reason:
+            return trace
+        self.stats["picked"] += 1
+        if self.mode == CPROFILE_MODE:
+            self._start_cprofile(trace)
+        task = asyncio.current_task()
+        if task is not None:
+            self._register_task(trace, task)
+        if self.sample_interval:
+            with self._lock:
+                self._sampling.add(trace)
+            self._ensure_sampler()
+            self._wake.set()
+        return trace
+
+    def end(self, trace: Trace, status: int):
+        trace.duration = time.perf_counter() - trace.started
+        trace.status = status
+        with self._lock:
+            self._active.discard(trace)
+            self._sampling.discard(trace)
+        for task in trace.tasks:
+            self._tasks.pop(task, None)
+        trace.tasks = []
+        if trace.loop_profile is not None:
+            trace.loop_profile.disable()
+            trace.profiles.append(trace.loop_profile)
+            trace.loop_profile = None
+            with self._lock:
+                self._cprofile_busy = False
+        slow = self.slow_ms and trace.duration * 1000 >= self.slow_ms
+        if slow:
+            self.stats["slow"] += 1
+        if slow or trace.reason:
+            self.ring.append(trace)
+
+    def _start_cprofile(self, trace: Trace):
+        with self._lock:
+            if self._cprofile_busy:
+                self.stats["cprofile_busy"] += 1
+                return
+            self._cprofile_busy = True
+        self.stats["cprofiled"] += 1
+        trace.profiles = []
+        trace.loop_profile = cProfile.Profile()
+        trace.loop_profile.enable()
+
+    def _register_task(self, trace: Trace, task):
+        trace.tasks.append(task)
+        self._tasks[task] = trace
+
+    def _task_factory(self, loop, coro, **kwargs):
+        # Tasks created while a request runs (e.g. by middleware task groups) work for that request
+        task = asyncio.Task(coro, loop=loop, **kwargs)
+        trace = _current_trace.get()
+        if trace is not None and trace.reason and trace.duration is None:
+            self._register_task(trace, task)
+        return task
+
+    def run_attached(self, trace: Trace, fn):
+        """Run fn() on this worker thread with its stacks (and cProfile data) going to trace"""
+        ident = threading.get_ident()
+        with self._lock:
+            self._threads[ident] = trace
+        profile = None
+        if trace.profiles is not None and trace.duration is None:
+            profile = cProfile.Profile()
+            profile.enable()
+        try:
+            return fn()
+        finally:
+            if profile is not None:
+                profile.disable()
+                trace.profiles.append(profile)
+            with self._lock:
+                self._threads.pop(ident, None)
+
+    # ----- Stack sampling -----
+
+    def _ensure_sampler(self):
+        if self._sampler is not None:
+            return
+        with self._lock:
+            if self._sampler is not None:
+                return
+            self._sampler = threading.Thread(target=self._sample_loop, name="request-profiler", daemon=True)
+        self._sampler.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._sampler is not None:
+            self._sampler.join(timeout=2)
+            self._sampler = None
+        self._stop.clear()
+
+    def _sample_loop(self):
+        while not self._stop.is_set():
+            if not self._sampling:
+                self._wake.wait()
+                self._wake.clear()
+                continue
+            if self._stop.wait(self.sample_interval):
+                break
+            try:
+                self.sample()
+            except Exception as e:
+                print(f"Error sampling request stacks: {e}")
+
+    def sample(self):
+        """Record one stack per thread currently working for a traced request"""
+        frames = sys._current_frames()
+        with self._lock:
+            targets = [(WORKER_ROLE, ident, trace) for ident, trace in self._threads.items()]
+        if self._loop is not None:
+            task = asyncio.current_task(self._loop)
+            trace = self._tasks.get(task) if task is not None else None
+            if trace is not None:
+                targets.append((LOOP_ROLE, self._loop_thread, trace))
+        for role, ident, trace in targets:
+            frame = frames.get(ident)
+            if frame is None or trace.duration is not None:
+                continue
+            trace.add_sample(role, ident, self._stack(frame))
+            self.stats["samples"] += 1
+
+    def _stack(self, frame) -> tuple:
+        labels = []
+        while frame is not None and len(labels) < MAX_STACK_DEPTH:
+            code = frame.f_code
+            label = self._labels.get(code)
+            if label is None:
+                name = getattr(code, "co_qualname", code.co_name)
+                label = f"{name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+                self._labels[code] = label
+            labels.append(label)
+            frame = frame.f_back
+        labels.reverse()
+        return tuple(labels)
+
+    # ----- Captured profiles -----
+
+    def get(self, trace_id: str):
+        for trace in self.ring:
+            if trace.id == trace_id:
+                return trace
+        return None
+
+    def profiles(self, path: str = None) -> list:
+        return [trace for trace in self.ring if path is None or route_matches(path, trace.path)]
+
+    def snapshot(self) -> dict:
+        return {
+            "config": self.config(),
+            "in_flight": len(self._active),
+            "stats": dict(self.stats),
+            "profiles": [trace.summary() for trace in reversed(self.ring)],
+        }
+
+
+def pstats_bytes(trace: Trace):
+    """The trace's merged cProfile data in the .prof format pstats, snakeviz and tuna read"""
+    stats = trace.cprofile_stats()
+    return marshal.dumps(stats.stats) if stats is not None else None
+
+
+class ProfilingMiddleware:
+    """Pure ASGI, so the request's own task runs the endpoint and its stacks are attributed"""
+
+    def __init__(self, app, profiler: RequestProfiler):
+        self.app = app
+        self.profiler = profiler
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.profiler.traced(scope["path"]):
+            await self.app(scope, receive, send)
+            return
+        trace = self.profiler.begin(scope["method"], scope["path"])
+        response = {"status": 500}
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+            await send(message)
+
+        token = _current_trace.set(trace)
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            _current_trace.reset(token)
+            self.profiler.end(trace, response["status"])
@@ -0,0 +1,149 @@
+"""Chunking and a per-user brute-force vector index for document retrieval.
+
+Each user's chunk embeddings live in one L2-normalised float32 matrix that is
+persisted as an .npz file next to the chunk ids. Search is a single
+matrix-vector product plus argpartition, which stays well under a
+millisecond for the few thousand chunks a user typically has, so no ANN
+structure is needed at this scale.
+"""
+import hashlib
+import os
+import re
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+def chunk_text(text: str, chunk_chars: int = 1500, overlap_chars: int = 200) -> list:
+    """Split text into ~chunk_chars pieces on paragraph/sentence boundaries with a small overlap"""
+    text = re.sub(r"[ \t]+", " ", text or "").strip()
+    if not text:
+        return []
+    if len(text) <= chunk_chars:
+        return [text]
+
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = min(len(text), start + chunk_chars)
+        if end < len(text):
+            window = text[start:end]
+            # Prefer to cut at a paragraph break, then a sentence end, then whitespace
+            cut = -1
+            for pattern in ("\n\n", ". ", "\n", " "):
+                cut = window.rfind(pattern, chunk_chars // 2)
+                if cut != -1:
+                    cut += len(pattern)
+                    break
+            if cut > 0:
+                end = start + cut
+        chunk = text[start:end].strip()
+        if chunk:
+            chunks.append(chunk)
+        if end >= len(text):
+            break
+        start = max(end - overlap_chars, start + 1)
+    return chunks
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+class UserVectorIndex:
+    """Embeddings and chunk ids for one user"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.ids = np.empty(0, dtype=object)
+        self.vectors = None
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            with np.load(path, allow_pickle=False) as data:
+                self.vectors = data["vectors"].astype(np.float32, copy=False)
+                self.ids = data["ids"].astype(object)
+
+    def __len__(self):
+        return 0 if self.vectors is None else self.vectors.shape[0]
+
+    def _save(self):
+        tmp_path = self.path + ".tmp.npz"
+        np.savez(tmp_path, vectors=self.vectors, ids=self.ids.astype(str))
+        os.replace(tmp_path, self.path)
+
+    def add(self, ids: list, vectors):
+        vectors = _normalize(np.asarray(vectors, dtype=np.float32))
+        with self.lock:
+            if self.vectors is None or len(self) == 0:
+                self.vectors = vectors
+                self.ids = np.array(ids, dtype=object)
+            else:
+                if vectors.shape[1] != self.vectors.shape[1]:
+                    raise ValueError("Embedding dimension does not match the existing index")
+                self.vectors = np.vstack([self.vectors, vectors])
+                self.ids = np.concatenate([self.ids, np.array(ids, dtype=object)])
+            self._save()
+
+    def remove_prefix(self, prefix: str) -> int:
+        """Drop every chunk whose id starts with `prefix` (e.g. a document id)"""
+        with self.lock:
+            if len(self) == 0:
+                return 0
+            keep = np.array([not str(i).startswith(prefix) for i in self.ids], dtype=bool)
+            removed = int((~keep).sum())
+            if removed:
+                self.vectors = self.vectors[keep]
+                self.ids = self.ids[keep]
+                self._save()
+            return removed
+
+    def search(self, query_vector, k: int = 5, allowed_prefixes=None) -> list:
+        """Top-k (chunk_id, cosine score) pairs"""
+        with self.lock:
+            if len(self) == 0:
+                return []
+            vectors, ids = self.vectors, self.ids
+        if allowed_prefixes:
+            mask = np.array([str(i).split(":", 1)[0] in allowed_prefixes for i in ids], dtype=bool)
+            if not mask.any():
+                return []
+            vectors, ids = vectors[mask], ids[mask]
+        query = _normalize(np.asarray(query_vector, dtype=np.float32).reshape(1, -1))[0]
+        scores = vectors @ query
+        k = min(k, scores.shape[0])
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(str(ids[i]), float(scores[i])) for i in top]
+
+
+class VectorIndexStore:
+    """Lazily loads per-user indexes from disk, keeping the most recently used in memory"""
+
+    def __init__(self, directory: str, max_loaded: int = 256):
+        self.directory = directory
+        self.max_loaded = max_loaded
+        self._indexes = OrderedDict()
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, user_id: str) -> str:
+        # Hash the id so arbitrary user ids are safe file names
+        name = hashlib.sha256(user_id.encode("utf-8")).hexdigest()[:32]
+        return os.path.join(self.directory, f"{name}.npz")
+
+    def get(self, user_id: str) -> UserVectorIndex:
+        with self._lock:
+            index = self._indexes.get(user_id)
+            if index is not None:
+                self._indexes.move_to_end(user_id)
+                return index
+        index = UserVectorIndex(self._path(user_id))
+        with self._lock:
+            index = self._indexes.setdefault(user_id, index)
+            self._indexes.move_to_end(user_id)
+            while len(self._indexes) > self.max_loaded:
+                self._indexes.popitem(last=False)
+        return index
@@ -0,0 +1,116 @@
+"""Negotiated gzip/brotli compression of complete response bodies.
+
+Only responses that arrive as a single body message with a known
+Content-Length of at least `minimum_size` bytes and a compressible content
+type are compressed. Streamed responses (SSE, streaming chat) pass through
+untouched, so compression never delays their chunks.
+"""
+import gzip
+
+import anyio
+
+try:
+    import brotli
+except ImportError:  # brotli is optional; gzip is always available
+    brotli = None
+
+# Bodies larger than this are compressed on a worker thread instead of the event loop
+THREAD_COMPRESS_BYTES = 256 * 1024
+COMPRESSIBLE_TYPES = ("application/json", "text/html", "text/plain", "text/csv", "application/javascript")
+
+
+def parse_accept_encoding(header: str) -> dict:
+    """{"gzip": 1.0, "br": 0.8, ...} from an Accept-Encoding header"""
+    encodings = {}
+    for part in (header or "").split(","):
+        name, _, params = part.strip().partition(";")
+        if not name:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        encodings[name.strip().lower()] = q
+    return encodings
+
+
+def choose_encoding(header: str, brotli_enabled: bool = True):
+    accepted = parse_accept_encoding(header)
+    options = [("br", accepted.get("br", accepted.get("*", 0)))] if brotli_enabled and brotli is not None else []
+    options.append(("gzip", accepted.get("gzip", accepted.get("*", 0))))
+    # Ties go to brotli (listed first), which compresses JSON noticeably better
+    best = max(options, key=lambda option: option[1])
+    return best[0] if best[1] > 0 else None
+
+
+class CompressionMiddleware:
+    def __init__(self, app, minimum_size: int = 1024, gzip_level: int = 6, brotli_quality: int = 4,
+                 brotli_enabled: bool = True):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.brotli_enabled = brotli_enabled
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        headers = dict(scope.get("headers") or [])
+        encoding = choose_encoding(headers.get(b"accept-encoding", b"").decode("latin-1"), self.brotli_enabled)
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start_message = None
+
+        async def send_wrapper(message):
+            nonlocal start_message
+            if message["type"] == "http.response.start":
+                # Hold the headers back until the body shows whether it is worth compressing
+                start_message = message
+                return
+            if message["type"] != "http.response.body" or start_message is None:
+                await send(message)
+                return
+            start, start_message = start_message, None
+            body = message.get("body", b"")
+            if message.get("more_body", False) or not self._should_compress(start, body):
+                await send(start)
+                await send(message)
+                return
+            if len(body) > THREAD_COMPRESS_BYTES:
+                compressed = await anyio.to_thread.run_sync(self._compress, body, encoding)
+            else:
+                compressed = self._compress(body, encoding)
+            response_headers = [
+                (name, value) for name, value in start["headers"]
+                if name.lower() not in (b"content-length", b"vary")
+            ]
+            vary = [value for name, value in start["headers"] if name.lower() == b"vary"]
+            response_headers += [
+                (b"content-encoding", encoding.encode("latin-1")),
+                (b"content-length", str(len(compressed)).encode("latin-1")),
+                (b"vary", b", ".join(vary + [b"Accept-Encoding"])),
+            ]
+            await send({**start, "headers": response_headers})
+            await send({**message, "body": compressed})
+
+        await self.app(scope, receive, send_wrapper)
+
+    def _should_compress(self, start: dict, body: bytes) -> bool:
+        if len(body) < self.minimum_size:
+            return False
+        headers = {name.lower(): value for name, value in start["headers"]}
+        if b"content-encoding" in headers:
+            return False
+        content_type = headers.get(b"content-type", b"").decode("latin-1").split(";")[0].strip()
+        return content_type in COMPRESSIBLE_TYPES
+
+    def _compress(self, body: bytes, encoding: str) -> bytes:
+        if encoding == "br":
+            return brotli.compress(body, quality=self.brotli_quality)
+        return gzip.compress(body, compresslevel=self.gzip_level)
@@ -0,0 +1,144 @@
+"""Bounded in-memory LRU cache of recent chat messages per active session.
+
+The cache holds up to `max_messages` of the newest messages for each session
+and is kept current write-through: every stored message is appended to the
+cached session, and every other write path invalidates it. Memory is capped
+both by session count and by an approximate byte budget, evicting least
+recently used sessions first.
+
+A miss populates the cache from the database. To avoid a slow read
+overwriting a newer write-through append, loads are tagged with the write
+sequence number at start and discarded if the session was written since.
+"""
+import threading
+from collections import OrderedDict
+
+# Rough per-message overhead on top of content length (dict, strings, timestamps)
+MESSAGE_OVERHEAD_BYTES = 200
+
+
+def _message_size(message: dict) -> int:
+    return len(message.get("content") or "") + MESSAGE_OVERHEAD_BYTES
+
+
+class _Entry:
+    __slots__ = ("messages", "complete", "bytes")
+
+    def __init__(self, messages: list, complete: bool):
+        self.messages = messages
+        # True when `messages` is the session's entire history
+        self.complete = complete
+        self.bytes = sum(_message_size(m) for m in messages)
+
+
+class SessionHistoryCache:
+    def __init__(self, max_sessions: int = 1000, max_bytes: int = 64 * 1024 * 1024, max_messages: int = 50):
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.max_messages = max_messages
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._write_seq = 0
+        self._last_write = {}
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0,
+                      "appends": 0, "stale_loads_discarded": 0}
+
+    # ---------- internals (caller holds the lock) ----------
+    def _mark_write(self, session_id: str):
+        self._write_seq += 1
+        self._last_write[session_id] = self._write_seq
+        if len(self._last_write) > self.max_sessions * 20:
+            # Loads never span this many writes, so old sequence numbers can go
+            cutoff = self._write_seq - self.max_sessions * 10
+            self._last_write = {k: v for k, v in self._last_write.items() if v > cutoff}
+
+    def _drop(self, session_id: str):
+        entry = self._entries.pop(session_id, None)
+        if entry is not None:
+            self._bytes -= entry.bytes
+        return entry
+
+    def _trim(self, entry: _Entry):
+        while len(entry.messages) > self.max_messages:
+            removed = entry.messages.pop(0)
+            entry.bytes -= _message_size(removed)
+            self._bytes -= _message_size(removed)
+            entry.complete = False
+
+    def _enforce_limits(self):
+        while self._entries and (len(self._entries) > self.max_sessions or self._bytes > self.max_bytes):
+            session_id, entry = self._entries.popitem(last=False)
+            self._bytes -= entry.bytes
+            self.stats["evictions"] += 1
+
+    # ---------- public API ----------
+    def get(self, session_id: str, limit: int = None):
+        """Newest `limit` messages (oldest first) or None on a miss; limit=None needs the full history"""
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is not None and (entry.complete or (limit is not None and limit <= len(entry.messages))):
+                self._entries.move_to_end(session_id)
+                self.stats["hits"] += 1
+                messages = entry.messages if limit is None else entry.messages[-limit:]
+                return [dict(m) for m in messages]
+            self.stats["misses"] += 1
+            return None
+
+    def begin_load(self, session_id: str) -> int:
+        """Token to pass to populate() after reading the session from the database"""
+        with self._lock:
+            return self._write_seq
+
+    def populate(self, session_id: str, messages: list, complete: bool, token: int):
+        """Cache messages read from the database unless the session was written since `token`"""
+        with self._lock:
+            if self._last_write.get(session_id, -1) > token:
+                self.stats["stale_loads_discarded"] += 1
+                return
+            self._drop(session_id)
+            entry = _Entry([dict(m) for m in messages], complete)
+            self._trim(entry)
+            self._entries[session_id] = entry
+            self._bytes += entry.bytes
+            self._enforce_limits()
+
+    def append(self, session_id: str, message: dict):
+        """Write-through for a newly stored message"""
+        with self._lock:
+            self._mark_write(session_id)
+            entry = self._entries.get(session_id)
+            if entry is None:
+                return
+            entry.messages.append(dict(message))
+            size = _message_size(message)
+            entry.bytes += size
+            self._bytes += size
+            self._trim(entry)
+            self._entries.move_to_end(session_id)
+            self.stats["appends"] += 1
+            self._enforce_limits()
+
+    def invalidate(self, session_id: str):
+        with self._lock:
+            self._mark_write(session_id)
+            if self._drop(session_id) is not None:
+                self.stats["invalidations"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            lookups = self.stats["hits"] + self.stats["misses"]
+            return {
+                "sessions": len(self._entries),
+                "bytes": self._bytes,
+                "max_sessions": self.max_sessions,
+                "max_bytes": self.max_bytes,
+                "max_messages_per_session": self.max_messages,
+                "hit_ratio": round(self.stats["hits"] / lookups, 4) if lookups else None,
+                **self.stats,
+            }
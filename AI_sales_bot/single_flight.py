@@ -0,0 +1,99 @@
+"""Single-flight coalescing of identical concurrent calls.
+
+While a call for a key is in flight, further calls with the same key wait for
+its result instead of starting their own upstream request. Nothing is cached:
+once the leader finishes, the next call for that key runs again. Every
+caller that shared a result gets its own deep copy, so callers may mutate
+what they receive.
+"""
+import copy
+import functools
+import hashlib
+import json
+import re
+import threading
+from concurrent.futures import Future
+
+
+def flight_key(*parts) -> str:
+    """Normalize call arguments into a key: strings are case/whitespace-folded, anything else is canonical JSON"""
+    normalized = []
+    for part in parts:
+        if isinstance(part, str):
+            normalized.append(re.sub(r"\s+", " ", part).strip().lower())
+        else:
+            normalized.append(json.dumps(part, sort_keys=True, default=str))
+    joined = "\x1f".join(normalized)
+    if len(joined) > 200:
+        # Keep keys small when an argument is a whole document
+        return hashlib.sha256(joined.encode("utf-8")).hexdigest()
+    return joined
+
+
+class SingleFlight:
+    def __init__(self, name: str, unshared_errors: tuple = ()):
+        self.name = name
+        # A leader failing with one of these (e.g. its own rate limit) makes followers run the call themselves
+        self.unshared_errors = unshared_errors
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self.stats = {"calls": 0, "executions": 0, "coalesced": 0, "errors": 0, "retried_unshared": 0}
+
+    def do(self, key: str, fn):
+        """Run fn() unless an identical call is in flight, in which case share its outcome"""
+        with self._lock:
+            self.stats["calls"] += 1
+            flight = self._in_flight.get(key)
+            leader = flight is None
+            if leader:
+                # [future, number of followers waiting on it]
+                flight = [Future(), 0]
+                self._in_flight[key] = flight
+                self.stats["executions"] += 1
+            else:
+                flight[1] += 1
+                self.stats["coalesced"] += 1
+            future = flight[0]
+
+        if not leader:
+            try:
+                # Followers get their own copy so callers can't mutate each other's results
+                return copy.deepcopy(future.result())
+            except self.unshared_errors:
+                with self._lock:
+                    self.stats["retried_unshared"] += 1
+                return fn()
+
+        try:
+            result = fn()
+        except BaseException as e:
+            with self._lock:
+                self.stats["errors"] += 1
+                self._in_flight.pop(key, None)
+            future.set_exception(e)
+            raise
+        with self._lock:
+            self._in_flight.pop(key, None)
+            # No one can join once the key is gone, so an unshared result needs no copy
+            shared = flight[1] > 0
+        future.set_result(result)
+        # The shared original stays untouched while followers copy it
+        return copy.deepcopy(result) if shared else result
+
+    def coalesce(self, key_fn):
+        """Decorator: coalesce calls whose key_fn(*args, **kwargs) match"""
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                return self.do(key_fn(*args, **kwargs), lambda: fn(*args, **kwargs))
+            return wrapper
+        return decorator
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            calls = self.stats["calls"]
+            return {
+                **self.stats,
+                "in_flight": len(self._in_flight),
+                "coalesced_ratio": round(self.stats["coalesced"] / calls, 4) if calls else None,
+            }
@@ -0,0 +1,244 @@
+"""Streaming CSV / NDJSON / XLSX exports.
+
+Rows are pulled from an iterator (normally a Mongo cursor read in batches) and
+encoded `chunk_rows` at a time, so an export holds one chunk in memory however
+many rows it has. XLSX is written with the standard library: a workbook is a
+zip of a few small XML parts plus the worksheets, and each worksheet is
+streamed row by row into a deflated zip entry with a trailing data descriptor,
+so nothing ever seeks back over bytes already sent to the client.
+"""
+import csv
+import io
+import json
+import math
+import re
+import zipfile
+from datetime import datetime
+from urllib.parse import quote
+from xml.sax.saxutils import escape
+
+EXPORT_FORMATS = {
+    "csv": "text/csv; charset=utf-8",
+    "ndjson": "application/x-ndjson",
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+}
+
+# Excel's limits: rows past the last one spill into another sheet, longer cells are cut
+XLSX_MAX_ROWS = 1048576
+XLSX_MAX_CELL_CHARS = 32767
+# Characters XML 1.0 cannot carry at all, even escaped
+_XML_ILLEGAL = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]")
+# Spreadsheet apps evaluate text cells starting with these as formulas
+_FORMULA_PREFIXES = ("=", "+", "-", "@", "\t", "\r")
+
+
+def get_path(doc: dict, path: str):
+    """doc["a"]["b"] for path "a.b"; None when any step is missing"""
+    value = doc
+    for key in path.split("."):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key)
+    return value
+
+
+def iter_rows(docs, columns):
+    """Lists of values, in column order, from documents and (header, path) columns"""
+    for doc in docs:
+        yield [get_path(doc, path) for _, path in columns]
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+
+def _text(value) -> str:
+    if value is None:
+        return ""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, (list, dict)):
+        return json.dumps(value, default=_json_default, ensure_ascii=False)
+    return str(value)
+
+
+def _csv_cell(value) -> str:
+    text = _text(value)
+    if isinstance(value, str) and text.startswith(_FORMULA_PREFIXES):
+        # Model-written text is untrusted: keep it from running as a formula when opened
+        return "'" + text
+    return text
+
+
+def stream_csv(rows, headers, chunk_rows: int = 500):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    # Excel only reads a CSV as UTF-8 when it starts with a BOM
+    buffer.write("\ufeff")
+    writer.writerow(headers)
+    for count, row in enumerate(rows, 1):
+        writer.writerow([_csv_cell(value) for value in row])
+        if count % chunk_rows == 0:
+            yield buffer.getvalue().encode("utf-8")
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode("utf-8")
+
+
+def stream_ndjson(rows, headers, chunk_rows: int = 500):
+    lines = []
+    for row in rows:
+        lines.append(json.dumps(dict(zip(headers, row)), default=_json_default, ensure_ascii=False))
+        if len(lines) >= chunk_rows:
+            yield ("\n".join(lines) + "\n").encode("utf-8")
+            lines = []
+    if lines:
+        yield ("\n".join(lines) + "\n").encode("utf-8")
+
+
+class _ChunkSink:
+    """Write-only file for ZipFile; what was written since the last take() is handed out"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def _xlsx_cell(value) -> str:
+    if value is None:
+        return "<c/>"
+    if isinstance(value, bool):
+        return f'<c t="b"><v>{int(value)}</v></c>'
+    if isinstance(value, int) or (isinstance(value, float) and math.isfinite(value)):
+        return f"<c><v>{value}</v></c>"
+    # Inline strings: no shared-string table has to be built (and held) for the whole export
+    text = _XML_ILLEGAL.sub("", _text(value))[:XLSX_MAX_CELL_CHARS]
+    return f'<c t="inlineStr"><is><t xml:space="preserve">{escape(text)}</t></is></c>'
+
+
+def _xlsx_row(values) -> bytes:
+    return ("<row>" + "".join(_xlsx_cell(value) for value in values) + "</row>").encode("utf-8")
+
+
+_XML_DECLARATION = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+_SHEET_HEAD = (_XML_DECLARATION + '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+               '<sheetData>').encode("utf-8")
+_SHEET_TAIL = b"</sheetData></worksheet>"
+
+
+def _xlsx_package_parts(sheet_names):
+    """The workbook's fixed parts, written after the sheets once their number is known"""
+    sheet_types = "".join(
+        f'<Override PartName="/xl/worksheets/sheet{i}.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        for i in range(1, len(sheet_names) + 1)
+    )
+    sheets = "".join(
+        f'<sheet name="{escape(name)}" sheetId="{i}" r:id="rId{i}"/>'
+        for i, name in enumerate(sheet_names, 1)
+    )
+    sheet_rels = "".join(
+        f'<Relationship Id="rId{i}" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+        f'Target="worksheets/sheet{i}.xml"/>'
+        for i in range(1, len(sheet_names) + 1)
+    )
+    return {
+        "[Content_Types].xml": (
+            '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            '<Override PartName="/xl/workbook.xml" '
+            'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+            f"{sheet_types}</Types>"
+        ),
+        "_rels/.rels": (
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            '<Relationship Id="rId1" '
+            'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+            'Target="xl/workbook.xml"/></Relationships>'
+        ),
+        "xl/workbook.xml": (
+            '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+            'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+            f"<sheets>{sheets}</sheets></workbook>"
+        ),
+        "xl/_rels/workbook.xml.rels": (
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            f"{sheet_rels}</Relationships>"
+        ),
+    }
+
+
+def _sheet_name(base: str, index: int) -> str:
+    # Sheet names are at most 31 characters and may not contain []:*?/\
+    name = re.sub(r"[\[\]:*?/\\]", "_", base)[:31] or "Export"
+    if index == 1:
+        return name
+    suffix = f" ({index})"
+    return name[:31 - len(suffix)] + suffix
+
+
+def stream_xlsx(rows, headers, sheet_name: str = "Export", chunk_rows: int = 500):
+    sink = _ChunkSink()
+    sheet_names = []
+    with zipfile.ZipFile(sink, "w", compression=zipfile.ZIP_DEFLATED) as workbook:
+        sheet = None
+        sheet_rows = XLSX_MAX_ROWS
+        for count, row in enumerate(rows, 1):
+            if sheet_rows >= XLSX_MAX_ROWS:
+                if sheet is not None:
+                    sheet.write(_SHEET_TAIL)
+                    sheet.close()
+                sheet_names.append(_sheet_name(sheet_name, len(sheet_names) + 1))
+                # The size isn't known up front, so the entry must allow for Zip64
+                sheet = workbook.open(f"xl/worksheets/sheet{len(sheet_names)}.xml", "w", force_zip64=True)
+                sheet.write(_SHEET_HEAD)
+                sheet.write(_xlsx_row(headers))
+                sheet_rows = 1
+            sheet.write(_xlsx_row(row))
+            sheet_rows += 1
+            if count % chunk_rows == 0:
+                chunk = sink.take()
+                if chunk:
+                    yield chunk
+        if sheet is None:
+            # No rows: still a valid workbook, with just the header row
+            sheet_names.append(_sheet_name(sheet_name, 1))
+            sheet = workbook.open("xl/worksheets/sheet1.xml", "w")
+            sheet.write(_SHEET_HEAD)
+            sheet.write(_xlsx_row(headers))
+        sheet.write(_SHEET_TAIL)
+        sheet.close()
+        for name, body in _xlsx_package_parts(sheet_names).items():
+            workbook.writestr(name, _XML_DECLARATION + body)
+    yield sink.take()
+
+
+def stream_export(export_format: str, rows, headers, sheet_name: str = "Export", chunk_rows: int = 500):
+    """Byte chunks of the rows encoded in `export_format` (one of EXPORT_FORMATS)"""
+    if export_format == "csv":
+        return stream_csv(rows, headers, chunk_rows)
+    if export_format == "ndjson":
+        return stream_ndjson(rows, headers, chunk_rows)
+    if export_format == "xlsx":
+        return stream_xlsx(rows, headers, sheet_name, chunk_rows)
+    raise ValueError(f"Unsupported export format: {export_format}")
+
+
+def content_disposition(filename: str) -> str:
+    ascii_name = filename.encode("ascii", "ignore").decode("ascii").replace('"', "") or "export"
+    return f"attachment; filename=\"{ascii_name}\"; filename*=UTF-8''{quote(filename)}"
@@ -0,0 +1,263 @@
+"""Structured (JSON) LLM output: validation, a single repair attempt, failure
+tracking per call site, and an incremental parser for streamed JSON objects.
+"""
+import json
+import re
+import threading
+
+from pydantic import ValidationError
+
+_FENCE_RE = re.compile(r"^```(?:json)?\s*|\s*```$", re.IGNORECASE)
+
+
+class StructuredOutputError(Exception):
+    """The model did not produce valid output, even after the repair attempt"""
+
+    def __init__(self, call_site: str, detail: str):
+        super().__init__(f"{call_site}: {detail}")
+        self.call_site = call_site
+        self.detail = detail
+
+
+def strip_json_fences(content: str) -> str:
+    """Remove markdown code fences and any prose around the outermost JSON object"""
+    content = _FENCE_RE.sub("", (content or "").strip())
+    start, end = content.find("{"), content.rfind("}")
+    if start != -1 and end > start:
+        return content[start:end + 1]
+    return content
+
+
+def parse_model(content: str, output_model):
+    """Validate raw model output against a Pydantic model (raises ValueError/ValidationError)"""
+    return output_model.model_validate_json(strip_json_fences(content))
+
+
+class ParseFailureTracker:
+    """Counts first-try parse failures, repairs and hard failures per call site"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sites = {}
+
+    def record(self, call_site: str, outcome: str):
+        with self._lock:
+            site = self._sites.setdefault(call_site, {"calls": 0, "ok": 0, "repaired": 0, "failed": 0})
+            site["calls"] += 1
+            site[outcome] += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                name: {
+                    **counts,
+                    "first_try_failure_rate": round((counts["repaired"] + counts["failed"]) / counts["calls"], 4),
+                    "failure_rate": round(counts["failed"] / counts["calls"], 4),
+                }
+                for name, counts in self._sites.items()
+            }
+
+
+def generate_structured(call_site: str, output_model, request, repair=None, tracker: ParseFailureTracker = None):
+    """Run request() -> raw text, validate it, and on failure make one repair(raw, error) -> raw text attempt"""
+    content = request()
+    try:
+        result = parse_model(content, output_model)
+        if tracker:
+            tracker.record(call_site, "ok")
+        return result
+    except (ValueError, ValidationError) as e:
+        error = e
+        print(f"Structured output for {call_site} failed validation: {str(e)[:300]}")
+
+    if repair is not None:
+        try:
+            result = parse_model(repair(content, str(error)[:1000]), output_model)
+            if tracker:
+                tracker.record(call_site, "repaired")
+            return result
+        except (ValueError, ValidationError) as e:
+            error = e
+
+    if tracker:
+        tracker.record(call_site, "failed")
+    raise StructuredOutputError(call_site, str(error)[:500])
+
+
+def repair_prompt(content: str, error: str, output_model) -> str:
+    schema = json.dumps(output_model.model_json_schema())
+    return f"""The following JSON output is invalid.
+
+Validation error:
+{error}
+
+Required JSON schema:
+{schema}
+
+Invalid output:
+{content}
+
+Return ONLY the corrected JSON object."""
+
+
+def _loads_or_raw(raw: str):
+    try:
+        return json.loads(raw)
+    except ValueError:
+        return raw
+
+
+class IncrementalJSONParser:
+    """Parse a streamed JSON object, reporting values as soon as they are complete.
+
+    feed() returns the (path, value) pairs completed by the new text, for values
+    nested at most `max_depth` levels deep (path is a tuple of keys and list
+    indexes, so depth 1 means top-level fields). partial() exposes the string
+    value currently being streamed, if any, so callers can render long text
+    fields progressively.
+    """
+
+    def __init__(self, max_depth: int = 1):
+        self.max_depth = max_depth
+        self.buffer = ""
+        self.fields = {}
+        self.done = False
+        self._root = None
+        self._pos = 0
+        self._stack = []
+        self._in_string = False
+        self._escape = False
+        self._string_start = None
+
+    def _path(self) -> tuple:
+        return tuple(f["key"] if f["type"] == "object" else f["index"] for f in self._stack)
+
+    def _complete_value(self, value, completed: list):
+        frame = self._stack[-1]
+        path = self._path()
+        if len(path) <= self.max_depth:
+            completed.append((path, value))
+        if len(self._stack) == 1:
+            self.fields[frame["key"]] = value
+        frame["state"] = "comma"
+
+    def _open(self, kind: str, start: int):
+        self._stack.append({
+            "type": kind,
+            "start": start,
+            "state": "key" if kind == "object" else "value",
+            "key": None,
+            "index": 0,
+            "value_start": None,
+        })
+
+    def _close(self, end: int, completed: list):
+        frame = self._stack.pop()
+        value = _loads_or_raw(self.buffer[frame["start"]:end + 1])
+        if self._stack:
+            self._complete_value(value, completed)
+        else:
+            self._root = value
+            self.done = True
+
+    def feed(self, text: str) -> list:
+        completed = []
+        if self.done or not text:
+            return completed
+        self.buffer += text
+        buffer = self.buffer
+        i = self._pos
+        while i < len(buffer) and not self.done:
+            c = buffer[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif c == "\\":
+                    self._escape = True
+                elif c == '"':
+                    self._in_string = False
+                    frame = self._stack[-1]
+                    raw = buffer[self._string_start:i + 1]
+                    if frame["state"] == "key_string":
+                        frame["key"] = json.loads(raw)
+                        frame["state"] = "colon"
+                    else:
+                        self._complete_value(_loads_or_raw(raw), completed)
+                i += 1
+                continue
+
+            if not self._stack:
+                # Skip anything before the object, such as a code fence
+                if c == "{":
+                    self._open("object", i)
+                i += 1
+                continue
+
+            frame = self._stack[-1]
+            state = frame["state"]
+            if state == "scalar":
+                if c not in ",}]":
+                    i += 1
+                    continue
+                self._complete_value(_loads_or_raw(buffer[frame["value_start"]:i].strip()), completed)
+                state = "comma"
+
+            closes = "}" if frame["type"] == "object" else "]"
+            if state == "comma" or (c == closes and state in ("key", "value")):
+                if c == ",":
+                    if frame["type"] == "object":
+                        frame["state"] = "key"
+                        frame["key"] = None
+                    else:
+                        frame["index"] += 1
+                        frame["state"] = "value"
+                elif c == closes:
+                    self._close(i, completed)
+            elif state == "key":
+                if c == '"':
+                    self._in_string = True
+                    self._string_start = i
+                    frame["state"] = "key_string"
+            elif state == "colon":
+                if c == ":":
+                    frame["state"] = "value"
+            elif state == "value" and not c.isspace():
+                if c == '"':
+                    self._in_string = True
+                    self._string_start = i
+                    frame["state"] = "string"
+                elif c in "{[":
+                    frame["state"] = "child"
+                    self._open("object" if c == "{" else "array", i)
+                else:
+                    frame["value_start"] = i
+                    frame["state"] = "scalar"
+            i += 1
+        self._pos = i
+        return completed
+
+    def partial(self):
+        """(path, text so far) for a string value still being streamed, else None"""
+        if not self._in_string or not self._stack or self._stack[-1]["state"] != "string":
+            return None
+        path = self._path()
+        if len(path) > self.max_depth:
+            return None
+        raw = self.buffer[self._string_start:]
+        # Trim a cut-off escape sequence (a lone backslash or a partial \u escape) until the fragment decodes
+        for cut in range(0, min(6, len(raw) - 1) + 1):
+            try:
+                text = json.loads(raw[:len(raw) - cut] + '"')
+            except ValueError:
+                continue
+            # A high surrogate waits for the low half of its pair
+            if text and "\ud800" <= text[-1] <= "\udbff":
+                text = text[:-1]
+            return path, text
+        return None
+
+    def result(self) -> dict:
+        """The full object once done (falls back to the top-level fields seen so far)"""
+        if self.done and isinstance(self._root, dict):
+            return self._root
+        return dict(self.fields)
@@ -0,0 +1,453 @@
+"""Offline re-summarization of stored documents through a batch completion API.
+
+Backfills (e.g. after a prompt change) don't need interactive latency, so
+instead of calling the chat API one document at a time they are written as
+JSONL batch requests, submitted to a batch backend and collected when the
+backend finishes, at the batch discount and without touching the interactive
+admission limits. Progress is checkpointed to a JSON file so an interrupted
+run resumes where it stopped: documents already submitted or stored are
+skipped, and pending batches are collected instead of resubmitted.
+
+Run it against the API's database:
+
+    python summary_backfill.py --model gpt-4o-mini --batch-size 1000
+    python summary_backfill.py --backend local --user-id abc123 --limit 50
+
+The `local` backend runs each request against the configured OpenAI endpoint
+(e.g. the mock server) and writes the results as files, mimicking the batch
+output format.
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+import uuid
+from datetime import datetime
+
+from structured_output import parse_model
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+# Batch requests are billed at half the synchronous price
+BATCH_PRICE_RATIO = 0.5
+TERMINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+
+def batch_request(custom_id: str, body: dict) -> dict:
+    return {"custom_id": custom_id, "method": "POST", "url": BATCH_ENDPOINT, "body": body}
+
+
+def write_jsonl(path: str, rows):
+    with open(path, "w", encoding="utf-8") as f:
+        for row in rows:
+            f.write(json.dumps(row, default=str) + "\n")
+
+
+def read_jsonl_lines(lines):
+    for line in lines:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+
+def result_usage(row: dict):
+    """Token usage of one batch output line, or None if the request never produced a response"""
+    body = (row.get("response") or {}).get("body") or {}
+    return body.get("usage")
+
+
+def result_content(row: dict):
+    """(content, error) of one batch output line"""
+    response = row.get("response") or {}
+    if row.get("error") or response.get("status_code", 200) != 200:
+        error = row.get("error") or (response.get("body") or {}).get("error") or {}
+        return None, error.get("message") or f"status {response.get('status_code')}"
+    try:
+        return response["body"]["choices"][0]["message"]["content"], None
+    except (KeyError, IndexError, TypeError):
+        return None, "malformed response body"
+
+
+# ---------- Backends ----------
+class OpenAIBatchBackend:
+    """The OpenAI Batch API: upload the JSONL file, create a batch, download its output"""
+
+    def __init__(self, client, completion_window: str = "24h"):
+        self.client = client
+        self.completion_window = completion_window
+
+    def submit(self, path: str, metadata: dict = None) -> str:
+        with open(path, "rb") as f:
+            uploaded = self.client.files.create(file=f, purpose="batch")
+        batch = self.client.batches.create(
+            input_file_id=uploaded.id,
+            endpoint=BATCH_ENDPOINT,
+            completion_window=self.completion_window,
+            metadata=metadata or None
+        )
+        return batch.id
+
+    def status(self, batch_id: str) -> str:
+        return self.client.batches.retrieve(batch_id).status
+
+    def results(self, batch_id: str):
+        batch = self.client.batches.retrieve(batch_id)
+        # Failed requests are reported in a separate error file
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if file_id:
+                yield from read_jsonl_lines(self.client.files.content(file_id).text.splitlines())
+
+
+class LocalBatchBackend:
+    """File-based batch backend for tests and local runs.
+
+    Inputs are copied to `directory`; a batch is complete once
+    `<batch_id>.output.jsonl` exists. With a `respond(body) -> completion dict`
+    callable the output is produced immediately on submit, otherwise something
+    else (a test, a worker) is expected to write it.
+    """
+
+    def __init__(self, directory: str, respond=None):
+        self.directory = directory
+        self.respond = respond
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, batch_id: str, kind: str) -> str:
+        return os.path.join(self.directory, f"{batch_id}.{kind}.jsonl")
+
+    def submit(self, path: str, metadata: dict = None) -> str:
+        batch_id = f"local_batch_{uuid.uuid4().hex}"
+        with open(path, "r", encoding="utf-8") as f:
+            requests = list(read_jsonl_lines(f))
+        write_jsonl(self._path(batch_id, "input"), requests)
+        if self.respond is not None:
+            write_jsonl(self._path(batch_id, "output"), (self._run(request) for request in requests))
+        return batch_id
+
+    def _run(self, request: dict) -> dict:
+        row = {"id": f"batch_req_{uuid.uuid4().hex}", "custom_id": request["custom_id"], "error": None}
+        try:
+            row["response"] = {"status_code": 200, "body": self.respond(request["body"])}
+        except Exception as e:
+            row["response"] = None
+            row["error"] = {"code": type(e).__name__, "message": str(e)}
+        return row
+
+    def status(self, batch_id: str) -> str:
+        return "completed" if os.path.exists(self._path(batch_id, "output")) else "in_progress"
+
+    def results(self, batch_id: str):
+        with open(self._path(batch_id, "output"), "r", encoding="utf-8") as f:
+            yield from read_jsonl_lines(f)
+
+
+# ---------- Checkpoint ----------
+class BackfillCheckpoint:
+    """Progress of a backfill run, rewritten atomically after every change"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.state = {"batches": {}, "done": [], "failed": {}}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                self.state.update(json.load(f))
+        self._done = set(self.state["done"])
+        self._pending = {
+            custom_id
+            for batch in self.state["batches"].values()
+            if batch["status"] not in TERMINAL_STATUSES
+            for custom_id in batch["custom_ids"]
+        }
+
+    def save(self):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(prefix=".backfill-", suffix=".json", dir=directory)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(self.state, f, indent=2, default=str)
+        os.replace(tmp_path, self.path)
+
+    def seen(self, custom_id: str) -> bool:
+        """Already stored, or part of a batch that is still pending"""
+        return custom_id in self._done or custom_id in self._pending
+
+    def pending_batches(self) -> list:
+        return [batch_id for batch_id, batch in self.state["batches"].items() if batch["status"] not in TERMINAL_STATUSES]
+
+    def add_batch(self, batch_id: str, custom_ids: list, model: str):
+        self.state["batches"][batch_id] = {
+            "status": "submitted",
+            "model": model,
+            "custom_ids": custom_ids,
+            "submitted_at": datetime.utcnow().isoformat(),
+        }
+        self._pending.update(custom_ids)
+        self.save()
+
+    def finish_batch(self, batch_id: str, status: str, done: list, failed: dict):
+        batch = self.state["batches"][batch_id]
+        batch["status"] = status
+        batch["finished_at"] = datetime.utcnow().isoformat()
+        batch["stored"] = len(done)
+        batch["failed"] = len(failed)
+        self._pending.difference_update(batch["custom_ids"])
+        self._done.update(done)
+        self.state["done"] = sorted(self._done)
+        self.state["failed"].update(failed)
+        for custom_id in done:
+            self.state["failed"].pop(custom_id, None)
+        self.save()
+
+    def summary(self) -> dict:
+        statuses = {}
+        for batch in self.state["batches"].values():
+            statuses[batch["status"]] = statuses.get(batch["status"], 0) + 1
+        return {"batches": statuses, "done": len(self._done), "failed": len(self.state["failed"])}
+
+
+# ---------- Backfill ----------
+class SummaryBackfill:
+    def __init__(self, backend, checkpoint: BackfillCheckpoint, build_body, output_model, store_results,
+                 model: str, batch_size: int = 1000, store_batch_size: int = 500, work_dir: str = None,
+                 record_usage=None):
+        self.backend = backend
+        self.checkpoint = checkpoint
+        # build_body(document) -> chat completion request body, or None to skip the document
+        self.build_body = build_body
+        self.output_model = output_model
+        # store_results(list of (custom_id, validated summary), batch_id) -> None; bulk write
+        self.store_results = store_results
+        # record_usage(list of (custom_id, usage dict), batch_id) -> None; every billed result, parsed or not
+        self.record_usage = record_usage
+        self.model = model
+        self.batch_size = batch_size
+        self.store_batch_size = store_batch_size
+        self.work_dir = work_dir or tempfile.gettempdir()
+        self.stats = {"submitted": 0, "skipped": 0, "stored": 0, "failed": 0}
+
+    def submit(self, documents) -> list:
+        """Write and submit batches for documents (dicts with `document_id`) not seen before"""
+        batch_ids = []
+        pending = []
+        for document in documents:
+            custom_id = document["document_id"]
+            if self.checkpoint.seen(custom_id):
+                self.stats["skipped"] += 1
+                continue
+            body = self.build_body(document)
+            if body is None:
+                self.stats["skipped"] += 1
+                continue
+            pending.append(batch_request(custom_id, body))
+            if len(pending) >= self.batch_size:
+                batch_ids.append(self._submit_batch(pending))
+                pending = []
+        if pending:
+            batch_ids.append(self._submit_batch(pending))
+        return batch_ids
+
+    def _submit_batch(self, requests: list) -> str:
+        fd, path = tempfile.mkstemp(prefix="summary-backfill-", suffix=".jsonl", dir=self.work_dir)
+        os.close(fd)
+        try:
+            write_jsonl(path, requests)
+            batch_id = self.backend.submit(path, {"purpose": "summary_backfill"})
+        finally:
+            os.remove(path)
+        self.checkpoint.add_batch(batch_id, [r["custom_id"] for r in requests], self.model)
+        self.stats["submitted"] += len(requests)
+        print(f"Submitted batch {batch_id} with {len(requests)} requests")
+        return batch_id
+
+    def collect(self, wait: bool = True, poll_interval: float = 30.0, timeout: float = None):
+        """Store results of finished batches; with wait, poll until none are pending"""
+        give_up_at = time.monotonic() + timeout if timeout else None
+        while True:
+            for batch_id in self.checkpoint.pending_batches():
+                status = self.backend.status(batch_id)
+                if status in TERMINAL_STATUSES:
+                    self._collect_batch(batch_id, status)
+            pending = self.checkpoint.pending_batches()
+            if not pending or not wait:
+                return pending
+            if give_up_at is not None and time.monotonic() >= give_up_at:
+                return pending
+            time.sleep(poll_interval)
+
+    def _collect_batch(self, batch_id: str, status: str):
+        expected = set(self.checkpoint.state["batches"][batch_id]["custom_ids"])
+        done, failed, results, usage = [], {}, [], []
+        if status == "completed":
+            for row in self.backend.results(batch_id):
+                custom_id = row.get("custom_id")
+                if custom_id not in expected:
+                    continue
+                row_usage = result_usage(row)
+                if row_usage:
+                    usage.append((custom_id, row_usage))
+                content, error = result_content(row)
+                if error is None:
+                    try:
+                        results.append((custom_id, parse_model(content, self.output_model)))
+                    except ValueError as e:
+                        error = f"parse_error: {str(e)[:200]}"
+                if error is not None:
+                    failed[custom_id] = error
+                elif len(results) >= self.store_batch_size:
+                    done.extend(self._store(results, batch_id))
+                    results = []
+            if results:
+                done.extend(self._store(results, batch_id))
+        if usage and self.record_usage:
+            try:
+                self.record_usage(usage, batch_id)
+            except Exception as e:
+                print(f"Error recording usage of batch {batch_id}: {e}")
+        missing = expected - set(done) - set(failed)
+        failed.update({custom_id: f"no result (batch {status})" for custom_id in missing})
+        self.checkpoint.finish_batch(batch_id, status, done, failed)
+        self.stats["stored"] += len(done)
+        self.stats["failed"] += len(failed)
+        print(f"Collected batch {batch_id} ({status}): {len(done)} stored, {len(failed)} failed")
+
+    def _store(self, results: list, batch_id: str) -> list:
+        self.store_results(results, batch_id)
+        return [custom_id for custom_id, _ in results]
+
+    def run(self, documents, wait: bool = True, poll_interval: float = 30.0, timeout: float = None):
+        # Collect what earlier runs left pending before submitting more
+        self.collect(wait=False)
+        self.submit(documents)
+        return self.collect(wait=wait, poll_interval=poll_interval, timeout=timeout)
+
+
+# ---------- CLI ----------
+def main():
+    parser = argparse.ArgumentParser(description="Re-summarize stored documents through a batch API")
+    parser.add_argument("--backend", choices=["openai", "local"], default="openai")
+    parser.add_argument("--local-dir", default="summary_backfill_batches", help="Batch files of the local backend")
+    parser.add_argument("--checkpoint", default="summary_backfill.checkpoint.json")
+    parser.add_argument("--model", default=os.getenv("BACKFILL_MODEL", "gpt-4o-mini"),
+                        help="A batch file may only target one model")
+    parser.add_argument("--user-id", help="Only this user's documents")
+    parser.add_argument("--since", help="Only documents uploaded on or after this ISO date")
+    parser.add_argument("--limit", type=int, default=0)
+    parser.add_argument("--batch-size", type=int, default=int(os.getenv("BACKFILL_BATCH_SIZE", "1000")))
+    parser.add_argument("--no-wait", action="store_true", help="Submit and exit; rerun later to collect")
+    parser.add_argument("--poll-interval", type=float, default=60.0)
+    parser.add_argument("--status", action="store_true", help="Print the checkpoint and exit")
+    args = parser.parse_args()
+
+    checkpoint = BackfillCheckpoint(args.checkpoint)
+    if args.status:
+        print(json.dumps(checkpoint.summary(), indent=2))
+        return
+
+    # The prompt, output model and collections are the API's own
+    import openai_chatbot as api
+    from model_router import estimate_message_tokens
+    from pymongo import UpdateMany
+
+    if api.documents_collection is None or api.file_summaries_collection is None:
+        raise SystemExit("Database not connected. Please ensure MongoDB is running and MONGO_URI is set correctly.")
+    if api.openai_client is None:
+        raise SystemExit("OpenAI API key not configured. Please set OPENAI_API_KEY in your .env file.")
+    api.ensure_indexes()
+
+    profile = api.model_router.profiles.get(args.model)
+    max_output_tokens = 1000
+    response_format = api.structured_response_format()
+
+    def build_body(document):
+        messages = api.file_summary_messages(document["text"])
+        if profile and estimate_message_tokens(messages) + max_output_tokens > profile.context_window:
+            print(f"Skipping document {document['document_id']}: too large for {args.model}")
+            return None
+        body = {"model": args.model, "messages": messages, "temperature": 0.3, "max_tokens": max_output_tokens}
+        if response_format:
+            body["response_format"] = response_format
+        return body
+
+    def store_results(results, batch_id):
+        ids = [custom_id for custom_id, _ in results]
+        documents = {
+            doc["document_id"]: doc
+            for doc in api.documents_collection.find({"document_id": {"$in": ids}}, {"_id": 0, "text": 0})
+        }
+        now = datetime.utcnow()
+        operations = []
+        for custom_id, summary in results:
+            document = documents.get(custom_id)
+            if document is None:
+                continue
+            summary_data = summary.model_dump()
+            summary_data["timestamp"] = now.isoformat()
+            summary_data["is_fallback"] = False
+            # Every stored summary of the same file is refreshed; a file never summarized gets one
+            operations.append(UpdateMany(
+                {"user_id": document["user_id"], "file_sha256": document["file_sha256"]},
+                {
+                    "$set": {
+                        "summary": summary_data,
+                        "updated_at": now,
+                        "backfill": {"batch_id": batch_id, "model": args.model, "at": now},
+                    },
+                    "$setOnInsert": {
+                        "file_name": document.get("file_name"),
+                        "file_size": document.get("file_size"),
+                        "content_type": document.get("content_type"),
+                        "created_at": now,
+                    },
+                },
+                upsert=True
+            ))
+        if operations:
+            api.file_summaries_collection.bulk_write(operations, ordered=False)
+
+    def record_usage(usage, batch_id):
+        if api.usage_ledger is None:
+            return
+        ids = [custom_id for custom_id, _ in usage]
+        owners = {
+            doc["document_id"]: doc["user_id"]
+            for doc in api.documents_collection.find({"document_id": {"$in": ids}}, {"_id": 0, "document_id": 1, "user_id": 1})
+        }
+        for custom_id, tokens in usage:
+            prompt_tokens = tokens.get("prompt_tokens", 0)
+            completion_tokens = tokens.get("completion_tokens", 0)
+            cost = api.usage_price(args.model, prompt_tokens, completion_tokens)
+            api.usage_ledger.record(
+                args.model, prompt_tokens, completion_tokens, None,
+                user_id=owners.get(custom_id),
+                task="file_summary",
+                endpoint=f"BATCH {BATCH_ENDPOINT}",
+                cost=cost * BATCH_PRICE_RATIO if cost is not None else None
+            )
+        api.usage_ledger.flush()
+
+    if args.backend == "openai":
+        backend = OpenAIBatchBackend(api.openai_client)
+    else:
+        backend = LocalBatchBackend(
+            args.local_dir,
+            respond=lambda body: api.openai_client.chat.completions.create(**body).model_dump()
+        )
+
+    query = {"text": {"$exists": True}}
+    if args.user_id:
+        query["user_id"] = args.user_id
+    if args.since:
+        query["created_at"] = {"$gte": datetime.fromisoformat(args.since)}
+    documents = api.documents_collection.find(
+        query, {"_id": 0, "document_id": 1, "user_id": 1, "text": 1}
+    ).sort("created_at", 1).batch_size(100)
+    if args.limit:
+        documents = documents.limit(args.limit)
+
+    backfill = SummaryBackfill(backend, checkpoint, build_body, api.FileSummaryFields, store_results,
+                               model=args.model, batch_size=args.batch_size, record_usage=record_usage)
+    pending = backfill.run(documents, wait=not args.no_wait, poll_interval=args.poll_interval)
+    print(json.dumps({**backfill.stats, "pending_batches": pending, "checkpoint": checkpoint.summary()}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
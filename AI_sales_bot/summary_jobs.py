@@ -0,0 +1,198 @@
+"""Background job pipeline for bulk file summarization.
+
+A job is a list of files already spooled to disk. Files are extracted and
+summarized by a shared, bounded worker pool (so several large jobs can't
+starve the API of LLM capacity), per-file progress is tracked in memory,
+and finished summaries are written to the database in batches.
+"""
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+
+class SummaryJob:
+    def __init__(self, user_id: str, items: list, skipped: list = None):
+        self.job_id = str(uuid.uuid4())
+        self.user_id = user_id
+        self.status = "queued"
+        self.created_at = datetime.utcnow()
+        self.started_at = None
+        self.finished_at = None
+        self.files = [
+            {
+                "file_name": item["file_name"],
+                "file_size": item.get("file_size"),
+                "status": "queued",
+                "error": None,
+                "summary": None,
+            }
+            for item in items
+        ]
+        self.items = items
+        # Uploaded files left out of the job, each {"file_name", "reason"}
+        self.skipped = skipped or []
+        self.completed = 0
+        self.failed = 0
+        self.pending_writes = []
+        self.writing = 0
+        self.finishing = False
+        self.lock = threading.Lock()
+
+    @property
+    def total(self) -> int:
+        return len(self.files)
+
+    def to_dict(self, include_results: bool = True) -> dict:
+        with self.lock:
+            data = {
+                "job_id": self.job_id,
+                "user_id": self.user_id,
+                "status": self.status,
+                "total": self.total,
+                "completed": self.completed,
+                "failed": self.failed,
+                "skipped": [dict(s) for s in self.skipped],
+                "progress": round((self.completed + self.failed) / self.total, 4) if self.total else 1.0,
+                "created_at": self.created_at.isoformat(),
+                "started_at": self.started_at.isoformat() if self.started_at else None,
+                "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+            }
+            if include_results:
+                data["files"] = [dict(f) for f in self.files]
+            return data
+
+
+class SummaryJobManager:
+    """Runs SummaryJobs on a shared worker pool and tracks their progress"""
+
+    def __init__(self, process_file, store_batch, persist_job=None, max_workers: int = 4,
+                 batch_size: int = 25, retention_seconds: float = 3600, store_attempts: int = 2):
+        # process_file(user_id, item) -> summary document; raises on failure
+        self.process_file = process_file
+        # store_batch(list_of_documents) -> indexes of documents not stored (None if all were); bulk write
+        self.store_batch = store_batch
+        # persist_job(job_dict) -> None; called when a job finishes
+        self.persist_job = persist_job
+        self.batch_size = batch_size
+        self.store_attempts = store_attempts
+        self.retention_seconds = retention_seconds
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="summary-job")
+        self.max_workers = max_workers
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, user_id: str, items: list, skipped: list = None) -> SummaryJob:
+        job = SummaryJob(user_id, items, skipped)
+        with self._lock:
+            self._prune()
+            self._jobs[job.job_id] = job
+        for index in range(len(items)):
+            self.executor.submit(self._run_file, job, index)
+        if not items:
+            self._finish(job)
+        return job
+
+    def get(self, job_id: str):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def list_for_user(self, user_id: str) -> list:
+        with self._lock:
+            jobs = [j for j in self._jobs.values() if j.user_id == user_id]
+        return sorted(jobs, key=lambda j: j.created_at, reverse=True)
+
+    def _prune(self):
+        cutoff = time.time() - self.retention_seconds
+        for job_id, job in list(self._jobs.items()):
+            if job.finished_at and job.finished_at.timestamp() < cutoff:
+                del self._jobs[job_id]
+
+    def _run_file(self, job: SummaryJob, index: int):
+        item = job.items[index]
+        entry = job.files[index]
+        with job.lock:
+            if job.status == "queued":
+                job.status = "running"
+                job.started_at = datetime.utcnow()
+            entry["status"] = "processing"
+
+        to_flush = None
+        try:
+            document = self.process_file(job.user_id, item)
+            document["job_id"] = job.job_id
+            with job.lock:
+                entry["status"] = "completed"
+                entry["summary"] = document.get("summary")
+                job.completed += 1
+                job.pending_writes.append((index, document))
+                if len(job.pending_writes) >= self.batch_size:
+                    to_flush, job.pending_writes = job.pending_writes, []
+                    job.writing += 1
+        except Exception as e:
+            print(f"Bulk summary failed for {item['file_name']} in job {job.job_id}: {e}")
+            with job.lock:
+                entry["status"] = "failed"
+                entry["error"] = getattr(e, "detail", None) or str(e)
+                job.failed += 1
+        finally:
+            path = item.get("path")
+            if path:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+        if to_flush:
+            try:
+                self._flush(job, to_flush)
+            finally:
+                with job.lock:
+                    job.writing -= 1
+
+        with job.lock:
+            # A batch still being written can turn completed files into failed ones
+            done = job.completed + job.failed == job.total and not job.writing and not job.finishing
+            if done:
+                job.finishing = True
+        if done:
+            self._finish(job)
+
+    def _flush(self, job: SummaryJob, writes: list):
+        """Store (file index, document) pairs, retrying what failed; files still unsaved are marked failed"""
+        error = None
+        for _ in range(self.store_attempts):
+            try:
+                unsaved = self.store_batch([document for _, document in writes])
+            except Exception as e:
+                print(f"Error storing summaries for job {job.job_id}: {e}")
+                error = str(e)
+                continue
+            writes = [writes[i] for i in (unsaved or [])]
+            if not writes:
+                return
+            error = f"{len(writes)} summaries were rejected by the database"
+            print(f"Error storing summaries for job {job.job_id}: {error}")
+        with job.lock:
+            for index, _ in writes:
+                entry = job.files[index]
+                entry["status"] = "failed"
+                entry["error"] = f"Summary could not be saved: {error}"
+                job.completed -= 1
+                job.failed += 1
+
+    def _finish(self, job: SummaryJob):
+        with job.lock:
+            remaining, job.pending_writes = job.pending_writes, []
+        if remaining:
+            self._flush(job, remaining)
+        with job.lock:
+            job.status = "completed" if job.failed == 0 else ("failed" if job.completed == 0 else "completed_with_errors")
+            job.finished_at = datetime.utcnow()
+        if self.persist_job:
+            try:
+                self.persist_job(job.to_dict())
+            except Exception as e:
+                print(f"Error persisting job {job.job_id}: {e}")
@@ -0,0 +1,38 @@
+import os
+import sys
+import threading
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+# The backend modules live flat in AI_sales_bot/
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mock_openai_server  # noqa: E402
+
+
+@pytest.fixture
+def mock_openai():
+    """The fault-injecting mock server on a free port, with default faults and zeroed stats"""
+    with mock_openai_server.lock:
+        mock_openai_server.faults.clear()
+        mock_openai_server.faults.update(mock_openai_server.DEFAULT_FAULTS, latency_ms=0, stream_chunk_ms=0)
+        for key in mock_openai_server.stats:
+            mock_openai_server.stats[key] = 0
+    server = ThreadingHTTPServer(("127.0.0.1", 0), mock_openai_server.MockOpenAIHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture
+def openai_client(mock_openai):
+    from openai import OpenAI
+    host, port = mock_openai.server_address
+    # Retries are left to call_with_resilience, as in the API
+    return OpenAI(api_key="mock", base_url=f"http://{host}:{port}/v1", max_retries=0)
@@ -0,0 +1,152 @@
+"""IntentEngine rule table, direct-intent gating, tie-breaking and time windows"""
+from datetime import datetime
+
+import pytest
+
+from intent_engine import (
+    BUSINESS_ANALYST,
+    DOCUMENT_LIST,
+    FINANCIAL_ANALYST,
+    GENERAL,
+    MARKET_ANALYST,
+    SUMMARIZER,
+    SUMMARY_COUNT,
+    SUMMARY_LIST,
+    IntentClassifier,
+    IntentEngine,
+    time_window,
+)
+
+# A Wednesday, mid-afternoon
+NOW = datetime(2026, 10, 14, 15, 30)
+
+
+@pytest.fixture
+def engine():
+    return IntentEngine()
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("How many summaries do I have?", SUMMARY_COUNT),
+    ("count of my file summaries", SUMMARY_COUNT),
+    ("Show me my summaries", SUMMARY_LIST),
+    ("list all my document summaries from last week", SUMMARY_LIST),
+    ("What were my summaries yesterday?", SUMMARY_LIST),
+    ("my summaries", SUMMARY_LIST),
+    ("show my uploaded files", DOCUMENT_LIST),
+    ("Which documents did I upload this month?", DOCUMENT_LIST),
+])
+def test_direct_intents(engine, text, expected):
+    intent = engine.classify(text, NOW)
+
+    assert intent.name == expected
+    assert intent.direct
+    assert intent.source == "rules"
+    # Direct intents never pick a specialised prompt
+    assert intent.task == GENERAL
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("Write user stories with acceptance criteria for the checkout flow", BUSINESS_ANALYST),
+    ("Give me a tl;dr of this proposal", SUMMARIZER),
+    ("How is their financial performance and EBITDA margin?", FINANCIAL_ANALYST),
+    ("What are the market trends and main competitors in fintech?", MARKET_ANALYST),
+    ("Hello there", GENERAL),
+])
+def test_task_intents(engine, text, expected):
+    intent = engine.classify(text, NOW)
+
+    assert intent.name == expected
+    assert not intent.direct
+    assert intent.task == expected
+    assert intent.window is None
+
+
+def test_long_message_about_summaries_is_not_a_direct_intent(engine):
+    text = ("Can you look at my summaries from the Acme calls and show my summaries side by side, "
+            "then tell me which deals are most at risk and why the pricing objections keep coming up")
+    assert len(text.split()) > engine.direct_max_words
+
+    intent = engine.classify(text, NOW)
+
+    assert not intent.direct
+    assert intent.name == GENERAL
+
+
+def test_long_message_keeps_its_task_intent(engine):
+    text = ("Please summarize the key points from my summaries of this quarter so that the team "
+            "can review the renewal risks before the board meeting next week")
+
+    assert engine.classify(text, NOW).name == SUMMARIZER
+
+
+def test_ties_go_to_the_intent_listed_first(engine):
+    # Summarizer scores 2 ("summarize"), Financial Analyst 1 + 1 ("revenue", "profit")
+    intent = engine.classify("summarize the revenue and profit", NOW)
+
+    assert intent.score == 2
+    assert intent.name == SUMMARIZER
+    reordered = IntentEngine(rules=[rule for rule in engine.rules if rule[0] != SUMMARIZER]
+                             + [rule for rule in engine.rules if rule[0] == SUMMARIZER])
+    assert reordered.classify("summarize the revenue and profit", NOW).name == FINANCIAL_ANALYST
+
+
+def test_higher_score_beats_rule_order(engine):
+    # Financial Analyst 3 + 1 outscores Summarizer 2
+    assert engine.classify("summarize the financial statements and revenue", NOW).name == FINANCIAL_ANALYST
+
+
+def test_direct_intent_carries_its_time_window(engine):
+    intent = engine.classify("show my summaries from last week", NOW)
+
+    assert intent.window == ("last week", datetime(2026, 10, 5), datetime(2026, 10, 12))
+    assert intent.to_dict()["window"] == {"label": "last week", "start": "2026-10-05T00:00:00",
+                                          "end": "2026-10-12T00:00:00"}
+
+
+def test_classifier_only_used_when_confident_and_never_for_direct_intents():
+    classifier = IntentClassifier.train([
+        ("quarterly numbers look weak", FINANCIAL_ANALYST),
+        ("numbers for the quarter", FINANCIAL_ANALYST),
+        ("pull up my stuff", SUMMARY_LIST),
+        ("my stuff please", SUMMARY_LIST),
+    ], epochs=200)
+    engine = IntentEngine(classifier=classifier, min_confidence=0.6)
+
+    assert engine.classify("weak quarterly numbers", NOW).source == "classifier"
+    assert engine.classify("pull up my stuff", NOW).name == GENERAL
+    assert engine.classify("something unrelated", NOW).source == "default"
+
+
+@pytest.mark.parametrize("text, label, start, end", [
+    ("today", "today", datetime(2026, 10, 14), NOW),
+    ("yesterday", "yesterday", datetime(2026, 10, 13), datetime(2026, 10, 14)),
+    ("this week", "this week", datetime(2026, 10, 12), NOW),
+    ("last week", "last week", datetime(2026, 10, 5), datetime(2026, 10, 12)),
+    ("past week", "past week", datetime(2026, 10, 7, 15, 30), NOW),
+    ("this month", "this month", datetime(2026, 10, 1), NOW),
+    ("last month", "last month", datetime(2026, 9, 1), datetime(2026, 10, 1)),
+    ("this year", "this year", datetime(2026, 1, 1), NOW),
+    ("last 3 days", "last 3 days", datetime(2026, 10, 11, 15, 30), NOW),
+    ("past 2 weeks", "past 2 weeks", datetime(2026, 9, 30, 15, 30), NOW),
+    ("last 1 month", "last 1 month", datetime(2026, 9, 14, 15, 30), NOW),
+])
+def test_time_window_phrases(text, label, start, end):
+    assert time_window(f"summaries from {text.upper()} please", NOW) == (label, start, end)
+
+
+def test_last_month_in_january_is_december_of_the_previous_year():
+    now = datetime(2027, 1, 20, 9, 0)
+
+    assert time_window("last month", now) == ("last month", datetime(2026, 12, 1), datetime(2027, 1, 1))
+
+
+def test_last_week_on_a_monday_is_the_whole_previous_week():
+    now = datetime(2026, 10, 12, 8, 0)
+
+    assert time_window("last week", now) == ("last week", datetime(2026, 10, 5), datetime(2026, 10, 12))
+
+
+def test_no_time_window(engine):
+    assert time_window("show my summaries", NOW) is None
+    assert engine.classify("show my summaries", NOW).window is None
@@ -0,0 +1,117 @@
+"""AdmissionController priority queue, per-user caps and fast-fail rejections"""
+import threading
+import time
+
+import pytest
+
+from llm_admission import (
+    PRIORITY_BULK,
+    PRIORITY_CHAT,
+    PRIORITY_INSIGHTS,
+    AdmissionController,
+    AdmissionRejected,
+)
+
+
+def controller(**limits):
+    # Generous rate limits so only the concurrency rules under test apply
+    settings = dict(user_rate_per_min=6000, user_burst=100, model_rate_per_min=6000, model_burst=100,
+                    max_in_flight=1, max_user_in_flight=4, max_queue=8, queue_timeout=5)
+    settings.update(limits)
+    return AdmissionController(**settings)
+
+
+def wait_for_queue(admission, size):
+    deadline = time.monotonic() + 5
+    while admission.snapshot()["queued"] != size:
+        assert time.monotonic() < deadline, "waiters never queued"
+        time.sleep(0.01)
+
+
+def queue_call(admission, admitted, user_id, priority):
+    """Start a queued acquire on a thread; it records its user and releases once admitted"""
+    def run():
+        with admission.acquire(user_id, "gpt-4o-mini", priority):
+            admitted.append(user_id)
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread
+
+
+def test_queue_admits_best_priority_first():
+    admission = controller()
+    admitted = []
+    holder = admission.acquire("holder", "gpt-4o-mini")
+
+    threads = []
+    for user_id, priority in (("bulk", PRIORITY_BULK), ("insights", PRIORITY_INSIGHTS), ("chat", PRIORITY_CHAT)):
+        threads.append(queue_call(admission, admitted, user_id, priority))
+        wait_for_queue(admission, len(threads))
+    holder.release()
+    for thread in threads:
+        thread.join(5)
+
+    # Queued last, but chat goes first; equal priorities would keep arrival order
+    assert admitted == ["chat", "insights", "bulk"]
+    assert admission.snapshot()["in_flight"] == 0
+
+
+def test_user_cap_counts_queued_calls():
+    admission = controller(max_user_in_flight=2)
+    admitted = []
+    holder = admission.acquire("heavy", "gpt-4o-mini")
+    thread = queue_call(admission, admitted, "heavy", PRIORITY_CHAT)
+    wait_for_queue(admission, 1)
+
+    # One in flight plus one queued already reaches the cap of two
+    with pytest.raises(AdmissionRejected) as raised:
+        admission.acquire("heavy", "gpt-4o-mini")
+    assert raised.value.status_code == 429
+    assert raised.value.retry_after >= 1
+    assert admission.stats["rejected_user_concurrency"] == 1
+
+    # Other users still queue behind the busy slot
+    other = queue_call(admission, admitted, "other", PRIORITY_CHAT)
+    wait_for_queue(admission, 2)
+    holder.release()
+    thread.join(5)
+    other.join(5)
+
+    assert admitted == ["heavy", "other"]
+    assert admission._user_queued == {}
+    assert admission._user_in_flight == {}
+
+
+def test_full_queue_fails_fast_with_503_and_retry_after():
+    admission = controller(max_queue=1)
+    admitted = []
+    holder = admission.acquire("holder", "gpt-4o-mini")
+    thread = queue_call(admission, admitted, "queued", PRIORITY_CHAT)
+    wait_for_queue(admission, 1)
+
+    started = time.monotonic()
+    with pytest.raises(AdmissionRejected) as raised:
+        admission.acquire("late", "gpt-4o-mini")
+
+    assert time.monotonic() - started < 1
+    assert raised.value.status_code == 503
+    assert raised.value.retry_after == 2
+    assert admission.stats["rejected_queue_full"] == 1
+    holder.release()
+    thread.join(5)
+    assert admitted == ["queued"]
+
+
+def test_queue_timeout_frees_the_users_queue_slot():
+    admission = controller(max_user_in_flight=2)
+    holder = admission.acquire("holder", "gpt-4o-mini")
+
+    with pytest.raises(AdmissionRejected) as raised:
+        admission.acquire("waiter", "gpt-4o-mini", timeout=0.05)
+
+    assert raised.value.status_code == 503
+    assert admission.stats["rejected_queue_timeout"] == 1
+    assert admission._user_queued == {}
+    assert admission.snapshot()["queued"] == 0
+    holder.release()
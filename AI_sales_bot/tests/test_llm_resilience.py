@@ -0,0 +1,146 @@
+"""call_with_resilience against the fault-injecting mock server"""
+import itertools
+import time
+
+import pytest
+
+import mock_openai_server
+from llm_resilience import (
+    CircuitBreaker,
+    CircuitOpenError,
+    DeadlineExceeded,
+    LLMUpstreamError,
+    RetryPolicy,
+    call_with_resilience,
+)
+
+MESSAGES = [{"role": "user", "content": "ping"}]
+FAST_RETRIES = RetryPolicy(max_attempts=3, base_delay=0.01, max_delay=0.05)
+
+
+def set_faults(**changes):
+    with mock_openai_server.lock:
+        mock_openai_server.faults.update(changes)
+
+
+def requests_served():
+    return mock_openai_server.stats["requests"]
+
+
+def completion(client):
+    return lambda timeout: client.chat.completions.create(model="gpt-4o-mini", messages=MESSAGES, timeout=timeout)
+
+
+def test_retries_5xx_until_success(openai_client):
+    set_faults(fail_next=2, fail_status=503)
+    stats = {}
+    breaker = CircuitBreaker("gpt-4o-mini", failure_threshold=5)
+
+    response = call_with_resilience(completion(openai_client), 10, retry_policy=FAST_RETRIES,
+                                    breaker=breaker, stats=stats)
+
+    assert response.choices[0].message.content == mock_openai_server.DEFAULT_FAULTS["reply"]
+    assert stats["retries"] == 2
+    assert requests_served() == 3
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_rate_limit_honours_retry_after_and_maps_to_503(openai_client):
+    set_faults(rate_limit_rate=1.0, retry_after=1)
+    started = time.monotonic()
+
+    with pytest.raises(LLMUpstreamError) as raised:
+        call_with_resilience(completion(openai_client), 10,
+                             retry_policy=RetryPolicy(max_attempts=2, base_delay=0.01, max_delay=0.05))
+
+    # The backoff waited for the upstream's Retry-After, not the much shorter jittered delay
+    assert time.monotonic() - started >= 1.0
+    assert requests_served() == 2
+    assert raised.value.status_code == 503
+    assert raised.value.retry_after == 1
+
+
+def test_client_error_is_not_retried_and_keeps_breaker_closed(openai_client):
+    set_faults(fail_next=1, fail_status=400)
+    breaker = CircuitBreaker("gpt-4o-mini", failure_threshold=1)
+
+    with pytest.raises(LLMUpstreamError) as raised:
+        call_with_resilience(completion(openai_client), 10, retry_policy=FAST_RETRIES, breaker=breaker)
+
+    assert raised.value.status_code == 502
+    assert requests_served() == 1
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_slow_upstream_hits_the_deadline(openai_client):
+    set_faults(slow_rate=1.0, slow_ms=2000)
+
+    with pytest.raises(DeadlineExceeded) as raised:
+        call_with_resilience(completion(openai_client), 0.3, retry_policy=RetryPolicy(max_attempts=1))
+
+    assert raised.value.status_code == 504
+
+
+def test_hedge_wins_over_a_slow_primary(openai_client):
+    attempts = itertools.count()
+
+    def slow_then_fast(timeout):
+        # Only the first request the server receives is slow
+        set_faults(slow_rate=1.0 if next(attempts) == 0 else 0.0, slow_ms=3000)
+        return completion(openai_client)(timeout)
+
+    stats = {}
+    started = time.monotonic()
+    response = call_with_resilience(slow_then_fast, 10, retry_policy=FAST_RETRIES, hedge_after=0.2, stats=stats)
+
+    assert response.choices[0].message.content
+    assert time.monotonic() - started < 2.0
+    assert stats["hedges"] == 1
+    assert stats["hedge_wins"] == 1
+
+
+def test_breaker_opens_fails_fast_and_recovers(openai_client):
+    set_faults(error_rate=1.0, fail_status=500)
+    breaker = CircuitBreaker("gpt-4o-mini", failure_threshold=2, recovery_timeout=0.3)
+    single = RetryPolicy(max_attempts=1)
+
+    for _ in range(2):
+        with pytest.raises(LLMUpstreamError):
+            call_with_resilience(completion(openai_client), 5, retry_policy=single, breaker=breaker)
+    assert breaker.state == CircuitBreaker.OPEN
+
+    served = requests_served()
+    with pytest.raises(CircuitOpenError):
+        call_with_resilience(completion(openai_client), 5, retry_policy=single, breaker=breaker)
+    assert requests_served() == served
+
+    # After the cool-down one probe goes through; its failure re-opens the breaker
+    time.sleep(0.35)
+    with pytest.raises(LLMUpstreamError):
+        call_with_resilience(completion(openai_client), 5, retry_policy=single, breaker=breaker)
+    assert breaker.state == CircuitBreaker.OPEN
+
+    time.sleep(0.35)
+    set_faults(error_rate=0.0)
+    call_with_resilience(completion(openai_client), 5, retry_policy=single, breaker=breaker)
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_local_error_propagates_without_closing_a_half_open_breaker(openai_client):
+    set_faults(error_rate=1.0, fail_status=500)
+    breaker = CircuitBreaker("gpt-4o-mini", failure_threshold=1, recovery_timeout=0.2)
+    with pytest.raises(LLMUpstreamError):
+        call_with_resilience(completion(openai_client), 5, retry_policy=RetryPolicy(max_attempts=1), breaker=breaker)
+    time.sleep(0.25)
+
+    def buggy(timeout):
+        raise KeyError("choices")
+
+    with pytest.raises(KeyError):
+        call_with_resilience(buggy, 5, retry_policy=FAST_RETRIES, breaker=breaker)
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+
+    # The probe slot was released, so the next call is still let through as the probe
+    set_faults(error_rate=0.0)
+    call_with_resilience(completion(openai_client), 5, retry_policy=FAST_RETRIES, breaker=breaker)
+    assert breaker.state == CircuitBreaker.CLOSED
@@ -0,0 +1,90 @@
+"""SessionHistoryCache write-sequence tokens, write-through and LRU limits"""
+from session_cache import MESSAGE_OVERHEAD_BYTES, SessionHistoryCache
+
+
+def message(content, message_type="user"):
+    return {"content": content, "message_type": message_type}
+
+
+def test_fill_started_before_a_write_is_discarded():
+    cache = SessionHistoryCache()
+    token = cache.begin_load("s1")
+    # The slow database read is overtaken by a new message
+    cache.append("s1", message("newest"))
+    cache.populate("s1", [message("old")], complete=True, token=token)
+
+    assert cache.get("s1") is None
+    assert cache.stats["stale_loads_discarded"] == 1
+
+    # A fill started after the write is kept
+    token = cache.begin_load("s1")
+    cache.populate("s1", [message("old"), message("newest")], complete=True, token=token)
+    assert [m["content"] for m in cache.get("s1")] == ["old", "newest"]
+
+
+def test_invalidation_also_discards_an_earlier_fill():
+    cache = SessionHistoryCache()
+    token = cache.begin_load("s1")
+    cache.invalidate("s1")
+    cache.populate("s1", [message("deleted")], complete=True, token=token)
+
+    assert cache.get("s1") is None
+
+
+def test_writes_to_other_sessions_do_not_discard_a_fill():
+    cache = SessionHistoryCache()
+    token = cache.begin_load("s1")
+    cache.append("s2", message("elsewhere"))
+    cache.populate("s1", [message("a")], complete=True, token=token)
+
+    assert [m["content"] for m in cache.get("s1")] == ["a"]
+
+
+def test_append_is_written_through_and_trimmed():
+    cache = SessionHistoryCache(max_messages=2)
+    cache.populate("s1", [message("a"), message("b")], complete=True, token=cache.begin_load("s1"))
+    cache.append("s1", message("c"))
+
+    assert [m["content"] for m in cache.get("s1", limit=2)] == ["b", "c"]
+    # The oldest message was trimmed, so a full-history read must go to the database
+    assert cache.get("s1") is None
+
+
+def test_returned_messages_are_copies():
+    cache = SessionHistoryCache()
+    cache.populate("s1", [message("a")], complete=True, token=cache.begin_load("s1"))
+    cache.get("s1")[0]["content"] = "changed"
+
+    assert cache.get("s1")[0]["content"] == "a"
+
+
+def test_eviction_respects_the_session_cap_in_lru_order():
+    cache = SessionHistoryCache(max_sessions=2)
+    for session_id in ("s1", "s2"):
+        cache.populate(session_id, [message(session_id)], complete=True, token=cache.begin_load(session_id))
+    # Touch s1 so s2 is least recently used
+    cache.get("s1")
+    cache.populate("s3", [message("s3")], complete=True, token=cache.begin_load("s3"))
+
+    assert cache.get("s2") is None
+    assert cache.get("s1") is not None
+    assert cache.get("s3") is not None
+    assert cache.snapshot()["sessions"] == 2
+    assert cache.stats["evictions"] == 1
+
+
+def test_eviction_respects_the_byte_cap():
+    size = 100 + MESSAGE_OVERHEAD_BYTES
+    cache = SessionHistoryCache(max_bytes=size * 3)
+    for session_id in ("s1", "s2", "s3"):
+        cache.populate(session_id, [message("x" * 100)], complete=True, token=cache.begin_load(session_id))
+    assert cache.snapshot()["bytes"] == size * 3
+
+    # Growing s3 pushes the total over budget; the oldest session goes
+    cache.append("s3", message("x" * 100))
+
+    snapshot = cache.snapshot()
+    assert snapshot["bytes"] <= cache.max_bytes
+    assert snapshot["bytes"] == size * 3
+    assert cache.get("s1") is None
+    assert len(cache.get("s3")) == 2
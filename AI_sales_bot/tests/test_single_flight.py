@@ -0,0 +1,133 @@
+"""SingleFlight coalescing, shared errors and the unshared-error retry path"""
+import threading
+import time
+
+import pytest
+
+from single_flight import SingleFlight, flight_key
+
+
+class Unshared(Exception):
+    pass
+
+
+def wait_for_followers(flight, count):
+    deadline = time.monotonic() + 5
+    while flight.snapshot()["coalesced"] < count:
+        assert time.monotonic() < deadline, "followers never joined"
+        time.sleep(0.01)
+
+
+def run_concurrently(flight, key, fn, followers):
+    """Start a leader blocked inside fn, then `followers` identical calls; returns (threads, outcomes)"""
+    outcomes = []
+    lock = threading.Lock()
+
+    def call():
+        try:
+            outcome = flight.do(key, fn)
+        except Exception as e:
+            outcome = e
+        with lock:
+            outcomes.append(outcome)
+
+    threads = [threading.Thread(target=call) for _ in range(followers + 1)]
+    threads[0].start()
+    while flight.snapshot()["in_flight"] == 0:
+        time.sleep(0.01)
+    for thread in threads[1:]:
+        thread.start()
+    wait_for_followers(flight, followers)
+    return threads, outcomes
+
+
+def test_identical_calls_share_one_execution_and_get_their_own_copy():
+    flight = SingleFlight("test")
+    release = threading.Event()
+    executions = []
+
+    def fn():
+        executions.append(1)
+        release.wait(5)
+        return {"summary": {"points": [1, 2]}}
+
+    threads, outcomes = run_concurrently(flight, "doc", fn, followers=3)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert len(executions) == 1
+    assert len(outcomes) == 4
+    assert all(outcome == {"summary": {"points": [1, 2]}} for outcome in outcomes)
+    # Leader included: no two callers hold the same object
+    assert len({id(outcome) for outcome in outcomes}) == 4
+    assert len({id(outcome["summary"]) for outcome in outcomes}) == 4
+    assert flight.snapshot()["in_flight"] == 0
+
+
+def test_unshared_result_is_returned_as_is():
+    flight = SingleFlight("test")
+    result = {"a": 1}
+
+    assert flight.do("key", lambda: result) is result
+    # Nothing is cached once the call finished
+    assert flight.do("key", lambda: {"a": 2}) == {"a": 2}
+    assert flight.snapshot()["executions"] == 2
+
+
+def test_leader_error_is_shared_with_followers():
+    flight = SingleFlight("test")
+    release = threading.Event()
+    executions = []
+
+    def fn():
+        executions.append(1)
+        release.wait(5)
+        raise ValueError("upstream down")
+
+    threads, outcomes = run_concurrently(flight, "doc", fn, followers=2)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert len(executions) == 1
+    assert len(outcomes) == 3
+    assert all(isinstance(outcome, ValueError) for outcome in outcomes)
+    assert flight.stats["errors"] == 1
+
+
+def test_unshared_error_makes_followers_run_the_call_themselves():
+    flight = SingleFlight("test", unshared_errors=(Unshared,))
+    release = threading.Event()
+    executions = []
+    lock = threading.Lock()
+
+    def fn():
+        with lock:
+            executions.append(1)
+            first = len(executions) == 1
+        if first:
+            release.wait(5)
+            raise Unshared("leader was rate limited")
+        return "ok"
+
+    threads, outcomes = run_concurrently(flight, "doc", fn, followers=2)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert len(executions) == 3
+    assert sorted(map(str, outcomes)) == ["leader was rate limited", "ok", "ok"]
+    assert flight.stats["retried_unshared"] == 2
+
+
+@pytest.mark.parametrize("a, b", [
+    (("Acme  Corp",), ("acme corp",)),
+    (("acme", {"b": 1, "a": 2}), ("ACME", {"a": 2, "b": 1})),
+])
+def test_flight_key_normalizes_arguments(a, b):
+    assert flight_key(*a) == flight_key(*b)
+
+
+def test_flight_key_keeps_users_apart():
+    assert flight_key("user-1", "acme") != flight_key("user-2", "acme")
@@ -0,0 +1,151 @@
+"""IncrementalJSONParser across chunk boundaries, and the single repair attempt"""
+import json
+from typing import List
+
+import pytest
+from pydantic import BaseModel
+
+from structured_output import (
+    IncrementalJSONParser,
+    ParseFailureTracker,
+    StructuredOutputError,
+    generate_structured,
+)
+
+DOCUMENT = {
+    "summary": 'Line one\nQuoted "deal" with a back\\slash and tab\t',
+    "client_name": "Café Müller — 東京 \U0001F680",
+    "score": 12.5,
+    "active": True,
+    "owner": None,
+    "tags": ["a,b", "c]d", {"nested": "}{"}],
+    "details": {"region": "EMEA", "contacts": [{"name": "Ann"}, {"name": "Boé"}], "count": -3},
+}
+
+
+class Summary(BaseModel):
+    client_name: str
+    points: List[str]
+
+
+def encoded(document, ensure_ascii):
+    # ensure_ascii=True streams \uXXXX escapes (surrogate pairs for the emoji); False streams raw characters
+    return "```json\n" + json.dumps(document, indent=1, ensure_ascii=ensure_ascii) + "\n```"
+
+
+def chunks(text, size):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+def feed_all(parser, pieces):
+    completed = []
+    for piece in pieces:
+        completed.extend(parser.feed(piece))
+    return completed
+
+
+@pytest.mark.parametrize("size", [1, 3, 7])
+@pytest.mark.parametrize("ensure_ascii", [True, False])
+def test_chunked_stream_parses_like_json_loads(size, ensure_ascii):
+    parser = IncrementalJSONParser(max_depth=1)
+    completed = feed_all(parser, chunks(encoded(DOCUMENT, ensure_ascii), size))
+
+    assert parser.done
+    assert parser.result() == DOCUMENT
+    # Each top-level field is reported once, in stream order, with its final value
+    assert completed == [((key,), value) for key, value in DOCUMENT.items()]
+
+
+@pytest.mark.parametrize("size", [1, 3, 7])
+def test_nested_values_are_reported_up_to_max_depth(size):
+    parser = IncrementalJSONParser(max_depth=3)
+    completed = dict(feed_all(parser, chunks(json.dumps(DOCUMENT), size)))
+
+    assert completed[("details", "contacts", 1)] == {"name": "Boé"}
+    assert completed[("tags", 2)] == {"nested": "}{"}
+    assert completed[("details", "count")] == -3
+    # Four levels deep is past max_depth
+    assert ("details", "contacts", 0, "name") not in completed
+
+
+def test_escapes_split_across_chunks():
+    # Simple, quote, backslash and unicode escapes, including a surrogate pair
+    text = '{"summary": "a\\u00e9\\"\\\\\\n\\ud83d\\ude80 done"}'
+    expected = 'aé"\\\n\U0001F680 done'
+    assert json.loads(text)["summary"] == expected
+
+    # Every cut inside the string value, up to but excluding its closing quote
+    for split in range(len('{"summary": "'), len(text) - 1):
+        parser = IncrementalJSONParser()
+        assert parser.feed(text[:split]) == []
+        partial = parser.partial()
+        if partial is not None:
+            # A cut-off escape is held back, never rendered as a stray backslash or half a character
+            assert partial[0] == ("summary",)
+            assert expected.startswith(partial[1]), (split, partial)
+        assert parser.feed(text[split:]) == [(("summary",), expected)]
+        assert parser.result() == {"summary": expected}
+
+
+def test_partial_exposes_the_string_being_streamed():
+    parser = IncrementalJSONParser()
+    parser.feed('{"client_name": "Acme", "summary": "Renewal is ')
+
+    assert parser.partial() == (("summary",), "Renewal is ")
+    assert parser.fields == {"client_name": "Acme"}
+    assert not parser.done
+
+
+def test_result_falls_back_to_fields_seen_for_a_truncated_stream():
+    parser = IncrementalJSONParser()
+    parser.feed('{"a": 1, "b": [1, 2], "c": "cut o')
+
+    assert not parser.done
+    assert parser.result() == {"a": 1, "b": [1, 2]}
+
+
+def test_valid_output_needs_no_repair():
+    tracker = ParseFailureTracker()
+    repairs = []
+
+    result = generate_structured("summary", Summary, lambda: '```json\n{"client_name": "Acme", "points": []}\n```',
+                                 repair=lambda raw, error: repairs.append(raw), tracker=tracker)
+
+    assert result.client_name == "Acme"
+    assert repairs == []
+    assert tracker.snapshot()["summary"]["ok"] == 1
+
+
+def test_invalid_output_gets_exactly_one_repair_call():
+    tracker = ParseFailureTracker()
+    repairs = []
+
+    def repair(raw, error):
+        repairs.append((raw, error))
+        return '{"client_name": "Acme", "points": ["renewal"]}'
+
+    result = generate_structured("summary", Summary, lambda: '{"client_name": "Acme"}', repair=repair, tracker=tracker)
+
+    assert result.points == ["renewal"]
+    assert len(repairs) == 1
+    # The repair call sees the bad output and why it failed
+    assert repairs[0][0] == '{"client_name": "Acme"}'
+    assert "points" in repairs[0][1]
+    stats = tracker.snapshot()["summary"]
+    assert (stats["calls"], stats["repaired"], stats["first_try_failure_rate"], stats["failure_rate"]) == (1, 1, 1.0, 0.0)
+
+
+def test_failed_repair_raises_without_a_second_attempt():
+    tracker = ParseFailureTracker()
+    repairs = []
+
+    def repair(raw, error):
+        repairs.append(raw)
+        return "still not json"
+
+    with pytest.raises(StructuredOutputError) as raised:
+        generate_structured("summary", Summary, lambda: "not json", repair=repair, tracker=tracker)
+
+    assert raised.value.call_site == "summary"
+    assert len(repairs) == 1
+    assert tracker.snapshot()["summary"]["failed"] == 1
@@ -0,0 +1,146 @@
+"""UsageLedger flushes against fake collections, including partial bulk-write failures"""
+from pymongo.errors import BulkWriteError
+
+from usage_ledger import UsageLedger, counter_id
+
+
+class FakeCounters:
+    """Applies $inc upserts in memory; the indexes in fail_next[0] fail on the next bulk_write"""
+
+    def __init__(self):
+        self.docs = {}
+        self.fail_next = []
+        self.calls = 0
+
+    def bulk_write(self, updates, ordered=True):
+        self.calls += 1
+        failing = set(self.fail_next.pop(0)) if self.fail_next else set()
+        for index, update in enumerate(updates):
+            if index in failing:
+                continue
+            doc = self.docs.setdefault(update._filter["_id"], {})
+            for field, value in update._doc["$inc"].items():
+                doc[field] = doc.get(field, 0) + value
+        if failing:
+            raise BulkWriteError({
+                "writeErrors": [{"index": index, "code": 112, "errmsg": "WriteConflict"} for index in sorted(failing)],
+                "nUpserted": len(updates) - len(failing),
+            })
+
+
+class FakeRecords:
+    def __init__(self):
+        self.docs = []
+
+    def insert_many(self, docs, ordered=True):
+        self.docs.extend(docs)
+
+
+def ledger(**options):
+    return UsageLedger(FakeRecords(), FakeCounters(), price=lambda model, prompt, completion: 0.001 * (prompt + completion),
+                       **options)
+
+
+def record(usage, user_id, tokens=10):
+    usage.record("gpt-4o-mini", tokens, tokens, 0.5, user_id=user_id, task="chat", endpoint="POST /openai/chat")
+
+
+def calls_by_user(usage):
+    return {doc_id.split("|")[1]: doc["calls"] for doc_id, doc in usage.counters.docs.items()}
+
+
+def test_flush_sums_each_counter_once():
+    usage = ledger()
+    for user_id in ("alice", "alice", "bob"):
+        record(usage, user_id)
+
+    assert usage.flush() == 3
+    assert calls_by_user(usage) == {"alice": 2, "bob": 1}
+    alice = usage.counters.docs[next(k for k in usage.counters.docs if "|alice|" in k)]
+    assert alice["total_tokens"] == 40
+    assert round(alice["cost_usd"], 6) == 0.04
+    assert alice["timed"] == 2
+    assert len(usage.records.docs) == 3
+    assert usage.pending() == 0
+
+
+def test_partial_failure_requeues_only_the_failed_counters_records():
+    usage = ledger()
+    for user_id in ("alice", "bob", "alice", "carol"):
+        record(usage, user_id)
+    # Upserts are ordered by first appearance: alice, bob, carol. Bob's fails.
+    usage.counters.fail_next = [[1]]
+
+    assert usage.flush() == 3
+    assert calls_by_user(usage) == {"alice": 2, "carol": 1}
+    assert usage.pending() == 1
+    assert [doc["user_id"] for doc in usage.records.docs] == ["alice", "alice", "carol"]
+    assert usage.stats["write_errors"] == 1
+
+    # The retry applies bob once and does not repeat alice or carol
+    record(usage, "dave")
+    assert usage.flush() == 2
+    assert calls_by_user(usage) == {"alice": 2, "bob": 1, "carol": 1, "dave": 1}
+    assert sorted(doc["user_id"] for doc in usage.records.docs) == ["alice", "alice", "bob", "carol", "dave"]
+    assert usage.pending() == 0
+
+
+def test_requeued_records_come_before_newer_ones():
+    usage = ledger()
+    record(usage, "alice")
+    record(usage, "bob")
+    usage.counters.fail_next = [[0, 1]]
+    usage.flush()
+    record(usage, "carol")
+
+    assert [entry["user_id"] for entry in usage._buffer] == ["alice", "bob", "carol"]
+
+
+def test_unexpected_error_requeues_the_whole_batch():
+    usage = ledger()
+    record(usage, "alice")
+    record(usage, "bob")
+
+    def broken(updates, ordered=True):
+        raise ConnectionError("mongo down")
+    usage.counters.bulk_write = broken
+
+    assert usage.flush() == 0
+    assert usage.pending() == 2
+    assert usage.records.docs == []
+
+
+def test_full_buffer_drops_the_oldest_records():
+    usage = ledger(max_buffer=3)
+    for user_id in ("u1", "u2", "u3", "u4"):
+        record(usage, user_id)
+
+    assert [entry["user_id"] for entry in usage._buffer] == ["u2", "u3", "u4"]
+    assert usage.stats["dropped"] == 1
+
+
+def test_requeue_past_max_buffer_drops_the_oldest_records():
+    usage = ledger(max_buffer=3)
+    for user_id in ("u1", "u2", "u3"):
+        record(usage, user_id)
+    usage.counters.fail_next = [[0, 1, 2]]
+    # Simulate records arriving while the failing flush ran
+    original = usage.counters.bulk_write
+
+    def write_during_flush(updates, ordered=True):
+        record(usage, "late1")
+        record(usage, "late2")
+        return original(updates, ordered)
+    usage.counters.bulk_write = write_during_flush
+
+    usage.flush()
+
+    assert [entry["user_id"] for entry in usage._buffer] == ["u3", "late1", "late2"]
+    assert usage.stats["dropped"] == 2
+    assert usage.counters.docs == {}
+
+
+def test_counter_id_separates_tasks():
+    base = {"day": "2026-10-19", "user_id": "u", "endpoint": "POST /openai/chat", "model": "gpt-4o-mini"}
+
+    assert counter_id({**base, "task": "chat"}) != counter_id({**base, "task": None})
@@ -0,0 +1,162 @@
+"""Size-capped, hashing upload ingestion.
+
+inspect_upload() reads an upload that is already spooled (Starlette's
+UploadFile.file is a SpooledTemporaryFile) in place, chunk by chunk, hashing
+the bytes and aborting as soon as the configured maximum is exceeded, then
+rewinds it. spool_upload() does the same while copying a stream elsewhere,
+for uploads that must outlive the request. PDF, DOCX and ZIP are sniffed
+from magic bytes rather than trusting the client-supplied content type;
+NUL-free bytes are text if they decode as UTF-8 or the client declared them
+text/plain (or named them .txt), so legacy encodings such as cp1252 pass.
+"""
+import hashlib
+import os
+import tempfile
+import zipfile
+
+TEXT_PLAIN = "text/plain"
+PDF = "application/pdf"
+DOCX = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+ZIP = "application/zip"
+
+CHUNK_SIZE = 64 * 1024
+SPOOL_MEMORY_BYTES = 1024 * 1024
+SNIFF_BYTES = 8192
+
+
+class UploadTooLarge(Exception):
+    def __init__(self, max_bytes: int):
+        super().__init__(f"File exceeds the maximum upload size of {max_bytes // (1024 * 1024)} MB")
+        self.max_bytes = max_bytes
+
+
+class SpooledUpload:
+    """An upload copied to a temp file, with its size, hash and sniffed type"""
+
+    def __init__(self, file, filename: str, size: int, sha256: str, content_type: str):
+        self.file = file
+        self.filename = filename
+        self.size = size
+        self.sha256 = sha256
+        self.content_type = content_type
+
+    def close(self):
+        try:
+            self.file.close()
+        except Exception:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+
+def _looks_like_text(head: bytes) -> bool:
+    if not head:
+        return True
+    if b"\x00" in head:
+        return False
+    try:
+        head.decode("utf-8")
+        return True
+    except UnicodeDecodeError as e:
+        # A multi-byte character cut off by the sniff window is still text
+        return e.start >= len(head) - 3
+
+
+def _declared_text(declared_type: str = None, filename: str = None) -> bool:
+    if declared_type and declared_type.split(";")[0].strip().lower() == TEXT_PLAIN:
+        return True
+    return os.path.splitext(filename or "")[1].lower() == ".txt"
+
+
+def sniff_content_type(head: bytes, file=None, declared_type: str = None, filename: str = None) -> str:
+    """Detect PDF / DOCX / ZIP / plain text from the leading bytes (None if unsupported)"""
+    if head.startswith(b"%PDF-"):
+        return PDF
+    if head.startswith(b"PK\x03\x04"):
+        if file is not None:
+            try:
+                position = file.tell()
+                file.seek(0)
+                with zipfile.ZipFile(file) as archive:
+                    names = archive.namelist()
+                file.seek(position)
+                if "word/document.xml" in names:
+                    return DOCX
+            except zipfile.BadZipFile:
+                return None
+        return ZIP
+    if head.startswith(b"\xef\xbb\xbf"):
+        return TEXT_PLAIN
+    if _looks_like_text(head):
+        return TEXT_PLAIN
+    # Not UTF-8, but binary formats carry NULs; trust the client's word for a legacy-encoded text file
+    if b"\x00" not in head and _declared_text(declared_type, filename):
+        return TEXT_PLAIN
+    return None
+
+
+def _scan(stream, max_bytes: int, dest=None):
+    """Read `stream` to the end, optionally copying it to `dest`; returns (size, sha256, head)"""
+    digest = hashlib.sha256()
+    size = 0
+    head = b""
+    while True:
+        chunk = stream.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        size += len(chunk)
+        if size > max_bytes:
+            raise UploadTooLarge(max_bytes)
+        if len(head) < SNIFF_BYTES:
+            head += chunk[:SNIFF_BYTES - len(head)]
+        digest.update(chunk)
+        if dest is not None:
+            dest.write(chunk)
+    return size, digest.hexdigest(), head
+
+
+def inspect_upload(file, filename: str, max_bytes: int, declared_type: str = None) -> SpooledUpload:
+    """Hash, size-check and sniff a seekable upload file in place, without copying it"""
+    file.seek(0)
+    size, sha256, head = _scan(file, max_bytes)
+    file.seek(0)
+    return SpooledUpload(file, filename, size, sha256, sniff_content_type(head, file, declared_type, filename))
+
+
+def spool_upload(stream, filename: str, max_bytes: int, dest=None, declared_type: str = None) -> SpooledUpload:
+    """Copy `stream` into `dest` (a spooled temp file by default), hashing and size-checking as it goes"""
+    if dest is None:
+        dest = tempfile.SpooledTemporaryFile(max_size=SPOOL_MEMORY_BYTES)
+    try:
+        size, sha256, head = _scan(stream, max_bytes, dest)
+        dest.flush()
+        dest.seek(0)
+        content_type = sniff_content_type(head, dest, declared_type, filename)
+    except Exception:
+        dest.close()
+        raise
+    return SpooledUpload(dest, filename, size, sha256, content_type)
+
+
+def spool_upload_to_path(stream, filename: str, max_bytes: int, prefix: str = "upload-",
+                         declared_type: str = None) -> SpooledUpload:
+    """Like spool_upload but into a named temp file that outlives the request (caller deletes it)"""
+    suffix = os.path.splitext(filename or "")[1].lower()
+    fd, path = tempfile.mkstemp(prefix=prefix, suffix=suffix)
+    dest = os.fdopen(fd, "w+b")
+    try:
+        upload = spool_upload(stream, filename, max_bytes, dest=dest, declared_type=declared_type)
+    except Exception:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        raise
+    upload.path = path
+    upload.close()
+    return upload
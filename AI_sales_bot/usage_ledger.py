@@ -0,0 +1,390 @@
+"""Ledger of LLM token usage, cost and latency, with counters per user, day and endpoint.
+
+record() runs on the request path, so it only appends to an in-memory buffer.
+A flusher thread drains the buffer every `flush_interval` seconds, or sooner
+once `max_batch` records are waiting. A drain sums the batch in memory per
+(day, user, endpoint, model, task) and applies the totals in one unordered
+bulk_write, using a single $inc upsert per key. A burst of calls from a few
+users therefore costs a handful of writes. The raw records are also
+inserted, in one insert_many, into a collection whose TTL index expires them
+after `retention_days`. Queries read only the counters.
+
+If counter writes fail, the records behind the failed upserts go back to
+the buffer and are retried on the next flush; the upserts that were applied
+are not repeated. The buffer holds at most `max_buffer` records. When it is
+full, the oldest records are dropped and counted.
+"""
+import contextvars
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+from pymongo import ASCENDING, UpdateOne
+from pymongo.errors import BulkWriteError
+
+# Upper bounds (ms) of the latency histogram kept on every counter; slower calls fall in "inf"
+LATENCY_BUCKETS_MS = (250, 500, 1000, 2000, 5000, 10000, 20000, 30000, 60000)
+BUCKET_KEYS = tuple(str(bound) for bound in LATENCY_BUCKETS_MS) + ("inf",)
+# "timed" counts the calls with a latency; batch API results have none
+COUNTER_FIELDS = ("calls", "errors", "streamed", "estimated", "unpriced", "timed",
+                  "prompt_tokens", "completion_tokens", "total_tokens", "cost_usd", "latency_ms")
+GROUP_FIELDS = {"user": "user_id", "endpoint": "endpoint", "model": "model", "day": "day", "task": "task"}
+BACKGROUND = "background"
+
+_request_scope = contextvars.ContextVar("usage_request_scope", default=None)
+
+
+def current_endpoint() -> str:
+    """'METHOD /route/{template}' of the request being served, or 'background' outside one"""
+    scope = _request_scope.get()
+    if scope is None:
+        return BACKGROUND
+    route = scope.get("route")
+    path = getattr(route, "path", None) or scope.get("path", "")
+    method = scope.get("method") or "WS"
+    return f"{method} {path}"
+
+
+def latency_bucket(latency_ms: float) -> str:
+    for key, bound in zip(BUCKET_KEYS, LATENCY_BUCKETS_MS):
+        if latency_ms <= bound:
+            return key
+    return "inf"
+
+
+def latency_percentile(buckets: dict, fraction: float):
+    """Upper bound (ms) of the bucket holding the given fraction of calls.
+
+    None without data, or when the percentile falls beyond the last bucket.
+    """
+    total = sum(buckets.values())
+    if not total:
+        return None
+    seen = 0
+    for key in BUCKET_KEYS:
+        seen += buckets.get(key, 0)
+        if seen >= fraction * total:
+            return None if key == "inf" else int(key)
+    return None
+
+
+def counter_id(entry: dict) -> str:
+    """Counter document _id of a record: one counter per day, user, endpoint, model and task"""
+    return "|".join((entry["day"], entry["user_id"], entry["endpoint"], entry["model"], entry["task"] or ""))
+
+
+class UsageContextMiddleware:
+    """Pure ASGI middleware that lets record() label usage with the route being served"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] not in ("http", "websocket"):
+            await self.app(scope, receive, send)
+            return
+        # The router fills in scope["route"] on this same dict once it has matched
+        token = _request_scope.set(scope)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _request_scope.reset(token)
+
+
+class MeteredStream:
+    """A streamed completion that skips the usage-only final chunk and reports usage once it ends.
+
+    on_finish(usage, output_chars, error) is called exactly once. `usage` is None when the
+    stream ended before the API sent its usage chunk, e.g. because the client went away.
+    """
+
+    def __init__(self, stream, on_finish):
+        self._stream = stream
+        self._on_finish = on_finish
+        self._closed = False
+        self._finished = False
+
+    def __iter__(self):
+        usage = None
+        output_chars = 0
+        error = None
+        try:
+            for chunk in self._stream:
+                if getattr(chunk, "usage", None) is not None:
+                    usage = chunk.usage
+                if not chunk.choices:
+                    continue
+                content = chunk.choices[0].delta.content
+                if content:
+                    output_chars += len(content)
+                yield chunk
+        except Exception as e:
+            # Reading a stream we closed ourselves fails; that is a cancellation, not an error
+            if not self._closed:
+                error = e
+            raise
+        finally:
+            self._finish(usage, output_chars, error)
+
+    def _finish(self, usage, output_chars, error):
+        if self._finished:
+            return
+        self._finished = True
+        try:
+            self._on_finish(usage, output_chars, error)
+        except Exception as e:
+            print(f"Error recording stream usage: {e}")
+
+    def close(self):
+        self._closed = True
+        self._stream.close()
+
+
+class UsageLedger:
+    def __init__(self, records, counters, price=None, flush_interval: float = 2.0, max_batch: int = 500,
+                 max_buffer: int = 50000, retention_days: int = 30, keep_records: bool = True):
+        """price(model, prompt_tokens, completion_tokens) -> USD, or None for an unpriced model"""
+        self.records = records
+        self.counters = counters
+        self.price = price
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.max_buffer = max_buffer
+        self.retention_days = retention_days
+        self.keep_records = keep_records and records is not None
+        self._buffer = deque()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self.stats = {"recorded": 0, "flushed": 0, "dropped": 0, "flushes": 0, "write_errors": 0,
+                      "records_lost": 0, "last_flush_ms": None, "last_batch": 0}
+
+    def ensure_indexes(self):
+        self.counters.create_index([("day", ASCENDING)], name="day")
+        self.counters.create_index([("user_id", ASCENDING), ("day", ASCENDING)], name="user_day")
+        if self.keep_records:
+            self.records.create_index("at", name="at_ttl", expireAfterSeconds=int(self.retention_days * 86400))
+            self.records.create_index([("user_id", ASCENDING), ("at", ASCENDING)], name="user_at")
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name="usage-ledger", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+        self.flush()
+
+    def _loop(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Error flushing usage ledger: {e}")
+
+    def record(self, model: str, prompt_tokens: int, completion_tokens: int, latency: float, user_id: str = None,
+               task: str = None, endpoint: str = None, streamed: bool = False, estimated: bool = False,
+               error: str = None, cost: float = None):
+        """Buffer one call; latency in seconds, or None when unknown. `cost` overrides the price function."""
+        now = datetime.utcnow()
+        prompt_tokens = int(prompt_tokens or 0)
+        completion_tokens = int(completion_tokens or 0)
+        if cost is None and self.price:
+            cost = self.price(model, prompt_tokens, completion_tokens)
+        entry = {
+            "at": now,
+            "day": now.strftime("%Y-%m-%d"),
+            "user_id": user_id or "anonymous",
+            "endpoint": endpoint or current_endpoint(),
+            "model": model,
+            "task": task,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "cost_usd": cost,
+            "latency_ms": round(latency * 1000, 1) if latency is not None else None,
+            "streamed": streamed,
+            "estimated": estimated,
+            "error": error,
+        }
+        with self._lock:
+            if len(self._buffer) >= self.max_buffer:
+                self._buffer.popleft()
+                self.stats["dropped"] += 1
+            self._buffer.append(entry)
+            self.stats["recorded"] += 1
+            full = len(self._buffer) >= self.max_batch
+        if full:
+            self._wake.set()
+
+    def pending(self) -> int:
+        return len(self._buffer)
+
+    def flush(self) -> int:
+        """Write everything buffered; returns the number of records written"""
+        with self._flush_lock:
+            with self._lock:
+                batch = list(self._buffer)
+                self._buffer.clear()
+            if not batch:
+                return 0
+            started = time.perf_counter()
+            updates = self.counter_updates(batch)
+            try:
+                self.counters.bulk_write(updates, ordered=False)
+            except BulkWriteError as e:
+                # An unordered bulk write applies every upsert it can, so only the failed counters are retried.
+                # counter_updates() emits one upsert per counter, in the order the counters first appear.
+                ids = list(dict.fromkeys(counter_id(entry) for entry in batch))
+                failed = {ids[error["index"]] for error in e.details.get("writeErrors", [])}
+                retry = [entry for entry in batch if counter_id(entry) in failed]
+                batch = [entry for entry in batch if counter_id(entry) not in failed]
+                self._requeue(retry)
+                self.stats["write_errors"] += 1
+                print(f"Error writing usage counters ({len(retry)} records kept for retry): {e}")
+            except Exception as e:
+                self._requeue(batch)
+                self.stats["write_errors"] += 1
+                print(f"Error writing usage counters ({len(batch)} records kept for retry): {e}")
+                return 0
+            if batch and self.keep_records:
+                try:
+                    self.records.insert_many(batch, ordered=False)
+                except Exception as e:
+                    # The counters already hold this batch; retrying would count it twice
+                    self.stats["records_lost"] += len(batch)
+                    print(f"Error writing usage records: {e}")
+            self.stats["flushes"] += 1
+            self.stats["flushed"] += len(batch)
+            self.stats["last_batch"] = len(batch)
+            self.stats["last_flush_ms"] = round((time.perf_counter() - started) * 1000, 2)
+            return len(batch)
+
+    def _requeue(self, batch):
+        with self._lock:
+            pending = batch + list(self._buffer)
+            overflow = len(pending) - self.max_buffer
+            if overflow > 0:
+                self.stats["dropped"] += overflow
+                pending = pending[overflow:]
+            self._buffer.clear()
+            self._buffer.extend(pending)
+
+    @staticmethod
+    def counter_updates(batch) -> list:
+        """One $inc upsert per (day, user, endpoint, model, task) with the batch's totals"""
+        totals = {}
+        for entry in batch:
+            key = counter_id(entry)
+            total = totals.get(key)
+            if total is None:
+                total = totals[key] = {"entry": entry, "inc": dict.fromkeys(COUNTER_FIELDS, 0), "max": 0,
+                                       "last_at": entry["at"]}
+            inc = total["inc"]
+            inc["calls"] += 1
+            inc["errors"] += entry["error"] is not None
+            inc["streamed"] += entry["streamed"]
+            inc["estimated"] += entry["estimated"]
+            inc["unpriced"] += entry["cost_usd"] is None
+            inc["prompt_tokens"] += entry["prompt_tokens"]
+            inc["completion_tokens"] += entry["completion_tokens"]
+            inc["total_tokens"] += entry["prompt_tokens"] + entry["completion_tokens"]
+            inc["cost_usd"] += entry["cost_usd"] or 0
+            if entry["latency_ms"] is not None:
+                inc["timed"] += 1
+                inc["latency_ms"] += entry["latency_ms"]
+                bucket = f"latency_buckets.{latency_bucket(entry['latency_ms'])}"
+                inc[bucket] = inc.get(bucket, 0) + 1
+                total["max"] = max(total["max"], entry["latency_ms"])
+            total["last_at"] = max(total["last_at"], entry["at"])
+
+        updates = []
+        for key, total in totals.items():
+            entry = total["entry"]
+            updates.append(UpdateOne(
+                {"_id": key},
+                {
+                    "$inc": total["inc"],
+                    "$max": {"latency_ms_max": total["max"], "last_at": total["last_at"]},
+                    "$setOnInsert": {field: entry[field] for field in ("day", "user_id", "endpoint", "model", "task")},
+                },
+                upsert=True
+            ))
+        return updates
+
+    def query(self, group_by=("user",), user_id: str = None, endpoint: str = None, model: str = None,
+              date_from: str = None, date_to: str = None, limit: int = 100) -> dict:
+        """Counters summed per group, most expensive first, with totals over every matching counter.
+
+        Days are 'YYYY-MM-DD' strings (UTC), inclusive on both ends.
+        """
+        match = {}
+        if user_id:
+            match["user_id"] = user_id
+        if endpoint:
+            match["endpoint"] = endpoint
+        if model:
+            match["model"] = model
+        if date_from or date_to:
+            match["day"] = {}
+            if date_from:
+                match["day"]["$gte"] = date_from
+            if date_to:
+                match["day"]["$lte"] = date_to
+
+        sums = {field: {"$sum": f"${field}"} for field in COUNTER_FIELDS}
+        sums.update({f"bucket_{key}": {"$sum": f"$latency_buckets.{key}"} for key in BUCKET_KEYS})
+        sums["latency_ms_max"] = {"$max": "$latency_ms_max"}
+        sums["last_at"] = {"$max": "$last_at"}
+        group_id = {name: f"${GROUP_FIELDS[name]}" for name in group_by}
+
+        rows = list(self.counters.aggregate([
+            {"$match": match},
+            {"$group": {"_id": group_id, **sums}},
+            {"$sort": {"cost_usd": -1, "total_tokens": -1}},
+            {"$limit": limit},
+        ]))
+        totals = list(self.counters.aggregate([
+            {"$match": match},
+            {"$group": {"_id": None, **sums}},
+        ]))
+        return {
+            "group_by": list(group_by),
+            "rows": [self._summarize(row) for row in rows],
+            "totals": self._summarize(totals[0]) if totals else self._summarize({"_id": {}}),
+        }
+
+    @staticmethod
+    def _summarize(row: dict) -> dict:
+        summary = dict(row.pop("_id") or {})
+        buckets = {key: row.pop(f"bucket_{key}", 0) for key in BUCKET_KEYS}
+        summary.update({field: row.get(field, 0) for field in COUNTER_FIELDS if field != "latency_ms"})
+        summary["cost_usd"] = round(summary["cost_usd"], 6)
+        timed = row.get("timed", 0)
+        summary["avg_latency_ms"] = round(row.get("latency_ms", 0) / timed, 1) if timed else None
+        summary["p50_latency_ms"] = latency_percentile(buckets, 0.5)
+        summary["p95_latency_ms"] = latency_percentile(buckets, 0.95)
+        summary["max_latency_ms"] = row.get("latency_ms_max")
+        summary["last_at"] = row.get("last_at")
+        return summary
+
+    def snapshot(self) -> dict:
+        return {
+            **self.stats,
+            "pending": self.pending(),
+            "flush_interval_s": self.flush_interval,
+            "max_batch": self.max_batch,
+            "max_buffer": self.max_buffer,
+            "retention_days": self.retention_days,
+            "keep_records": self.keep_records,
+        }
@@ -0,0 +1,189 @@
+"""Scheduled pre-generation of the weekly summary PDFs.
+
+Once a day, in an off-peak hour, the scheduler computes the report data and
+renders the PDF for every user who had summaries in the report window. It
+handles `workers` users at a time. Renders run in separate processes, because
+WeasyPrint layout is CPU-bound Python and threads would serialize on the GIL.
+Each finished PDF is stored in Mongo as the user's one current report, so a
+download is a single document read.
+
+A run is claimed by inserting its run document. With several API instances,
+only one of them renders each day. If an instance dies mid-run, that day is
+not retried, and the users it missed get on-demand renders instead.
+"""
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+
+from bson import Binary
+from pymongo import ASCENDING
+from pymongo.errors import DuplicateKeyError
+
+# Stay clear of Mongo's 16MB document limit; bigger reports are rendered on demand
+MAX_STORED_PDF_BYTES = 15 * 1024 * 1024
+
+
+def render_pdf_bytes(html_content: str) -> bytes:
+    """Module-level so it can run in a spawned render process"""
+    from weasyprint import HTML
+    return HTML(string=html_content).write_pdf()
+
+
+class ReportStore:
+    def __init__(self, reports, runs):
+        self.reports = reports
+        self.runs = runs
+
+    def ensure_indexes(self):
+        self.reports.create_index("user_id", name="user_id", unique=True)
+        self.runs.create_index([("started_at", ASCENDING)], name="started_at")
+
+    def put(self, user_id: str, pdf: bytes, data: dict, generated_at: datetime, source: str) -> bool:
+        if len(pdf) > MAX_STORED_PDF_BYTES:
+            return False
+        self.reports.replace_one(
+            {"user_id": user_id},
+            {
+                "user_id": user_id,
+                "pdf": Binary(pdf),
+                "size": len(pdf),
+                "data": data,
+                "generated_at": generated_at,
+                "source": source,
+            },
+            upsert=True
+        )
+        return True
+
+    def get(self, user_id: str, max_age: timedelta):
+        """The user's stored report if it is younger than max_age, else None"""
+        return self.reports.find_one({
+            "user_id": user_id,
+            "generated_at": {"$gte": datetime.utcnow() - max_age}
+        }, {"_id": 0})
+
+    def claim_run(self, run_key: str) -> bool:
+        try:
+            self.runs.insert_one({"_id": run_key, "started_at": datetime.utcnow(), "status": "running"})
+            return True
+        except DuplicateKeyError:
+            return False
+
+    def finish_run(self, run_key: str, stats: dict):
+        self.runs.update_one({"_id": run_key}, {"$set": {**stats, "status": "finished", "finished_at": datetime.utcnow()}})
+
+    def recent_runs(self, limit: int = 5) -> list:
+        return list(self.runs.find({}).sort("started_at", -1).limit(limit))
+
+
+class WeeklyReportScheduler:
+    def __init__(self, store: ReportStore, list_users, build_report, hour: int = 3, weekdays=range(7),
+                 workers: int = 2, use_processes: bool = True, check_interval: float = 60.0):
+        """list_users() -> user ids to pre-generate; build_report(user_id) -> (html, data)"""
+        self.store = store
+        self.list_users = list_users
+        self.build_report = build_report
+        self.hour = hour
+        self.weekdays = set(weekdays)
+        self.workers = workers
+        self.use_processes = use_processes
+        self.check_interval = check_interval
+        self._stop = threading.Event()
+        self._thread = None
+        self._last_run_key = None
+        self._run_lock = threading.Lock()
+        self.running = False
+        self.last_stats = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name="weekly-reports", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def due_run_key(self, now: datetime = None):
+        """Key of today's run once its hour has come (a late start still runs the same day)"""
+        now = now or datetime.utcnow()
+        if now.weekday() not in self.weekdays or now.hour < self.hour:
+            return None
+        return f"weekly-reports-{now.strftime('%Y-%m-%d')}"
+
+    def _loop(self):
+        while not self._stop.wait(self.check_interval):
+            run_key = self.due_run_key()
+            if run_key is None or run_key == self._last_run_key:
+                continue
+            self._last_run_key = run_key
+            try:
+                if self.store.claim_run(run_key):
+                    self.run(run_key)
+            except Exception as e:
+                print(f"Error in weekly report run {run_key}: {e}")
+
+    def generate(self, user_id: str, render=None, source: str = "on_demand"):
+        """Build, render and store one user's report; returns (pdf, data, generated_at)"""
+        generated_at = datetime.utcnow()
+        html_content, data = self.build_report(user_id)
+        pdf = render(html_content) if render else render_pdf_bytes(html_content)
+        if not self.store.put(user_id, pdf, data, generated_at, source):
+            print(f"Weekly report for {user_id} is too large to store ({len(pdf)} bytes)")
+        return pdf, data, generated_at
+
+    def run(self, run_key: str = None) -> dict:
+        """Pre-generate every listed user's report, `workers` at a time"""
+        if not self._run_lock.acquire(blocking=False):
+            return {"skipped": "A weekly report run is already in progress"}
+        try:
+            if run_key is None:
+                run_key = f"weekly-reports-manual-{datetime.utcnow().strftime('%Y%m%dT%H%M%S%f')}"
+                self.store.claim_run(run_key)
+            return self._run(run_key)
+        finally:
+            self._run_lock.release()
+
+    def _run(self, run_key: str) -> dict:
+        self.running = True
+        started = time.perf_counter()
+        stats = {"run": run_key, "users": 0, "rendered": 0, "failed": 0, "bytes": 0}
+        renderers = None
+        try:
+            users = list(self.list_users())
+            stats["users"] = len(users)
+            if self.use_processes and users:
+                # spawn: forking a process that holds Mongo connections and threads is unsafe
+                renderers = ProcessPoolExecutor(max_workers=self.workers,
+                                                mp_context=multiprocessing.get_context("spawn"))
+                render = lambda html_content: renderers.submit(render_pdf_bytes, html_content).result()
+            else:
+                render = None
+            # One thread per worker builds a report and waits on its render, which bounds renders in flight
+            with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="weekly-report") as builders:
+                futures = {builders.submit(self.generate, user_id, render, "scheduled"): user_id for user_id in users}
+                for future in as_completed(futures):
+                    try:
+                        pdf, _, _ = future.result()
+                        stats["rendered"] += 1
+                        stats["bytes"] += len(pdf)
+                    except Exception as e:
+                        stats["failed"] += 1
+                        print(f"Error generating weekly report for {futures[future]}: {e}")
+        finally:
+            if renderers is not None:
+                renderers.shutdown()
+            self.running = False
+        stats["took_s"] = round(time.perf_counter() - started, 2)
+        stats["reports_per_minute"] = round(stats["rendered"] / max(stats["took_s"], 0.001) * 60, 1)
+        self.last_stats = stats
+        self.store.finish_run(run_key, stats)
+        print(f"Weekly reports {run_key}: {stats['rendered']}/{stats['users']} rendered, "
+              f"{stats['failed']} failed in {stats['took_s']}s")
+        return stats